@@ -5,6 +5,9 @@ import numpy as _np
 import sys
 import copy as CM
 
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
 debug = 0
 
 def walkCluster(i, links, labels, l, remainingIndexes):
@@ -26,6 +29,7 @@ def walkCluster(i, links, labels, l, remainingIndexes):
 LINK_GRAPH_METHOD = 1
 LINK_MAT_METHOD = 0
 LINK_CLUST_METHOD = 2
+LINK_EDGES_METHOD = 3
 
 def linkNodes(RefGraph, beta, GraphNodesLabels, GraphLinks, RefGrphNgbhPosi):
     
@@ -125,10 +129,67 @@ def set_cluster_labels(links, labels, nbClasses):
                     queue.update(links[k])
 
 
+def graph_edges(RefGraph, weights=None):
+    """
+    Return the edges of the non-oriented graph RefGraph as a tuple of arrays
+    (i, j, w) where i < j. w holds the weights of the edges (same shape as
+    RefGraph) or is None if *weights* is None.
+    """
+    nb_ngbs = _np.array([len(nl) for nl in RefGraph], dtype=int)
+    if nb_ngbs.sum() == 0:
+        return _np.zeros(0, dtype=int), _np.zeros(0, dtype=int), \
+            None if weights is None else _np.zeros(0)
+    i = _np.repeat(_np.arange(len(RefGraph)), nb_ngbs)
+    j = _np.concatenate([_np.asarray(nl, dtype=int) for nl in RefGraph
+                         if len(nl) > 0])
+    # keep only one occurrence of each edge
+    m = j > i
+    if weights is None:
+        return i[m], j[m], None
+    w = _np.concatenate([_np.asarray(wl, dtype=float) for wl in weights
+                         if len(wl) > 0])
+    return i[m], j[m], w[m]
+
+
+def SwendsenWangSampler_edges(edges, GraphNodesLabels, beta, NbLabels):
+    """
+    One Swendsen-Wang sweep performed on the edges arrays *edges* as returned
+    by graph_edges. All bonds are drawn at once and clusters are obtained
+    as the connected components of the sparse bond graph.
+    GraphNodesLabels is modified in place.
+    """
+    i, j, w = edges
+    nbNodes = len(GraphNodesLabels)
+    labels = _np.asarray(GraphNodesLabels)
+    # a bond exists with probability 1-exp(-beta*w) between equal labels:
+    if w is None:
+        pbond = 1. - _np.exp(-beta)
+    else:
+        pbond = 1. - _np.exp(-beta * w)
+    bonds = (labels[i] == labels[j]) & (_np.random.rand(len(i)) < pbond)
+    bond_graph = coo_matrix((_np.ones(bonds.sum(), dtype=_np.int8),
+                             (i[bonds], j[bonds])), shape=(nbNodes, nbNodes))
+    nbClusters, clusters = connected_components(bond_graph, directed=False)
+    GraphNodesLabels[:] = _np.random.randint(NbLabels, size=nbClusters)[clusters]
+
+
+def Cpt_U_edges(edges, GraphNodesLabels):
+    """
+    Vectorised version of Cpt_U_graph, on the edges arrays *edges* as
+    returned by graph_edges.
+    """
+    i, j, w = edges
+    labels = _np.asarray(GraphNodesLabels)
+    homo = labels[i] == labels[j]
+    if w is None:
+        return float(homo.sum())
+    return w[homo].sum()
+
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 def SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,
-                              GraphLinks=None,RefGrphNgbhPosi=None, method=1,
-                              weights=None):
+                              GraphLinks=None,RefGrphNgbhPosi=None,
+                              method=LINK_EDGES_METHOD, weights=None):
     """
     image sampling with Swendsen-Wang algorithm
     input:
@@ -158,11 +219,23 @@ def SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,
             Same shape as RefGraph. RefGrphNgbhPosi[i][j] indicates for which
             k is the link to i in RefGraph[RefGraph[i][j]][k]
             This optional list is never modified.
+        * method:
+            LINK_EDGES_METHOD (default): vectorised bonds and clustering by
+            sparse connected components. LINK_GRAPH_METHOD and
+            LINK_MAT_METHOD: former pure python implementations.
+        * weights:
+            Same shape as RefGraph. Each entry is the weight of the
+            corresponding edge in RefGraph.
     output:
         * GraphNodesLabels:
             resampled nodes labels. (not returned but modified)
     """
     
+    if method == LINK_EDGES_METHOD:
+        SwendsenWangSampler_edges(graph_edges(RefGraph, weights),
+                                  GraphNodesLabels, beta, NbLabels)
+        return
+
     #initializations...
     NodesNb=len(RefGraph)
     
@@ -272,26 +345,18 @@ def Cpt_Vec_U_graph(RefGraph,beta,LabelsNb,SamplesNb,
         for i in xrange(len(GraphNodesLabels)):
             GraphNodesLabels[i]=0
     
-    if GraphLinks==None:
-        GraphLinks=CptDefaultGraphLinks(RefGraph)
-    
-    if RefGrphNgbhPosi==None:
-        RefGrphNgbhPosi=CptRefGrphNgbhPosi(RefGraph)
+    # GraphLinks and RefGrphNgbhPosi are not needed by the edges-based sampler
+    edges = graph_edges(RefGraph, GraphWeight)
         
     #all estimates of ImagLoc will then be significant in the expectation calculation (initial field is homogeneous)
-    SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,LabelsNb,
-                              GraphLinks=GraphLinks,RefGrphNgbhPosi=RefGrphNgbhPosi,
-                              weights=GraphWeight)
+    SwendsenWangSampler_edges(edges, GraphNodesLabels, beta, LabelsNb)
     
     #estimation
     VecU=_np.zeros(SamplesNb)
     
     for i in xrange(SamplesNb):
-        SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,
-                                  LabelsNb,GraphLinks=GraphLinks,RefGrphNgbhPosi=RefGrphNgbhPosi,
-                                  weights=GraphWeight)
-        
-        VecU[i]=Cpt_U_graph(RefGraph,GraphNodesLabels,GraphWeight=GraphWeight)
+        SwendsenWangSampler_edges(edges, GraphNodesLabels, beta, LabelsNb)
+        VecU[i]=Cpt_U_edges(edges, GraphNodesLabels)
     
     return VecU
 
@@ -402,8 +467,9 @@ def GraphBetaMix(RefGraph,GraphNodesLabels,beta=0.5,NbLabels=2,NbIt=5,weights=No
         * GraphNodesLabels: sampled GraphNodesLabels (not returned but modified)
     """
     
+    edges = graph_edges(RefGraph, weights)
     for i in xrange(NbIt):
-        SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,weights)
+        SwendsenWangSampler_edges(edges, GraphNodesLabels, beta, NbLabels)
         
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -520,6 +520,67 @@ def create_prf(prf_duration=25., dt=.5):
     return prf
 
 
+def batch_stim_induced_signal(amplitudes, rastered_paradigm, rf,
+                              voxel_block_size=500):
+    """
+    Compute sum_{m=1}^M a^m_j X^m rf_j for all voxels j at once.
+    The response levels are combined with the rastered paradigm by matrix
+    products. When voxels share the same response function, the regressors
+    X^m rf are computed once for all of them. Otherwise, convolutions are
+    performed in the Fourier domain, by blocks of voxels.
+
+    Args:
+        - amplitudes (np.ndarray): response levels, shape (M, nb voxels)
+        - rastered_paradigm (np.ndarray): paradigm sequences, shape (M, nb dt).
+          Only entries equal to 1 are scaled by the response levels.
+        - rf (np.ndarray): a single response function (shape (L,)) or one
+          per voxel (shape (L, nb voxels))
+        - voxel_block_size (int): number of voxels transformed together, to
+          bound memory usage
+
+    Return a signal array of shape (nb dt + L - 1, nb voxels)
+    """
+    nb_conds, npos = amplitudes.shape
+    paradigm = np.asarray(rastered_paradigm, dtype=float)[:nb_conds]
+    onsets = (paradigm == 1).astype(float)
+    # entries different from 0 and 1 are kept as is:
+    others = (paradigm - onsets).sum(0)
+
+    def regressors(h):
+        r = np.array([np.convolve(o, h) for o in onsets]).T
+        if others.any():
+            return r, np.convolve(others, h)
+        return r, 0.
+
+    if rf.ndim == 1:
+        reg, offset = regressors(rf)
+        return np.dot(reg, amplitudes) + np.atleast_1d(offset)[:, np.newaxis]
+
+    duration_dt = rf.shape[0] + paradigm.shape[1] - 1
+    signal = np.zeros((duration_dt, npos))
+
+    # group voxels sharing the same response function:
+    rf_cols = np.ascontiguousarray(rf.T)
+    keys = rf_cols.view(np.dtype((np.void, rf_cols.strides[0]))).ravel()
+    _, first, groups = np.unique(keys, return_index=True, return_inverse=True)
+    if len(first) * 10 <= npos:
+        for ig, ipos in enumerate(first):
+            vox = np.where(groups == ig)[0]
+            reg, offset = regressors(rf_cols[ipos])
+            signal[:, vox] = np.dot(reg, amplitudes[:, vox]) + \
+                np.atleast_1d(offset)[:, np.newaxis]
+        return signal
+
+    activity = np.dot(amplitudes.T, onsets) + others
+    nfft = 2 ** int(np.ceil(np.log2(duration_dt)))
+    for start in xrange(0, npos, voxel_block_size):
+        vox = slice(start, start + voxel_block_size)
+        signal[:, vox] = np.fft.irfft(np.fft.rfft(activity[vox], nfft) *
+                                      np.fft.rfft(rf_cols[vox], nfft),
+                                      nfft)[:, :duration_dt].T
+    return signal
+
+
 def create_stim_induced_signal(nrls, rastered_paradigm, hrf, dt):
     """
     Create a stimulus induced signal from neural response levels, paradigm and
@@ -530,20 +591,7 @@ def create_stim_induced_signal(nrls, rastered_paradigm, hrf, dt):
 
     Return a bold array of shape (nb scans, nb voxels)
     """
-
-    npos = nrls.shape[1]
-    duration_dt = hrf.shape[0] + len(rastered_paradigm[0]) - 1
-    bold = np.zeros((duration_dt, npos))
-    for ipos in xrange(npos):
-        if hrf.ndim == 2:
-            h = hrf[:, ipos]
-        else:
-            h = hrf  # single HRF
-        for ic in xrange(nrls.shape[0]):
-            activity = np.array(rastered_paradigm[ic, :], dtype=float)
-            activity[np.where(activity == 1)] = nrls[ic, ipos]
-            bold[:, ipos] += np.convolve(activity, h)
-    return bold
+    return batch_stim_induced_signal(nrls, rastered_paradigm, hrf)
 
 
 def create_Xh(nrls, rastered_paradigm, hrf, condition_defs,
@@ -551,16 +599,9 @@ def create_Xh(nrls, rastered_paradigm, hrf, condition_defs,
     """
     Retrieve the product X.h
     """
-    npos = nrls.shape[1]
-    duration_dt = len(hrf[:, 0]) + len(rastered_paradigm[0]) - 1
-    Xh = np.zeros((duration_dt, npos))
-    for ipos in xrange(npos):
-        h = hrf[:, ipos]
-        for ic, c in enumerate(condition_defs):
-            activity = np.array(rastered_paradigm[ic, :], dtype=float)
-            Xh[:, ipos] += np.convolve(activity, h)
-
-    return Xh
+    npos = hrf.shape[1]
+    return batch_stim_induced_signal(np.ones((len(condition_defs), npos)),
+                                     rastered_paradigm, hrf)
 
 
 def create_multisess_stim_induced_signal(nrls_session, rastered_paradigm,
@@ -575,17 +616,8 @@ def create_multisess_stim_induced_signal(nrls_session, rastered_paradigm,
 
     Return a bold array of shape (nb scans, nb voxels)
     """
-    npos = nrls_session.shape[1]
-    duration_dt = len(hrf[:, 0]) + len(rastered_paradigm[0]) - 1
-    bold = np.zeros((duration_dt, npos))
-    for ipos in xrange(npos):
-        h = hrf[:, ipos]
-        for ic, c in enumerate(condition_defs):
-            activity = np.array(rastered_paradigm[ic, :], dtype=float)
-            activity[np.where(activity == 1)] = nrls_session[ic, ipos]
-            bold[:, ipos] += np.convolve(activity, h)
-
-    return bold
+    return batch_stim_induced_signal(nrls_session[:len(condition_defs)],
+                                     rastered_paradigm, hrf)
 
 
 def create_bold_stim_induced_signal(brls, rastered_paradigm, brf, condition_defs,
@@ -600,18 +632,8 @@ def create_bold_stim_induced_signal(brls, rastered_paradigm, brf, condition_defs
 
     Return a asl array of shape (nb scans, nb voxels)
     """
-    npos = brls.shape[1]
-    duration_dt = len(brf[:, 0]) + len(rastered_paradigm[0]) - 1
-    asl = np.zeros((duration_dt, npos))
-
-    for ipos in xrange(npos):
-        h = brf[:, ipos]
-        for ic, c in enumerate(condition_defs):
-            activity = np.array(rastered_paradigm[ic, :], dtype=float)
-            activity[np.where(activity == 1)] = brls[ic, ipos]
-
-            asl[:, ipos] += np.convolve(activity, h)
-    return asl
+    return batch_stim_induced_signal(brls[:len(condition_defs)],
+                                     rastered_paradigm, brf)
 
 
 def create_perf_baseline(asl_shape, perf_baseline_var, perf_baseline_mean=0.):
@@ -633,18 +655,8 @@ def create_perf_stim_induced_signal(prls, rastered_paradigm, prf, condition_defs
 
     Return a asl array of shape (nb scans, nb voxels)
     """
-    npos = prls.shape[1]
-    duration_dt = len(prf[:, 0]) + len(rastered_paradigm[0]) - 1
-    asl = np.zeros((duration_dt, npos))
-
-    for ipos in xrange(npos):
-        g = prf[:, ipos]
-        for ic, c in enumerate(condition_defs):
-            activity = np.array(rastered_paradigm[ic, :], dtype=float)
-            activity[np.where(activity == 1)] = prls[ic, ipos]
-
-            asl[:, ipos] += np.convolve(activity, g)
-    return asl
+    return batch_stim_induced_signal(prls[:len(condition_defs)],
+                                     rastered_paradigm, prf)
 
 
 def create_stim_induced_signal_Parsi(nrls, rastered_paradigm, hrf,
@@ -59,6 +59,12 @@ defaults = {
     },
     'treatment-default': {
         'save_result_dump': 0,
+        'cache_graphs': 0,
+        'lnz_cache_path': None,
+        'lnz_cache_max_size': 100,
+        'mcmc_history_path': None,
+        'mcmc_checkpoint_path': None,
+        'mcmc_checkpoint_pace': 100,
     }
 }
 
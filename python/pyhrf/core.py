@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
 import os.path as op
+import shutil
 import string
 import cPickle
+import hashlib
 import tempfile
 import logging
 
 import numpy as np
 from pkg_resources import Requirement, resource_filename, resource_listdir
 import pyhrf
-from pyhrf.ndarray import MRI3Daxes, MRI4Daxes, expand_array_in_mask, TIME_AXIS
+from pyhrf.ndarray import MRI3Daxes, MRI4Daxes, expand_array_in_mask, TIME_AXIS, \
+    get_label_index
 from nipy.labs import compute_mask_files
 from pyhrf.tools import stack_trees, distance
 from pyhrf.graph import parcels_to_graphs, kerMask3D_6n, \
@@ -491,23 +494,28 @@ class FmriGroupData(XmlInitable):
         # all ROIs, for one subject
 
 
-def get_roi_simulation(simu_sessions, mask, roi_id):
+def get_roi_simulation(simu_sessions, mask, roi_id, m=None):
     """
     Extract the ROI from the given simulation dict.
     Args:
         - simu (dict): dictionnary of simulated quantities
         - mask (np.ndarray): binary mask defining the spatial extent of the ROI
         - roi_id (int) : the id of the roi to extract
+        - m (tuple of np.ndarray): result of np.where(mask == roi_id), can be
+          passed to speed up if already computed (see
+          pyhrf.ndarray.get_label_index)
     Return:
          dict of roi-specific simulation items
     """
     if simu_sessions is None:
         return None
 
+    if m is None:
+        m = np.where(mask == roi_id)
+
     simus = []
     for simu in simu_sessions:
         roi_simu = {}
-        m = np.where(mask == roi_id)
 
         def duplicate(label):
             if simu.has_key(label):
@@ -537,6 +545,26 @@ def get_roi_simulation(simu_sessions, mask, roi_id):
     return simus
 
 
+def _sparse_roi_data(roi_id, roi_coords, spatial_shape, onsets, bold, tr,
+                     sessionsScans, graph, durations, meta_obj, simulation,
+                     backgroundLabel, data_files, data_type):
+    """ Build the FmriData object of a single ROI from the coordinates of its
+    voxels, without allocating a full-volume mask.
+    """
+    # flat mask so that bold is taken as is, the geometry is restored after:
+    roi_labels = np.repeat(roi_id, len(roi_coords[0]))
+    roi_data = FmriData(onsets, bold, tr, sessionsScans, roi_labels,
+                        None, durations, meta_obj, simulation,
+                        backgroundLabel, data_files, data_type)
+    roi_data.np_roi_mask = tuple(roi_coords)
+    roi_data.spatial_shape = spatial_shape
+    roi_data.mask_key = None
+    if graph is not None:
+        roi_data.graphs = roi_data.graphs_full = {roi_id: graph}
+        roi_data.graphs_key = roi_data.get_mask_key()
+    return roi_data
+
+
 class FmriData(XmlInitable):
     """
     Attributes:
@@ -646,6 +674,10 @@ class FmriData(XmlInitable):
         self.bold_avg = None
 
         self.graphs = graphs
+        self.graphs_key = None
+        if graphs is not None:
+            self.graphs_key = self.get_mask_key()
+        self.graphs_cache_dir = None
         self.edge_lengths = edge_lengths
         self.graphs_full = graphs
         self.graphs_avg = None
@@ -675,6 +707,40 @@ class FmriData(XmlInitable):
         self.roi_ids_in_mask = roiMask[self.np_roi_mask]
         self.nb_voxels_in_mask = len(self.roi_ids_in_mask)
         self.spatial_shape = roiMask.shape
+        self.roi_index = None
+        self.mask_key = None
+
+    def get_roi_index(self):
+        """ Return the positions of the voxels of each ROI within the in-mask
+        voxels, as an OrderedDict roi_id -> np.where(roi_ids_in_mask==roi_id).
+        The index is computed once (see pyhrf.ndarray.get_label_index).
+        """
+        if getattr(self, 'roi_index', None) is None:
+            self.roi_index = get_label_index(self.roi_ids_in_mask)
+        return self.roi_index
+
+    def get_mask_key(self):
+        """ Return a digest of the current mask, which identifies the graphs
+        built over it. The digest is computed once per mask, from its sparse
+        representation.
+        """
+        if getattr(self, 'mask_key', None) is None:
+            digest = hashlib.sha512(repr(self.spatial_shape))
+            for c in self.np_roi_mask:
+                digest.update(np.ascontiguousarray(c, dtype=np.int64).data)
+            digest.update(np.ascontiguousarray(self.roi_ids_in_mask,
+                                               dtype=np.int64).data)
+            self.mask_key = digest.hexdigest()
+        return self.mask_key
+
+    def enable_graphs_cache(self, mask_file):
+        """ Save graphs next to *mask_file* once built, and reload them from
+        there for subsequent treatments on the same parcellation.
+        Enabled only if option 'cache_graphs' of section 'treatment-default'
+        is set in the pyhrf configuration.
+        """
+        if pyhrf.cfg['treatment-default']['cache_graphs']:
+            self.graphs_cache_dir = op.dirname(op.abspath(mask_file))
 
     def get_roi_mask(self):
         roi_mask = np.zeros(self.spatial_shape,
@@ -717,6 +783,7 @@ class FmriData(XmlInitable):
                       data_type='volume',
                       mask_loaded_from_file=mask_loaded_from_file,
                       backgroundLabel=background_label)
+        fd.enable_graphs_cache(mask_file)
         fd.set_init(FmriData.from_vol_files, mask_file=mask_file,
                     paradigm_csv_file=paradigm_csv_file,
                     bold_files=bold_files, tr=tr,
@@ -746,6 +813,7 @@ class FmriData(XmlInitable):
                       data_files=bold_files + [mask_file, paradigm_csv_file],
                       data_type='volume',
                       mask_loaded_from_file=mask_loaded_from_file)
+        fd.enable_graphs_cache(mask_file)
         fd.set_init(FmriData.from_vol_files, mask_file=mask_file,
                     paradigm_csv_file=paradigm_csv_file,
                     bold_files=bold_files, tr=tr)
@@ -814,6 +882,7 @@ class FmriData(XmlInitable):
                              backgroundLabel=background_label,
                              data_type='volume',
                              mask_loaded_from_file=mask_loaded_from_file)
+        fmri_data.enable_graphs_cache(mask_file)
 
         fmri_data.set_init(FmriData.from_vol_ui, sessions_data=sessions_data,
                            tr=tr, mask_file=mask_file,
@@ -999,17 +1068,77 @@ class FmriData(XmlInitable):
 
         return paradigm_file, bold_file, mask_file
 
+    def get_graphs_cache_file(self):
+        """ Return the file where graphs are cached on disk for the current
+        mask, or None if the disk cache is not enabled.
+        """
+        cache_dir = getattr(self, 'graphs_cache_dir', None)
+        if cache_dir is None:
+            return None
+        return op.join(cache_dir,
+                       'pyhrf_graphs_%s.pck' % self.get_mask_key()[:32])
+
+    def load_cached_graphs(self):
+        cache_file = self.get_graphs_cache_file()
+        if cache_file is None or not op.exists(cache_file):
+            return None
+        logger.info('Load graphs from cache file %s', cache_file)
+        try:
+            f = open(cache_file)
+            try:
+                mask_key, graphs = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError), e:
+            logger.warning('Could not load graphs from %s: %s',
+                           cache_file, str(e))
+            return None
+        if mask_key != self.get_mask_key():
+            return None
+        return graphs
+
+    def save_cached_graphs(self):
+        cache_file = self.get_graphs_cache_file()
+        if cache_file is None:
+            return
+        logger.info('Save graphs to cache file %s', cache_file)
+        try:
+            f = open(cache_file, 'w')
+            try:
+                cPickle.dump((self.graphs_key, self.graphs), f,
+                             protocol=cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except IOError, e:
+            logger.warning('Could not save graphs to %s: %s',
+                           cache_file, str(e))
+
     def build_graphs(self, force=False):
+        """ Build the graphs of all parcels, only if they are not computed
+        yet for the current mask (see get_mask_key) or if *force* is True.
+        """
         logger.debug('FmriData.build_graphs (self.graphs is None ? %s ) ...',
                      str(self.graphs is None))
         logger.debug('data_type: %s', self.data_type)
-        if self.graphs is None or force:
+        mask_key = self.get_mask_key()
+        up_to_date = (self.graphs is not None and
+                      getattr(self, 'graphs_key', None) == mask_key)
+        if not up_to_date or force:
             if self.data_type == 'volume':
-                logger.info('Building graph from volume ...')
-                to_discard = [self.backgroundLabel]
-                self.graphs = parcels_to_graphs(self.roiMask,
-                                                kerMask3D_6n,
-                                                toDiscard=to_discard)
+                graphs = None
+                if not force:
+                    graphs = self.load_cached_graphs()
+                built = graphs is None
+                if built:
+                    logger.info('Building graph from volume ...')
+                    to_discard = [self.backgroundLabel]
+                    graphs = parcels_to_graphs(self.roiMask,
+                                               kerMask3D_6n,
+                                               toDiscard=to_discard)
+                self.graphs = graphs
+                self.graphs_key = mask_key
+                if built:
+                    self.save_cached_graphs()
                 logger.info('Graph built (%d rois)!', len(self.graphs.keys()))
                 self.edge_lentghs = dict([(i, [[1] * len(nl) for nl in g])
                                           for i, g in self.graphs.items()])
@@ -1038,7 +1167,7 @@ class FmriData(XmlInitable):
         # return (self.roiMask != self.backgroundLabel).sum()
 
     def get_graph(self):
-        self.build_graphs(force=True)
+        self.build_graphs()
         if len(self.graphs) == 1:
             return self.graphs[self.graphs.keys()[0]]
         else:
@@ -1046,44 +1175,47 @@ class FmriData(XmlInitable):
 
     def roi_split(self, mask=None):
         if mask is None:
-            mask = self.roiMask
-
-        assert mask.shape == self.roiMask.shape
+            np_mask = self.np_roi_mask
+            in_mask = self.roi_ids_in_mask
+            roi_index = self.get_roi_index()
+        else:
+            assert mask.shape == self.spatial_shape
+            np_mask = np.where(mask != self.backgroundLabel)
+            in_mask = mask[np_mask]
+            roi_index = get_label_index(in_mask)
 
         onsets = self.paradigm.stimOnsets
         durations = self.paradigm.stimDurations
 
-        in_mask = mask[np.where(mask != self.backgroundLabel)]
         data_rois = []
-        for roiId in np.unique(mask):
-            if roiId != self.backgroundLabel:
-                mroi = np.where(mask == roiId)
-                roiMask = np.zeros_like(mask) + self.backgroundLabel
-                roiMask[mroi] = roiId
-                mroi_bold = np.where(in_mask == roiId)
-                roiBold = self.bold[:, mroi_bold[0]]
-                roiGraph = None
-                if self.graphs is not None:
-                    roiGraph = self.graphs[roiId]
-                    logger.info('graph for roi %s has %d nodes',
-                                roiId, len(roiGraph))
-                else:
-                    logger.info('graph for roi %s is None', (roiId))
-
-                simulation = get_roi_simulation(
-                    self.simulation, in_mask, roiId)
-
-                data_rois.append(FmriData(onsets, roiBold, self.tr,
-                                          self.sessionsScans, roiMask,
-                                          {roiId: roiGraph},
-                                          durations, self.meta_obj,
-                                          simulation, self.backgroundLabel,
-                                          self.data_files, self.data_type))
+        for roiId, mroi_bold in roi_index.iteritems():
+            roiBold = self.bold[:, mroi_bold[0]]
+            roiGraph = None
+            if self.graphs is not None:
+                roiGraph = self.graphs[roiId]
+                logger.info('graph for roi %s has %d nodes',
+                            roiId, len(roiGraph))
+            else:
+                logger.info('graph for roi %s is None', (roiId))
+
+            simulation = get_roi_simulation(self.simulation, in_mask,
+                                            roiId, m=mroi_bold)
+
+            roi_coords = [c[mroi_bold[0]] for c in np_mask]
+            data_rois.append(_sparse_roi_data(roiId, roi_coords,
+                                              self.spatial_shape, onsets,
+                                              roiBold, self.tr,
+                                              self.sessionsScans, roiGraph,
+                                              durations, self.meta_obj,
+                                              simulation,
+                                              self.backgroundLabel,
+                                              self.data_files,
+                                              self.data_type))
         return data_rois
 
     def discard_small_rois(self, min_size):
-        too_small_rois = [i for i in np.unique(self.roi_ids_in_mask)
-                          if (self.roi_ids_in_mask == i).sum() < min_size]
+        too_small_rois = [i for i, m in self.get_roi_index().iteritems()
+                          if len(m[0]) < min_size]
         logger.info(" %d too small ROIs are discarded (size < %d)",
                     len(too_small_rois), min_size)
         self.discard_rois(too_small_rois)
@@ -1095,7 +1227,7 @@ class FmriData(XmlInitable):
             roiMask[mroi] = self.backgroundLabel
         self.store_mask_sparse(roiMask)
         if self.graphs is not None:
-            self.build_graphs(force=True)
+            self.build_graphs()
 
     def keep_only_rois(self, roiIds):
         roiToKeep = set(np.unique(roiIds))
@@ -1212,3 +1344,87 @@ class FmriData(XmlInitable):
         # TODO: make proper 'readable' __repr__ function for BoldModel object
         r += ')'
         return r
+
+
+class FmriSharedData(object):
+    """
+    ROI-wise access to the BOLD signals of an FmriData object through a
+    memory-mapped file, used to dispatch parcels to local worker processes.
+
+    In-mask voxels are grouped by ROI (keeping their relative order) so that
+    the signals of one ROI form a contiguous block of columns of the
+    memory-mapped BOLD matrix. Pickling an instance only transfers the
+    file name, the voxel coordinates and the paradigm: workers map the file
+    and build ROI data sets on zero-copy views.
+
+    Args:
+        - fdata (FmriData): the data to share
+        - bold_file (str): file where to store the BOLD matrix. If None, a
+          file is created in the pyhrf temporary directory.
+    """
+
+    def __init__(self, fdata, bold_file=None):
+        # temporary directory created for the BOLD file (removed by clean)
+        self.tmp_dir = None
+        if bold_file is None:
+            self.tmp_dir = pyhrf.get_tmp_path()
+            bold_file = op.join(self.tmp_dir, 'shared_bold.dat')
+        self.bold_file = bold_file
+
+        order = np.argsort(fdata.roi_ids_in_mask, kind='mergesort')
+        sorted_ids = fdata.roi_ids_in_mask[order]
+        self.roi_ids, starts = np.unique(sorted_ids, return_index=True)
+        stops = np.append(starts[1:], len(sorted_ids))
+        self.roi_bounds = dict(zip(self.roi_ids, zip(starts, stops)))
+        self.coords = np.array(fdata.np_roi_mask)[:, order]
+
+        self.bold_shape = fdata.bold.shape
+        self.bold_dtype = fdata.bold.dtype
+        self._bold = np.memmap(bold_file, dtype=self.bold_dtype, mode='w+',
+                               shape=self.bold_shape)
+        self._bold[:] = fdata.bold[:, order]
+        self._bold.flush()
+
+        self.onsets = fdata.paradigm.stimOnsets
+        self.durations = fdata.paradigm.stimDurations
+        self.tr = fdata.tr
+        self.sessionsScans = fdata.sessionsScans
+        self.meta_obj = fdata.meta_obj
+        self.backgroundLabel = fdata.backgroundLabel
+        self.data_files = fdata.data_files
+        self.data_type = fdata.data_type
+        self.spatial_shape = fdata.spatial_shape
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_bold'] = None
+        return state
+
+    def get_bold(self):
+        if self._bold is None:
+            self._bold = np.memmap(self.bold_file, dtype=self.bold_dtype,
+                                   mode='c', shape=self.bold_shape)
+        return self._bold
+
+    def get_roi_data(self, roi_id, graph=None, simulation=None):
+        """ Return an FmriData object restricted to ROI *roi_id*, whose BOLD
+        signals are a view on the shared memory-mapped matrix.
+        """
+        start, stop = self.roi_bounds[roi_id]
+        return _sparse_roi_data(roi_id, self.coords[:, start:stop],
+                                self.spatial_shape, self.onsets,
+                                self.get_bold()[:, start:stop], self.tr,
+                                self.sessionsScans, graph, self.durations,
+                                self.meta_obj, simulation,
+                                self.backgroundLabel, self.data_files,
+                                self.data_type)
+
+    def clean(self):
+        """ Remove the memory-mapped file, and the temporary directory
+        holding it if it was created here. Views that are already open remain
+        valid on POSIX systems.
+        """
+        if op.exists(self.bold_file):
+            os.remove(self.bold_file)
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
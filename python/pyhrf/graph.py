@@ -13,8 +13,7 @@ import pyhrf
 
 from pyhrf.tools import cartesian
 from pyhrf.boldsynth.spatialconfig import lattice_indexes
-from pyhrf.boldsynth.spatialconfig import mask_to_coords
-from pyhrf.ndarray import expand_array_in_mask
+from pyhrf.ndarray import expand_array_in_mask, get_label_index
 
 
 logger = logging.getLogger(__name__)
@@ -285,6 +284,101 @@ def graph_to_sparse_matrix(graph):
     return coo_matrix((np.ones(len(ij[0]), dtype=int), ij))
 
 
+def _full_ker_mask(ndim):
+    """ Full neighbourhood, ie 8 in 2D, 26 in 3D ...
+    """
+    neighbourCoords = list(cartesian(*[[0, -1, 1]] * ndim))[1:]
+    return tuple(np.array(neighbourCoords, dtype=int).transpose())
+
+
+def _lattice_neighbours(shape, coords, kerMask, toroidal=False):
+    """ Shift all positions *coords* (tuple of arrays, as returned by np.where)
+    at once by each offset of *kerMask*.
+
+    Return:
+        - flat indexes (in the lattice of shape *shape*) of the neighbours,
+          as an array of shape (nb positions, kerMask size)
+        - a boolean array of the same shape flagging neighbours which fall
+          within the lattice (always True if *toroidal*)
+    """
+    nbPos = len(coords[0])
+    nbNeighbours = len(kerMask[0])
+    inside = np.ones((nbPos, nbNeighbours), dtype=bool)
+    ncoords = []
+    for ic, s in enumerate(shape):
+        comp = coords[ic][:, np.newaxis] + kerMask[ic][np.newaxis, :]
+        if not toroidal:
+            inside &= (comp >= 0) & (comp < s)
+            np.clip(comp, 0, s - 1, comp)
+        else:
+            # same wrapping as center_mask_at
+            comp[comp < 0] = s - 1
+            comp[comp >= s] = 0
+        ncoords.append(comp)
+    return np.ravel_multi_index(ncoords, shape), inside
+
+
+def _neighbours_table_to_csr(table):
+    """ Convert a table of neighbour indexes padded with -1 into CSR arrays,
+    keeping the order of the table within each row.
+    """
+    valid = table >= 0
+    indptr = np.zeros(table.shape[0] + 1, dtype=int)
+    np.cumsum(valid.sum(1), out=indptr[1:])
+    return indptr, table[valid]
+
+
+def lattice_to_csr(mask, kerMask=None, toroidal=False):
+    """
+    Creates the adjacency structure of the graph defined over the valid
+    positions of *mask* in a n-dimensional lattice, as compressed sparse rows.
+    Neighbours are found by shifting all positions at once by each offset of
+    *kerMask* (see graph_from_lattice), instead of visiting positions one by
+    one.
+
+    Return:
+        (indptr, indices) such that the neighbours of the position i (in the
+        order of np.where(mask)) are indices[indptr[i]:indptr[i+1]]
+    """
+    if kerMask is not None:
+        assert mask.ndim == len(kerMask)
+    else:
+        kerMask = _full_ker_mask(mask.ndim)
+
+    latticeIndexes = lattice_indexes(mask)
+    nflat, inside = _lattice_neighbours(mask.shape, np.where(mask), kerMask,
+                                        toroidal)
+    table = latticeIndexes.ravel()[nflat]
+    table[~inside] = -1
+    return _neighbours_table_to_csr(table)
+
+
+def csr_to_graph(indptr, indices):
+    """
+    Convert a CSR adjacency structure (see lattice_to_csr) into a list of
+    neighbours index (numpy array of arrays).
+    """
+    graph = np.empty(len(indptr) - 1, dtype=object)
+    for i, nl in enumerate(np.split(indices, indptr[1:-1])):
+        graph[i] = nl
+    return graph
+
+
+def csr_to_neighbours_indexes(indptr, indices):
+    """
+    Convert a CSR adjacency structure (see lattice_to_csr) into a 2D array of
+    neighbour indexes, padded with -1 (as BOLDSamplerInput.neighboursIndexes).
+    """
+    counts = np.diff(indptr)
+    maxNeighbours = counts.max() if len(counts) > 0 else 0
+    neighboursIndexes = np.zeros((len(counts), maxNeighbours), dtype=np.int32)
+    neighboursIndexes -= 1
+    rows = np.repeat(np.arange(len(counts)), counts)
+    cols = np.arange(len(indices)) - np.repeat(indptr[:-1], counts)
+    neighboursIndexes[rows, cols] = indices
+    return neighboursIndexes
+
+
 def graph_from_lattice(mask, kerMask=None, depth=1, toroidal=False):
     """
     Creates a graph from a n-dimensional lattice
@@ -293,29 +387,8 @@ def graph_from_lattice(mask, kerMask=None, depth=1, toroidal=False):
     neighbourhood system, ie the relative positions of neighbours for a given
     position in the lattice.
     """
-    # print 'size:', latticeIndexes.size
-    if kerMask is not None:
-        assert mask.ndim == len(kerMask)
-    else:
-        # Full neighbourhood, ie 8 in 2D, 26 in 3D ...
-        ndim = mask.ndim
-        neighbourCoords = list(cartesian(*[[0, -1, 1]] * ndim))[1:]
-        kerMask = tuple(np.array(neighbourCoords, dtype=int).transpose())
-
-    # loop over valid positions:
-    # print mask.shape
-    positions = mask_to_coords(mask)
-    latticeIndexes = lattice_indexes(mask)
-    # print positions
-    # print positions.shape
-    # Build lists of closest neighbours:
-    closestNeighbours = np.empty(len(positions), dtype=object)
-    for idx, pos in enumerate(positions):
-        # print 'idx :', idx, '- pos:', pos
-        # O(n) :
-        m = center_mask_at(kerMask, pos, latticeIndexes, toroidal)
-        # print 'm:', m
-        closestNeighbours[idx] = latticeIndexes[m][latticeIndexes[m] >= 0]
+    # Build lists of closest neighbours, all positions at once:
+    closestNeighbours = csr_to_graph(*lattice_to_csr(mask, kerMask, toroidal))
 
     if depth == 1:
         return closestNeighbours
@@ -351,6 +424,87 @@ def graph_from_lattice(mask, kerMask=None, depth=1, toroidal=False):
     return neighboursSets
 
 
+def graph_from_neighbours_indexes(neighboursIndexes):
+    """
+    Convert a 2D array of neighbour indexes, padded with -1 (as stored in
+    BOLDSamplerInput.neighboursIndexes), back to a list of neighbours index.
+    """
+    return np.array([nl[nl >= 0] for nl in neighboursIndexes], dtype=object)
+
+
+def graph_bipartite_coloring(graph):
+    """
+    Try to colour the nodes of 'graph' with 2 colours so that two adjacent
+    nodes never share the same colour (eg checkerboard on a 6-connected
+    lattice).
+    Return an int array of colours (0 or 1) or None if the graph is not
+    bipartite.
+    """
+    nbNodes = len(graph)
+    colors = np.zeros(nbNodes, dtype=int) - 1
+    for root in xrange(nbNodes):
+        if colors[root] != -1:
+            continue
+        colors[root] = 0
+        front = np.array([root], dtype=int)
+        while front.size > 0:
+            # next front: uncoloured neighbours of the current front
+            nextFront = []
+            for n in front:
+                nl = np.asarray(graph[n], dtype=int)
+                if (colors[nl] == colors[n]).any():
+                    return None
+                nextFront.append(nl[colors[nl] == -1])
+            if len(nextFront) == 0:
+                break
+            nextFront = np.unique(np.concatenate(nextFront))
+            colors[nextFront] = 1 - colors[front[0]]
+            front = nextFront
+    return colors
+
+
+def graph_greedy_coloring(graph):
+    """
+    Colour the nodes of 'graph' so that two adjacent nodes never share the
+    same colour. Nodes are visited by decreasing degree and each node takes
+    the smallest colour not already used by its neighbours.
+    Return an int array of colours.
+    """
+    nbNodes = len(graph)
+    colors = np.zeros(nbNodes, dtype=int) - 1
+    degrees = np.array([len(nl) for nl in graph], dtype=int)
+    for n in np.argsort(-degrees, kind='mergesort'):
+        used = colors[np.asarray(graph[n], dtype=int)]
+        free = np.setdiff1d(np.arange(degrees[n] + 1), used)
+        colors[n] = free[0]
+    return colors
+
+
+def graph_coloring(graph):
+    """
+    Colour the nodes of 'graph' (list of neighbours index or 2D array of
+    neighbour indexes padded with -1) such that adjacent nodes have
+    different colours. A 2-colouring (checkerboard) is used whenever the graph
+    is bipartite, as for 4-connected 2D or 6-connected 3D lattices. Otherwise,
+    eg for meshes or 26-connected lattices, fall back to a greedy colouring.
+
+    Nodes sharing a colour are not neighbours of each other and are thus
+    conditionally independent given the other nodes in a Markov random field.
+
+    Return:
+        a list of int arrays, each one holding the node indexes of one colour
+    """
+    if isinstance(graph, np.ndarray) and graph.ndim == 2:
+        graph = graph_from_neighbours_indexes(graph)
+
+    colors = graph_bipartite_coloring(graph)
+    if colors is None:
+        colors = graph_greedy_coloring(graph)
+    logger.info('graph coloring: %d colors for %d nodes',
+                colors.max() + 1 if len(colors) > 0 else 0, len(colors))
+    return [np.where(colors == c)[0] for c in np.unique(colors)]
+
+
 def breadth_first_search(graph, root=0, visitable=None):
     """Traverses a graph in breadth-first order.
 
@@ -564,12 +718,58 @@ def parcels_to_graphs(parcellation, kerMask, toKeep=None,
     # print 'parcelIds:', parcelIdsx
 
     parcelGraphs = {}
-    parcelNodeMap = {}
-    # loop over parcels
-    for pid in parcelIds:
-        parcelGraphs[pid] = graph_from_lattice(parcellation == pid,
-                                               kerMask=kerMask)
-        # print 'pg:', parcelGraphs[pid]
+    for pid, csr in parcels_to_csr_graphs(parcellation, kerMask,
+                                          parcelIds).iteritems():
+        parcelGraphs[pid] = csr_to_graph(*csr)
         assert graph_is_sane(parcelGraphs[pid])
 
     return parcelGraphs
+
+
+def parcels_to_csr_graphs(parcellation, kerMask=None, parcelIds=None,
+                          toroidal=False):
+    """
+    Compute the graphs of all parcels in *parcellation* in one pass over the
+    labelled volume: all positions are shifted at once by each offset of
+    *kerMask* and only neighbours sharing the same label are kept.
+
+    Return :
+     - a dictionnary mapping a parcel ID to its graph as compressed sparse
+       rows (indptr, indices), see lattice_to_csr. Positions within a
+       parcel are indexed in the order of np.where(parcellation == pid).
+    """
+    if kerMask is not None:
+        assert parcellation.ndim == len(kerMask)
+    else:
+        kerMask = _full_ker_mask(parcellation.ndim)
+
+    shape = parcellation.shape
+    labelIndex = get_label_index(parcellation)
+    if parcelIds is None:
+        parcelIds = labelIndex.keys()
+    parcelIds = list(parcelIds)
+    if len(parcelIds) == 0:
+        return {}
+
+    # flat positions of all parcels, concatenated parcel after parcel, and
+    # rank of each position within its own parcel:
+    flatPos = [np.ravel_multi_index(labelIndex[pid], shape)
+               for pid in parcelIds]
+    sizes = np.array([len(fp) for fp in flatPos], dtype=int)
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    flatPos = np.concatenate(flatPos)
+    rank = np.zeros(parcellation.size, dtype=int)
+    rank[flatPos] = np.arange(len(flatPos)) - np.repeat(bounds[:-1], sizes)
+
+    flatLabels = parcellation.ravel()
+    nflat, inside = _lattice_neighbours(shape, np.unravel_index(flatPos,
+                                                                 shape),
+                                        kerMask, toroidal)
+    inside &= flatLabels[nflat] == flatLabels[flatPos][:, np.newaxis]
+    table = rank[nflat]
+    table[~inside] = -1
+
+    parcelGraphs = {}
+    for pid, start, stop in zip(parcelIds, bounds[:-1], bounds[1:]):
+        parcelGraphs[pid] = _neighbours_table_to_csr(table[start:stop])
+    return parcelGraphs
@@ -12,6 +12,8 @@ from pyhrf.ndarray import xndarray, stack_cuboids
 from pyhrf.jde.models import (WN_BiG_Drift_BOLDSamplerInput,
                               GSDefaultCallbackHandler)
 from pyhrf.jde.samplerbase import GibbsSampler, GibbsSamplerVariable
+from pyhrf.jde.drift import sampleDriftWhiteNoise
+from pyhrf.stats.random import sample_diag_gaussian, sample_gaussian
 
 from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, getCanoHRF
 from pyhrf.jde.intensivecalc import asl_compute_y_tilde
@@ -209,20 +211,9 @@ class DriftCoeffSampler(GibbsSamplerVariable, xmlio.XmlInitable):
         logger.debug('Noise vars :')
         logger.debug(v_b)
 
-        for i in xrange(self.nbVoxels):
+        logger.debug('v_l : %f', v_l)
+        self.currentValue[:] = sampleDriftWhiteNoise(self.P, ytilde, v_b, v_l)
 
-            v_lj = v_b[i] * v_l / (v_b[i] + v_l)
-            mu_lj = v_lj / v_b[i] * np.dot(self.P.transpose(), ytilde[:, i])
-            logger.debug('ivox=%d, v_lj=%f, std_lj=%f mu_lj=%s',
-                         i, v_lj, v_lj ** .5, mu_lj)
-
-            self.currentValue[:, i] = (np.random.randn(self.dimDrift) *
-                                       v_lj ** .5) + mu_lj
-
-            logger.debug('v_l : %f', v_l)
-
-            # if i == 15:
-            #    raise Exception()
         logger.debug('drift params :')
         logger.debug(self.currentValue)
 
@@ -466,9 +457,7 @@ class ResponseSampler(GibbsSamplerVariable):
         v_resp = self.samplerEngine.get_variable(self.var_name).currentValue
 
         varInvSigma = StS + self.nbVoxels * self.varR / v_resp
-        mean_h = np.linalg.solve(varInvSigma, StY)
-        resp = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY)
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
             resp /= norm
@@ -1432,14 +1421,12 @@ class PerfBaselineSampler(GibbsSamplerVariable, xmlio.XmlInitable):
         residuals = self.compute_residuals()
         v_b = self.samplerEngine.get_variable('noise_var').currentValue
 
-        for i in xrange(self.nbVoxels):
-            m_apost = ( np.dot(w.T, residuals[:, i]) ) /  \
-                      (self.ny + v_b[i] / v_alpha)
-            v_apost = (v_alpha * v_b[i]) / (self.ny * v_alpha + v_b[i])
+        m_apost = np.dot(w.T, residuals) / (self.ny + v_b / v_alpha)
+        v_apost = (v_alpha * v_b) / (self.ny * v_alpha + v_b)
 
-            a = np.random.randn() * v_apost ** .5 + m_apost
-            self.currentValue[i] = a
-            self.wa[:, i] = self.w * a
+        a = sample_diag_gaussian(m_apost[np.newaxis, :], v_apost)[0]
+        self.currentValue[:] = a
+        self.wa[:] = np.outer(self.w, a)
 
 
 class PerfBaselineVarianceSampler(GibbsSamplerVariable, xmlio.XmlInitable):
@@ -17,6 +17,7 @@ from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, getCanoHRF
 from pyhrf.boldsynth.scenarios import build_ctrl_tag_matrix
 from pyhrf.jde.intensivecalc import asl_compute_y_tilde
 from pyhrf.jde.intensivecalc import sample_potts
+from pyhrf.stats.random import sample_gaussian
 
 
 logger = logging.getLogger(__name__)
@@ -431,9 +432,7 @@ class PhysioBOLDResponseSampler(ResponseSampler, xmlio.XmlInitable):
             new_factor_var = np.dot(np.dot(omega.transpose(), sigma_g_inv), omega)\
                 / v_prf
         varInvSigma = StS + self.nbVoxels * self.varR / v_resp + new_factor_var
-        mean_h = np.linalg.solve(varInvSigma, StY + self.new_factor_mean)
-        resp = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + self.new_factor_mean)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -603,9 +602,7 @@ class PhysioPerfResponseSampler(ResponseSampler, xmlio.XmlInitable):
             new_factor = np.dot(sigma_g_inv, Oh) / v_resp
 
             varInvSigma = (StS + self.nbVoxels * self.varR / v_resp)
-            mean_h = np.linalg.solve(varInvSigma, StY + new_factor)
-            resp = np.random.multivariate_normal(mean_h,
-                                                 np.linalg.inv(varInvSigma))
+            resp = sample_gaussian(varInvSigma, StY + new_factor)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -1651,19 +1648,18 @@ class PerfBaselineSampler(GibbsSamplerVariable, xmlio.XmlInitable):
 
         # considering residuals
         if 1:
-            for i in xrange(self.nbVoxels):
-                if 1:
-                    # considering alpha
-                    m_apost = ( np.dot(w.T, residuals[:, i]) * v_alpha) /  \
-                        (self.ny * v_alpha + v_b[i])
-                    v_apost = (v_alpha * v_b[i]) / (self.ny * v_alpha + v_b[i])
-                else:
-                    # without considering alpha
-                    m_apost = (np.dot(w.T, residuals[:, i])) / (self.ny)
-                    v_apost = (v_b[i]) / (self.ny)
-                a = rnd[i] * v_apost ** .5 + m_apost
-                self.currentValue[i] = a
-                self.wa[:, i] = self.w * a
+            if 1:
+                # considering alpha
+                m_apost = (np.dot(w.T, residuals) * v_alpha) /  \
+                    (self.ny * v_alpha + v_b)
+                v_apost = (v_alpha * v_b) / (self.ny * v_alpha + v_b)
+            else:
+                # without considering alpha
+                m_apost = np.dot(w.T, residuals) / self.ny
+                v_apost = v_b / self.ny
+            a = rnd * v_apost ** .5 + m_apost
+            self.currentValue[:] = a
+            self.wa[:] = np.outer(self.w, a)
         else:
             # considering residuals' mean
             if 1:
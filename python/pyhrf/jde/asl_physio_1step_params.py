@@ -19,6 +19,7 @@ from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, getCanoHRF
 from pyhrf.boldsynth.scenarios import build_ctrl_tag_matrix
 from pyhrf.jde.intensivecalc import asl_compute_y_tilde
 from pyhrf.jde.intensivecalc import sample_potts
+from pyhrf.stats.random import sample_gaussian
 from pyhrf.sandbox.physio_params import (PHY_PARAMS_FRISTON00,
                                          linear_rf_operator)
 
@@ -454,9 +455,7 @@ class PhysioBOLDResponseSampler(ResponseSampler, xmlio.XmlInitable):
                 / v_prf
         #varInvSigma = StS + self.nbVoxels * self.varR / v_resp + new_factor_var
         varInvSigma = StS + self.varR / v_resp + new_factor_var
-        mean_h = np.linalg.solve(varInvSigma, StY + self.new_factor_mean)
-        resp = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + self.new_factor_mean)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -633,10 +632,7 @@ class PhysioPerfResponseSampler(ResponseSampler, xmlio.XmlInitable):
 
             #varInvSigma = (StS + self.nbVoxels * self.varR / v_resp)
             varInvSigma = (StS + self.varR / v_resp)
-            mean_h = np.linalg.solve(varInvSigma, StY + new_factor)
-            resp = np.random.multivariate_normal(mean_h,
-                                                 np.linalg.inv(varInvSigma))
-            #resp = mean_h
+            resp = sample_gaussian(varInvSigma, StY + new_factor)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -1725,19 +1721,18 @@ class PerfBaselineSampler(GibbsSamplerVariable, xmlio.XmlInitable):
 
         # considering residuals
         if 1:
-            for i in xrange(self.nbVoxels):
-                if 1:
-                    # considering alpha
-                    m_apost = ( np.dot(w.T, residuals[:, i]) * v_alpha) /  \
-                        (self.ny * v_alpha + v_b[i])
-                    v_apost = (v_alpha * v_b[i]) / (self.ny * v_alpha + v_b[i])
-                else:
-                    # without considering alpha
-                    m_apost = (np.dot(w.T, residuals[:, i])) / (self.ny)
-                    v_apost = (v_b[i]) / (self.ny)
-                a = rnd[i] * v_apost ** .5 + m_apost
-                self.currentValue[i] = a
-                self.wa[:, i] = self.w * a
+            if 1:
+                # considering alpha
+                m_apost = (np.dot(w.T, residuals) * v_alpha) /  \
+                    (self.ny * v_alpha + v_b)
+                v_apost = (v_alpha * v_b) / (self.ny * v_alpha + v_b)
+            else:
+                # without considering alpha
+                m_apost = np.dot(w.T, residuals) / self.ny
+                v_apost = v_b / self.ny
+            a = rnd * v_apost ** .5 + m_apost
+            self.currentValue[:] = a
+            self.wa[:] = np.outer(self.w, a)
         else:
             # considering residuals' mean
             if 1:
@@ -13,6 +13,7 @@ from numpy.testing import assert_almost_equal
 import pyhrf
 
 from pyhrf.jde.samplerbase import GibbsSampler, GibbsSamplerVariable
+from pyhrf.jde.drift import sampleDriftWhiteNoise
 from pyhrf import xmlio
 from pyhrf.ndarray import xndarray, stack_cuboids
 from pyhrf.jde.models import (WN_BiG_Drift_BOLDSamplerInput,
@@ -21,6 +22,7 @@ from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, getCanoHRF
 from pyhrf.boldsynth.scenarios import build_ctrl_tag_matrix
 from pyhrf.jde.intensivecalc import asl_compute_y_tilde
 from pyhrf.jde.intensivecalc import sample_potts
+from pyhrf.stats.random import sample_gaussian, sample_diag_gaussian
 
 
 logger = logging.getLogger(__name__)
@@ -410,9 +412,7 @@ class PhysioBOLDResponseSampler(ResponseSampler, xmlio.XmlInitable):
             / v_prf
 
         varInvSigma = StS + self.nbVoxels * self.varR / v_resp + new_factor_var
-        mean_h = np.linalg.solve(varInvSigma, StY + new_factor_mean)
-        resp = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + new_factor_mean)
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
             resp /= norm
@@ -543,9 +543,7 @@ class PhysioPerfResponseSampler(ResponseSampler, xmlio.XmlInitable):
             new_factor = np.dot(sigma_g_inv, np.dot(omega, brf)) / v_resp
 
             varInvSigma = StS + self.nbVoxels * self.varR / v_resp
-            mean_h = np.linalg.solve(varInvSigma, StY + new_factor)
-            resp = np.random.multivariate_normal(mean_h,
-                                                 np.linalg.inv(varInvSigma))
+            resp = sample_gaussian(varInvSigma, StY + new_factor)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -823,17 +821,8 @@ class DriftCoeffSampler(GibbsSamplerVariable, xmlio.XmlInitable):
         logger.debug('Noise vars :')
         logger.debug(v_b)
 
-        for i in xrange(self.nbVoxels):
-
-            v_lj = v_b[i] * v_l / (v_b[i] + v_l)
-            mu_lj = v_lj / v_b[i] * np.dot(self.P.transpose(), ytilde[:, i])
-            logger.debug('ivox=%d, v_lj=%f, std_lj=%f mu_lj=%s', i, v_lj,
-                         v_lj ** .5, str(mu_lj))
-
-            self.currentValue[:, i] = (np.random.randn(self.dimDrift) *
-                                       v_lj ** .5) + mu_lj
-
-            logger.debug('v_l : %f', v_l)
+        logger.debug('v_l : %f', v_l)
+        self.currentValue[:] = sampleDriftWhiteNoise(self.P, ytilde, v_b, v_l)
 
         logger.debug('drift params :')
         logger.debug(self.currentValue)
@@ -1589,14 +1578,12 @@ class PerfBaselineSampler(GibbsSamplerVariable, xmlio.XmlInitable):
         residuals = self.compute_residuals()
         v_b = self.samplerEngine.get_variable('noise_var').currentValue
 
-        for i in xrange(self.nbVoxels):
-            m_apost = ( np.dot(w.T, residuals[:, i]) ) /  \
-                      (self.ny + v_b[i] / v_alpha)
-            v_apost = (v_alpha * v_b[i]) / (self.ny * v_alpha + v_b[i])
+        m_apost = np.dot(w.T, residuals) / (self.ny + v_b / v_alpha)
+        v_apost = (v_alpha * v_b) / (self.ny * v_alpha + v_b)
 
-            a = np.random.randn() * v_apost ** .5 + m_apost
-            self.currentValue[i] = a
-            self.wa[:, i] = self.w * a
+        a = sample_diag_gaussian(m_apost[np.newaxis, :], v_apost)[0]
+        self.currentValue[:] = a
+        self.wa[:] = np.outer(self.w, a)
 
 
 class PerfBaselineVarianceSampler(GibbsSamplerVariable, xmlio.XmlInitable):
@@ -15,6 +15,7 @@ from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, getCanoHRF
 from pyhrf.boldsynth.scenarios import build_ctrl_tag_matrix
 from pyhrf.jde.intensivecalc import asl_compute_y_tilde
 from pyhrf.jde.intensivecalc import sample_potts
+from pyhrf.stats.random import sample_gaussian
 
 
 logger = logging.getLogger(__name__)
@@ -336,11 +337,9 @@ class PhysioTrueBOLDResponseSampler(ResponseSampler, xmlio.XmlInitable):
         varInvSigma = R_resp / v_mu + sigma_h_inv / v_brf + \
             np.dot(np.dot(omega.T, sigma_g_inv), omega) / v_prf
 
-        mean_mu = np.linalg.solve(varInvSigma, np.dot(sigma_h_inv, brf) / v_brf +
-                                  np.dot(np.dot(omega.T, sigma_g_inv), prf) / v_prf)
-
-        resp = np.random.multivariate_normal(
-            mean_mu, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma,
+                               np.dot(sigma_h_inv, brf) / v_brf +
+                               np.dot(np.dot(omega.T, sigma_g_inv), prf) / v_prf)
 
         # resp = brf #HACK
 
@@ -450,10 +449,7 @@ class PhysioBOLDResponseSampler(ResponseSampler, xmlio.XmlInitable):
 
         varInvSigma = StS + new_factor_var
 
-        mean_h = np.linalg.solve(varInvSigma, StY + new_factor_mean)
-
-        resp = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + new_factor_mean)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -592,10 +588,7 @@ class PhysioPerfResponseSampler(ResponseSampler, xmlio.XmlInitable):
 
         varInvSigma = StS + new_factor_var
 
-        mean_g = np.linalg.solve(varInvSigma, StY + new_factor_mean)
-
-        resp = np.random.multivariate_normal(
-            mean_g, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + new_factor_mean)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
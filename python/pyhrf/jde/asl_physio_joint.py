@@ -17,6 +17,7 @@ from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, getCanoHRF
 from pyhrf.boldsynth.scenarios import build_ctrl_tag_matrix
 from pyhrf.jde.intensivecalc import asl_compute_y_tilde
 from pyhrf.jde.intensivecalc import sample_potts
+from pyhrf.stats.random import sample_gaussian
 
 
 logger = logging.getLogger(__name__)
@@ -336,9 +337,7 @@ class PhysioBOLDResponseSampler(ResponseSampler, xmlio.XmlInitable):
 
         varInvSigma = StS + self.nbVoxels * self.varR / v_resp + new_factor_var
         #varInvSigma = StS + self.varR / v_resp + new_factor_var
-        mean_h = np.linalg.solve(varInvSigma, StY + self.new_factor_mean)
-        resp = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + self.new_factor_mean)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -473,9 +472,7 @@ class PhysioPerfResponseSampler(ResponseSampler, xmlio.XmlInitable):
         new_factor = np.dot(sigma_g_inv, np.dot(omega, brf)) / v_resp
 
         varInvSigma = StS + self.nbVoxels * self.varR / v_resp
-        mean_h = np.linalg.solve(varInvSigma, StY + new_factor)
-        resp = np.random.multivariate_normal(mean_h,
-                                             np.linalg.inv(varInvSigma))
+        resp = sample_gaussian(varInvSigma, StY + new_factor)
 
         if self.normalise:
             norm = (resp ** 2).sum() ** .5
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import os
+import os.path as op
+import shutil
+import hashlib
+import cPickle
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+
+from pyhrf.tools.misc import digest_data
+
+
+logger = logging.getLogger(__name__)
+
+
+def freeze(obj):
+    """ Return *obj* where arrays (also inside lists and tuples) are replaced
+    by read-only views.
+    """
+    if isinstance(obj, np.ndarray):
+        obj = obj.view()
+        obj.flags.writeable = False
+        return obj
+    elif isinstance(obj, list):
+        return [freeze(e) for e in obj]
+    elif isinstance(obj, tuple):
+        return tuple(freeze(e) for e in obj)
+    return obj
+
+
+class DesignCache:
+
+    """ Cache of the design structures of sampler inputs: paradigm
+    convolution matrices (varX, stackX, ...), drift basis and the
+    precalculations that only involve them (matXQX, matXQ, ...).
+
+    These structures only depend on the paradigm, the TR, the number of
+    scans, dt and the HRF and drift settings, which are the same for all the
+    ROIs of a treatment. They are built for the first ROI and the following
+    ones get read-only views on the same arrays.
+
+    If *cache_dir* is set, designs are also stored there, arrays being saved
+    as .npy files which are loaded as read-only memory maps. Worker processes
+    of a parallel treatment pointing to the same directory then build each
+    design only once and share its physical memory.
+    """
+
+    def __init__(self, cache_dir=None, max_size=4):
+        """
+        Args:
+            *cache_dir* is the directory where designs are shared between
+                        processes (None: in-memory only).
+            *max_size* is the maximum number of designs kept in memory (the
+                       least recently used one is dropped first).
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.designs = OrderedDict()
+        self.lock = threading.RLock()
+
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def clear(self):
+        with self.lock:
+            self.designs.clear()
+
+    def make_key(self, *params):
+        """ Return the key of the design defined by *params*, eg the input
+        class name, the paradigm onsets, the TR ...
+        """
+        digest = hashlib.sha1()
+        digest_data(digest, params)
+        return digest.hexdigest()
+
+    def _get_design_dir(self, key):
+        return op.join(self.cache_dir, 'design_' + key)
+
+    def get(self, key):
+        """ Return the attributes of the design *key* or None if it has not
+        been built yet.
+        """
+        with self.lock:
+            if key in self.designs:
+                design = self.designs.pop(key)
+                self.designs[key] = design
+                return design
+
+            if self.cache_dir is None:
+                return None
+            design_dir = self._get_design_dir(key)
+            if not op.exists(design_dir):
+                return None
+            logger.info('Loading shared design from %s', design_dir)
+            f = open(op.join(design_dir, 'attributes.pck'), 'rb')
+            try:
+                design, array_names = cPickle.load(f)
+            finally:
+                f.close()
+            for name in array_names:
+                design[name] = np.load(op.join(design_dir, name + '.npy'),
+                                       mmap_mode='r')
+            return self._store(key, design)
+
+    def add(self, key, design):
+        """ Register the attributes *design* (dict) as the design *key* and
+        return their read-only version.
+        """
+        with self.lock:
+            if self.cache_dir is not None:
+                self._save(key, design)
+            return self._store(key, design)
+
+    def _store(self, key, design):
+        design = dict((k, freeze(v)) for k, v in design.iteritems())
+        self.designs[key] = design
+        while len(self.designs) > self.max_size:
+            self.designs.popitem(last=False)
+        return design
+
+    def _save(self, key, design):
+        design_dir = self._get_design_dir(key)
+        if op.exists(design_dir):
+            return
+        if not op.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # the design is written in a temporary directory which is then
+        # renamed: concurrent processes never see a partial design
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        array_names = [k for k, v in design.iteritems()
+                       if isinstance(v, np.ndarray) and not v.dtype.hasobject]
+        others = dict((k, v) for k, v in design.iteritems()
+                      if k not in array_names)
+        for name in array_names:
+            np.save(op.join(tmp_dir, name + '.npy'), design[name])
+        f = open(op.join(tmp_dir, 'attributes.pck'), 'wb')
+        try:
+            cPickle.dump((others, array_names), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp_dir, design_dir)
+        except OSError:
+            # another process stored the same design in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def setup(self, obj, key, build):
+        """
+        Set the attributes of the design *key* on *obj*. If the design is
+        not available, *build* (a callable without argument) is called to
+        compute it on *obj*: the attributes it adds or replaces are cached.
+        """
+        design = self.get(key)
+        if design is None:
+            before = dict(obj.__dict__)
+            build()
+            design = dict((k, v) for k, v in obj.__dict__.iteritems()
+                          if k not in before or v is not before[k])
+            design = self.add(key, design)
+        else:
+            logger.info('Reusing design %s', key)
+        obj.__dict__.update(design)
+
+
+# design cache shared by all sampler inputs of the current process
+design_cache = DesignCache()
@@ -5,12 +5,13 @@ import logging
 from numpy import *
 import numpy as np
 
-from numpy.linalg import cholesky
 from numpy.matlib import repmat
 
 import pyhrf
 import intensivecalc
 from pyhrf import xmlio
+from pyhrf.stats.random import (sample_diag_gaussian, sample_gaussian,
+                                sample_gaussian_precision)
 from samplerbase import *
 from numpy.matlib import *
 
@@ -96,34 +97,12 @@ class DriftSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         sHrf = self.get_variable('hrf')
         eta = self.get_variable('drift_var').currentValue
 
-        for i in xrange(self.nbVox):
-            # inv_sigma = np.eye(self.dimDrift) * (1/eta + 1/reps[i])
-            # pty = np.dot(self.P.transpose(), snrls.varYtilde[:,i])
-            # self.currentValue[:,i] = sampleDrift(inv_sigma, pty, self.dimDrift)
-
-            v_lj = reps[i] * eta / (reps[i] + eta)
-            #v_lj = ( 1/reps[i] + 1/eta )
-            mu_lj = v_lj / reps[i] * \
-                np.dot(self.P.transpose(), snrls.varYtilde[:, i])
-            # print 'ivox=%d, v_lj=%f, std_lj=%f mu_lj=' %(i,v_lj,v_lj**.5),
-            # mu_lj
-            self.currentValue[:, i] = np.random.randn(
-                self.dimDrift) * v_lj ** .5 + mu_lj
-
         logger.debug('eta : %f', eta)
         logger.debug('reps :')
         logger.debug(reps)
 
-        inv_vars_l = (1 / reps + 1 / eta) * self.ones_Q_J
-        mu_l = 1 / inv_vars_l * np.dot(self.P.transpose(), snrls.varYtilde)
-
-        logger.debug('vars_l :')
-        logger.debug(1 / inv_vars_l)
-
-        logger.debug('mu_l :')
-        logger.debug(mu_l)
-
-        cur_val = np.random.normal(mu_l, 1 / inv_vars_l)
+        self.currentValue[:] = sampleDriftWhiteNoise(self.P, snrls.varYtilde,
+                                                     reps, eta)
 
         logger.debug('drift params :')
         logger.debug(self.currentValue)
@@ -208,36 +187,16 @@ class DriftSamplerWithRelVar(DriftSampler):
         eta = self.get_variable('drift_var').currentValue
         w = self.get_variable('W').currentValue
 
-        for i in xrange(self.nbVox):
-            v_lj = reps[i] * eta / (reps[i] + eta)
-            mu_lj = v_lj / reps[i] * \
-                np.dot(self.P.transpose(), snrls.varYtilde[:, i])
-            self.currentValue[:, i] = np.random.randn(
-                self.dimDrift) * v_lj ** .5 + mu_lj
-
         logger.debug('eta : %f' % eta)
         logger.debug('reps :')
         logger.debug(reps)
 
-        inv_vars_l = (1 / reps + 1 / eta) * self.ones_Q_J
-        mu_l = 1 / inv_vars_l * np.dot(self.P.transpose(), snrls.varYtilde)
-
-        logger.debug('vars_l :')
-        logger.debug(1 / inv_vars_l)
-
-        logger.debug('mu_l :')
-        logger.debug(mu_l)
-
-        cur_val = np.random.normal(mu_l, 1 / inv_vars_l)
+        self.currentValue[:] = sampleDriftWhiteNoise(self.P, snrls.varYtilde,
+                                                     reps, eta)
 
         logger.debug('drift params :')
         logger.debug(self.currentValue)
 
-        logger.debug('drift params (alt) :')
-        logger.debug(cur_val)
-
-        #assert np.allclose(cur_val, self.currentValue)
-
         self.updateNorm()
         self.matPl = dot(self.P, self.currentValue)
 
@@ -258,13 +217,32 @@ class DriftSamplerWithRelVar(DriftSampler):
         return outputs
 
 
-def sampleDrift(varInvSigma_drift, ptLambdaY, dim):
+def sampleDriftWhiteNoise(P, varYtilde, reps, eta):
+    """
+    Sample the drift coefficients of all voxels at once, in the case of
+    white noise. Voxels are conditionally independent: the posterior of
+    voxel j is N(v_j/reps_j P^t ytilde_j, v_j I) with
+    v_j = reps_j*eta / (reps_j+eta).
+
+    Args:
+        *P* (np.ndarray): drift basis, shape (ny, dimDrift)
+        *varYtilde* (np.ndarray): drift-free residuals, shape (..., ny, nbVox)
+        *reps* (np.ndarray): noise variances, shape (..., nbVox)
+        *eta* (float or np.ndarray): drift variance(s), broadcastable to reps
+
+    Return an array of shape (..., dimDrift, nbVox). The leading axes (eg
+    sessions or subjects) share the same drift basis.
+    """
+    reps = np.asarray(reps, dtype=float)
+    v_l = reps * eta / (reps + eta)
+    pty = np.dot(P.transpose(), varYtilde)
+    mu_l = (v_l / reps)[..., np.newaxis, :] * \
+        np.rollaxis(pty, 0, pty.ndim - 1)
+    return sample_diag_gaussian(mu_l, v_l)
 
-    mean_drift = np.linalg.solve(varInvSigma_drift, ptLambdaY)
-    choleskyInvSigma_drift = cholesky(varInvSigma_drift).transpose()
-    drift = np.linalg.solve(choleskyInvSigma_drift, random.randn(dim))
-    drift += mean_drift
-    return drift
+
+def sampleDrift(varInvSigma_drift, ptLambdaY, dim):
+    return sample_gaussian(varInvSigma_drift, ptLambdaY)
 
 
 class DriftARSampler(xmlio.XmlInitable, GibbsSamplerVariable):
@@ -308,15 +286,10 @@ class DriftARSampler(xmlio.XmlInitable, GibbsSamplerVariable):
     def updateVarYmDrift(self):
         self.matPl = dot(self.P, self.currentValue)
         # print matPl.shape, self.dataInput.varMBY.shape
-        for v in range(self.nbVox):
-            self.varMBYPl[:, v] = self.dataInput.varMBY[
-                :, v] - self.matPl[:, v]
+        self.varMBYPl[:] = self.dataInput.varMBY - self.matPl
 
     def computeVarYTilde(self, varNrls, varXh):
-        for v in xrange(self.nbVox):
-            repNRLv = repmat(varNrls[:, v], self.ny, 1)
-            avjXjh = repNRLv * varXh
-            self.varYTilde[:, v] = self.varMBYPl[:, v] - avjXjh.sum(axis=1)
+        self.varYTilde[:] = self.varMBYPl - np.dot(varXh, varNrls)
 
     def checkAndSetInitValue(self, variables):
         smplVarDrift = self.get_variable('drift_var')
@@ -384,13 +357,10 @@ class DriftARSampler(xmlio.XmlInitable, GibbsSamplerVariable):
                                                  self.varPtLambdaYmP)
             logger.debug('Computing PtDeltaP and PtDeltaY in C fashion'
                          ' done in %1.3f sec', time.time() - tSQSOptimIni)
-            for v in xrange(self.nbVox):
-                invSigma = eye(self.dimDrift, dtype=float) / \
-                    eta + self.varPtLambdaP[:, :, v]
-                self.currentValue[:, v] = sampleDrift(invSigma,
-                                                      self.varPtLambdaYmP[
-                                                          :, v],
-                                                      self.dimDrift)
+            invSigma = self.varPtLambdaP + \
+                (np.eye(self.dimDrift) / eta)[:, :, np.newaxis]
+            self.currentValue[:] = sample_gaussian_precision(
+                invSigma, self.varPtLambdaYmP)
             logger.debug('Sampling drift in C fashion done in %1.3f sec',
                          time.time() - tSQSOptimIni)
         if 0:
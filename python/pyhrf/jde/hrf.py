@@ -16,6 +16,7 @@ from pyhrf.jde.samplerbase import *
 from pyhrf.boldsynth.hrf import genGaussianSmoothHRF, buildFiniteDiffMatrix
 from pyhrf.boldsynth.hrf import genCanoBezierHRF, getCanoHRF
 from pyhrf.ndarray import xndarray
+from pyhrf.stats.random import sample_gaussian
 
 try:
     from pyhrf.stats import cRandom
@@ -69,8 +70,7 @@ def buildDiagGaussianMat(size, width):
     return toeplitz(np.concatenate((b, np.zeros(size - len(b)))))
 
 
-def sampleHRF_voxelwise_iid(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
-
+def logHRFPosteriorParams(stLambdaS, varR, rh):
     logger.info('stLambdaS:')
     logger.info(stLambdaS)
     logger.info('varR:')
@@ -79,68 +79,32 @@ def sampleHRF_voxelwise_iid(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
     logger.info('varR/rh:')
     logger.info(varR / rh)
 
-    varInvSigma_h = stLambdaS + nbVox * varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY)
 
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+def sampleHRF_voxelwise_iid(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
+    """
+    Sample the HRF from its posterior N(Q^{-1} StLambdaY, Q^{-1}) with
+    Q = StLambdaS + nbVox*R/rh.
+    """
+    logHRFPosteriorParams(stLambdaS, varR, rh)
+    return sample_gaussian(stLambdaS + nbVox * varR / rh, stLambdaY)
 
 
 def sampleHRF_single_hrf_hack(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
-    varInvSigma_h = stLambdaS / nbVox
-
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    varInvSigma_h += varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY / nbVox)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    """
+    Sample the HRF from its posterior N(Q^{-1} StLambdaY/nbVox, Q^{-1}) with
+    Q = StLambdaS/nbVox + R/rh.
+    """
+    logHRFPosteriorParams(stLambdaS, varR, rh)
+    return sample_gaussian(stLambdaS / nbVox + varR / rh, stLambdaY / nbVox)
 
 
 def sampleHRF_single_hrf(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
-
-    varInvSigma_h = stLambdaS
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    varInvSigma_h += varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    """
+    Sample the HRF from its posterior N(Q^{-1} StLambdaY, Q^{-1}) with
+    Q = StLambdaS + R/rh.
+    """
+    logHRFPosteriorParams(stLambdaS, varR, rh)
+    return sample_gaussian(stLambdaS + varR / rh, stLambdaY)
 
 
 class HRFSampler(xmlio.XmlInitable, GibbsSamplerVariable):
@@ -897,7 +861,8 @@ class HRFARSampler(HRFSampler):
 
         self.currentValue = sampleHRF_single_hrf(self.varDeltaS,
                                                  self.varDeltaY,
-                                                 self.varR, rh, self.nbColX, self.nbVox)
+                                                 self.varR, rh, self.nbColX,
+                                                 self.nbVox)
 
         logger.debug('All HRF coeffs :')
         logger.debug(self.currentValue)
@@ -980,15 +945,12 @@ class HRFwithHabSampler(HRFSampler):
         y = self.dataInput.varMBY
         #Q = self.dataInput.delta
 
-        varDeltaS = np.zeros((self.nbColX, self.nbColX), dtype=float)
-        varDeltaY = np.zeros((self.nbColX), dtype=float)
         np.divide(y, rb, self.varYrb)
 
-        for nv in range(self.nbVox):
-            # print shape(sumaX[:,:,nv]), shape(Q)
-            temp = np.dot(sumaX[:, :, nv].transpose(), Q)
-            varDeltaY += np.dot(temp, self.varYrb[:, nv])
-            varDeltaS += np.dot(temp, sumaX[:, :, nv]) / rb[nv]
+        # (sumaX_v^t Q)^t for all voxels v, shape (ny, nbColX, nbVox)
+        temp = np.tensordot(Q.T, sumaX, 1)
+        varDeltaY = np.einsum('ikv,iv->k', temp, self.varYrb)
+        varDeltaS = np.einsum('ikv,ilv->kl', temp / rb, sumaX)
 
         return (varDeltaS, varDeltaY)
 
@@ -1013,8 +975,10 @@ class HRFwithHabSampler(HRFSampler):
 
         rh = self.get_variable('hrf_var').currentValue
 
-        self.currentValue = sampleHRF(self.varDeltaS, self.varDeltaY,
-                                      self.varR, rh, self.nbColX)
+        self.currentValue = sampleHRF_single_hrf(self.varDeltaS,
+                                                 self.varDeltaY,
+                                                 self.varR, rh, self.nbColX,
+                                                 self.nbVox)
 
         logger.debug('All HRF coeffs :')
         logger.debug(self.currentValue)
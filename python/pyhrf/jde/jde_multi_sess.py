@@ -16,11 +16,14 @@ from numpy.testing import assert_almost_equal
 import pyhrf
 from pyhrf.jde.noise import NoiseVariance_Drift_Sampler
 from pyhrf.jde.drift import ETASampler
-from pyhrf.jde.hrf import RHSampler, ScaleSampler
+from pyhrf.jde.hrf import (RHSampler, ScaleSampler, sampleHRF_single_hrf,
+                           sampleHRF_single_hrf_hack)
+import pyhrf.jde.hrf
 from pyhrf.jde.nrl.bigaussian import (NRLSampler, MixtureWeightsSampler,
                                       BiGaussMixtureParamsSampler)
 from pyhrf.jde.beta import BetaSampler
 from pyhrf.jde.samplerbase import GSDefaultCallbackHandler
+from pyhrf.jde.design import design_cache
 from pyhrf import xmlio
 from pyhrf.graph import graph_nb_cliques
 from pyhrf.jde.intensivecalc import computeYtilde, sampleSmmNrlBar
@@ -29,6 +32,7 @@ from pyhrf.tools import get_2Dtable_string
 from pyhrf.tools._io import write_volume
 from pyhrf.jde.samplerbase import GibbsSampler, GibbsSamplerVariable
 from pyhrf.tools import array_summary
+from pyhrf.stats.random import sample_diag_gaussian, sample_noise_variances
 
 
 logger = logging.getLogger(__name__)
@@ -84,19 +88,9 @@ class NoiseVariance_Drift_Multi_Sess_Sampler(xmlio.XmlInitable,
         self.varYbar = self.samplerEngine.get_variable(
             'nrl_by_session').varYbar
 
-        for s in xrange(self.nbSess):
-            for j in xrange(self.nbVox):
-                var_y_bar = self.varYbar[s, :, j]
-                # if j==1 and s==0:
-                # print "s=%d, j=%d" %(s,j)
-                # print 'var_y_bar:', var_y_bar[:10]
-                beta_g = np.dot(var_y_bar.transpose(), var_y_bar) / 2
-                # print 'beta_g:', beta_g
-
-                gammaSample = np.random.gamma((self.ny - 1) / 2, 1)
-                # print 'gammasamples:', gammaSamples
-
-                self.currentValue[s, j] = np.divide(beta_g, gammaSample)
+        beta_g = (self.varYbar * self.varYbar).sum(1) / 2
+        self.currentValue[:] = sample_noise_variances(beta_g,
+                                                      (self.ny - 1) / 2)
         # print 'value:', self.currentValue[0,1]
         # print 'test:', (self.varYbar[0,:,185]*self.varYbar[0,:,185]).sum()
         # print 'beta_g_185:', np.dot(self.varYbar[0,:,1].transpose(), self.varYbar[0,:,1])/2
@@ -188,21 +182,17 @@ class Drift_MultiSess_Sampler(xmlio.XmlInitable, GibbsSamplerVariable):
         snrls = self.samplerEngine.get_variable('nrl_by_session')
         noise_vars = self.samplerEngine.get_variable('noise_var').currentValue
 
-        for j in xrange(self.nbVox):
-            for s in xrange(self.nbSess):
-                reps = noise_vars[s, j]
-
-                logger.debug('eta : %f', eta)
-                logger.debug('reps :')
-                logger.debug(reps)
-
-                v_lj = reps * eta / (reps + eta)
-                mu_lj = v_lj / reps * np.dot(self.P[s].transpose(),
-                                             snrls.varYtilde[s, :, j])
+        logger.debug('eta : %f', eta)
+        logger.debug('reps :')
+        logger.debug(noise_vars)
 
-                self.currentValue[s, :, j] = randn(self.dimDrift) * \
-                    v_lj ** .5 + mu_lj
-                # print 'drifts coeffs:', self.currentValue[s][:,j]
+        # drift bases differ across sessions, only posterior means are
+        # computed session-wise:
+        v_l = noise_vars * eta / (noise_vars + eta)
+        mu_l = np.array([v_l[s] / noise_vars[s] *
+                         np.dot(self.P[s].transpose(), snrls.varYtilde[s])
+                         for s in xrange(self.nbSess)])
+        self.currentValue[:] = sample_diag_gaussian(mu_l, v_l)
 
         self.updateNorm()
 
@@ -293,77 +283,14 @@ class ETASampler_MultiSess(ETASampler):
 
 def sampleHRF_voxelwise_iid(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox,
                             nbSess):
-
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    varInvSigma_h = stLambdaS + nbSess * nbVox * varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
-
-
-def sampleHRF_single_hrf_hack(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
-    varInvSigma_h = stLambdaS / nbVox
-
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    varInvSigma_h += varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY / nbVox)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
-
-
-def sampleHRF_single_hrf(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox):
-
-    varInvSigma_h = stLambdaS
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    varInvSigma_h += varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    """
+    Sample the HRF from its posterior N(Q^{-1} StLambdaY, Q^{-1}) with
+    Q = StLambdaS + nbSess*nbVox*R/rh
+    (see pyhrf.jde.hrf.sampleHRF_voxelwise_iid).
+    """
+    return pyhrf.jde.hrf.sampleHRF_voxelwise_iid(stLambdaS, stLambdaY,
+                                                 nbSess * varR, rh, nbColX,
+                                                 nbVox)
 
 
 class HRF_MultiSess_Sampler(xmlio.XmlInitable, GibbsSamplerVariable):
@@ -2144,23 +2071,36 @@ class BOLDSampler_Multi_SessInput:
         self.onsets = [onsets[cn] for cn in self.cNames]
         durations = data.paradigm.stimDurations
         self.durations = [durations[cn] for cn in self.cNames]
-        # print 'durations are :', self.durations
+
+        # design matrices are the same for all ROIs of a treatment:
+        design_key = design_cache.make_key(
+            '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            self.cNames, self.onsets, self.durations, self.tr, self.nys,
+            self.ny, dt, hrfZc, hrfDuration, typeLFD, paramLFD)
+        design_cache.setup(self, design_key,
+                           lambda: self.buildDesign(dt, typeLFD, paramLFD,
+                                                    hrfZc, hrfDuration))
+
+        logger.info('Making precalculcations ...')
+        self.makePrecalculations()
+
+    def buildDesign(self, dt, typeLFD, paramLFD, hrfZc, hrfDuration):
+        """
+        Build the structures that only depend on the paradigm, TR, dt, HRF
+        and drift settings (see pyhrf.jde.models.BOLDSamplerInput.buildDesign)
+        """
         self.chewUpOnsets(dt, hrfZc, hrfDuration)
 
         # Build matrices related to low frequency drift
         logger.info('Building LFD mats %% ...')
         self.setLFDMat(paramLFD, typeLFD)
 
-        logger.info('Making precalculcations ...')
-        self.makePrecalculations()
+        self.makeDesignPrecalculations()
 
-    def makePrecalculations(self):
-        # XQX & XQ:
+    def makeDesignPrecalculations(self):
+        # XQX, XQ & XtX:
         XQX = []
         XQ = []
-        Qy = []
-        yTQ = []
-        yTQy = []
         XtX = []
         for iSess in xrange(self.nbSessions):
             self.matXQX = np.zeros((self.nbConditions, self.nbConditions,
@@ -2176,6 +2116,24 @@ class BOLDSampler_Multi_SessInput:
                                                      self.varX[iSess, k, :, :])
             XQX.append(self.matXQX)
             XQ.append(self.matXQ)
+
+            self.matXtX = np.zeros((self.nbConditions, self.nbConditions,
+                                    self.nbColX, self.nbColX), dtype=float)
+            for j in xrange(self.nbConditions):
+                for k in xrange(self.nbConditions):
+                    self.matXtX[j, k, :, :] = np.dot(self.varX[iSess, j, :, :].transpose(),
+                                                     self.varX[iSess, k, :, :])
+            XtX.append(self.matXtX)
+
+        self.matXQX = np.array(XQX)
+        self.matXQ = np.array(XQ)
+        self.matXtX = np.array(XtX)
+
+    def makePrecalculations(self):
+        Qy = []
+        yTQ = []
+        yTQy = []
+        for iSess in xrange(self.nbSessions):
             # Qy, yTQ & yTQy  :
             self.matQy = np.zeros((self.ny, self.nbVoxels), dtype=float)
             self.yTQ = np.zeros((self.ny, self.nbVoxels), dtype=float)
@@ -2189,24 +2147,13 @@ class BOLDSampler_Multi_SessInput:
                 self.yTQy[i] = np.dot(
                     self.varMBY[iSess][:, i], self.matQy[:, i])
 
-            self.matXtX = np.zeros((self.nbConditions, self.nbConditions,
-                                    self.nbColX, self.nbColX), dtype=float)
-            for j in xrange(self.nbConditions):
-                for k in xrange(self.nbConditions):
-                    self.matXtX[j, k, :, :] = np.dot(self.varX[iSess, j, :, :].transpose(),
-                                                     self.varX[iSess, k, :, :])
-
             Qy.append(self.matQy)
             yTQ.append(self.yTQ)
             yTQy.append(self.yTQy)
-            XtX.append(self.matXtX)
 
-        self.matXQX = np.array(XQX)
-        self.matXQ = np.array(XQ)
         self.matQy = np.array(Qy)
         self.yTQ = np.array(yTQ)
         self.yTQy = np.array(yTQy)
-        self.matXtX = np.array(XtX)
 
     def cleanPrecalculations(self):
 
@@ -10,12 +10,12 @@ from collections import defaultdict
 import numpy as np
 import scipy
 
-from numpy.random import randn
 from numpy.testing import assert_almost_equal
 
 import pyhrf
 from pyhrf import Condition
 from pyhrf.jde.samplerbase import GSDefaultCallbackHandler
+from pyhrf.jde.design import design_cache
 from pyhrf import xmlio
 from pyhrf.graph import graph_nb_cliques
 from pyhrf.boldsynth.hrf import getCanoHRF, genGaussianSmoothHRF
@@ -23,6 +23,9 @@ from pyhrf.core import FmriData, FmriGroupData
 from pyhrf.jde.intensivecalc import computeYtilde, sample_potts
 from pyhrf.ndarray import xndarray, stack_cuboids
 from pyhrf.jde.samplerbase import GibbsSampler, GibbsSamplerVariable
+from pyhrf.jde.drift import sampleDriftWhiteNoise
+from pyhrf.jde.hrf import logHRFPosteriorParams
+from pyhrf.stats.random import sample_noise_variances, sample_gaussian
 
 
 logger = logging.getLogger(__name__)
@@ -77,13 +80,9 @@ class NoiseVariance_Drift_MultiSubj_Sampler(GibbsSamplerVariable):
 
         varYbar = snrl.varYtilde - matPl
 
-        for s in xrange(self.nbSubj):
-            for j in xrange(self.nbVox):
-                var_y_bar = varYbar[s, :, j]
-                beta_g = np.dot(var_y_bar.transpose(), var_y_bar) / 2
-                gammaSample = np.random.gamma((self.ny - 1) / 2, 1)
-
-                self.currentValue[s, j] = np.divide(beta_g, gammaSample)
+        beta_g = (varYbar * varYbar).sum(1) / 2
+        self.currentValue[:] = sample_noise_variances(beta_g,
+                                                      (self.ny - 1) / 2)
 
 
 ##################################################
@@ -160,19 +159,14 @@ class Drift_MultiSubj_Sampler(GibbsSamplerVariable):
         snrls = self.samplerEngine.get_variable('nrl')
         noise_vars = self.samplerEngine.get_variable('noise_var').currentValue
 
-        for j in xrange(self.nbVox):
-            for s in xrange(self.nbSubj):
-                reps = noise_vars[s, j]
-                logger.debug('eta :')
-                logger.debug(eta[s])
-                logger.debug('reps :')
-                logger.debug(reps)
-                v_lj = reps * eta[s] / (reps + eta[s])
-                mu_lj = v_lj / reps * np.dot(self.P.transpose(),
-                                             snrls.varYtilde[s, :, j])
-
-                self.currentValue[s, :, j] = randn(self.dimDrift) * \
-                    v_lj ** .5 + mu_lj
+        logger.debug('eta :')
+        logger.debug(eta)
+        logger.debug('reps :')
+        logger.debug(noise_vars)
+        # the drift basis is shared by all subjects:
+        self.currentValue[:] = sampleDriftWhiteNoise(
+            self.P, snrls.varYtilde, noise_vars,
+            np.asarray(eta)[:, np.newaxis])
 
         self.updateNorm()
 
@@ -287,82 +281,38 @@ class ETASampler_MultiSubj(GibbsSamplerVariable):
 
 def sampleHRF_voxelwise_iid(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox,
                             hgroup, nbsubj):
-    varInvSigma_h = stLambdaS
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh over subjects:')
-    logger.info(rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    varInvSigma_h += nbVox * varR / rh
-
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY +
-                             nbsubj * np.dot(varR, hgroup) / rh)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
-
-
-def sampleHRF_single_hrf_hack(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox, hgroup):
-    varInvSigma_h = stLambdaS / nbVox
-
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
-
-    # if hrf subject NOT regularized
-    varInvSigma_h += np.eye(varR.shape[0]) / rh
-    mean_h = np.linalg.solve(varInvSigma_h,
-                             stLambdaY / nbVox + np.dot(varR, hgroup) / rh)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    """
+    Sample a subject HRF from its posterior N(Q^{-1} m, Q^{-1}) with
+    Q = StLambdaS + nbVox*R/rh and m = StLambdaY + nbsubj*R*hgroup/rh.
+    """
+    logHRFPosteriorParams(stLambdaS, varR, rh)
 
+    return sample_gaussian(stLambdaS + nbVox * varR / rh,
+                           stLambdaY + nbsubj * np.dot(varR, hgroup) / rh)
 
-def sampleHRF_single_hrf(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox,
-                         hgroup):
 
-    logger.info('stLambdaS:')
-    logger.info(stLambdaS)
-    logger.info('varR:')
-    logger.info(varR)
-    logger.info('rh: %f', rh)
-    logger.info('varR/rh:')
-    logger.info(varR / rh)
+def sampleHRF_single_hrf_hack(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox,
+                              hgroup):
+    """
+    Same as sampleHRF_voxelwise_iid with Q = StLambdaS/nbVox + I/rh and
+    m = StLambdaY/nbVox + R*hgroup/rh (the subject HRF is not regularised).
+    """
+    logHRFPosteriorParams(stLambdaS, varR, rh)
 
-    varInvSigma_h = stLambdaS + varR / rh
+    return sample_gaussian(stLambdaS / nbVox + np.eye(varR.shape[0]) / rh,
+                           stLambdaY / nbVox + np.dot(varR, hgroup) / rh)
 
-    mean_h = np.linalg.solve(
-        varInvSigma_h, stLambdaY + np.dot(varR, hgroup) / rh)
 
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
+def sampleHRF_single_hrf(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox,
+                         hgroup):
+    """
+    Same as sampleHRF_voxelwise_iid with Q = StLambdaS + R/rh and
+    m = StLambdaY + R*hgroup/rh.
+    """
+    logHRFPosteriorParams(stLambdaS, varR, rh)
 
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    return sample_gaussian(stLambdaS + varR / rh,
+                           stLambdaY + np.dot(varR, hgroup) / rh)
 
 
 ######################
@@ -1257,9 +1207,8 @@ class HRF_Group_Sampler(GibbsSamplerVariable):
 
         h_on_rh = hrf_subj.sum(0) / sum_vh_subj
 
-        mean_h = np.linalg.solve(varInvSigma_h, np.dot(shrf.varR, h_on_rh))
-        sigma_h = np.linalg.inv(varInvSigma_h)
-        self.currentValue = np.random.multivariate_normal(mean_h, sigma_h)
+        self.currentValue = sample_gaussian(varInvSigma_h,
+                                            np.dot(shrf.varR, h_on_rh))
 
         self.updateNorm()
 
@@ -2134,16 +2083,33 @@ class BOLDSampler_MultiSujInput:
         self.onsets = [onsets[cn] for cn in self.cNames]
         durations = data[0].paradigm.stimDurations
         self.durations = [durations[cn] for cn in self.cNames]
+
+        # design matrices are the same for all ROIs of a treatment:
+        design_key = design_cache.make_key(
+            '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            self.cNames, self.onsets, self.durations, self.tr, self.nySubj,
+            self.ny, dt, hrfZc, hrfDuration, typeLFD, paramLFD)
+        design_cache.setup(self, design_key,
+                           lambda: self.buildDesign(dt, typeLFD, paramLFD,
+                                                    hrfZc, hrfDuration))
+
+        logger.info('Making precalculcations ...')
+        self.makePrecalculations()
+
+    def buildDesign(self, dt, typeLFD, paramLFD, hrfZc, hrfDuration):
+        """
+        Build the structures that only depend on the paradigm, TR, dt, HRF
+        and drift settings (see pyhrf.jde.models.BOLDSamplerInput.buildDesign)
+        """
         self.chewUpOnsets(dt, hrfZc, hrfDuration)
 
         # Build matrices related to low frequency drift
         logger.info('Building LFD mats %% ...')
         self.setLFDMat(paramLFD, typeLFD)
 
-        logger.info('Making precalculcations ...')
-        self.makePrecalculations()
+        self.makeDesignPrecalculations()
 
-    def makePrecalculations(self):
+    def makeDesignPrecalculations(self):
         # XQX & XQ:
         self.matXQX = np.zeros((self.nbConditions, self.nbConditions,
                                 self.nbColX, self.nbColX), dtype=float)
@@ -2156,6 +2122,15 @@ class BOLDSampler_MultiSujInput:
             for k in xrange(self.nbConditions):
                 self.matXQX[j, k, :, :] = np.dot(self.matXQ[j, :, :],
                                                  self.varX[k, :, :])
+
+        self.matXtX = np.zeros((self.nbConditions, self.nbConditions,
+                                self.nbColX, self.nbColX), dtype=float)
+        for j in xrange(self.nbConditions):
+            for k in xrange(self.nbConditions):
+                self.matXtX[j, k, :, :] = np.dot(self.varX[j, :, :].transpose(),
+                                                 self.varX[k, :, :])
+
+    def makePrecalculations(self):
         # Qy, yTQ & yTQy  :
         self.matQy = np.zeros((self.nySubj[0], self.nbVoxels), dtype=float)
         self.yTQ = np.zeros((self.nySubj[0], self.nbVoxels), dtype=float)
@@ -2167,13 +2142,6 @@ class BOLDSampler_MultiSujInput:
                 self.yTQ[:, i] = np.dot(self.varMBY[s, :, i], self.delta)
                 self.yTQy[i] = np.dot(self.varMBY[s, :, i], self.matQy[:, i])
 
-        self.matXtX = np.zeros((self.nbConditions, self.nbConditions,
-                                self.nbColX, self.nbColX), dtype=float)
-        for j in xrange(self.nbConditions):
-            for k in xrange(self.nbConditions):
-                self.matXtX[j, k, :, :] = np.dot(self.varX[j, :, :].transpose(),
-                                                 self.varX[k, :, :])
-
     # def makePrecalculations(self):
         # XQX & XQ:
         # XQX=[]
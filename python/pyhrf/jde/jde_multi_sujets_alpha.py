@@ -26,6 +26,7 @@ from pyhrf.jde.intensivecalc import sample_potts
 from pyhrf.ndarray import xndarray, stack_cuboids
 from pyhrf.jde.samplerbase import GibbsSampler, GibbsSamplerVariable
 from pyhrf.tools import get_2Dtable_string
+from pyhrf.stats.random import sample_gaussian
 
 
 logger = logging.getLogger(__name__)
@@ -322,19 +323,10 @@ def sampleHRF_voxelwise_iid(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox,
 
     if only_hrf_subj:
         # do not ponderate hrfgroup because it is at zero
-        mean_h = np.linalg.solve(varInvSigma_h, stLambdaY)
+        return sample_gaussian(varInvSigma_h, stLambdaY)
     else:
-        mean_h = np.linalg.solve(
-            varInvSigma_h, stLambdaY + nbsubj * hgroup / rh)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+        return sample_gaussian(varInvSigma_h,
+                               stLambdaY + nbsubj * hgroup / rh)
 
 
 def sampleHRF_single_hrf_hack(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox, hgroup):
@@ -350,16 +342,7 @@ def sampleHRF_single_hrf_hack(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox, hgr
 
     # if hrf subject NOT regularized
     varInvSigma_h += np.eye(varR.shape[0]) / rh
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY / nbVox + hgroup / rh)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    return sample_gaussian(varInvSigma_h, stLambdaY / nbVox + hgroup / rh)
 
 
 def sampleHRF_single_hrf(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox, hgroup, reg):
@@ -383,17 +366,7 @@ def sampleHRF_single_hrf(stLambdaS, stLambdaY, varR, rh, nbColX, nbVox, hgroup,
         # if hrf subject NOT regularized
         varInvSigma_h += np.eye(varR.shape[0]) / rh
 
-    mean_h = np.linalg.solve(varInvSigma_h, stLambdaY + hgroup / rh)
-
-    if 0:
-        choleskyInvSigma_h = np.linalg.cholesky(varInvSigma_h).transpose()
-
-        hrf = np.linalg.solve(choleskyInvSigma_h, np.random.randn(nbColX))
-        hrf += mean_h
-    else:
-        hrf = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
-    return hrf
+    return sample_gaussian(varInvSigma_h, stLambdaY + hgroup / rh)
 
 
 ######################
@@ -1415,9 +1388,8 @@ class HRF_Group_Sampler(xmlio.XmlInitable, GibbsSamplerVariable):
         # print h_on_rhxalph.sum(0)
         # print varInvSigma_h
         # print hs_1alph_on_rh.sum(0)
-        mean_h = np.linalg.solve(varInvSigma_h, hs_1alph_on_rh.sum(0))
-        self.currentValue = np.random.multivariate_normal(
-            mean_h, np.linalg.inv(varInvSigma_h))
+        self.currentValue = sample_gaussian(varInvSigma_h,
+                                            hs_1alph_on_rh.sum(0))
 
         self.updateNorm()
 
@@ -19,6 +19,7 @@ from pyhrf.jde.beta import *
 from pyhrf.jde.wsampler import *
 from pyhrf.jde.nrl.bigaussian import *
 from pyhrf.jde.nrl.bigaussian_drift import *
+from pyhrf.jde.design import design_cache
 from pyhrf.tools.misc import Pipeline, diagBlock
 
 
@@ -166,14 +167,36 @@ class BOLDSamplerInput:
         self.onsets = [onsets[cn] for cn in self.cNames]
         durations = data.paradigm.get_joined_durations()
         self.durations = [durations[cn] for cn in self.cNames]
+
+        # design matrices are the same for all ROIs of a treatment:
+        design_key = design_cache.make_key(
+            '%s.%s' % (self.__class__.__module__, self.__class__.__name__),
+            self.cNames, self.onsets, self.durations, self.tr, self.nys,
+            self.ny, dt, hrfZc, hrfDuration, typeLFD, paramLFD)
+        design_cache.setup(self, design_key,
+                           lambda: self.buildDesign(dt, typeLFD, paramLFD,
+                                                    hrfZc, hrfDuration))
+
+        logger.info('Making precalculcations ...')
+        self.makePrecalculations()
+
+    def buildDesign(self, dt, typeLFD, paramLFD, hrfZc, hrfDuration):
+        """
+        Build the structures that only depend on the paradigm, TR, dt, HRF
+        and drift settings: convolution matrices, drift basis and
+        precalculations of makeDesignPrecalculations. They are shared by all
+        ROIs through pyhrf.jde.design.design_cache and must not be modified.
+        """
         self.chewUpOnsets(dt, hrfZc, hrfDuration)
 
         # Build matrices related to low frequency drift
         logger.info('Building LFD mats ...')
         self.setLFDMat(paramLFD, typeLFD)
 
-        logger.info('Making precalculcations ...')
-        self.makePrecalculations()
+        self.makeDesignPrecalculations()
+
+    def makeDesignPrecalculations(self):
+        pass
 
     def makePrecalculations(self):
         pass
@@ -523,7 +546,7 @@ class BOLDSamplerInput:
 
 class WN_BiG_BOLDSamplerInput(BOLDSamplerInput):
 
-    def makePrecalculations(self):
+    def makeDesignPrecalculations(self):
         # XQX & XQ:
         self.matXQX = np.zeros((self.nbConditions, self.nbConditions,
                                 self.nbColX, self.nbColX), dtype=float)
@@ -538,6 +561,8 @@ class WN_BiG_BOLDSamplerInput(BOLDSamplerInput):
             for k in xrange(self.nbConditions):
                 self.matXQX[j, k, :, :] = np.dot(self.matXQ[j, :, :],
                                                  self.varX[k, :, :])
+
+    def makePrecalculations(self):
         # Qy, yTQ & yTQy  :
         self.matQy = np.zeros((self.ny, self.nbVoxels), dtype=float)
         self.yTQ = np.zeros((self.ny, self.nbVoxels), dtype=float)
@@ -559,7 +584,7 @@ class WN_BiG_BOLDSamplerInput(BOLDSamplerInput):
 
 class WN_BiG_Drift_BOLDSamplerInput(BOLDSamplerInput):
 
-    def makePrecalculations(self):
+    def makeDesignPrecalculations(self):
         # XQX & XQ:
         self.matXtX = np.zeros((self.nbConditions, self.nbConditions,
                                 self.nbColX, self.nbColX), dtype=float)
@@ -601,20 +626,6 @@ class ARN_BiG_BOLDSamplerInput(BOLDSamplerInput):
 class Hab_WN_BiG_BOLDSamplerInput(WN_BiG_BOLDSamplerInput):
 
     def makePrecalculations(self):
-        self.matXQX = np.zeros((self.nbConditions, self.nbConditions,
-                                self.nbColX, self.nbColX), dtype=float)
-        self.matXQ = np.zeros((self.nbConditions, self.nbColX, self.ny),
-                              dtype=float)
-
-        for j in xrange(self.nbConditions):
-            # print 'self.varX :', self.varX[j,:,:].transpose().shape
-            # print 'self.delta :', self.delta.shape
-            self.matXQ[j, :, :] = np.dot(self.varX[j, :, :].transpose(),
-                                         self.delta)
-            for k in xrange(self.nbConditions):
-                self.matXQX[j, k, :, :] = np.dot(self.matXQ[j, :, :],
-                                                 self.varX[k, :, :])
-
         # Qy, yTQ & yTQy  :
         self.matQy = np.zeros((self.ny, self.nbVoxels), dtype=float)
         self.yTQ = np.zeros((self.ny, self.nbVoxels), dtype=float)
@@ -1096,7 +1107,18 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
         'If x>=1: define the step in iterations number between saved '
         ' samples.\n'
         'If x=1: save samples at each iteration.',
-        'obs_hist_pace': 'See comment for samplesHistoryPaceSave.'
+        'obs_hist_pace': 'See comment for samplesHistoryPaceSave.',
+        'fit_hist_pace': 'Pace (in iterations) at which the reconstruction '
+        'error and the log-likelihood are evaluated.\n'
+        'If x<0: only evaluated at the end of sampling (for the BIC).\n'
+        'If 0<x<1: define the fraction of iterations.',
+        'stop_crit_rhat': 'Adaptive burn-in and stopping: the burn-in period '
+        'ends when the split-chain R-hat of the HRF and NRLs is below this '
+        'threshold. The sampling ends when it is again below the '
+        'threshold after burn-in.\nIf x<0: not used.',
+        'stop_crit_ess': 'Adaptive stopping: the sampling ends when the '
+        'effective sample size of each HRF coefficient and NRL after '
+        'burn-in is above this threshold.\nIf x<0: not used.',
     }
 
     def __init__(self, nb_iterations=default_nb_its,
@@ -1108,9 +1130,16 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
                  hrf_var=RHSampler(), mixt_weights=MixtureWeightsSampler(),
                  mixt_params=BiGaussMixtureParamsSampler(), scale=ScaleSampler(),
                  stop_crit_threshold=-1, stop_crit_from_start=False,
-                 check_final_value=None):
+                 check_final_value=None, fit_hist_pace=1,
+                 stop_crit_rhat=-1., stop_crit_ess=-1.,
+                 stop_crit_pace=10):
         """
         check_final_value: None, 'print' or 'raise'
+
+        stop_crit_rhat, stop_crit_ess: thresholds of the adaptive burn-in and
+        stopping (see ConvergenceMonitor), checked every stop_crit_pace
+        iterations. The burnin and nb_iterations parameters are then upper
+        bounds.
         """
         # print 'param:', parameters
         xmlio.XmlInitable.__init__(self)
@@ -1135,6 +1164,10 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
         if smplHistPace > 0. and smplHistPace < 1.:
             smplHistPace = max(1, int(round(nbIt * smplHistPace)))
 
+        fitHistPace = fit_hist_pace
+        if fitHistPace > 0. and fitHistPace < 1.:
+            fitHistPace = max(1, int(round(nbIt * fitHistPace)))
+
         if nbSweeps > 0. and nbSweeps < 1.:
             nbSweeps = int(round(nbIt * nbSweeps))
 
@@ -1151,7 +1184,14 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
                               obsHistPace, nbSweeps,
                               callbackObj,
                               globalObsHistoryPace=globalObsHistPace,
-                              check_ftval=check_ftval)
+                              check_ftval=check_ftval,
+                              fitHistoryPace=int(fitHistPace))
+
+        if stop_crit_rhat >= 0. or stop_crit_ess >= 0.:
+            self.convergence_monitor = \
+                ConvergenceMonitor(['hrf', 'nrl'], max_rhat=stop_crit_rhat,
+                                   min_ess=stop_crit_ess,
+                                   check_pace=stop_crit_pace)
 
         # self.buildSharedDataTree()
 
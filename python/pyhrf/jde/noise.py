@@ -6,6 +6,7 @@ import numpy as np
 
 from pyhrf.jde.samplerbase import *
 from pyhrf import xmlio
+from pyhrf.stats.random import quadratic_forms, sample_noise_variances
 
 
 logger = logging.getLogger(__name__)
@@ -177,9 +178,8 @@ class NoiseVarianceSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
         else:
             y_tilde = self.samplerEngine.get_variable('nrl').varYtilde
-            for i in xrange(self.nbVox):
-                varYtildeTdelta = np.dot(y_tilde[:, i], self.dataInput.delta)
-                self.beta[i] = 0.5 * np.dot(varYtildeTdelta, y_tilde[:, i])
+            self.beta[:] = 0.5 * quadratic_forms(y_tilde,
+                                                 self.dataInput.delta)
         logger.debug('All betas apost :')
         logger.debug(self.beta)
         logger.info('betas apost = %1.3f(%1.3f)', self.beta.mean(),
@@ -252,9 +252,7 @@ class NoiseVarianceSamplerWithRelVar(NoiseVarianceSampler):
         aaww = aa * ww
         aawwXhQXh = (aaww * self.mXhQXh).sum(1).sum(1)
 
-        for i in xrange(self.nbVox):
-            self.beta[i] = .5 * (yTQy[i] - 2 * np.dot(swaXh[:, i], matQy[:, i])
-                                 + aawwXhQXh[i])
+        self.beta[:] = .5 * (yTQy - 2 * (swaXh * matQy).sum(0) + aawwXhQXh)
 
         logger.debug('All betas apost :')
         logger.debug(self.beta)
@@ -315,15 +313,9 @@ class NoiseVariancewithHabSampler(NoiseVarianceSampler):
         yTQy = self.dataInput.yTQy
         matQy = self.dataInput.matQy
 
-        for i in xrange(self.nbVox):
-            aaXhQXhi = 0.0
-            for j in xrange(self.nbConditions):
-                for k in xrange(self.nbConditions):
-                    aaXhQXhi += np.dot(np.dot(aXh[:, i, j],
-                                              self.dataInput.delta), aXh[:, i, k])
-
-            self.beta[i] = .5 * (yTQy[i] - 2 * np.dot(saXh[:, i], matQy[:, i])
-                                 + aaXhQXhi)
+        # sum_{j,k} (a_j Xh)^t Q (a_k Xh) = (sum_j a_j Xh)^t Q (sum_k a_k Xh)
+        aaXhQXh = quadratic_forms(aXh.sum(2), self.dataInput.delta)
+        self.beta[:] = .5 * (yTQy - 2 * (saXh * matQy).sum(0) + aaXhQXh)
 
         logger.debug('All betas apost :')
         logger.debug(self.beta)
@@ -331,10 +323,8 @@ class NoiseVariancewithHabSampler(NoiseVarianceSampler):
                      self.beta.std())
 
         a = 0.5 * (self.ny - self.dataInput.colP + 1)
-        gammaSamples = np.random.gamma(a, 1, self.nbVox)
-
         logger.debug('sigma2 ~betas/Ga(%1.3f,1)', a)
-        self.currentValue = np.divide(self.beta, gammaSamples)
+        self.currentValue = sample_noise_variances(self.beta, a)
 
         logger.debug('All noise vars :')
         logger.debug(self.currentValue)
@@ -357,10 +347,7 @@ class NoiseVarianceARSampler(NoiseVarianceSampler):
         self.varYTilde = np.empty((self.ny, self.nbVox), dtype=float)
 
     def computeVarYTilde(self, varNrls, varXh, varMBYPl):
-        for v in xrange(self.nbVox):
-            repNRLv = np.tile(varNrls[:, v], (self.ny, 1))
-            avjXjh = repNRLv * varXh
-            self.varYTilde[:, v] = varMBYPl[:, v] - avjXjh.sum(axis=1)
+        self.varYTilde[:] = varMBYPl - np.dot(varXh, varNrls)
 
     def sampleNextInternal(self, variables):
         # TODO : comment
@@ -375,15 +362,12 @@ class NoiseVarianceARSampler(NoiseVarianceSampler):
         varNRLs = smplNRL.currentValue
         self.computeVarYTilde(varNRLs, varXh, varMBYPl)
 
-        for i in xrange(self.nbVox):
-            varYtildeTdelta = np.dot(
-                self.varYTilde[:, i], InvAutoCorrNoise[:, :, i])
-            self.beta[i] = 0.5 * np.dot(varYtildeTdelta, self.varYTilde[:, i])
+        self.beta[:] = 0.5 * quadratic_forms(self.varYTilde, InvAutoCorrNoise)
         logger.debug('betas apost :')
         logger.debug(np.array2string(self.beta, precision=3))
         logger.debug('sigma2 ~betas/Ga(%1.3f,1)', 0.5 * (self.ny + 1))
-        gammaSamples = np.random.gamma(0.5 * (self.ny + 1), 1, self.nbVox)
-        self.currentValue = np.divide(self.beta, gammaSamples)
+        self.currentValue = sample_noise_variances(self.beta,
+                                                   0.5 * (self.ny + 1))
         logger.debug('All noise vars :')
         logger.debug(np.array2string(self.currentValue, precision=3))
         logger.info('noise vars = %1.3f(%1.3f)', self.currentValue.mean(),
@@ -500,15 +484,14 @@ class NoiseARParamsSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         logger.debug('ARp :')
         logger.debug(ARp)
 
-        for v in xrange(self.nbVox):
-            DiagAutoCorr = np.repeat(1 + ARp[v] ** 2, self.ny - 2)
-            DiagAutoCorr = np.concatenate(([1], DiagAutoCorr, [1]))
-            InvAutoCorrMatrix = np.diag(DiagAutoCorr, k=0)
-
-            DiagInfAutoCorr = np.repeat(-ARp[v], self.ny - 1)
-            InvAutoCorrMatrix += np.diag(DiagInfAutoCorr, k=1)
-            InvAutoCorrMatrix += np.diag(DiagInfAutoCorr, k=-1)
-            self.InvAutoCorrNoise[:, :, v] = InvAutoCorrMatrix
+        # tridiagonal inverse autocorrelation matrices of all voxels:
+        idx = np.arange(self.ny)
+        self.InvAutoCorrNoise[:] = 0.
+        self.InvAutoCorrNoise[idx[1:-1], idx[1:-1], :] = 1 + ARp ** 2
+        self.InvAutoCorrNoise[0, 0, :] = 1.
+        self.InvAutoCorrNoise[-1, -1, :] = 1.
+        self.InvAutoCorrNoise[idx[:-1], idx[1:], :] = -ARp
+        self.InvAutoCorrNoise[idx[1:], idx[:-1], :] = -ARp
 
         logger.debug('InvAutoCorrNoise :')
         logger.debug(self.InvAutoCorrNoise[:, :, 0])
@@ -18,6 +18,7 @@ from pyhrf.jde.intensivecalc import (sampleSmmNrlWithRelVar,
 from pyhrf.jde.samplerbase import *
 from pyhrf.jde.beta import *
 from pyhrf.boldsynth.spatialconfig import hashMask
+from pyhrf.graph import graph_coloring
 from pyhrf.jde.nrl.base import *
 from pyhrf.tools.aexpression import ArithmeticExpression as AExpr
 from pyhrf.tools.aexpression import (ArithmeticExpressionNameError,
@@ -45,6 +46,9 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         'contrasts': 'Define contrasts as arithmetic expressions.\n'
         'Condition names used in expressions must be consistent with '
         'those specified in session data above',
+        'chromatic_sampling': 'Sample NRLs and labels of the spatial model '
+        'by colour blocks of the ROI graph (vectorised) instead of visiting '
+        'voxels one at a time',
     }
 
     # other class attributes
@@ -64,7 +68,7 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
                  ppm_proba_threshold=0.05, ppm_value_threshold=0,
                  ppm_value_multi_threshold=np.arange(0., 4.1, 0.1),
                  mean_activation_threshold=4, rescale_results=False,
-                 wip_variance_computation=False):
+                 wip_variance_computation=False, chromatic_sampling=False):
 
         # TODO : comment
         xmlio.XmlInitable.__init__(self)
@@ -100,6 +104,8 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         self.ppm_value_thresh = ppm_value_threshold
         self.ppm_value_multi_thresh = ppm_value_multi_threshold
         self.rescale_results = rescale_results
+        self.chromatic_sampling = chromatic_sampling
+        self.colorBlocks = None
 
     def linkToData(self, dataInput):
         self.dataInput = dataInput
@@ -107,6 +113,8 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         self.nbVox = self.dataInput.nbVoxels
         self.ny = self.dataInput.ny
         self.nbSessions = self.dataInput.nbSessions
+        # colour blocks depend on the graph of the ROI:
+        self.colorBlocks = None
         self.cardClass = np.zeros(
             (self.nbClasses, self.nbConditions), dtype=int)
         self.voxIdx = [range(self.nbConditions)
@@ -639,22 +647,16 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
     def saveObservables(self, it):
         GibbsSamplerVariable.saveObservables(self, it)
-        if self.labelsMeanHistory is not None:
-            self.labelsMeanHistory = np.concatenate((self.labelsMeanHistory,
-                                                     [self.meanLabels]))
-        else:
-            self.labelsMeanHistory = np.array([self.meanLabels.copy()])
+        self._append_history('labelsMeanHistory', self.meanLabels,
+                             self.samplerEngine.obsHistoryPace)
 
         # print 'save trucs'
 
     def saveCurrentValue(self, it):
         # print 'self.labels', self.labels
         GibbsSamplerVariable.saveCurrentValue(self, it)
-        if self.labelsSmplHistory is not None:
-            self.labelsSmplHistory = np.concatenate((self.labelsSmplHistory,
-                                                     [self.labels]))
-        else:
-            self.labelsSmplHistory = np.array([self.labels.copy()])
+        self._append_history('labelsSmplHistory', self.labels,
+                             self.samplerEngine.smplHistoryPace)
 
     def cleanObservables(self):
         GibbsSamplerVariable.cleanObservables(self)
@@ -863,6 +865,101 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
         self.countLabels(self.labels, self.voxIdx, self.cardClass)
 
+    def sampleNrlsChromatic(self, gTQg, variables):
+        """
+        Same sampling scheme as sampleNrlsSerial but voxels are updated by
+        colour blocks of the ROI graph. Voxels of the same colour are not
+        neighbours, so that they are conditionally independent given the labels
+        of the other colours and can be drawn all at once.
+        """
+        logger.info('Sampling Nrls (chromatic, spatial prior) ...')
+        logger.info('Label sampling: %s', str(self.sampleLabelsFlag))
+        sIMixtP = self.get_variable('mixt_params')
+        var = sIMixtP.getCurrentVars()
+        mean = sIMixtP.getCurrentMeans()
+        rb = self.get_variable('noise_var').currentValue
+        varXh = self.get_variable('hrf').varXh
+        beta = self.get_variable('beta').currentValue
+        neighbours = self.dataInput.neighboursIndexes
+
+        if self.colorBlocks is None:
+            self.colorBlocks = graph_coloring(neighbours)
+
+        nrls = self.currentValue
+        for j in xrange(self.nbConditions):
+            xhj = varXh[:, j, np.newaxis]
+            # posterior variances do not depend on the other voxels:
+            vApost = 1. / (1. / var[:, j, np.newaxis] + gTQg[j] / rb)
+            sApost = vApost ** .5
+            priorTerm = mean[:, j, np.newaxis] ** 2 / var[:, j, np.newaxis]
+            for vox in self.colorBlocks:
+                ej = self.varYtilde[:, vox] + nrls[j, vox] * xhj
+                varXjhtQjej = np.dot(self.varXhtQ[j, :], ej) / rb[vox]
+                mApost = vApost[:, vox] * (mean[:, j, np.newaxis] /
+                                           var[:, j, np.newaxis] +
+                                           varXjhtQjej)
+                self.meanClassApost[:, j, vox] = mApost
+                self.varClassApost[:, j, vox] = np.maximum(vApost[:, vox],
+                                                           1e-8)
+
+                if self.sampleLabelsFlag:
+                    self.labels[j, vox] = self.sampleLabelsBlock(
+                        j, vox, beta[j], neighbours, mApost, vApost[:, vox],
+                        sApost[:, vox], priorTerm, var[:, j])
+
+                lab = self.labels[j, vox]
+                ivox = np.arange(len(vox))
+                newNrls = sApost[lab, vox] * self.nrlsSamples[j, vox] + \
+                    mApost[lab, ivox]
+                self.varYtilde[:, vox] += (nrls[j, vox] - newNrls) * xhj
+                nrls[j, vox] = newNrls
+
+        if (self.varClassApost <= 0).any():
+            raise Exception('Negative posterior variances!')
+
+        self.countLabels(self.labels, self.voxIdx, self.cardClass)
+
+    def sampleLabelsBlock(self, cond, vox, beta, neighbours, mApost, vApost,
+                          sApost, priorTerm, var):
+        """
+        Sample the labels of a block of voxels which are not neighbours of
+        each other (see sampleNrlsChromatic).
+        Return the array of new labels for voxels in 'vox'.
+        """
+        nl = neighbours[vox]
+        nlLabels = self.labels[cond, nl]
+        nCount = np.array([((nlLabels == c) & (nl >= 0)).sum(1)
+                           for c in xrange(self.nbClasses)])
+
+        def ratio_lambda(l1, l2):
+            # saturated ratios are fine: they give a posterior label proba
+            # of 0 or 1, as in the C implementation
+            with np.errstate(over='ignore', under='ignore'):
+                return (var[l2] / var[l1]) ** .5 * sApost[l1] / sApost[l2] * \
+                    np.exp(.5 * (mApost[l1] ** 2 / vApost[l1] -
+                                 mApost[l2] ** 2 / vApost[l2] -
+                                 priorTerm[l1] + priorTerm[l2]) +
+                           beta * (nCount[l1] - nCount[l2]))
+
+        L_CI, L_CA = self.L_CI, self.L_CA
+        rl_I_A = ratio_lambda(L_CI, L_CA)
+        if self.nbClasses == 2:
+            lApost = [1. - 1. / (1. + rl_I_A)]
+        else:
+            L_CD = self.L_CD
+            lApostD = 1. / (1. + ratio_lambda(L_CI, L_CD) +
+                            ratio_lambda(L_CA, L_CD))
+            lApostI = 1. - 1. / (1. + rl_I_A + ratio_lambda(L_CD, L_CA)) - \
+                lApostD
+            lApost = [lApostI, 1. - lApostD - lApostI]
+
+        u = self.labelsSamples[cond, vox]
+        labels = np.zeros(len(vox), dtype=self.labels.dtype) + \
+            (self.nbClasses - 1)
+        for c in xrange(self.nbClasses - 1):
+            labels[u <= lApost[c]] = c
+        return labels
+
 # TODO: rewrite the following function to use logging module
     def printState(self, verboseLevel):
         if pyhrf.verbose.verbosity >= verboseLevel:
@@ -938,6 +1035,9 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         if self.imm:
             self.sampleNrlsParallel(varXh, rb, h, varLambda, varCI,
                                     varCA, meanCA, gTQg, variables)
+        elif self.chromatic_sampling:  # MMS, colour blocks
+            self.sampleNrlsChromatic(gTQg, variables)
+            self.computeVarYTildeOpt(varXh)
         else:  # MMS
             self.sampleNrlsSerial(rb, h, varCI, varCA, meanCA, gTQg, variables)
             self.computeVarYTildeOpt(varXh)
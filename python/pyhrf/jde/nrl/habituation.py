@@ -12,6 +12,7 @@ from pyhrf.ndarray import xndarray
 from pyhrf.jde.samplerbase import *
 from pyhrf.jde.nrl.bigaussian import NRLSampler
 from pyhrf.jde.intensivecalc import sampleSmmNrl
+from pyhrf.stats.random import quadratic_forms
 
 logger = logging.getLogger(__name__)
 
@@ -108,21 +109,14 @@ class NRLwithHabSampler(NRLSampler):
         self.lastonset = int(self.lastonset + 1)
         # print self.lastonset
 
-        # determination du nbGammas utile dans spExtract -> mais il y a une
-        # erreur pour Xmask (dans sparsedot
-        self.nbGammas = range(self.nbConditions)
-        self.nnulls = range(self.nbConditions)
-        self.Xmask = range(self.nbConditions)
+        # flat indexes (trial, scan) of the design entries, used to compute
+        # the regressors of all trials at once (see trialRegressors)
+        self.trialBins = range(self.nbConditions)
         for nc in xrange(self.nbConditions):
-            self.Xmask[nc] = range(self.nbTrials[nc])
-            self.nbGammas[nc] = zeros(self.nbTrials[nc], dtype=int)
-            self.nnulls[nc] = zeros(
-                (self.varSingleCondXtrials[nc, :, :] == 0).sum())
-            for i in xrange(self.nbTrials[nc]):
-                #self.nbGammas[j][i] = (self.varSingleCondXtrials[j,:,:] == (i + 1)).sum()
-                self.Xmask[nc][i] = transpose(
-                    where(self.varSingleCondXtrials[nc, :, :] == (i + 1)))
-                self.nbGammas[nc][i] = shape(self.Xmask[nc][i])[0]
+            trialX = self.varSingleCondXtrials[nc, :, :]
+            ny = trialX.shape[0]
+            self.trialBins[nc] = (trialX * ny +
+                                  arange(ny)[:, newaxis]).ravel()
 
         logger.info('deltaOns :')
         logger.info(self.deltaOns)
@@ -290,41 +284,35 @@ class NRLwithHabSampler(NRLSampler):
         self.iteration = 0
 
     def updateXh(self, varHRF):
-        temp = empty((self.nbVox, self.nbConditions), dtype=float)
+        # X_tilde h = sum_t gamma_t X_t h: the habituation-modulated
+        # regressors of all voxels are combinations of the trial regressors
         self.sumaX = zeros((self.ny, self.nh, self.nbVox), dtype=float)
-        #self.sumaXQ = zeros((self.ny,self.nh , self.nbVox), dtype = float)
-        for nv in xrange(self.nbVox):
-            for nc in xrange(self.nbConditions):
-                self.updateGammaTimeNRLs(nc, nv)
-                Xtilde = self.spExtract(
-                    self.Gamma[nc][nv, :], self.varSingleCondXtrials[nc, :, :], nc)
-                aXtilde = self.spExtract(
-                    self.timeNrls[nc][nv, :], self.varSingleCondXtrials[nc, :, :], nc)
-                self.sumaX[:, :, nv] += Xtilde
-                self.varXh[nv, :, nc] = dot(Xtilde, varHRF)
-
-                # ici, j ai fait un essai avec sparsedot, mais ca ne marche pas...
-                #Xhtemp = zeros(self.ny, dtype = float)
-                #aXhtemp = zeros(self.ny, dtype = float)
-                # for t in xrange(self.nbTrials[nc]):
-                #Xhtemp += sparsedotdimun(self.Gamma[nc][nv,t], varHRF, self.Xmask[nc][t], self.ny)
-                #aXhtemp += sparsedotdimun(self.timeNrls[nc][nv,t], varHRF, self.Xmask[nc][t], self.ny)
-                ##self.sumaXQ[:,:,nv] += sparsedot(self.timeNrls[nc][nv,t], self.dataInput.delta, self.Xmask[nc][t], (self.ny, self.nh))
-                #self.varXh[nv,:,nc]= Xhtemp
-
-                self.aXh[:, nv, nc] = dot(aXtilde, varHRF)
-                #self.aXh[:,nv,nc] = aXhtemp
-
-                temp[nv, nc] = dot(
-                    dot(self.aXh[:, nv, nc], self.dataInput.delta), self.aXh[:, nv, nc])
-
-                #aXQaX = zeros((self.nh, self.nh), dtype=float)
-                ##aXQaX = self.bilinearsparsedot(self.timeNrls[nc][nv,:], self.dataInput.delta, self.nh, nc)
-                #temp[nv,nc] = dot(dot(varHRF, aXQaX), varHRF)
+        self.sumaXhtQaXh = zeros(self.nbVox, dtype=float)
+        for nc in xrange(self.nbConditions):
+            self.updateGammaTimeNRLs(nc)
+            trialXh = self.trialRegressors(nc, varHRF)
+            Xtilde = self.spExtract(self.Gamma[nc],
+                                    self.varSingleCondXtrials[nc, :, :], nc)
+            self.sumaX += rollaxis(Xtilde, 0, 3)
+            self.varXh[:, :, nc] = dot(self.Gamma[nc], trialXh)
+            self.aXh[:, :, nc] = dot(self.timeNrls[nc], trialXh).T
+            self.sumaXhtQaXh += quadratic_forms(self.aXh[:, :, nc],
+                                                self.dataInput.delta)
 
         # utile pour noise.py
-        self.sumaXh = sum(self.aXh, axis=2)
-        self.sumaXhtQaXh = sum(temp, axis=1)
+        self.sumaXh = self.aXh.sum(2)
+
+    def trialRegressors(self, nc, varHRF):
+        """
+        Return the regressors X_t h of the trials t of condition *nc*, as an
+        array of shape (nbTrials, ny), X_t being the part of the design
+        matrix involving trial t.
+        """
+        nbTrials = self.nbTrials[nc]
+        ny = self.varSingleCondXtrials.shape[1]
+        xh = bincount(self.trialBins[nc], weights=tile(varHRF, ny),
+                      minlength=(nbTrials + 1) * ny)
+        return xh.reshape(nbTrials + 1, ny)[1:]
 
     # doit etre precede d un updateXh pour avoir sumaXh
     def updateYtilde(self):
@@ -339,20 +327,15 @@ class NRLwithHabSampler(NRLSampler):
                 (self.nbVox, self.nbTrials[nc]), dtype=float)
             self.Gamma[nc] = numpy.zeros(
                 (self.nbVox, self.nbTrials[nc]), dtype=float)
-            for nv in xrange(self.nbVox):
-                self.updateGammaTimeNRLs(nc, nv)
-
-    def updateGammaTimeNRLs(self, nc, nv):
+            self.updateGammaTimeNRLs(nc)
 
-        self.Gamma[nc][nv, 0] = 1.
-        self.timeNrls[nc][nv, 0] = self.currentValue[nc, nv]
-        skk = 0.
-        for k in xrange(1, self.nbTrials[nc]):
-            skk = (self.habits[nc, nv] ** self.deltaOns[nc]
-                   [k - 1]) * (skk + self.timeNrls[nc][nv, k - 1])
-            self.Gamma[nc][nv, k] = 1. / (1. + skk)
-            self.timeNrls[nc][nv, k] = self.Gamma[
-                nc][nv, k] * self.currentValue[nc, nv]
+    def updateGammaTimeNRLs(self, nc, nv=slice(None)):
+        """ Update habituation factors and time-varying NRLs of condition
+        *nc* in voxels *nv* (default: all voxels)
+        """
+        self.Gamma[nc][nv], self.timeNrls[nc][nv] = \
+            subcptGamma(self.currentValue[nc, nv], self.habits[nc, nv],
+                        self.nbTrials[nc], self.deltaOns[nc])
 
     def setupGamma(self):
         # lorsqu on connait les timeNRLs
@@ -382,10 +365,9 @@ class NRLwithHabSampler(NRLSampler):
         # for j in xrange(self.nbConditions):
         gTQgjrb = XhtQXh[:, j] / rb   # de taille nbVox
 
-        ej = self.varYtilde + \
-            repmat(nrls[j, :], self.ny, 1) * self.varXh[:, :, j].swapaxes(0, 1)
-        numpy.divide(
-            diag(dot(self.varXhtQ[:, j, :], ej)), rb, self.varXjhtQjeji)
+        ej = self.varYtilde + nrls[j, :] * self.varXh[:, :, j].T
+        numpy.divide((self.varXhtQ[:, j, :] * ej.T).sum(1), rb,
+                     self.varXjhtQjeji)
 
         # ici classe: 0 (inactif) ou 1 (actif)
         for c in xrange(self.nbClasses):
@@ -404,112 +386,93 @@ class NRLwithHabSampler(NRLSampler):
             logger.debug(self.meanClassApost[c, j, :])
 
     def habitCondSampler(self, j, rb, varHRF):
-
-        # Samples habituation factors
-        for i in xrange(self.nbVox):  # loops over voxels
-            # compute new voxel-dependant design matrix
-            # for j in xrange(self.nbConditions):## loops over conditions
-            logger.debug('Condition %i :', j)
-            if (self.labels[j, i] == 1):  # sampling the habituation factors
-                eji = self.varYtilde[:, i] + self.aXh[:, i, j]
-
-            # Generate a candidate for the habitutation parameter in voxel i
-            newHabit, KhabNew = LaplacianPdf(
-                self.Lexp, self.habits[j, i], 0., 1., 1)
+        """
+        Metropolis-Hastings step on the habituation speeds of condition *j*.
+        Given the NRLs and labels, voxels are independent: the candidates of
+        all active voxels are drawn at once from the truncated Laplacian law
+        and accepted or rejected voxel-wise. Inactive voxels get a null
+        habituation speed.
+        """
+        logger.debug('Condition %i :', j)
+        delta = self.dataInput.delta
+        active = where(self.labels[j, :] == 1)[0]
+        self.habits[j, self.labels[j, :] != 1] = 0.
+        trialXh = self.trialRegressors(j, varHRF)
+
+        if len(active) > 0:
+            habits = self.habits[j, active]
+            eji = self.varYtilde[:, active] + self.aXh[:, active, j]
+
+            # Generate candidates for the habituation parameters
+            newHabits, KhabNew = LaplacianPdf(self.Lexp, habits, 0., 1.)
 
             # pour afficher les courbes de ratio
             if self.keepSamples and self.outputRatio:
                 if (self.iteration % self.sampleHistoryPace) == 0:
-                    Dif2 = eji - self.aXh[:, i, j]
-                    # on calcule les ratio tous les 1/100
-                    for iii in range(100):
-                        ii = iii / 100.
-                        tirage = 0.
-                        vrai = 0.
-                        Gamma_ii, timeNrls_ii = subcptGamma(
-                            self.currentValue[j, i], ii, self.nbTrials[j], self.deltaOns[j][:])
-                        XsumWT_ii = self.spExtract(
-                            timeNrls_ii, self.varSingleCondXtrials[j], j)
-                        varG_ii = numpy.dot(XsumWT_ii, varHRF)
-                        XsumWTb_ii = self.spExtract(
-                            Gamma_ii, self.varSingleCondXtrials[j], j)
-                        varGb_ii = numpy.dot(XsumWTb_ii, varHRF)
-
-                        Dif1 = eji - varG_ii
-
-                        Dif12QDif12 = dot(dot(Dif1.transpose(), self.dataInput.delta), Dif1) - dot(
-                            dot(Dif2.transpose(), self.dataInput.delta), Dif2)
-                        #Dif12QDif12=dot(Dif1.transpose(),Dif1) - dot(Dif2.transpose(),Dif2)
-
-                        # probleme observe lorsque le ratio est trop grand
-                        if Dif12QDif12 / rb[i] > -1400.:
-                            Ratio1 = math.exp(-.5 * Dif12QDif12 / rb[i])
-                        else:
-                            Ratio1 = 1000000.
-                        Ratio2 = (2. - math.exp(-self.Lexp * self.habits[j, i]) - math.exp(self.Lexp * (
-                            self.habits[j, i] - 1.))) / (2. - math.exp(-self.Lexp * ii) - math.exp(self.Lexp * (ii - 1.)))
-                        if abs(ii - newHabit) < 0.005:
-                            tirage = min(Ratio1 * Ratio2, 1)
-
-                        if abs(ii - self.trueHabits[j, i]) < 0.005:
-                            vrai = 1.
-                        if abs(ii - self.habits[j, i]) < 0.005:
-                            vrai = 0.7
-
-                        self.ratiocourbe[j, i, iii, :] = [
-                            min(Ratio1, 10.), Ratio2, min(Ratio1 * Ratio2, 1), tirage, vrai]
-            # calcul gamma - habituation factor
-            GammaNew, timeNrlsNew = subcptGamma(
-                self.currentValue[j, i], newHabit, self.nbTrials[j], self.deltaOns[j][:])
-            # compute key quantities for the new candidate
-            XsumWT_x = self.spExtract(
-                timeNrlsNew, self.varSingleCondXtrials[j], j)
-            varG_x = numpy.dot(XsumWT_x, varHRF)
-            XsumWTb_x = self.spExtract(
-                GammaNew, self.varSingleCondXtrials[j], j)
-            varGb_x = numpy.dot(XsumWTb_x, varHRF)
-
-            Dif1 = eji - varG_x
-            Dif2 = eji - self.aXh[:, i, j]
-#           Dif2 = self.varYtilde[:,i]
-
-            #Dif12QDif12=dot(Dif1.transpose(),Dif1) - dot(Dif2.transpose(),Dif2)
-            Dif12QDif12 = dot(dot(Dif1.transpose(), self.dataInput.delta),
-                              Dif1) - dot(dot(Dif2.transpose(), self.dataInput.delta), Dif2)
-
-            # probleme observe lorsque le ratio est trop grand -> on tronque
-            # dans ce cas
-            if Dif12QDif12 / rb[i] > -1400.:
-                Ratio1 = math.exp(-.5 * Dif12QDif12 / rb[i])
-            else:
-                Ratio1 = 1000000.  # assure que Alpha = 1
+                    self.computeRatioCurves(j, active, eji, rb, newHabits,
+                                            trialXh)
 
-            Ratio2 = (2. - math.exp(-self.Lexp * self.habits[j, i]) - math.exp(self.Lexp * (self.habits[j, i] - 1.))) / (
-                2. - math.exp(-self.Lexp * newHabit) - math.exp(self.Lexp * (newHabit - 1.)))
-
-            # TODO pour gagner du temps -> prendre KhabNew issu de LaplacianPdf
-            # Ratio2 = self.Khab[j,i] / KhabNew   # probleme car KhabNew est en
-            # fait l'ancienne valeur
+            # calcul gamma - habituation factor
+            GammaNew, timeNrlsNew = subcptGamma(self.currentValue[j, active],
+                                                newHabits, self.nbTrials[j],
+                                                self.deltaOns[j])
+            # compute key quantities for the new candidates
+            Dif1 = eji - dot(timeNrlsNew, trialXh).T
+            Dif2 = eji - self.aXh[:, active, j]
+            Dif12QDif12 = quadratic_forms(Dif1, delta) - \
+                quadratic_forms(Dif2, delta)
+
+            Ratio1 = habitLikelihoodRatio(Dif12QDif12, rb[active])
+            Ratio2 = truncLaplacianConst(self.Lexp, habits, 0., 1.) / \
+                truncLaplacianConst(self.Lexp, newHabits, 0., 1.)
 
             # sauvegarde du ratio
             if self.outputRatio:
-                self.ratio[j, i, :] = [Ratio1, Ratio2]
-
-            # Compute the acceptation rate of the MH algo
-            Alpha = min(Ratio1 * Ratio2, 1)
-            u = numpy.random.rand()
-            if (u <= Alpha):
-                self.habits[j, i] = newHabit
-
-                # sauvegarde le nombre de fois que l'habituation a change
-                if self.keepSamples and self.outputRatio:
-                    self.compteur[j, i] += 1
+                self.ratio[j, active, 0] = Ratio1
+                self.ratio[j, active, 1] = Ratio2
 
-            self.updateGammaTimeNRLs(j, i)
+            # Compute the acceptation rates of the MH algo
+            Alpha = minimum(Ratio1 * Ratio2, 1)
+            accept = numpy.random.rand(len(active)) <= Alpha
+            self.habits[j, active[accept]] = newHabits[accept]
 
-        else:  # Inactiv voxel
-            self.habits[j, i] = 0.
-            self.updateGammaTimeNRLs(j, i)
+            # sauvegarde le nombre de fois que l'habituation a change
+            if self.keepSamples and self.outputRatio:
+                self.compteur[j, active[accept]] += 1
+
+        self.updateGammaTimeNRLs(j)
+        # residuals of the next conditions involve the new a X_tilde h
+        aXhj = dot(self.timeNrls[j], trialXh).T
+        self.varYtilde += self.aXh[:, :, j] - aXhj
+        self.aXh[:, :, j] = aXhj
+
+    def computeRatioCurves(self, j, active, eji, rb, newHabits, trialXh):
+        """ Compute the MH ratios of condition *j* in the voxels *active*
+        on a grid of 100 habituation speeds (diagnostic output)
+        """
+        delta = self.dataInput.delta
+        habits = self.habits[j, active]
+        Dif2QDif2 = quadratic_forms(eji - self.aXh[:, active, j], delta)
+        # on calcule les ratio tous les 1/100
+        for iii in range(100):
+            ii = iii / 100.
+            Gamma_ii, timeNrls_ii = subcptGamma(self.currentValue[j, active],
+                                                ii, self.nbTrials[j],
+                                                self.deltaOns[j])
+            Dif1 = eji - dot(timeNrls_ii, trialXh).T
+            Ratio1 = habitLikelihoodRatio(quadratic_forms(Dif1, delta) -
+                                          Dif2QDif2, rb[active])
+            Ratio2 = truncLaplacianConst(self.Lexp, habits, 0., 1.) / \
+                truncLaplacianConst(self.Lexp, ii, 0., 1.)
+            Ratio12 = minimum(Ratio1 * Ratio2, 1)
+            tirage = where(abs(ii - newHabits) < 0.005, Ratio12, 0.)
+            vrai = zeros(len(active), dtype=float)
+            if self.trueHabits is not None:
+                vrai[abs(ii - self.trueHabits[j, active]) < 0.005] = 1.
+            vrai[abs(ii - habits) < 0.005] = 0.7
+            self.ratiocourbe[j, active, iii, :] = \
+                transpose([minimum(Ratio1, 10.), Ratio2, Ratio12, tirage,
+                           vrai])
 
     def sampleNrlsSerial_bak(self, rb, h, varLambda, varCI, varCA,
                              meanCA, varXhtQXh, variables):
@@ -572,20 +535,23 @@ class NRLwithHabSampler(NRLSampler):
         pass
 
     def habitCondSamplerParallel(self, rb, h):
-        pass
+        for j in random.permutation(self.nbConditions):
+            self.habitCondSampler(j, rb, h)
 
     def habitCondSamplerSerial(self, rb, h):
-        pass
+        # habituation speeds do not depend on neighbouring voxels: all
+        # voxels are updated at once whatever the NRL sampling mode
+        self.habitCondSamplerParallel(rb, h)
 
     def computeVarYTildeHab(self, varXh):
-        # print 'varXh.shape:', varXh.shape
-        # print 'self.varYtilde:', self.varYtilde.shape
-        for i in xrange(self.nbVox):
-            repNRLi = repmat(self.currentValue[:, i], self.ny, 1)
-            aijXjh = repNRLi * varXh[i, :, :]
-            # print 'aijXjh:', aijXjh.shape
-            self.varYtilde[:, i] = self.dataInput.varMBY[
-                :, i] - aijXjh.sum(axis=1)
+        # yTilde_j = y_j - sum_m(a_j^m X_j^m h)
+        aXh = varXh * self.currentValue.T[:, newaxis, :]
+        self.varYtilde[:] = self.dataInput.varMBY - aXh.sum(2).T
+
+    def computeVarXhtQXh(self):
+        """ Return the array (nbVox, nbConditions) of (X_j^m h)^t Q X_j^m h
+        """
+        return (self.varXhtQ * self.varXh.swapaxes(1, 2)).sum(2)
 
     def computeVarYTildeHabOld(self, varXh):
         # yTilde_j = y_j - sum_m(a_j^m X^m h)
@@ -632,10 +598,7 @@ class NRLwithHabSampler(NRLSampler):
         self.labelsSamples = random.rand(self.nbConditions, self.nbVox)
         self.nrlsSamples = random.randn(self.nbConditions, self.nbVox)
 
-        varXhtQXh = zeros((self.nbVox, self.nbConditions), dtype=float)
-        for i in xrange(self.nbVox):
-            varXhtQXh[i, :] = diag(
-                dot(self.varXhtQ[i, :, :], self.varXh[i, :, :]))
+        varXhtQXh = self.computeVarXhtQXh()
 
         # Calcul des variables a post regroupe dans self.computeComponentsApost
         #self.computeLambdaAPost(varCI, varCA, varLambda)
@@ -647,6 +610,9 @@ class NRLwithHabSampler(NRLSampler):
             if self.sampleHabitFlag:
                 logger.info(
                     '(it %i) Habituation conditional sampling parallel mode ...')
+                # time-varying NRLs must follow the new NRLs before the MH step
+                self.updateXh(h)
+                self.updateYtilde()
                 self.habitCondSamplerParallel(rb, h)
                 self.computeVarYTildeHab(self.varXh)
         else:
@@ -656,6 +622,8 @@ class NRLwithHabSampler(NRLSampler):
             if self.sampleHabitFlag:
                 logger.info(
                     '(it %i) Habituation conditional sampling serial mode ...')
+                self.updateXh(h)
+                self.updateYtilde()
                 self.habitCondSamplerSerial(rb, h)
             self.saveSamples()
         self.updateXh(h)
@@ -696,10 +664,7 @@ class NRLwithHabSampler(NRLSampler):
         if self.sampleLabelsFlag:
             self.computeVarXhtQ(self.dataInput.delta)
             self.labelsSamples = random.rand(self.nbConditions, self.nbVox)
-            varXhtQXh = zeros((self.nbVox, self.nbConditions), dtype=float)
-            for i in xrange(self.nbVox):
-                varXhtQXh[i, :] = diag(
-                    dot(self.varXhtQ[i, :, :], self.varXh[i, :, :]))
+            varXhtQXh = self.computeVarXhtQXh()
 
             for j in random.permutation(self.nbConditions):
                 self.computeComponentsApost(variables, j, varXhtQXh)
@@ -713,8 +678,7 @@ class NRLwithHabSampler(NRLSampler):
         if self.sampleHabitFlag:
             logger.info('(it %i) Habituation conditional sampling ...',
                         self.iteration)
-            for j in random.permutation(self.nbConditions):
-                self.habitCondSampler(j, rb, varHRF)
+            self.habitCondSamplerParallel(rb, varHRF)
             logger.info('(it %i) update done ...', self.iteration)
 
         self.saveSamples()
@@ -796,9 +760,8 @@ class NRLwithHabSampler(NRLSampler):
         parmask = [where(rpar[c] == 1) for c in self.dataInput.cNames]
         tnrl = zeros((self.nbVox, self.nbConditions, len(rpar[rpar.keys()[0]])),
                      dtype=float)
-        for i in xrange(self.nbVox):
-            for j in xrange(self.nbConditions):
-                tnrl[i, j, parmask[j]] = self.timeNrls[j][i, :]
+        for j in xrange(self.nbConditions):
+            tnrl[:, j, parmask[j][0]] = self.timeNrls[j]
 
         # TODO: dirac outputs to use less space
         axes_domains = {'condition': self.dataInput.cNames,
@@ -869,8 +832,7 @@ class NRLwithHabSampler(NRLSampler):
 
         del self.sumaX
         #del self.sumaXQ
-        del self.Xmask
-        del self.nnulls
+        del self.trialBins
         del self.varSingleCondXtrials
         del self.voxelActivity
 
@@ -896,11 +858,14 @@ class NRLwithHabSampler(NRLSampler):
         #del self.varsumXh
 
     def spExtract(self, spInd, mtrx, cond):
-        X = mtrx + 0.
-        xr = X.ravel()
-        xr[argsort(xr)] = concatenate(
-            (self.nnulls[cond], spInd.repeat(self.nbGammas[cond])), axis=0)
-        return X
+        """ Return *mtrx* where trial indexes (1 to nbTrials, 0 out of any
+        trial) are replaced by the matching values of *spInd*. The trial axis
+        of *spInd* is the last one: with *spInd* of shape (nbVox, nbTrials),
+        one matrix is returned per voxel.
+        """
+        spInd = asarray(spInd, dtype=float)
+        padded = concatenate((zeros(spInd.shape[:-1] + (1,)), spInd), axis=-1)
+        return padded[..., mtrx]
 
         # def bilinearsparsedot(self, gamma, Q, taille, cond):
         #Y = zeros((taille, taille), dtype= float)
@@ -937,51 +902,56 @@ def sparsedotdimun(X, A, mask, lenght):
 
 ##----- functions for habitSamper() ------##
 
+def truncLaplacianConst(beta, r0Hab, a, b):
+    """ Normalising constant of the Laplacian law of parameter *beta*,
+    centred on *r0Hab* (a <= r0Hab <= b) and truncated to [a, b]
+    """
+    return (2. - exp(beta * (a - r0Hab)) - exp(beta * (r0Hab - b))) / beta
+
+
+def habitLikelihoodRatio(Dif12QDif12, rb):
+    """ Likelihood ratio exp(-Dif12QDif12 / (2 rb)) of an habituation
+    candidate, set to a large value when it would overflow
+    """
+    Dif12QDif12rb = asarray(Dif12QDif12 / rb)
+    # probleme observe lorsque le ratio est trop grand -> on tronque
+    # dans ce cas (assure que Alpha = 1)
+    return where(Dif12QDif12rb > -1400.,
+                 exp(-.5 * maximum(Dif12QDif12rb, -1400.)), 1000000.)
+
+
 def LaplacianPdf(beta, r0Hab, a, b, N=1):  # instrumental law for MH algo
-    if size(r0Hab) > 1:
-        N = size(r0Hab)
-        u = numpy.random.rand(1, N)
-    elif size(r0Hab) == 1:
-        u = numpy.random.rand()
+    """
+    Sample the Laplacian law of parameter *beta* centred on *r0Hab* and
+    truncated to [a, b]. *r0Hab* may be an array (eg one habituation speed
+    per voxel), one value is then drawn for each of its items.
+    Return the samples and the normalising constants of the laws.
+    """
+    r0Hab = asarray(r0Hab, dtype=float)
+    u = numpy.random.rand(*r0Hab.shape)
     la = beta * a
     lb = beta * b
-    lr0Hab = beta * r0Hab
-
-    if all(r0Hab < a):
-        #        print "r0Hab<a"
-        abConst = math.exp(-la) - math.exp(-lb)
-        x = -log(math.exp(-la) - u * abConst) / beta
-        r0HabConst = 1.
-    elif all(r0Hab > b):
-        #        print "r0Hab>b"
-        abConst = math.exp(lb) - math.exp(la)
-        x = log(math.exp(la) + u * abConst) / beta
-        r0HabConst = 1.
-    elif size(r0Hab) == 1:  # r0Hab value in [a,b] interval
-        #        print "size(r0Hab)==1"
-        e_lamr0Hab = math.exp(beta * (a - r0Hab))
-        e_lr0Habmb = math.exp(beta * (r0Hab - b))
-        r0HabConst = (2. - e_lamr0Hab - e_lr0Habmb) / beta
-        F_r0Hab = (1. - e_lamr0Hab) / (2. - e_lamr0Hab - e_lr0Habmb)
-        if (u < F_r0Hab):
-            abConst = r0HabConst * beta * math.exp(lr0Hab)
-            x = log(math.exp(la) + u * abConst) / beta
-        elif (u >= F_r0Hab):
-            abConst = r0HabConst * beta
-            x = r0Hab - log(2. - e_lamr0Hab - u * abConst) / beta
-        else:
-            abConst0 = r0HabConst * beta * math.exp(lr0Hab)
-            abConst1 = r0HabConst * beta
-#            for k in xrange(0,N):
-            if (u < F_r0Hab):
-                x = log(math.exp(la) + u * abConst0) / beta
-            else:
-                x = r0Hab - log(2. - e_lamr0Hab - u * abConst1) / beta
-    else:
-        x = zeros((N), dtype=float)
-        for i in xrange(N):
-            x[i] = LaplacianPdf(beta, r0Hab[i], a, b, 1.0)
-            r0HabConst.append(r0HabConst)
+
+    # r0Hab value in [a,b] interval
+    r0c = clip(r0Hab, a, b)
+    e_lamr0Hab = exp(beta * (a - r0c))
+    e_lr0Habmb = exp(beta * (r0c - b))
+    r0HabConst = (2. - e_lamr0Hab - e_lr0Habmb) / beta
+    F_r0Hab = (1. - e_lamr0Hab) / (2. - e_lamr0Hab - e_lr0Habmb)
+    abConst0 = r0HabConst * beta * exp(beta * r0c)
+    abConst1 = r0HabConst * beta
+    x = where(u < F_r0Hab, log(exp(la) + u * abConst0) / beta,
+              r0c - log(2. - e_lamr0Hab - u * abConst1) / beta)
+
+    below = r0Hab < a
+    above = r0Hab > b
+    if below.any() or above.any():
+        x = where(below, -log(exp(-la) - u * (exp(-la) - exp(-lb))) / beta, x)
+        x = where(above, log(exp(la) + u * (exp(lb) - exp(la))) / beta, x)
+        r0HabConst = where(below | above, 1., r0HabConst)
+
+    if r0Hab.ndim == 0:
+        return float(x), float(r0HabConst)
     return x, r0HabConst
 
 # def spExtract(spInd, mtrx):
@@ -1000,19 +970,23 @@ def LaplacianPdf(beta, r0Hab, a, b, N=1):  # instrumental law for MH algo
 
 
 def subcptGamma(nrl, habit, nbTrials, deltaOns):
-    # print 'function subcptGamma: start...',
-    gamma = zeros(nbTrials, dtype=float)
-    timeNrls = zeros(nbTrials, dtype=float)
-    gamma[0] = 1.
-    timeNrls[0] = nrl
-    skk = 0.
+    """
+    Compute the habituation factors (gamma) and the time-varying NRLs of
+    the *nbTrials* successive trials of a condition, with exponentially
+    decaying amplitudes. *nrl* and *habit* may be arrays (eg one value per
+    voxel): trials are then along the last axis of the results.
+    """
+    nrl, habit = broadcast_arrays(asarray(nrl, dtype=float),
+                                  asarray(habit, dtype=float))
+    gamma = zeros(nrl.shape + (nbTrials,), dtype=float)
+    timeNrls = zeros(nrl.shape + (nbTrials,), dtype=float)
+    gamma[..., 0] = 1.
+    timeNrls[..., 0] = nrl
+    skk = zeros(nrl.shape, dtype=float)
     for k in xrange(1, nbTrials):
-        skk = (habit ** deltaOns[k - 1]) * (skk + timeNrls[k - 1])
-        gamma[k] = 1. / (1. + skk)
-        timeNrls[k] = gamma[k] * nrl
-    # print 'OK'
-    # print 'skk',skk, 'gamma',gamma, 'timeNrls',timeNrls
-#    return gamma
+        skk = (habit ** deltaOns[k - 1]) * (skk + timeNrls[..., k - 1])
+        gamma[..., k] = 1. / (1. + skk)
+        timeNrls[..., k] = gamma[..., k] * nrl
     return gamma, timeNrls
 
 # def spExtract(spInd, mtrx):
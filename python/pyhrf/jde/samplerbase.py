@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+import os.path as op
 import time
+import cPickle
 import logging
+import tempfile
 
 import numpy as np
 import numpy.matlib
@@ -43,7 +47,7 @@ class GibbsSampler:
     def __init__(self, variables, nbIt, smplHistoryPace=-1,
                  obsHistoryPace=-1, nbSweeps=None,
                  callbackObj=None, randomSeed=None, globalObsHistoryPace=-1,
-                 check_ftval=None, output_fit=False):
+                 check_ftval=None, output_fit=False, fitHistoryPace=1):
         """
         Initialize a new GibbsSampler object.
         @param variables: contains all instances of type C{GibbsSamplerVariable}
@@ -53,6 +57,8 @@ class GibbsSampler:
         @param callbackObj: is an object which function L{callback()} is called
         after each sampling iteration (typically for plotting/report purpose.
         See C{GSDefaultCallbackHandler}.
+        @param fitHistoryPace: pace (in iterations) at which the reconstruction
+        error and the log-likelihood are evaluated (-1: never)
         """
 
         # TODO change to Exceptions ...
@@ -88,8 +94,11 @@ class GibbsSampler:
         self.smplHistoryPace = smplHistoryPace
         self.obsHistoryPace = obsHistoryPace
         self.globalObsHistoryPace = globalObsHistoryPace
+        self.fitHistoryPace = fitHistoryPace
         self.globalObsHistoryIts = None
         self.globalObsHistoryTiming = None
+        # directory where to memory-map histories (None -> kept in memory):
+        self.history_dir = pyhrf.cfg['treatment-default']['mcmc_history_path']
 
         self.tSamplingOnly = 0
         self.analysis_duration = 0
@@ -104,6 +113,15 @@ class GibbsSampler:
 
         self.check_ftval = check_ftval
 
+        # periodic snapshots of the sampling state (see save_checkpoint):
+        self.checkpoint_file = None
+        self.checkpoint_pace = -1
+        self.checkpoint_state = None
+
+        # adaptive burn-in and stopping (see ConvergenceMonitor):
+        self.convergence_monitor = None
+        self.sampling_converged = False
+
     def set_nb_iterations(self, n):
         prev_its = self.nbIterations
         self.nbIterations = n
@@ -124,6 +142,10 @@ class GibbsSampler:
             self.obsHistoryPace = int(np.ceil(self.obsHistoryPace *
                                               (n * 1. / prev_its)))
 
+        if getattr(self, 'fitHistoryPace', -1) > 0:
+            self.fitHistoryPace = int(np.ceil(self.fitHistoryPace *
+                                              (n * 1. / prev_its)))
+
     def linkToData(self, dataInput):
         #-> set input data
         self.dataInput = dataInput
@@ -148,9 +170,10 @@ class GibbsSampler:
     def get_variable(self, label):
         return self.variablesMapping[label]
 
-    def iterate_sampling(self):
-        it = 0
-        while it < self.nbIterations and not self.stop_criterion(it):
+    def iterate_sampling(self, start=0):
+        it = start
+        while it < self.nbIterations and not self.stop_criterion(it) and \
+                not getattr(self, 'sampling_converged', False):
             yield it
             it += 1
 
@@ -164,7 +187,15 @@ class GibbsSampler:
         L{GibbsSamplerVariable.sampleNext()} of each variable. Call the callback
         function after each iteration. Measure time elapsed and store it in
         L{tSamplinOnly} and L{analysis_duration}
+
+        If the sampler was restored by load_checkpoint, the chain continues
+        right after the iteration of the snapshot.
         """
+        resume_state = getattr(self, 'checkpoint_state', None)
+        if resume_state is not None:
+            self.checkpoint_state = None
+            return self._sample(atomData, resume_state)
+
         if self.randomSeed is not None:
             logger.info('setting random seed: %s', str(self.randomSeed))
             np.random.seed(self.randomSeed)
@@ -175,6 +206,11 @@ class GibbsSampler:
         if self.nbSweeps is None:
             self.nbSweeps = self.nbIterations / 3
 
+        self.sampling_converged = False
+        monitor = getattr(self, 'convergence_monitor', None)
+        if monitor is not None:
+            monitor.reset()
+
         logger.info('Nb sweeps: %d', self.nbSweeps)
         logger.info('obs hist pace: %d', self.obsHistoryPace)
         logger.info('smpl hist pace: %d', self.obsHistoryPace)
@@ -199,6 +235,41 @@ class GibbsSampler:
             v.initObservables()
         self.initGlobalObservables()
 
+        for v in self.variables:
+            if self.smplHistoryPace != -1:
+                logger.info('Saving init value of %s', v.name)
+                v.saveCurrentValue(-1)
+
+        fit_pace = getattr(self, 'fitHistoryPace', 1)
+        if fit_pace > 0:
+            nb_fit_evals = self.nbIterations / fit_pace + 1
+        else:
+            nb_fit_evals = 0
+        fit_state = {'rerror': np.zeros(nb_fit_evals),
+                     'loglkhd': np.zeros(nb_fit_evals),
+                     'nb_fits': 0, 'it_last_fit': None}
+
+        return self._sample(atomData, {'iteration': -1,
+                                       'fit_state': fit_state})
+
+    def _sample(self, atomData, state):
+        """
+        Main sampling loop, starting after iteration state['iteration'].
+        If state holds a random state, it is restored first.
+        """
+        if 'random_state' in state:
+            logger.info('Resuming sampling after iteration %d',
+                        state['iteration'])
+            np.random.set_state(state['random_state'])
+        fit_state = state['fit_state']
+        rerror = fit_state['rerror']
+        loglkhd = fit_state['loglkhd']
+        nb_fits = fit_state['nb_fits']
+        it_last_fit = fit_state['it_last_fit']
+        fit_pace = getattr(self, 'fitHistoryPace', 1)
+        checkpoint_pace = getattr(self, 'checkpoint_pace', -1)
+        monitor = getattr(self, 'convergence_monitor', None)
+
         # init for time measures :
         tGlobIni = time.time()
         tIni = time.time()
@@ -217,15 +288,8 @@ class GibbsSampler:
                     self.dataInput.nbConditions, lhrf)
 
         tLoopIni = time.time()
-        for v in self.variables:
-            if self.smplHistoryPace != -1:
-                logger.info('Saving init value of %s', v.name)
-                v.saveCurrentValue(-1)
-
-        rerror = np.array([])
-        loglkhd = np.array([])
-
-        for it in self.iterate_sampling():
+        it = state['iteration']
+        for it in self.iterate_sampling(it + 1):
             iv = 0
 
             for v in self.variables:
@@ -244,6 +308,9 @@ class GibbsSampler:
                 self.tVars[iv] += time.time() - tIniv
                 iv += 1
 
+            if monitor is not None:
+                self.update_convergence(monitor, it)
+
             for v in self.variables:
 
                 v.record_trajectories(it)
@@ -279,31 +346,19 @@ class GibbsSampler:
             #self.jde_fit_vec = np.append(self.jde_fit_vec, self.computeFit())
 
             # Compute error measures
-            try:
-                bold = atomData.bold
-
-                # relative reconstruction error
-                jde_fit = self.computeFit()
-                r = bold - jde_fit
-                rec_error_j = np.sum(r ** 2, 0)
-                bold2 = np.sum(bold ** 2, 0)
-                #rec_error = np.mean(rec_error_j/bold2)   # Univariate analysis
-                rec_error = np.mean(rec_error_j) / np.mean(bold2)
-                rerror = np.append(rerror, rec_error)
-    
-                # Loglikelihood
-                var_noise = self.get_variable('noise_var').currentValue
-                loglh = 0
-                N = r.shape[0]
-                J = r.shape[1]
-                for j in np.arange(0., J):
-                    loglh -= (np.log(np.abs(2*np.pi*var_noise[j]*N)) + \
-                        np.dot(r[:,j].T,r[:,j])/var_noise[j] / 2)
-                loglkhd = np.append(loglkhd, loglh)
-
-            except AttributeError:
-                pass
-                
+            if fit_pace > 0 and (it % fit_pace) == 0:
+                try:
+                    bold = atomData.bold
+                    if nb_fits == len(rerror):  # more its than expected
+                        rerror = np.concatenate((rerror, np.zeros_like(rerror)))
+                        loglkhd = np.concatenate((loglkhd,
+                                                  np.zeros_like(loglkhd)))
+                    rerror[nb_fits], loglkhd[nb_fits] = \
+                        self.compute_fit_errors(bold)
+                    nb_fits += 1
+                    it_last_fit = it
+                except AttributeError:
+                    pass
 
             # Some verbose about online profiling :
             now = time.time()
@@ -327,6 +382,13 @@ class GibbsSampler:
             # launch callback function after each sample step :
             logger.info('calling callback ...')
             self.callbacker(it, self.variables, self)
+
+            if checkpoint_pace > 0 and self.checkpoint_file is not None and \
+                    ((it + 1) % checkpoint_pace) == 0:
+                self.save_checkpoint(it, {'rerror': rerror,
+                                          'loglkhd': loglkhd,
+                                          'nb_fits': nb_fits,
+                                          'it_last_fit': it_last_fit})
             tIni = time.time()
         self.final_iteration = it
         logger.info('##- Sampling done, final iteration=%d -##',
@@ -337,8 +399,14 @@ class GibbsSampler:
             Q, J = bold.shape
 
             #BIC
-            self.converror = rerror
-            self.loglikelihood = loglkhd
+            if it_last_fit != self.final_iteration:
+                # the BIC is computed at the final iteration
+                loglh = self.compute_fit_errors(bold)[1]
+            else:
+                loglh = loglkhd[nb_fits - 1]
+            N = Q
+            self.converror = rerror[:nb_fits]
+            self.loglikelihood = loglkhd[:nb_fits]
             try:
                 hrf = self.get_variable('brf').currentValue
             except KeyError:
@@ -378,6 +446,87 @@ class GibbsSampler:
 
         return
 
+    def update_convergence(self, monitor, it):
+        """
+        Feed the convergence monitor with the current values of iteration
+        *it*. End the burn-in period or the sampling when the convergence
+        thresholds of the monitor are met.
+        """
+        if it == self.nbSweeps:
+            # only diagnose samples drawn after the burn-in period
+            monitor.reset()
+        monitor.record([self.get_variable(vn).currentValue
+                        for vn in monitor.variable_names])
+        if ((it + 1) % monitor.check_pace) != 0:
+            return
+        if it < self.nbSweeps:
+            if monitor.burnin_reached():
+                logger.info('(it %d) burn-in period reached (R-hat=%f)', it,
+                            monitor.split_rhat(last_half=True))
+                self.nbSweeps = it + 1
+                for v in self.variables:
+                    v.set_burnin(self.nbSweeps)
+        elif monitor.converged():
+            logger.info('(it %d) sampling converged (ESS=%f, R-hat=%f)', it,
+                        monitor.ess(), monitor.split_rhat())
+            self.sampling_converged = True
+
+    def set_checkpoint(self, file_name, pace):
+        """
+        Save a snapshot of the sampling state in *file_name* every *pace*
+        iterations (-1: never). See save_checkpoint.
+        """
+        self.checkpoint_file = file_name
+        self.checkpoint_pace = pace
+
+    def save_checkpoint(self, it, fit_state):
+        """
+        Pickle the whole sampler, together with the iteration counter *it*,
+        the state of the random generator and the fit errors tracked so far.
+        Only the NumPy generator is saved. The C kernels of the samplers
+        draw from random samples generated with NumPy, so that a resumed
+        chain reproduces the uninterrupted one. This would not hold for code
+        drawing with the C rand() function, whose state is not saved (it is
+        only used by VEM kernels of UtilsC).
+        Variables are pickled at once so that arrays shared between them
+        remain shared when the snapshot is loaded by load_checkpoint.
+        The snapshot file is replaced atomically.
+        """
+        logger.info('(it %d) saving checkpoint to %s', it, self.checkpoint_file)
+        self.checkpoint_state = {'iteration': it,
+                                 'random_state': np.random.get_state(),
+                                 'fit_state': fit_state}
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                dir=op.dirname(op.abspath(self.checkpoint_file)),
+                suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_file, self.checkpoint_file)
+        finally:
+            self.checkpoint_state = None
+
+    def compute_fit_errors(self, bold):
+        """
+        Return the relative reconstruction error of *bold* by the current fit
+        (see computeFit) and the log-likelihood of the current sample.
+        """
+        r = bold - self.computeFit()
+        rec_error_j = np.sum(r ** 2, 0)
+        bold2 = np.sum(bold ** 2, 0)
+        #rec_error = np.mean(rec_error_j/bold2)   # Univariate analysis
+        rec_error = np.mean(rec_error_j) / np.mean(bold2)
+
+        # Loglikelihood
+        var_noise = self.get_variable('noise_var').currentValue
+        N = r.shape[0]
+        loglh = -(np.log(np.abs(2 * np.pi * var_noise * N)) +
+                  rec_error_j / var_noise / 2).sum()
+        return rec_error, loglh
+
     def finalizeSampling(self):
         pass
 
@@ -470,6 +619,17 @@ class GibbsSampler:
                                        axes_names=['condition', 'time', 'P'],
                                        axes_domains=ad,
                                        value_label='value')
+        if getattr(self, 'convergence_monitor', None) is not None:
+            # iterations reached by the adaptive burn-in and stopping:
+            nb_vox = self.dataInput.nbVoxels
+            outputs['mcmc_nb_iterations'] = \
+                xndarray(np.zeros(nb_vox, dtype=np.int32) +
+                         self.final_iteration + 1, axes_names=['voxel'],
+                         value_label='iteration')
+            outputs['mcmc_burnin'] = \
+                xndarray(np.zeros(nb_vox, dtype=np.int32) + self.nbSweeps,
+                         axes_names=['voxel'], value_label='iteration')
+
         if self.output_fit:
             try:
                 fit = self.computeFit()
@@ -529,6 +689,238 @@ class GibbsSampler:
         # if len(self.fitHistory) > 0:
 
 
+class ConvergenceMonitor:
+
+    """ Running convergence diagnostics of sampled quantities, computed from
+    batch statistics kept in a fixed amount of memory: samples are gathered
+    in consecutive batches whose sums and sums of squares are stored. When
+    the number of batches reaches 2*nb_batches, pairs of batches are merged
+    and the batch size doubles.
+
+    Two diagnostics are available, for each component of the monitored
+    quantities:
+        - the split-chain R-hat, the batches being split into *nb_chains*
+          consecutive sub-chains,
+        - the batch-means effective sample size (ESS).
+    Components with a null variance (eg not sampled) are ignored. Variances
+    are computed from running sums, so that constant components may show a
+    round-off variance: variances below var_rtol times the squared mean are
+    considered null.
+    """
+
+    var_rtol = 1e-10
+
+    def __init__(self, variable_names, max_rhat=-1., min_ess=-1.,
+                 check_pace=10, min_samples=100, nb_batches=32, nb_chains=4):
+        """
+        Args:
+            *variable_names* are the names of the monitored variables.
+            *max_rhat* is the R-hat threshold below which the burn-in
+                       period ends, and the sampling too (-1: not used).
+            *min_ess* is the minimum ESS of each component to end the
+                      sampling (-1: not used).
+            *check_pace* is the pace (in iterations) at which diagnostics are
+                         evaluated.
+            *min_samples* is the minimum number of samples before testing
+                          convergence.
+        """
+        self.variable_names = variable_names
+        self.max_rhat = max_rhat
+        self.min_ess = min_ess
+        self.check_pace = check_pace
+        self.min_samples = min_samples
+        self.nb_batches = nb_batches
+        self.nb_chains = nb_chains
+        self.reset()
+
+    def reset(self):
+        """ Forget all recorded samples """
+        self.batch_size = 1
+        self.nb_full = 0
+        self.sums = None
+        self.sums2 = None
+        self.current = None
+        self.current2 = None
+        self.current_count = 0
+
+    def record(self, values):
+        """ Record a sample made of the list of arrays *values* """
+        x = np.concatenate([np.asarray(v, dtype=np.float64).ravel()
+                            for v in values])
+        if self.sums is None:
+            self.sums = np.zeros((2 * self.nb_batches, x.size))
+            self.sums2 = np.zeros((2 * self.nb_batches, x.size))
+            self.current = np.zeros(x.size)
+            self.current2 = np.zeros(x.size)
+        self.current += x
+        self.current2 += x * x
+        self.current_count += 1
+        if self.current_count == self.batch_size:
+            self.sums[self.nb_full] = self.current
+            self.sums2[self.nb_full] = self.current2
+            self.nb_full += 1
+            self.current[:] = 0.
+            self.current2[:] = 0.
+            self.current_count = 0
+            if self.nb_full == len(self.sums):
+                # merge pairs of batches:
+                n = self.nb_batches
+                self.sums[:n] = self.sums[0::2] + self.sums[1::2]
+                self.sums2[:n] = self.sums2[0::2] + self.sums2[1::2]
+                self.sums[n:] = 0.
+                self.sums2[n:] = 0.
+                self.nb_full = n
+                self.batch_size *= 2
+
+    def nb_samples(self, last_half=False):
+        """ Number of samples in full batches """
+        return len(self._batches(last_half)) * self.batch_size
+
+    def _batches(self, last_half=False):
+        first = self.nb_full / 2 if last_half else 0
+        return np.arange(first, self.nb_full)
+
+    def _moments(self, batches):
+        """ Return the sample count, mean and variance of each component
+        over the given batches
+        """
+        n = len(batches) * self.batch_size
+        mean = self.sums[batches].sum(0) / n
+        var = (self.sums2[batches].sum(0) - n * mean ** 2) / (n - 1)
+        return n, mean, var
+
+    def _varying(self, var, mean):
+        """ Return the mask of components with a non-negligible variance """
+        return var > self.var_rtol * np.maximum(mean ** 2,
+                                                np.finfo(float).tiny)
+
+    def split_rhat(self, last_half=False):
+        """
+        Return the maximum split-chain R-hat over all components (inf if
+        there are not enough batches). If *last_half* is True, only the last
+        half of the samples is considered.
+        """
+        batches = self._batches(last_half)
+        if len(batches) < 2 * self.nb_chains:
+            return np.inf
+        chains = [self._moments(b) for b in
+                  np.array_split(batches, self.nb_chains)]
+        n = np.mean([c[0] for c in chains])
+        means = np.array([c[1] for c in chains])
+        w = np.mean([c[2] for c in chains], 0)
+        b_n = means.var(0, ddof=1)
+        m = self._varying(w, means.mean(0))
+        if not m.any():
+            return 1.
+        var_plus = (n - 1) / n * w[m] + b_n[m]
+        return np.sqrt(var_plus / w[m]).max()
+
+    def ess(self):
+        """
+        Return the minimum batch-means effective sample size over all
+        components (0 if there are not enough batches).
+        """
+        batches = self._batches()
+        if len(batches) < 2:
+            return 0.
+        n, mean, var = self._moments(batches)
+        batch_means = self.sums[batches] / self.batch_size
+        var_batch = batch_means.var(0, ddof=1) * self.batch_size
+        m = self._varying(var, mean)
+        if not m.any():
+            return float(n)
+        ess = n * var[m] / np.maximum(var_batch[m], 1e-300)
+        return min(float(n), ess.min())
+
+    def burnin_reached(self):
+        if self.max_rhat < 0 or \
+                self.nb_samples(last_half=True) < self.min_samples:
+            return False
+        return self.split_rhat(last_half=True) <= self.max_rhat
+
+    def converged(self):
+        if (self.max_rhat < 0 and self.min_ess < 0) or \
+                self.nb_samples() < self.min_samples:
+            return False
+        if self.max_rhat >= 0 and self.split_rhat() > self.max_rhat:
+            return False
+        return self.min_ess < 0 or self.ess() >= self.min_ess
+
+
+def load_checkpoint(file_name):
+    """
+    Load a sampler saved by GibbsSampler.save_checkpoint. Calling its
+    runSampling method continues the chain right after the saved iteration.
+    """
+    f = open(file_name, 'rb')
+    try:
+        return cPickle.load(f)
+    finally:
+        f.close()
+
+
+class HistoryBuffer:
+
+    """ Store the successive values of a numpy array in a buffer allocated
+    once for the expected number of values, instead of growing the history
+    at each saved iteration. The buffer is doubled if the expected number of
+    values is exceeded.
+    """
+
+    def __init__(self, value, capacity, history_dir=None):
+        """
+        Args:
+            *value* is the first value to store. It defines the shape and the
+                    type of the stored values.
+            *capacity* is the expected number of values.
+            *history_dir* is a directory where to store the buffer as a
+                          memory-mapped file, so that the history does not
+                          have to fit in RAM. If None, the buffer is kept in
+                          memory.
+        """
+        value = np.asarray(value)
+        self.history_dir = history_dir
+        self.count = 0
+        self.buffer = self._allocate(max(1, capacity), value.shape,
+                                     value.dtype)
+        self.view = None
+
+    def _allocate(self, capacity, shape, dtype):
+        if self.history_dir is None:
+            return np.zeros((capacity,) + shape, dtype=dtype)
+        fd, fn = tempfile.mkstemp(prefix='pyhrf_history_', suffix='.dat',
+                                  dir=self.history_dir)
+        os.close(fd)
+        buf = np.memmap(fn, dtype=dtype, mode='w+',
+                        shape=(capacity,) + shape)
+        # the mapping stays valid after unlinking, and the file is
+        # automatically removed when the buffer is garbage collected:
+        os.remove(fn)
+        return buf
+
+    def append(self, value):
+        """ Store *value* after the previous ones and return the history so far
+        as an array (a view on the buffer) of shape (nb values,)+value.shape
+        """
+        value = np.asarray(value)
+        if value.shape != self.buffer.shape[1:]:
+            raise ValueError('Cannot append value of shape %s to history of '
+                             'shape %s' % (str(value.shape),
+                                           str(self.buffer.shape[1:])))
+        dtype = np.promote_types(self.buffer.dtype, value.dtype)
+        if self.count == len(self.buffer) or dtype != self.buffer.dtype:
+            capacity = len(self.buffer)
+            if self.count == capacity:
+                capacity *= 2
+            new_buffer = self._allocate(capacity, value.shape, dtype)
+            new_buffer[:self.count] = self.buffer[:self.count]
+            self.buffer = new_buffer
+        self.buffer[self.count] = value
+        self.count += 1
+        self.view = self.buffer[:self.count]
+        return self.view
+
+
 class Trajectory:
 
     """ Keep track of a numpy array that is modified _inplace_ iteratively
@@ -556,16 +948,10 @@ class Trajectory:
         self.axes_domains = axes_domains
         self.hist_pace = history_pace
         self.hist_start = history_start
+        self.max_iterations = max_iterations
+        self.save_init = (first_saved_iteration == -1)
 
-        if history_pace > 0:
-            nsamples_max = max_iterations / history_pace - history_start
-        else:
-            nsamples_max = 0
-
-        if first_saved_iteration == -1:
-            nsamples_max += 1  # +1 because of init
-
-        self.history = np.zeros((nsamples_max,) + variable.shape,
+        self.history = np.zeros((self._nsamples_max(),) + variable.shape,
                                 dtype=variable.dtype)
 
         self.sample_count = 0
@@ -576,6 +962,29 @@ class Trajectory:
             self.saved_iterations.append(-1)
             self.sample_count = 1
 
+    def _nsamples_max(self):
+        if self.hist_pace > 0:
+            nsamples_max = self.max_iterations / self.hist_pace - \
+                self.hist_start
+        else:
+            nsamples_max = 0
+
+        if self.save_init:
+            nsamples_max += 1  # +1 because of init
+        return nsamples_max
+
+    def set_start(self, history_start):
+        """
+        Change the iteration when to start saving values, eg when the burn-in
+        period ends earlier than planned. The history is enlarged if needed.
+        """
+        self.hist_start = history_start
+        extra = self._nsamples_max() - len(self.history)
+        if extra > 0:
+            self.history = np.concatenate(
+                (self.history, np.zeros((extra,) + self.history.shape[1:],
+                                        dtype=self.history.dtype)))
+
     def record(self, iteration):
         """
         Increment the history saving.
@@ -655,9 +1064,12 @@ class GibbsSamplerVariable:
         self.meanHistory = None
         self.errorHistory = None
         self.obsHistoryIts = []
+        self.history_buffers = {}
 
         # Used to save history of samples:
         self.tracked_quantities = {}
+        # names of quantities only saved after the burn-in period:
+        self.obs_quantities = []
 
     def chooseSampleNext(self, flag):
         if flag:
@@ -683,6 +1095,8 @@ class GibbsSamplerVariable:
         # remove the closure that cannot be pickled
         if d.has_key('sampleNext'):
             del d['sampleNext']
+        # history buffers are rebuilt from the histories if needed
+        d['history_buffers'] = {}
         # return state to be pickled
         return d
 
@@ -757,8 +1171,16 @@ class GibbsSamplerVariable:
             history_pace = self.samplerEngine.obsHistoryPace
 
         burnin = self.samplerEngine.nbSweeps
-        self._track_quantity(q, name, axes_domains, axes_domains,
+        self._track_quantity(q, name, axes_names, axes_domains,
                              history_pace, hist_start=burnin)
+        self.obs_quantities.append(name)
+
+    def set_burnin(self, burnin):
+        """ Start saving observable quantities from iteration *burnin*
+        (see ConvergenceMonitor)
+        """
+        for name in getattr(self, 'obs_quantities', []):
+            self.tracked_quantities[name].set_start(burnin)
 
     def record_trajectories(self, it):
         for q in self.tracked_quantities.values():
@@ -816,28 +1238,42 @@ class GibbsSamplerVariable:
         if (self.error < 0.).any():
             raise Exception('neg error on variable %s' % self.name)
 
+    def _append_history(self, hname, value, history_pace):
+        """ Append *value* to the history stored in attribute *hname*.
+        Values are stored in a HistoryBuffer allocated once from the number of
+        iterations and *history_pace*. The attribute is a view on the buffer.
+        """
+        if not hasattr(self, 'history_buffers'):  # older pickles
+            self.history_buffers = {}
+        history = getattr(self, hname)
+        hbuffer = self.history_buffers.get(hname)
+        if hbuffer is None or history is not hbuffer.view:
+            # first value, or history modified outside of this function
+            engine = getattr(self, 'samplerEngine', None)
+            capacity = 1
+            history_dir = None
+            if engine is not None:
+                capacity = engine.nbIterations / max(1, history_pace) + 2
+                history_dir = getattr(engine, 'history_dir', None)
+            first = value if history is None else history[0]
+            hbuffer = HistoryBuffer(first, capacity, history_dir)
+            if history is not None:
+                for h in history:
+                    hbuffer.append(h)
+            self.history_buffers[hname] = hbuffer
+        setattr(self, hname, hbuffer.append(value))
+
     def saveObservables(self, it):
 
         self.obsHistoryIts.append(it)
-        if self.meanHistory is not None:
-            self.meanHistory = np.concatenate((self.meanHistory,
-                                               [self.mean]))
-        else:
-            self.meanHistory = np.array([self.mean.copy()])
-
-        if self.errorHistory is not None:
-            self.errorHistory = np.concatenate((self.errorHistory,
-                                                [self.error]))
-        else:
-            self.errorHistory = np.array([self.error.copy()])
+        pace = self.samplerEngine.obsHistoryPace
+        self._append_history('meanHistory', self.mean, pace)
+        self._append_history('errorHistory', self.error, pace)
 
     def saveCurrentValue(self, it):
         self.smplHistoryIts.append(it)
-        if self.smplHistory is not None:
-            self.smplHistory = np.concatenate((self.smplHistory,
-                                               [self.currentValue]))
-        else:
-            self.smplHistory = np.array([self.currentValue.copy()])
+        self._append_history('smplHistory', self.currentValue,
+                             self.samplerEngine.smplHistoryPace)
 
     def roiMapped(self):
         logger.debug('roiMapped ?')
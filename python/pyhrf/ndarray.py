@@ -773,10 +773,12 @@ class xndarray:
           'y': arange(0,3,1)
           'z': arange(0,3,1)
         """
-        logger.debug('expand ... mask: %s -> region size=%d, '
-                     'axis: %s, target_axes: %s, target_domains: %s',
-                     str(mask.shape), mask.sum(dtype=int), axis,
-                     str(target_axes), str(target_domains))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('expand ... mask: %s -> region size=%d, '
+                         'axis: %s, target_axes: %s, target_domains: %s',
+                         str(mask.shape),
+                         mask.sum(dtype=int) if m is None else len(m[0]),
+                         axis, str(target_axes), str(target_domains))
 
         if do_checks:
             if not ((mask.min() == 0 and mask.max() == 1) or
@@ -1802,6 +1804,35 @@ def stack_cuboids(c_list, axis, domain=None, axis_pos='first'):
     return targetCub
 
 
+def get_label_index(labels):
+    """ Group the positions of the elements of *labels* by label value.
+
+    The index is built with a single stable sort of the labels, instead of
+    one ``np.where(labels == l)`` per label which scales as
+    nb labels x nb positions.
+
+    Return:
+        OrderedDict mapping each label (in increasing order) to the positions
+        of its elements, in the same format and order as
+        ``np.where(labels == label)``
+
+    Example:
+    >>> import numpy as np
+    >>> idx = get_label_index(np.array([[2, 0, 2], [1, 2, 0]]))
+    >>> idx.keys()
+    [0, 1, 2]
+    >>> idx[2]
+    (array([0, 0, 1]), array([0, 2, 1]))
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, axis=None, kind='mergesort')
+    sorted_labels = labels.ravel()[order]
+    ulabels, starts = np.unique(sorted_labels, return_index=True)
+    stops = np.append(starts[1:], sorted_labels.size)
+    return OrderedDict((l, np.unravel_index(order[b:e], labels.shape))
+                       for l, b, e in zip(ulabels, starts, stops))
+
+
 def expand_array_in_mask(flat_data, mask, flat_axis=0, dest=None, m=None):
     """ Map the flat_axis of flat_data onto the region within mask.
     flat_data is then reshaped so that flat_axis is replaced with mask.shape
@@ -1870,10 +1901,15 @@ def merge(arrays, mask, axis, fill_value=0):
     if len(arrays) == 0:
         raise Exception('Empty list of arrays')
 
+    label_index = get_label_index(mask.data)
     dest_c = None
     for i, a in arrays.iteritems():
-        dest_c = a.expand(mask.data == i, axis, mask.axes_names,
-                          dest=dest_c, do_checks=False)
+        m = label_index.get(i)
+        if m is None:
+            m = np.where(mask.data == i)
+        # mask.data is only used for its shape, positions are given by m:
+        dest_c = a.expand(mask.data, axis, mask.axes_names,
+                          dest=dest_c, do_checks=False, m=m)
 
     return dest_c
 
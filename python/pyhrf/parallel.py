@@ -7,7 +7,7 @@ import shutil
 import subprocess
 import logging
 
-from os.path import basename, splitext
+from os.path import basename
 from tempfile import mkdtemp
 
 try:
@@ -20,7 +20,7 @@ except ImportError:
 
 import pyhrf
 
-from pyhrf.tools._io import remote_copy
+from pyhrf.tools._io import remote_copy, load_results
 from pyhrf import xmliobak
 
 
@@ -266,13 +266,7 @@ def run_soma_workflow(treatments, exec_cmd, tmp_local_dirs, server_id,
         if treatment.analyser.outFile is not None:
             # return result only for last treatment ...
             print 'Load result from %s ...' % local_result_file
-            if splitext(local_result_file)[1] == '.gz':
-                import gzip
-                fresult = gzip.open(local_result_file)
-            else:
-                fresult = open(local_result_file)
-            results = cPickle.load(fresult)
-            fresult.close()
+            results = load_results(local_result_file)
             # print 'Make outputs ...'
             #treatment.output(results, dump=False)
             logger.info('Cleaning tmp dirs ...')
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import os
+import os.path as op
 import logging
+import hashlib
+import tempfile
 
 from time import time
+from copy import copy
 from collections import defaultdict
 
 import numpy
@@ -44,8 +49,23 @@ class RFIREstim(xmlio.XmlInitable):
         ' nb_hrf_coeffs * hrf_dt ',
         'hrf_dt': 'Required HRF temporal resolution',
         'drift_type': 'Basis type in the drift model. Either "cosine" or "poly"',
+        'voxel_block_size': 'Number of voxels jointly processed by the EM '
+        'solver. Set to 0 to process voxels one at a time.',
+        'voxel_chunk_size': 'If > 0, voxels are split into chunks of this '
+        'size, which are estimated independently (see nb_procs and '
+        'checkpoint_dir).',
+        'nb_procs': 'Number of processes running voxel chunks in parallel '
+        '(requires joblib)',
+        'checkpoint_dir': 'Directory where the results of each voxel chunk '
+        'are saved as soon as it is done. Chunks found there are not '
+        'estimated again, so that an interrupted analysis can be resumed.',
     }
 
+    # result arrays filled by StoreRes, voxel axis is the last one:
+    chunk_results = ['Pvalues', 'ResponseFunctionsEvaluated',
+                     'StdValEvaluated', 'SignalEvaluated', 'l',
+                     'stop_iterations']
+
     if pyhrf.__usemode__ == pyhrf.ENDUSER:
         default_stop_crit1 = 0.0001
         default_stop_crit2 = 0.00001
@@ -61,7 +81,9 @@ class RFIREstim(xmlio.XmlInitable):
                  stop_crit1=default_stop_crit1, stop_crit2=default_stop_crit2,
                  nb_its_max=5, nb_iterations=default_nb_its, nb_its_min=1,
                  average_bold=False, taum=0.01, lambda_reg=100., fixed_taum=False,
-                 discarded_scan_indexes=None, output_fit=False):
+                 discarded_scan_indexes=None, output_fit=False,
+                 voxel_block_size=100, voxel_chunk_size=0, nb_procs=1,
+                 checkpoint_dir=None):
         """
            'discarded_scan_indexes' : None if no subsampling done, else give position that were removed after temporal subsampling as a 2d numpy array
 
@@ -90,6 +112,10 @@ class RFIREstim(xmlio.XmlInitable):
 
         self.pos_removed = discarded_scan_indexes or np.array(([0]))
         self.output_fit = output_fit
+        self.voxel_block_size = voxel_block_size
+        self.voxel_chunk_size = voxel_chunk_size
+        self.nb_procs = nb_procs
+        self.checkpoint_dir = checkpoint_dir
 
     def linkToData(self, data):
 
@@ -135,6 +161,25 @@ class RFIREstim(xmlio.XmlInitable):
 
         self.stop_iterations = np.zeros(self.bold.shape[1], dtype=int)
 
+        if self.save_history:
+            self.run_voxelwise()
+        elif self.voxel_chunk_size > 0:
+            self.run_chunks()
+        elif self.voxel_block_size > 0:
+            self.run_blocks()
+        else:
+            self.run_voxelwise()
+
+        self.clean_memory()
+
+        logger.info('Nb of iterations to reach stop crit: %s',
+                    array_summary(self.stop_iterations))
+
+    def run_voxelwise(self):
+        """
+        Voxel-wise analysis, where every quantity is recomputed for each voxel.
+        Used when the estimation history has to be recorded.
+        """
         # voxelwise analysis. This loop handles the currently analyzed voxels.
         for POI in xrange(self.bold.shape[1]):  # POI = point of interest
             t0 = time()
@@ -165,10 +210,112 @@ class RFIREstim(xmlio.XmlInitable):
             self.StoreRes(POI)
             logger.info("Done in %s", format_duration(time() - t0))
 
-        self.clean_memory()
+    def run_blocks(self):
+        """
+        Analysis by blocks of voxels: the voxel-invariant quantities (drift
+        basis, onset matrices, R and inv(R)) are computed once and the EM
+        updates are performed jointly on *voxel_block_size* voxels.
+        """
+        logger.info('Precompute voxel-invariant quantities ...')
+        self.PrecomputeVoxelInvariants()
 
-        logger.info('Nb of iterations to reach stop crit: %s',
-                    array_summary(self.stop_iterations))
+        nvox = self.bold.shape[1]
+        for start in xrange(0, nvox, self.voxel_block_size):
+            t0 = time()
+            vox = slice(start, min(start + self.voxel_block_size, nvox))
+            logger.info("Points %d to %d / %d", vox.start, vox.stop - 1,
+                        self.nbVoxels)
+            self.StoreResBlock(vox, *self.EM_solver_block(vox))
+            logger.info("Done in %s", format_duration(time() - t0))
+
+    def run_chunks(self):
+        """
+        Analysis by chunks of *voxel_chunk_size* voxels, run by *nb_procs*
+        processes. The results of a chunk are saved in *checkpoint_dir* (if
+        not None) as soon as it is done, and are then merged into the
+        storage matrices. Chunks already saved are not estimated again.
+        """
+        nvox = self.bold.shape[1]
+        chunks = [slice(start, min(start + self.voxel_chunk_size, nvox))
+                  for start in xrange(0, nvox, self.voxel_chunk_size)]
+        if self.checkpoint_dir is not None:
+            if not op.exists(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+            checkpoints = [self.get_chunk_checkpoint(c) for c in chunks]
+        else:
+            checkpoints = [None] * len(chunks)
+
+        todo = [(c, f) for c, f in zip(chunks, checkpoints)
+                if f is None or not op.exists(f)]
+        logger.info('%d voxel chunks, %d already done', len(chunks),
+                    len(chunks) - len(todo))
+
+        if self.nb_procs > 1 and len(todo) > 1:
+            try:
+                from joblib import Parallel, delayed
+            except ImportError:
+                raise ImportError('Can not import joblib. It is required to '
+                                  'process voxel chunks in parallel.')
+            p = Parallel(n_jobs=self.nb_procs)
+            results = p(delayed(run_rfir_chunk)(self.get_chunk_estimator(c),
+                                                f)
+                        for c, f in todo)
+        else:
+            results = [run_rfir_chunk(self.get_chunk_estimator(c), f)
+                       for c, f in todo]
+        results = dict((c.start, r) for (c, f), r in zip(todo, results))
+
+        logger.info('Merge voxel chunks ...')
+        for c, f in zip(chunks, checkpoints):
+            self.merge_chunk(c, results.get(c.start, f))
+        # drift basis used by the outputs (each chunk builds its own):
+        self.buildLowFreqMat()
+
+    def get_chunk_estimator(self, vox):
+        """
+        Return a copy of the current estimator restricted to the voxels in
+        slice *vox*. The onset matrices are shared with the current estimator.
+        The storage matrices are not copied: they are allocated for the chunk
+        voxels by run_rfir_chunk.
+        """
+        estimator = copy(self)
+        for name in self.chunk_results + ['ResponseFunctionsEvaluated_PctChgt',
+                                          'StdValEvaluated_PctChgt']:
+            if hasattr(self, name):
+                setattr(estimator, name, None)
+        estimator.bold = self.bold[:, vox].copy()
+        estimator.nbVoxels = estimator.bold.shape[1]
+        estimator.voxel_chunk_size = 0
+        return estimator
+
+    def get_chunk_checkpoint(self, vox):
+        """
+        Return the checkpoint file of the voxel chunk *vox*. Its name
+        contains a digest of the chunk BOLD signals, of the onset matrices
+        and of the estimation parameters so that a stale checkpoint is never
+        reused.
+        """
+        params = (self.K, self.DeltaT, self.OrthoBtype, self.nbItMax,
+                  self.nbItMin, self.nbIt, self.emStop1, self.emStop2,
+                  self.fixed_taum, self.taum_init, self.lambda_reg,
+                  vox.start, vox.stop)
+        digest = hashlib.sha1(repr(params))
+        digest.update(np.ascontiguousarray(self.bold[:, vox]).data)
+        for x in self.X:
+            digest.update(np.ascontiguousarray(x).data)
+        return op.join(self.checkpoint_dir,
+                       'rfir_chunk_%s.npz' % digest.hexdigest())
+
+    def merge_chunk(self, vox, chunk_res):
+        """
+        Copy the results of a voxel chunk into the storage matrices.
+        *chunk_res* is either a dict mapping items of *chunk_results* to arrays
+        or the name of the file where they were saved.
+        """
+        if isinstance(chunk_res, basestring):
+            chunk_res = np.load(chunk_res)
+        for name in chunk_res.keys():
+            getattr(self, name)[..., vox] = chunk_res[name]
 
     def clean_memory(self):
         """ Clean all objects that are useless for outputs
@@ -336,6 +483,24 @@ class RFIREstim(xmlio.XmlInitable):
         # computes det(R)
         self.DetR = 1. / det_InvR
 
+    #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def PrecomputeVoxelInvariants(self):
+        """
+        computes once for all voxels the drift basis P, InvR, R, DetR and, for
+        each session i, the concatenated onset matrix self.Xcat[i] (of shape
+        Ni x M*(K-1)) as well as its cross-product self.XtX[i]
+        requires:
+            * X computed (Compute_onset_matrix3)
+        """
+        self.buildLowFreqMat()
+        self.Compute_INV_R_and_R_and_DET_R()
+
+        SBS = self.K - 1
+        self.Xcat = [np.asarray(self.X[i], dtype=float).transpose(1, 0, 2)
+                     .reshape(-1, self.M * SBS) for i in xrange(self.I)]
+        self.XtX = [dot(xc.T, xc) for xc in self.Xcat]
+        self.trRR = dot(self.R, self.R).trace()
+
     #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     def Compute_onset_matrix3(self):
         """
@@ -634,6 +799,38 @@ class RFIREstim(xmlio.XmlInitable):
             # only one session
             self.SignalEvaluated[:, POI] = self.compute_fit(POI)
 
+    def StoreResBlock(self, vox, h, l, Sigma, InvSigma):
+        """
+        Store results computed by EM_solver_block for the voxels in slice *vox*
+        """
+        SBS = self.K - 1
+        if self.compute_pct_change:
+            meanLoc = np.abs(self.bold[:, vox].mean(0))
+
+        for m in xrange(self.M):
+            cblock = slice(m * SBS, (m + 1) * SBS)
+            hm = h[:, cblock]
+            self.ResponseFunctionsEvaluated[m, 1:self.K, vox] = hm.T
+            if self.compute_pct_change:
+                self.ResponseFunctionsEvaluated_PctChgt[m, 1:self.K, vox] = \
+                    hm.T * 100 / meanLoc
+
+            chi2 = np.einsum('vj,vjk,vk->v', hm, InvSigma[:, cblock, cblock],
+                             hm)
+            self.Pvalues[m, vox] = 1 - scipy.stats.chi2.cdf(chi2, SBS)
+
+            errors = np.sqrt(Sigma[:, cblock, cblock].diagonal(axis1=1,
+                                                               axis2=2))
+            self.StdValEvaluated[m, 1:self.K, vox] = errors.T
+            if self.compute_pct_change:
+                self.StdValEvaluated_PctChgt[m, 1:self.K, vox] = \
+                    errors.T * 100 / meanLoc
+
+        self.l[:, :, vox] = l
+        # fit computed only for the first session
+        fit = dot(self.P[0], l[0]) + dot(self.Xcat[0], h.T)
+        self.SignalEvaluated[:fit.shape[0], vox] = fit
+
     def compute_fit(self, POI):
         # store the signal evaluated in the first session
         # (drift + convolution between evluated HRF and Onset matrix)
@@ -1039,9 +1236,212 @@ class RFIREstim(xmlio.XmlInitable):
         logger.info(
             "iteration: %s -> delta_h=%s", str(iteration), str(delta_h))
 
+    def em_continue(self, iterations, StopTest1, StopTest2):
+        """ Vectorised version of the stopping criterion of EM_solver """
+        if self.nbIt is not None:
+            return iterations < self.nbIt
+        return (iterations < self.nbItMin) | \
+            ((iterations < self.nbItMax) &
+             ((StopTest1 > self.emStop1) | (StopTest2 > self.emStop2)))
+
+    def CptFctQBlock(self, h, TauM, OldTauM, rb):
+        """
+        Vectorised version of CptFctQ for a set of voxels.
+        *h* is (nvox, M*(K-1)), *TauM* and *OldTauM* are (nvox, M) and *rb*
+        is (nvox, I).
+        """
+        SBS = self.K - 1
+        hs = h.reshape(h.shape[0], self.M, SBS)
+        result = dot(rb, self.Ni.astype(float))
+        result -= SBS * log(TauM).sum(1) / 2.
+        result -= (TauM * np.einsum('vmj,jk,vmk->vm', hs, self.R, hs)).sum(1) / 2.
+        if self.OrthoBtype == 'cosine':
+            result -= (OldTauM * TauM).sum(1) * self.trRR / 2
+        else:
+            result -= (TauM * TauM).sum(1) * self.trRR / 2
+        result -= (float(self.M) / 2.) * log(self.DetR)
+        return result
+
+    def CptSigmaBlock(self, TauM, rb):
+        """
+        Vectorised version of CptSigma: returns Sigma and InvSigma as stacks
+        of shape (nvox, M*(K-1), M*(K-1)).
+        """
+        SBS = self.K - 1
+        InvSigma = np.zeros((TauM.shape[0], self.M * SBS, self.M * SBS))
+        for m in xrange(self.M):
+            cblock = slice(m * SBS, (m + 1) * SBS)
+            InvSigma[:, cblock, cblock] = self.InvR / TauM[:, m, newaxis, newaxis]
+        for i in xrange(self.I):
+            InvSigma += self.XtX[i] / rb[:, i, newaxis, newaxis]
+        return linalg.inv(InvSigma), InvSigma
+
+    #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def EM_solver_block(self, vox):
+        """
+        Same as EM_solver but performed jointly on all voxels in slice *vox*.
+        Each voxel keeps its own stopping criterion: updates of a voxel are
+        stopped as soon as it has converged, so that results match those of
+        the voxel-wise solver.
+        requires:
+            * PrecomputeVoxelInvariants has been called
+        Return: h (nvox, M*(K-1)), l (I, Q, nvox), Sigma and InvSigma
+                (nvox, M*(K-1), M*(K-1))
+        """
+        SBS = self.K - 1
+        y = [self.bold[self.sscans[i], vox].astype(float)
+             for i in xrange(self.I)]
+        nvox = y[0].shape[1]
+
+        hcano = getCanoHRF(dt=self.DeltaT, duration=self.K * self.DeltaT)[1]
+        h = np.tile(hcano[1:self.K], (nvox, self.M))
+        l = np.zeros((self.I, self.l.shape[1], nvox))
+        iterations = np.ones(nvox, dtype=int)
+
+        def residuals(i, l, h, voxels):
+            return y[i][:, voxels] - dot(self.P[i], l[i]) - dot(self.Xcat[i], h.T)
+
+        if not self.fixed_taum:
+            TauM = np.zeros((nvox, self.M)) + self.taum_init
+            OldTauM = np.ones((nvox, self.M)) / 100.
+            rb = np.ones((nvox, self.I))
+            Old_rb = np.ones((nvox, self.I))
+            Sigma, InvSigma = self.CptSigmaBlock(TauM, rb)
+            FctQ = np.zeros(nvox) + 1000000000.0
+            StopTest1 = np.ones(nvox)
+            StopTest2 = np.ones(nvox)
+
+            active = self.em_continue(iterations, StopTest1, StopTest2)
+            while active.any():
+                a = np.where(active)[0]
+                la, rba, Sa = l[:, :, a], rb[a], Sigma[a]
+
+                # 1 ) estimation of \hat{h^{MAP}}
+                BigVector = np.zeros((len(a), self.M * SBS))
+                for i in xrange(self.I):
+                    temp = y[i][:, a] - dot(self.P[i], la[i])
+                    BigVector += dot(temp.T, self.Xcat[i]) / rba[:, i, newaxis]
+                ha = np.einsum('vjk,vk->vj', Sa, BigVector)
+
+                # 2 ) estimation of \hat{l_i}
+                for i in xrange(self.I):
+                    la[i] = dot(self.P[i].T,
+                                y[i][:, a] - dot(self.Xcat[i], ha.T))
+
+                # 3 ) estimation of \hat{rb}
+                Old_rb[a] = rba
+                for i in xrange(self.I):
+                    term1 = (residuals(i, la, ha, a) ** 2).sum(0)
+                    term2 = np.einsum('vjk,jk->v', Sa, self.XtX[i])
+                    rba[:, i] = (term1 + term2) / float(self.Ni[i])
+
+                # 4 ) reestimation of sigma
+                Sa, InvSa = self.CptSigmaBlock(TauM[a], rba)
+
+                # 5 ) estimation of \TauM
+                OldTauM[a] = TauM[a]
+                for m in xrange(self.M):
+                    cblock = slice(m * SBS, (m + 1) * SBS)
+                    hm = ha[:, cblock]
+                    TauM[a, m] = (np.einsum('vj,jk,vk->v', hm, self.InvR, hm) +
+                                  np.einsum('vjk,kj->v', Sa[:, cblock, cblock],
+                                            self.InvR)) / SBS
+
+                # 6 ) Q function estimation
+                FctQ_prev = FctQ[a]
+                FctQ[a] = self.CptFctQBlock(ha, TauM[a], OldTauM[a], rba)
+
+                # 7 ) Stopping criterion
+                iterations[a] += 1
+                StopTest1[a] = np.abs(FctQ[a] - FctQ_prev) / np.abs(FctQ[a])
+                dTau = ((TauM[a] - OldTauM[a]) ** 2).sum(1)[:, newaxis]
+                nTau = (TauM[a] ** 2).sum(1)[:, newaxis]
+                StopTest2[a] = (sqrt(dTau + (Old_rb[a] - rba) ** 2) /
+                                sqrt(nTau + rba ** 2)).max(1)
+
+                h[a], l[:, :, a], rb[a] = ha, la, rba
+                Sigma[a], InvSigma[a] = Sa, InvSa
+                active = self.em_continue(iterations, StopTest1, StopTest2)
+        else:
+            # Sigma does not depend on the voxel when tau is fixed
+            InvSigma = np.kron(eye(self.M), self.InvR * self.lambda_reg) + \
+                sum(self.XtX)
+            Sigma = linalg.inv(InvSigma)
+            h_prev = np.ones((nvox, self.M * SBS))
+            delta_h = np.ones(nvox)
+            self.epsilon = 1e-4
+
+            def go_on(iterations, delta_h):
+                if self.nbIt is not None:
+                    return iterations < self.nbIt
+                return (iterations < self.nbItMin) | \
+                    ((iterations < self.nbItMax) & (delta_h > self.epsilon))
+
+            active = go_on(iterations, delta_h)
+            while active.any():
+                a = np.where(active)[0]
+                la = l[:, :, a]
+
+                BigVector = np.zeros((len(a), self.M * SBS))
+                for i in xrange(self.I):
+                    temp = y[i][:, a] - dot(self.P[i], la[i])
+                    BigVector += dot(temp.T, self.Xcat[i])
+                ha = dot(BigVector, Sigma.T)
+
+                for i in xrange(self.I):
+                    la[i] = dot(self.P[i].T,
+                                y[i][:, a] - dot(self.Xcat[i], ha.T))
+
+                iterations[a] += 1
+                delta_h[a] = ((h_prev[a] - ha) ** 2).sum(1) ** .5
+                h_prev[a] = ha
+
+                h[a], l[:, :, a] = ha, la
+                active = go_on(iterations, delta_h)
+
+            Sigma = np.tile(Sigma, (nvox, 1, 1))
+            InvSigma = np.tile(InvSigma, (nvox, 1, 1))
+
+        self.stop_iterations[vox] = iterations
+
+        return h, l, Sigma, InvSigma
+
+
+def run_rfir_chunk(estimator, checkpoint_file=None):
+    """
+    Run the estimation of the voxel chunk handled by *estimator* (see
+    RFIREstim.get_chunk_estimator). Return the dict of the result arrays, or
+    the name of the file where they were saved if *checkpoint_file* is not
+    None.
+    """
+    estimator.InitStorageMat()
+    estimator.stop_iterations = np.zeros(estimator.bold.shape[1], dtype=int)
+    if estimator.voxel_block_size > 0:
+        estimator.run_blocks()
+    else:
+        estimator.run_voxelwise()
+
+    names = list(estimator.chunk_results)
+    if estimator.compute_pct_change:
+        names += ['ResponseFunctionsEvaluated_PctChgt',
+                  'StdValEvaluated_PctChgt']
+    results = dict((n, getattr(estimator, n)) for n in names)
+    if checkpoint_file is None:
+        return results
+
+    # write to a temporary file first so that an interrupted job never
+    # leaves a partial checkpoint:
+    fd, tmp_file = tempfile.mkstemp(dir=op.dirname(checkpoint_file),
+                                    suffix='.npz')
+    os.close(fd)
+    np.savez(tmp_file, **results)
+    os.rename(tmp_file, checkpoint_file)
+    return checkpoint_file
+
 
 def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100,
-         nb_its_min=5, fixed_taum=False, lambda_reg=100.):
+         nb_its_min=5, fixed_taum=False, lambda_reg=100., voxel_chunk_size=0,
+         nb_procs=1, checkpoint_dir=None):
     """
     Fit a Regularized FIR on functional data *func_data*:
     - multisession voxel-based fwd model: y = \sum Xh + Pl + b
@@ -1065,6 +1465,12 @@ def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100,
                               Only used if *fixed_taum* is true.
         *nb_its_min*: minimum number of iterations for the EM
         *nb_its_max*: maximum number of iterations for the EM
+        *voxel_chunk_size* (int): if > 0, estimate voxels by chunks of this
+                                  size
+        *nb_procs* (int): number of processes running the voxel chunks
+        *checkpoint_dir* (str): directory where the results of each voxel
+                                chunk are saved. Chunks already found there
+                                are not estimated again.
 
     Returns: dict of xndarray instances
 
@@ -1078,7 +1484,10 @@ def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100,
     rfir_estimator = RFIREstim(hrf_nb_coeffs=int(np.round(fir_duration / fir_dt)),
                                hrf_dt=fir_dt, nb_its_max=nb_its_max,
                                nb_its_min=nb_its_min, fixed_taum=fixed_taum,
-                               lambda_reg=lambda_reg)
+                               lambda_reg=lambda_reg,
+                               voxel_chunk_size=voxel_chunk_size,
+                               nb_procs=nb_procs,
+                               checkpoint_dir=checkpoint_dir)
     rfir_estimator.linkToData(func_data)
     rfir_estimator.run()
     outputs = rfir_estimator.getOutputs()
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import os.path as op
+import logging
+
 import numpy as np
 
 from pyhrf import Condition
@@ -8,6 +10,9 @@ from pyhrf.tools import Pipeline
 
 import pyhrf.boldsynth.scenarios as simbase
 
+
+logger = logging.getLogger(__name__)
+
 PHY_PARAMS_FRISTON00 = {
     'model_name' : 'Friston00',
     'tau_s' : 1/.8,
@@ -117,42 +122,89 @@ def phy_integrate_euler(phy_params, tstep, stim, epsilon, Y0=None):
     TODO: should the output signals be rescaled wrt their value at rest?
     """
 
-    epsilon = phy_params['eps']   #WARNING!! Added to compute figures 
+    epsilon = phy_params['eps']   #WARNING!! Added to compute figures
+    return phy_integrate(phy_params, tstep, stim, epsilon, Y0,
+                         method='euler')[:, :, 0]
+
+
+def phy_integrate(phy_params, tstep, stim, epsilon, Y0=None, method='rk4'):
+    """
+    Integrate the ODEs of the physiological model for several neural
+    efficacies at once. The states of all voxels are advanced together as
+    (4, nb_voxels) arrays.
+
+    Args:
+        - phy_params (dict (<param_name> : <param_value>):
+            parameters of the physiological model
+        - tstep (float): time step of the integration, in seconds.
+        - stim (np.array(nb_steps, float)): stimulation sequence with a temporal
+            resolution equal to the time step of the integration. It is
+            considered constant within each time step.
+        - epsilon (float | np.array(nb_voxels, float)): neural efficacies
+        - Y0 (np.array(4, float) | None): initial values for the physiological
+                                          signals.
+                                          If None: [0, 1,   1, 1.]
+                                                    s  f_in v  q
+        - method (str): integration scheme, either 'euler' (1st order) or
+            'rk4' (4th order Runge-Kutta, which allows much coarser time
+            steps for the same accuracy)
+    Result:
+        - np.array((4, nb_steps, nb_voxels), float)
+          -> the integrated physiological signals, where indexes of the first
+          axis correspond to:
+              0 : flow inducing
+              1 : inflow
+              2 : blood volume
+              3 : HbR
+    """
+    epsilon = np.atleast_1d(np.asarray(epsilon, dtype=float))
     tau_s = phy_params['tau_s']
     tau_f = phy_params['tau_f']
     tau_m = phy_params['tau_m']
     alpha_w = phy_params['alpha_w']
     E0 = phy_params['E0']
 
-    def cpt_phy_model_deriv(y, s, epsi, dest):
+    def cpt_phy_model_deriv(y, s):
         N, f_in, v, q = y
-        if f_in < 0.:
-            #raise Exception('Negative f_in (%f) at t=%f' %(f_in, ti))
+        if (f_in < 0.).any():
             #HACK
-            print 'Warning: Negative f_in (%f) at t=%f' %(f_in, ti)
-            f_in = 1e-4
-
-        dest[0] = epsi*s - (N/tau_s)-((f_in - 1)/tau_f) #dNdt
-        dest[1] = N #dfidt
-        dest[2] = (1/tau_m)*(f_in-v**(1/alpha_w)) #dvdt
-        dest[3] = (1/tau_m)*((f_in/E0)*(1-(1-E0)**(1/f_in)) - \
-                             (q/v)*(v**(1/alpha_w))) #dqdt
-        return dest
-
-    res = np.zeros((stim.size+1,4))
-    res[0,:] = Y0 or np.array([0., 1., 1., 1.])
-
-    for ti in xrange(1, stim.size+1):
-        cpt_phy_model_deriv(res[ti-1], stim[ti-1], epsilon, dest=res[ti])
-        res[ti] *= tstep
-        res[ti] += res[ti-1]
-
-    return res[1:,:].T
-
+            logger.warning('Negative f_in (min=%f) during integration',
+                           f_in.min())
+            f_in = np.where(f_in < 0., 1e-4, f_in)
+
+        v_w = v ** (1 / alpha_w)
+        return np.array([epsilon * s - (N / tau_s) - ((f_in - 1) / tau_f),
+                         N,
+                         (1 / tau_m) * (f_in - v_w),
+                         (1 / tau_m) * ((f_in / E0) * (1 - (1 - E0) ** (1 / f_in)) -
+                                        (q / v) * v_w)])
+
+    if method not in ['euler', 'rk4']:
+        raise ValueError('Unknown integration method: %s' % method)
+
+    y = np.zeros((4, epsilon.size))
+    y[:] = np.array([0., 1., 1., 1.] if Y0 is None else Y0)[:, np.newaxis]
+
+    res = np.zeros((4, stim.size, epsilon.size))
+    for ti in xrange(stim.size):
+        s = stim[ti]
+        k1 = cpt_phy_model_deriv(y, s)
+        if method == 'euler':
+            y = k1 * tstep + y
+        else:
+            k2 = cpt_phy_model_deriv(y + tstep / 2. * k1, s)
+            k3 = cpt_phy_model_deriv(y + tstep / 2. * k2, s)
+            k4 = cpt_phy_model_deriv(y + tstep * k3, s)
+            y = y + tstep / 6. * (k1 + 2 * k2 + 2 * k3 + k4)
+        res[:, ti] = y
+
+    return res
 
 
 def create_evoked_physio_signals(physiological_params, paradigm,
-                                 neural_efficacies, dt, integration_step=.05):
+                                 neural_efficacies, dt, integration_step=.05,
+                                 integration_method='euler',
+                                 voxel_efficacies=False):
     """
     Generate evoked hemodynamics signals by integrating a physiological model.
 
@@ -167,7 +219,15 @@ def create_evoked_physio_signals(physiological_params, paradigm,
         - dt (float):
              temporal resolution of the output signals, in second
         - integration_step (float):
-             time step used for integration, in second
+             time step used for integration, in second. It can be set to dt
+             with the 'rk4' integration method.
+        - integration_method (str):
+             'rk4' (4th order Runge-Kutta) or 'euler'
+        - voxel_efficacies (bool):
+             if True, each voxel is driven by its own neural efficacy.
+             Otherwise, as in phy_integrate_euler, all voxels use the
+             efficacy of the model (physiological_params['eps']) and only the
+             number of voxels is taken from neural_efficacies.
 
     Returns:
         - np.array((nb_signals, nb_scans, nb_voxels), float)
@@ -185,17 +245,25 @@ def create_evoked_physio_signals(physiological_params, paradigm,
     stim = paradigm.get_rastered(integration_step)[first_cond][0]
     neural_efficacies = neural_efficacies[0]
 
-    # response matrix intialization
-    integrated_vars = np.zeros((4, neural_efficacies.shape[0], stim.shape[0]))
-    for i, epsilon in enumerate(neural_efficacies):
-        integrated_vars[:,i,:] = phy_integrate_euler(physiological_params,
-                                                     integration_step, stim,
-                                                     epsilon)
-
-    #downsampling:
     nb_scans = paradigm.get_rastered(dt)[first_cond][0].size
     dsf = int(dt/integration_step)
-    return np.swapaxes(integrated_vars[:,:,::dsf][:,:,:nb_scans], 1, 2)
+
+    if voxel_efficacies:
+        integrated_vars = phy_integrate(physiological_params,
+                                        integration_step, stim,
+                                        neural_efficacies,
+                                        method=integration_method)
+        #downsampling:
+        return integrated_vars[:, ::dsf][:, :nb_scans]
+    else:
+        # all voxels share the same signals: integrate them once, then
+        # downsample before copying them to every voxel
+        integrated_vars = phy_integrate(physiological_params,
+                                        integration_step, stim,
+                                        physiological_params['eps'],
+                                        method=integration_method)
+        return np.repeat(integrated_vars[:, ::dsf][:, :nb_scans],
+                         neural_efficacies.size, axis=2)
 
 def create_bold_from_hbr_and_cbv(physiological_params, hbr, cbv):
     """
@@ -6,6 +6,7 @@ from numpy import *
 from scipy.stats import truncnorm
 from scipy.special import erfc
 from scipy.special import erf
+from scipy.linalg import solve_triangular
 
 class RandomGenerator():
     """B
@@ -215,3 +216,82 @@ def gm_sample(means, variances, props, n=1):
     labels = (rand(n)[:,np.newaxis] > np.cumsum(props)[np.newaxis,:]).sum(1)
 
     return randn(n) * variances[labels]**.5 + means[labels]
+
+
+def sample_diag_gaussian(means, variances):
+    """
+    Sample independent Gaussian vectors with isotropic covariances, eg one
+    vector per voxel, in a single array operation.
+
+    Args:
+        *means* (np.ndarray): shape (..., dim, nbVox)
+        *variances* (np.ndarray): variance of each vector, shape (..., nbVox)
+                                  or broadcastable to it
+
+    Standard normal deviates are drawn voxel after voxel, so that the result
+    is the same as looping over voxels (and then over the leading axes) and
+    calling randn(dim) for each vector.
+    """
+    means = np.asarray(means)
+    dim, nb_vox = means.shape[-2:]
+    noise = randn(*((nb_vox,) + means.shape[:-2] + (dim,)))
+    noise = np.rollaxis(noise, 0, noise.ndim)
+    stds = np.sqrt(np.asarray(variances, dtype=float))
+    return means + noise * stds[..., np.newaxis, :]
+
+
+def sample_gaussian(precision, vector):
+    """
+    Sample x ~ N(Q^{-1} v, Q^{-1}) for a precision matrix Q and a vector v
+    from a single Cholesky factorisation Q = L L^t, used both for the mean
+    and the draw: x = L^{-t} (L^{-1} v + z) with z ~ N(0, I).
+    """
+    chol = np.linalg.cholesky(precision)
+    w = solve_triangular(chol, vector, lower=True)
+    return solve_triangular(chol.T, w + randn(len(w)), lower=False)
+
+
+def sample_gaussian_precision(precisions, vectors):
+    """
+    Batched version of sample_gaussian: sample x ~ N(Q^{-1} v, Q^{-1}) for a
+    stack of precision matrices Q and vectors v, eg one per voxel, in a
+    single array operation.
+
+    Args:
+        *precisions* (np.ndarray): shape (dim, dim, nbVox)
+        *vectors* (np.ndarray): shape (dim, nbVox)
+
+    Return an array of shape (dim, nbVox). Draws are the same as calling
+    sample_gaussian on each voxel in turn.
+    Requires numpy >= 1.8 (stacked linear algebra).
+    """
+    q = np.rollaxis(np.asarray(precisions, dtype=float), 2)
+    v = np.asarray(vectors, dtype=float).T[:, :, np.newaxis]
+    chol = np.linalg.cholesky(q)
+    w = np.linalg.solve(chol, v)
+    w += randn(*v.shape[:2])[:, :, np.newaxis]
+    return np.linalg.solve(chol.swapaxes(1, 2), w)[:, :, 0].T
+
+
+def quadratic_forms(x, q=None):
+    """
+    Compute x_i^t Q x_i for all columns x_i of *x* (shape (n, nbVox)).
+
+    *q* is either None (identity), a (n, n) matrix shared by all columns or a
+    stack of (n, n, nbVox) matrices, one per column.
+    """
+    if q is None:
+        return (x * x).sum(0)
+    if q.ndim == 2:
+        return (x * np.dot(q, x)).sum(0)
+    return np.einsum('iv,ijv,jv->v', x, q, x)
+
+
+def sample_noise_variances(betas, shape):
+    """
+    Sample the variances betas / Ga(shape, 1), one per element of *betas*
+    (any shape), ie inverse-gamma draws of scales *betas*.
+    Draws are made in the C order of *betas*.
+    """
+    betas = np.asarray(betas, dtype=float)
+    return betas / np.random.gamma(shape, 1, betas.shape)
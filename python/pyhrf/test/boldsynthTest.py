@@ -79,6 +79,28 @@ class FieldFuncsTest(unittest.TestCase):
         mapPotts = np.ones_like(mask)
         mapPotts[np.where(mask)] = labels
 
+    def test_swendsenwang_edges(self):
+        """ The edges-based sampler should reproduce the former pure python
+        implementation, given the same random state """
+        mask = np.ones((6, 7), dtype=int)
+        g = graph_from_lattice(mask, kerMask=kerMask2D_4n)
+        weights = [np.random.rand(len(nl)) for nl in g]
+        for w in [None, weights]:
+            samples = []
+            for method in [LINK_GRAPH_METHOD, LINK_EDGES_METHOD]:
+                np.random.seed(42)
+                labels = np.zeros(mask.size, dtype=int)
+                for i in xrange(5):
+                    SwendsenWangSampler_graph(g, labels, .6, 3, method=method,
+                                              weights=w)
+                samples.append(labels)
+            np.testing.assert_array_equal(samples[0], samples[1])
+
+        edges = graph_edges(g, weights)
+        self.assertEqual(len(edges[0]), 6 * 6 + 5 * 7)
+        self.assertAlmostEqual(Cpt_U_edges(edges, samples[0]),
+                               Cpt_U_graph(g, samples[0], weights))
+
     def test_potts_gibbs(self):
         nbLabels = 2
         shape = (15, 15)
@@ -91,3 +113,38 @@ class FieldFuncsTest(unittest.TestCase):
                       nbLabels)
         mapPotts = np.ones_like(mask)
         mapPotts[np.where(mask)] = labels
+
+
+class StimInducedSignalTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(2)
+        self.nb_conds, self.nb_vox, self.nb_dt, self.hrf_len = 3, 40, 200, 20
+        self.paradigm = (np.random.rand(self.nb_conds, self.nb_dt) < .05)\
+            .astype(int)
+        self.nrls = np.random.randn(self.nb_conds, self.nb_vox)
+
+    def _loop_signal(self, hrf):
+        bold = np.zeros((self.hrf_len + self.nb_dt - 1, self.nb_vox))
+        for ipos in xrange(self.nb_vox):
+            h = hrf[:, ipos] if hrf.ndim == 2 else hrf
+            for ic in xrange(self.nb_conds):
+                activity = self.paradigm[ic, :] * self.nrls[ic, ipos]
+                bold[:, ipos] += np.convolve(activity, h)
+        return bold
+
+    def test_single_hrf(self):
+        hrf = np.random.randn(self.hrf_len)
+        bold = create_stim_induced_signal(self.nrls, self.paradigm, hrf, .5)
+        np.testing.assert_allclose(bold, self._loop_signal(hrf), atol=1e-12)
+
+    def test_voxel_hrfs(self):
+        hrf = np.random.randn(self.hrf_len, self.nb_vox)
+        bold = create_stim_induced_signal(self.nrls, self.paradigm, hrf, .5)
+        np.testing.assert_allclose(bold, self._loop_signal(hrf), atol=1e-12)
+
+    def test_shared_hrfs(self):
+        hrf = np.repeat(np.random.randn(self.hrf_len, 2), self.nb_vox / 2,
+                        axis=1)
+        bold = create_stim_induced_signal(self.nrls, self.paradigm, hrf, .5)
+        np.testing.assert_allclose(bold, self._loop_signal(hrf), atol=1e-12)
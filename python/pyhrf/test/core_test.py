@@ -2,12 +2,14 @@
 import os
 import os.path as op
 import unittest
+import cPickle
 import tempfile
 import shutil
 import numpy as np
 
 import pyhrf
-from pyhrf.core import FmriData, merge_fmri_sessions
+from pyhrf.core import FmriData, FmriSharedData, merge_fmri_sessions, \
+    DEFAULT_MASK_VOL_FILE
 
 class FMRIDataTest(unittest.TestCase):
     
@@ -24,3 +26,69 @@ class FMRIDataTest(unittest.TestCase):
         self.assertEqual(fd_msession.nbSessions, 2)
 
         
+
+    def test_roi_split(self):
+        fmri_data = FmriData.from_vol_ui()
+        mask = fmri_data.roiMask
+        in_mask = mask[np.where(mask != fmri_data.backgroundLabel)]
+        roi_datasets = fmri_data.roi_split()
+        roi_ids = [i for i in np.unique(mask)
+                   if i != fmri_data.backgroundLabel]
+        self.assertEqual([rd.get_roi_id() for rd in roi_datasets], roi_ids)
+        for roi_id, roi_data in zip(roi_ids, roi_datasets):
+            roi_mask = np.zeros_like(mask) + fmri_data.backgroundLabel
+            roi_mask[np.where(mask == roi_id)] = roi_id
+            np.testing.assert_equal(roi_data.roiMask, roi_mask)
+            np.testing.assert_equal(roi_data.bold,
+                                    fmri_data.bold[:, in_mask == roi_id])
+
+    def test_graph_cache(self):
+        fmri_data = FmriData.from_vol_ui()
+        graphs = fmri_data.get_graph()
+        # graphs are not rebuilt as long as the mask does not change:
+        self.assertTrue(fmri_data.get_graph() is graphs)
+        roi_ids = sorted(graphs.keys())
+        fmri_data.discard_rois(roi_ids[:1])
+        self.assertEqual(sorted(fmri_data.graphs.keys()), roi_ids[1:])
+
+    def test_graph_disk_cache(self):
+        tmp_dir = tempfile.mkdtemp(prefix='pyhrf_tests',
+                                   dir=pyhrf.cfg['global']['tmp_path'])
+        cache_graphs = pyhrf.cfg['treatment-default']['cache_graphs']
+        try:
+            pyhrf.cfg['treatment-default']['cache_graphs'] = 1
+            mask_file = op.join(tmp_dir, 'mask.nii.gz')
+            shutil.copy(DEFAULT_MASK_VOL_FILE, mask_file)
+            graphs = FmriData.from_vol_files(mask_file=mask_file).get_graph()
+            cache_files = [f for f in os.listdir(tmp_dir)
+                           if f.startswith('pyhrf_graphs_')]
+            self.assertEqual(len(cache_files), 1)
+
+            fmri_data = FmriData.from_vol_files(mask_file=mask_file)
+            self.assertTrue(fmri_data.load_cached_graphs() is not None)
+            cached_graphs = fmri_data.get_graph()
+            self.assertEqual(sorted(cached_graphs.keys()),
+                             sorted(graphs.keys()))
+            for roi_id, g in graphs.iteritems():
+                for nl, cached_nl in zip(g, cached_graphs[roi_id]):
+                    np.testing.assert_array_equal(nl, cached_nl)
+        finally:
+            pyhrf.cfg['treatment-default']['cache_graphs'] = cache_graphs
+            shutil.rmtree(tmp_dir)
+
+    def test_shared_data_roi_views(self):
+        fmri_data = FmriData.from_vol_ui()
+        shared_data = FmriSharedData(fmri_data)
+        bold_file = shared_data.bold_file
+        # ROI data sets are rebuilt from the pickled instance, as in workers:
+        shared_data = cPickle.loads(cPickle.dumps(shared_data))
+        for roi_data in fmri_data.roi_split():
+            roi_id = roi_data.get_roi_id()
+            shared_roi_data = shared_data.get_roi_data(roi_id)
+            self.assertEqual(shared_roi_data.get_roi_id(), roi_id)
+            np.testing.assert_equal(shared_roi_data.bold, roi_data.bold)
+            np.testing.assert_equal(shared_roi_data.roiMask,
+                                    roi_data.roiMask)
+        shared_data.clean()
+        self.assertFalse(op.exists(bold_file))
+        self.assertFalse(op.exists(op.dirname(bold_file)))
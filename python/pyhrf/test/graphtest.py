@@ -10,10 +10,27 @@ import shutil
 import numpy as _np
 
 from pyhrf.graph import *
-from pyhrf.boldsynth.spatialconfig import lattice_indexes
+from pyhrf.boldsynth.spatialconfig import lattice_indexes, mask_to_coords
+from pyhrf.tools import cartesian
 
 from pyhrf.tools._io import read_volume, write_volume
 
+def graph_from_lattice_loop(mask, kerMask=None):
+    """ Reference construction of a lattice graph, position by position, by
+    centering *kerMask* on each position (former graph_from_lattice)
+    """
+    if kerMask is None:
+        neighbourCoords = list(cartesian(*[[0, -1, 1]] * mask.ndim))[1:]
+        kerMask = tuple(_np.array(neighbourCoords, dtype=int).transpose())
+    positions = mask_to_coords(mask)
+    latticeIndexes = lattice_indexes(mask)
+    closestNeighbours = _np.empty(len(positions), dtype=object)
+    for idx, pos in enumerate(positions):
+        m = center_mask_at(kerMask, pos, latticeIndexes)
+        closestNeighbours[idx] = latticeIndexes[m][latticeIndexes[m] >= 0]
+    return closestNeighbours
+
+
 class GraphTest(unittest.TestCase):
 
     def setUp(self):
@@ -132,6 +149,22 @@ class GraphTest(unittest.TestCase):
 #         print graphWhere2
         assert graph_is_sane(graphWhere2)
 
+    def test_graph_coloring(self):
+        """ Test colouring of 6-connected (checkerboard) and 26-connected
+        (greedy) 3D lattices
+        """
+        for kerMask, nbColors in [(kerMask3D_6n, 2), (None, None)]:
+            g = graph_from_lattice(self.lattice3D > 0, kerMask=kerMask)
+            blocks = graph_coloring(g)
+            if nbColors is not None:
+                self.assertEqual(len(blocks), nbColors)
+            all_nodes = _np.sort(_np.concatenate(blocks))
+            _np.testing.assert_array_equal(all_nodes, _np.arange(len(g)))
+            for block in blocks:
+                sblock = set(block)
+                for n in block:
+                    assert len(sblock.intersection(g[n])) == 0
+
     def test_parcels_to_graphs(self):
 #         print 'lattice:'
 #         print self.lattice3D
@@ -140,6 +173,50 @@ class GraphTest(unittest.TestCase):
             assert graph_is_sane(pg)
 
 
+    def test_lattice_to_csr(self):
+        """ Test that the CSR adjacency matches the graph built position by
+        position, and its conversion to padded neighbour indexes
+        """
+        mask = self.lattice3D > 0
+        g = graph_from_lattice_loop(mask, kerMask=kerMask3D_6n)
+        indptr, indices = lattice_to_csr(mask, kerMask=kerMask3D_6n)
+        self.assertEqual(len(indptr), len(g) + 1)
+        for nl, csr_nl in zip(g, csr_to_graph(indptr, indices)):
+            _np.testing.assert_array_equal(nl, csr_nl)
+
+        ni = csr_to_neighbours_indexes(indptr, indices)
+        self.assertEqual(ni.shape, (len(g), max(len(nl) for nl in g)))
+        for nl, ni_row in zip(g, ni):
+            _np.testing.assert_array_equal(nl, ni_row[ni_row >= 0])
+
+    def test_graph_from_lattice(self):
+        """ Test graphs built by array shifts against the graphs built
+        position by position
+        """
+        masks = [self.lattice2D > 0, self.lattice3D > 0, self.lattice3D == 2]
+        kerMasks = [kerMask2D_4n, kerMask3D_6n, None]
+        for mask, kerMask in zip(masks, kerMasks):
+            g = graph_from_lattice(mask, kerMask=kerMask)
+            g_ref = graph_from_lattice_loop(mask, kerMask=kerMask)
+            self.assertEqual(len(g), len(g_ref))
+            for nl, nl_ref in zip(g, g_ref):
+                _np.testing.assert_array_equal(nl, nl_ref)
+
+    def test_parcels_to_csr_graphs(self):
+        """ Test that parcel graphs computed in one pass over the labelled
+        volume match graphs computed parcel by parcel
+        """
+        for kerMask in [kerMask3D_6n, None]:
+            pgs = parcels_to_csr_graphs(self.lattice3D, kerMask=kerMask)
+            self.assertEqual(set(pgs.keys()), set([0, 1, 2]))
+            for pid, (indptr, indices) in pgs.iteritems():
+                g = graph_from_lattice_loop(self.lattice3D == pid,
+                                            kerMask=kerMask)
+                g_csr = csr_to_graph(indptr, indices)
+                assert graph_is_sane(g_csr)
+                for nl, csr_nl in zip(g, g_csr):
+                    _np.testing.assert_array_equal(nl, csr_nl)
+
     def test_bfs(self):
 
         vol = np.array( [[1,1,0,1,1],
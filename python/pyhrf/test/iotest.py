@@ -286,6 +286,41 @@ class DataLoadTest(unittest.TestCase):
             print h
 
 
+class ResultArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='pyhrf_tests',
+                                        dir=pyhrf.cfg['global']['tmp_path'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dump_load(self):
+        results = [(i, np.arange(i + 3.), 'ok') for i in (3, 1, 7)]
+        fn = op.join(self.tmp_dir, 'result.pck')
+        pio.dump_results(results, fn)
+        loaded = pio.load_results(fn)
+        self.assertEqual(sorted(r[0] for r in loaded), [1, 3, 7])
+        with pio.ResultArchive(fn) as archive:
+            self.assertEqual(sorted(archive.roi_ids()), [1, 3, 7])
+            np.testing.assert_equal(archive.load(7)[1], np.arange(10.))
+
+    def test_append(self):
+        fn = op.join(self.tmp_dir, 'result.pck')
+        pio.dump_results([(1, None, 'ok')], fn)
+        with pio.ResultArchive(fn, 'a') as archive:
+            archive.dump((2, None, 'ok'))
+        self.assertEqual(len(pio.load_results(fn)), 2)
+
+    def test_legacy_pickle(self):
+        import cPickle
+        fn = op.join(self.tmp_dir, 'result.pck')
+        f = open(fn, 'w')
+        cPickle.dump([(1, None, 'ok')], f)
+        f.close()
+        self.assertEqual(pio.load_results(fn), [(1, None, 'ok')])
+
+
 class xndarrayIOTest(unittest.TestCase):
 
     def setUp(self):
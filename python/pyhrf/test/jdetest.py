@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import os
+import os.path as op
 import unittest
 import tempfile
 import shutil
 import logging
+import copy
 
 import numpy as np
 
@@ -17,15 +20,34 @@ from pyhrf.jde.models import BOLDGibbsSampler as BG
 from pyhrf.jde.beta import BetaSampler as BS
 from pyhrf.jde.nrl.bigaussian import NRLSampler as NS
 from pyhrf.jde.nrl.bigaussian import BiGaussMixtureParamsSampler as BGMS
+from pyhrf.jde.nrl.bigaussian import MixtureWeightsSampler
 from pyhrf.jde.hrf import RHSampler as HVS
 from pyhrf.jde.hrf import HRFSampler as HS
 from pyhrf.jde.models import simulate_bold
+from pyhrf.jde.hrf import ScaleSampler
 from pyhrf.jde.noise import NoiseVarianceSampler
+from pyhrf.ui.jde import JDEMCMCAnalyser
+from pyhrf.jde.samplerbase import GSDefaultCallbackHandler, load_checkpoint
+from pyhrf.jde.design import DesignCache, design_cache
+from pyhrf.jde.nrl.habituation import subcptGamma, LaplacianPdf, \
+    NRLwithHabSampler
 
 
 logger = logging.getLogger(__name__)
 
 
+class CrashCallback(GSDefaultCallbackHandler):
+    """ Interrupt the sampling at a given iteration """
+
+    def __init__(self, crash_it):
+        GSDefaultCallbackHandler.__init__(self)
+        self.crash_it = crash_it
+
+    def callback(self, it, variables, samplerEngine):
+        if it == self.crash_it:
+            raise KeyboardInterrupt()
+
+
 class JDETest(unittest.TestCase):
 
     def setUp(self):
@@ -165,6 +187,230 @@ class JDETest(unittest.TestCase):
         treatment, xml_file, result = jde_surf_from_files(nbIterations=2,
                                                           outputDir=self.tmp_dir)
 
+    def test_chromatic_nrl_sampling(self):
+        """ Without spatial correlation (beta=0), sampling NRLs by colour
+        blocks must give the same draws as the serial sampling.
+        """
+        pyhrf.logger.setLevel(logging.WARNING)
+        params = {
+            'nb_iterations': 1,
+            'beta': BS(do_sampling=False, val_ini=np.array([0.])),
+            'hrf': HS(do_sampling=False, use_true_value=True,
+                      prior_type='singleHRF'),
+            'hrf_var': HVS(do_sampling=False, use_true_value=True),
+            'response_levels': NS(do_sampling=True, do_label_sampling=True,
+                                  use_true_labels=True),
+            'mixt_params': BGMS(do_sampling=False, use_true_value=True),
+            'mixt_weights': MixtureWeightsSampler(do_sampling=False),
+            'scale': ScaleSampler(),
+            'noise_var': NoiseVarianceSampler(do_sampling=False,
+                                              use_true_value=True),
+        }
+
+        final_nrls = []
+        for chromatic in [False, True]:
+            sampler = BG(**copy.deepcopy(params))
+            sampler.get_variable('nrl').chromatic_sampling = chromatic
+            analyser = JDEMCMCAnalyser(sampler=sampler, dt=self.dt)
+            sampler.linkToData(analyser.packSamplerInput(self.data_simu))
+            np.random.seed(3)
+            sampler.runSampling(self.data_simu)
+            final_nrls.append(sampler.get_variable('nrl').finalValue)
+
+        np.testing.assert_array_almost_equal(final_nrls[0], final_nrls[1])
+
+    def test_chromatic_label_sampling_spatial(self):
+        """ With spatial correlation (beta>0), sampling labels by colour
+        blocks must give the same label posterior as the serial C sampler.
+        """
+        pyhrf.logger.setLevel(logging.WARNING)
+        params = {
+            'nb_iterations': 100,
+            'beta': BS(do_sampling=False, val_ini=np.array([0.8])),
+            'hrf': HS(do_sampling=False, use_true_value=True,
+                      prior_type='singleHRF'),
+            'hrf_var': HVS(do_sampling=False, use_true_value=True),
+            'response_levels': NS(do_sampling=True, do_label_sampling=True,
+                                  use_true_labels=False),
+            'mixt_params': BGMS(do_sampling=False, use_true_value=True),
+            'mixt_weights': MixtureWeightsSampler(do_sampling=False),
+            'scale': ScaleSampler(),
+            'noise_var': NoiseVarianceSampler(do_sampling=False,
+                                              use_true_value=True),
+        }
+
+        labels_pm = []
+        nrls_pm = []
+        for chromatic in [False, True]:
+            sampler = BG(**copy.deepcopy(params))
+            nrl_sampler = sampler.get_variable('nrl')
+            nrl_sampler.chromatic_sampling = chromatic
+            analyser = JDEMCMCAnalyser(sampler=sampler, dt=self.dt)
+            sampler.linkToData(analyser.packSamplerInput(self.data_simu))
+            np.random.seed(3)
+            sampler.runSampling(self.data_simu)
+            labels_pm.append(nrl_sampler.meanLabels)
+            nrls_pm.append(nrl_sampler.finalValue)
+
+        # the chains differ (update order), only posterior summaries agree:
+        self.assertLess(np.abs(labels_pm[0] - labels_pm[1]).mean(), .1)
+        agreement = (labels_pm[0].argmax(0) == labels_pm[1].argmax(0)).mean()
+        self.assertGreater(agreement, .9)
+        nrl_scale = np.abs(nrls_pm[0]).mean()
+        self.assertLess(np.abs(nrls_pm[0] - nrls_pm[1]).mean(),
+                        .2 * nrl_scale)
+
+    def test_fit_errors_pace(self):
+        """ Reconstruction error and log-likelihood are only tracked at the
+        given pace, the BIC is computed at the final iteration
+        """
+        pyhrf.logger.setLevel(logging.WARNING)
+        params = {
+            'nb_iterations': 5,
+            'fit_hist_pace': 2,
+            'beta': BS(do_sampling=False, val_ini=np.array([0.6])),
+            'hrf': HS(do_sampling=False, use_true_value=True,
+                      prior_type='singleHRF'),
+            'hrf_var': HVS(do_sampling=False, use_true_value=True),
+            'response_levels': NS(do_sampling=True, do_label_sampling=False,
+                                  use_true_labels=True),
+            'mixt_params': BGMS(do_sampling=False, use_true_value=True),
+            'mixt_weights': MixtureWeightsSampler(do_sampling=False),
+            'scale': ScaleSampler(),
+            'noise_var': NoiseVarianceSampler(do_sampling=False,
+                                              use_true_value=True),
+        }
+        sampler = BG(**params)
+        analyser = JDEMCMCAnalyser(sampler=sampler, dt=self.dt)
+        sampler.linkToData(analyser.packSamplerInput(self.data_simu))
+        sampler.runSampling(self.data_simu)
+        self.assertEqual(len(sampler.converror), 3)  # its 0, 2 and 4
+        self.assertEqual(len(sampler.loglikelihood), 3)
+
+        # check against the voxel-wise log-likelihood:
+        bold = self.data_simu.bold
+        r = bold - sampler.computeFit()
+        noise_var = sampler.get_variable('noise_var')
+        noise_var.currentValue = var_noise = noise_var.finalValue
+        loglh = 0.
+        for j in xrange(r.shape[1]):
+            loglh -= (np.log(np.abs(2 * np.pi * var_noise[j] * r.shape[0])) +
+                      np.dot(r[:, j], r[:, j]) / var_noise[j] / 2)
+        self.assertAlmostEqual(sampler.compute_fit_errors(bold)[1], loglh)
+
+    def test_adaptive_stopping(self):
+        """ Burn-in and sampling end before the maximum number of
+        iterations when the NRL chains converge
+        """
+        pyhrf.logger.setLevel(logging.WARNING)
+        sampler = BG(nb_iterations=1000, stop_crit_rhat=1.1,
+                     stop_crit_ess=100,
+                     beta=BS(do_sampling=False, val_ini=np.array([0.6])),
+                     hrf=HS(do_sampling=False, use_true_value=True,
+                            prior_type='singleHRF'),
+                     hrf_var=HVS(do_sampling=False, use_true_value=True),
+                     response_levels=NS(do_sampling=True,
+                                        do_label_sampling=False,
+                                        use_true_labels=True),
+                     mixt_params=BGMS(do_sampling=False, use_true_value=True),
+                     mixt_weights=MixtureWeightsSampler(do_sampling=False),
+                     scale=ScaleSampler(),
+                     noise_var=NoiseVarianceSampler(do_sampling=False,
+                                                    use_true_value=True))
+        # the true HRF is sampled at the time resolution of the simulation:
+        dt = self.data_simu.simulation[0]['dt']
+        analyser = JDEMCMCAnalyser(sampler=sampler, dt=dt)
+        sampler.linkToData(analyser.packSamplerInput(self.data_simu))
+        sampler.runSampling(self.data_simu)
+        self.assertTrue(sampler.nbSweeps < 300)
+        self.assertTrue(sampler.final_iteration < 999)
+        outputs = sampler.getOutputs()
+        self.assertEqual(outputs['mcmc_nb_iterations'].data[0],
+                         sampler.final_iteration + 1)
+
+    def test_shared_design(self):
+        """ Sampler inputs built with the same paradigm and settings share
+        their read-only design matrices
+        """
+        design_cache.clear()
+        analyser = JDEMCMCAnalyser(sampler=BG(), dt=self.dt)
+        input1 = analyser.packSamplerInput(self.data_simu)
+        input2 = analyser.packSamplerInput(self.data_simu)
+        self.assertTrue(np.may_share_memory(input1.varX, input2.varX))
+        self.assertTrue(np.may_share_memory(input1.stackX, input2.stackX))
+        self.assertFalse(input2.varX.flags.writeable)
+        # data-dependent precalculations are not shared:
+        self.assertFalse(np.may_share_memory(input1.matQy, input2.matQy))
+
+        analyser = JDEMCMCAnalyser(sampler=BG(), dt=self.dt / 2)
+        input3 = analyser.packSamplerInput(self.data_simu)
+        self.assertNotEqual(input3.varX.shape, input1.varX.shape)
+
+    def test_design_cache_dir(self):
+        """ Designs stored in a cache directory are reloaded by other
+        caches (eg in worker processes) as read-only memory maps
+        """
+        class DesignHolder:
+            pass
+
+        cache_dir = op.join(self.tmp_dir, 'designs')
+        holder = DesignHolder()
+
+        def build():
+            holder.mat = np.arange(6.).reshape(2, 3)
+            holder.nb_cols = 3
+
+        cache = DesignCache(cache_dir)
+        key = cache.make_key('design', np.arange(3))
+        cache.setup(holder, key, build)
+
+        def fail():
+            raise Exception('design should have been reused')
+
+        other_holder = DesignHolder()
+        DesignCache(cache_dir).setup(other_holder, key, fail)
+        np.testing.assert_array_equal(other_holder.mat, holder.mat)
+        self.assertTrue(isinstance(other_holder.mat, np.memmap))
+        self.assertFalse(other_holder.mat.flags.writeable)
+        self.assertEqual(other_holder.nb_cols, 3)
+
+    def test_checkpoint_resume(self):
+        """ A chain resumed from a checkpoint gives the same samples as an
+        uninterrupted chain
+        """
+        pyhrf.logger.setLevel(logging.WARNING)
+        params = {
+            'nb_iterations': 6,
+            'beta': BS(do_sampling=False, val_ini=np.array([0.6])),
+            'hrf': HS(do_sampling=True, prior_type='singleHRF'),
+            'hrf_var': HVS(do_sampling=False, use_true_value=True),
+            'response_levels': NS(do_sampling=True, do_label_sampling=True),
+            'mixt_params': BGMS(do_sampling=True),
+            'mixt_weights': MixtureWeightsSampler(do_sampling=False),
+            'scale': ScaleSampler(),
+            'noise_var': NoiseVarianceSampler(do_sampling=True),
+        }
+        checkpoint_file = op.join(self.tmp_dir, 'checkpoint.pck')
+        final_nrls = []
+        for interrupt in [False, True]:
+            sampler = BG(**copy.deepcopy(params))
+            analyser = JDEMCMCAnalyser(sampler=sampler, dt=self.dt)
+            sampler.linkToData(analyser.packSamplerInput(self.data_simu))
+            np.random.seed(3)
+            if interrupt:
+                sampler.callbacker = CrashCallback(4)
+                sampler.set_checkpoint(checkpoint_file, 3)
+                self.assertRaises(KeyboardInterrupt, sampler.runSampling,
+                                  self.data_simu)
+                np.random.seed(5)  # must be restored from the checkpoint
+                sampler = load_checkpoint(checkpoint_file)
+                sampler.callbacker = GSDefaultCallbackHandler()
+            sampler.runSampling(self.data_simu)
+            self.assertEqual(sampler.final_iteration, 5)
+            final_nrls.append(sampler.get_variable('nrl').finalValue)
+
+        np.testing.assert_array_equal(final_nrls[0], final_nrls[1])
+
 if 0:
     from pyhrf.jde.noise import NoiseVarianceARSampler
 
@@ -295,6 +541,9 @@ if 0:
 from pyhrf.tools._io import read_volume
 from pyhrf.graph import parcels_to_graphs, kerMask3D_6n
 from pyhrf.jde.beta import Cpt_Vec_Estim_lnZ_Graph, Cpt_Vec_Estim_lnZ_Graph_fast3
+from pyhrf.jde.beta import Cpt_Vec_Estim_lnZ_Graph_cached, lnz_cache_key, \
+    save_cached_lnz, warm_lnz_cache
+from pyhrf.jde.beta import LoadBaseLogPartFctRef, find_nearest_lnz_reference
 
 
 class PartitionFunctionTest(unittest.TestCase):
@@ -303,8 +552,70 @@ class PartitionFunctionTest(unittest.TestCase):
         pf = 'subj0_parcellation.nii.gz'
         fnm = pyhrf.get_data_file_name(pf)
         m, mh = read_volume(fnm)
-        self.graph = parcels_to_graphs(m.astype(int), kerMask3D_6n,
+        self.parcellation = m.astype(int)
+        self.graph = parcels_to_graphs(self.parcellation, kerMask3D_6n,
                                        toDiscard=[0])[1]
+        self.tmp_dir = tempfile.mkdtemp(prefix='pyhrf_tests',
+                                        dir=pyhrf.cfg['global']['tmp_path'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_nearest_lnz_reference(self):
+        base, v_beta = LoadBaseLogPartFctRef()
+        self.assertEqual(len(v_beta), len(base.values()[0]['LogPF']))
+        nbn = np.array([len(nl) for nl in self.graph])
+        s, c = len(self.graph), nbn.sum() / 2
+        std_ngbh = np.sqrt((((c * 1. / s - nbn / 2.) ** 2) / s).sum()) / \
+            (c / (s - 1.))
+        best_ref, best_err = find_nearest_lnz_reference(2, s, c, std_ngbh)
+        # exhaustive search over the data base:
+        errors = dict((i, (np.abs((r['NbSites'] - 1.) * c / r['NbCliques'] -
+                                  (s - 1.)) * np.log(2.) +
+                           np.abs(r['StdNgbhDivMoyNgbh'] - std_ngbh)) *
+                       100. / (s * np.log(2.)))
+                      for i, r in base.iteritems() if r['NbLabels'] == 2)
+        best_i = min(errors, key=errors.get)
+        self.assertEqual(best_ref['Id'], best_i)
+        self.assertAlmostEqual(best_err, errors[best_i])
+        np.testing.assert_array_equal(best_ref['LogPF'], base[best_i]['LogPF'])
+
+    def test_lnz_cache(self):
+        lnz = Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2,
+                                             cache_dir=self.tmp_dir)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 1)
+        # same topology with shuffled neighbours -> same entry:
+        shuffled = np.array([nl[::-1] for nl in self.graph], dtype=object)
+        self.assertEqual(lnz_cache_key(shuffled, 2),
+                         lnz_cache_key(self.graph, 2))
+        self.assertNotEqual(lnz_cache_key(self.graph, 3),
+                            lnz_cache_key(self.graph, 2))
+        cached_lnz = Cpt_Vec_Estim_lnZ_Graph_cached(shuffled, 2,
+                                                    cache_dir=self.tmp_dir)
+        np.testing.assert_array_equal(lnz[0], cached_lnz[0])
+        np.testing.assert_array_equal(lnz[1], cached_lnz[1])
+
+    def test_lnz_cache_eviction(self):
+        grid = (np.zeros(1000), np.zeros(1000))
+        for i in xrange(3):
+            save_cached_lnz('key%d' % i, grid, self.tmp_dir)
+            # make each entry more recent than the previous one:
+            fn = op.join(self.tmp_dir, 'lnz_key%d.npz' % i)
+            os.utime(fn, (i, i))
+        entry_size = os.stat(fn).st_size
+        save_cached_lnz('key3', grid, self.tmp_dir,
+                        max_size=2.5 * entry_size / 2. ** 20)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['lnz_key2.npz', 'lnz_key3.npz'])
+
+    def test_warm_lnz_cache(self):
+        parcellation = np.zeros((6, 6, 3), dtype=int)
+        parcellation[:3, :3] = 1
+        parcellation[3:, 3:] = 2  # same shape as parcel 1
+        parcellation[3:, :2] = 3
+        nb_graphs = warm_lnz_cache(parcellation, cache_dir=self.tmp_dir)
+        self.assertEqual(nb_graphs, 2)
+        self.assertEqual(len(os.listdir(self.tmp_dir)), 2)
 
     def testExtrapolation2C(self):
         nbclasses = 2
@@ -321,6 +632,126 @@ from pyhrf.jde import asl as jde_asl
 from pyhrf.jde import asl_physio as jde_asl_physio
 
 
+class HabituationTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(25)
+        self.nbVox = 20
+        self.nrls = np.random.randn(self.nbVox) + 3.
+        self.habits = np.random.rand(self.nbVox)
+        self.deltaOns = np.random.rand(9) * 3
+
+    def test_batched_gamma(self):
+        """ Habituation factors computed for all voxels at once must match
+        the voxel-wise computation
+        """
+        gamma, time_nrls = subcptGamma(self.nrls, self.habits, 10,
+                                       self.deltaOns)
+        self.assertEqual(gamma.shape, (self.nbVox, 10))
+        for i in xrange(self.nbVox):
+            g, tn = subcptGamma(self.nrls[i], self.habits[i], 10,
+                                self.deltaOns)
+            np.testing.assert_almost_equal(gamma[i], g)
+            np.testing.assert_almost_equal(time_nrls[i], tn)
+        np.testing.assert_almost_equal(time_nrls,
+                                       gamma * self.nrls[:, np.newaxis])
+
+    def test_batched_laplacian_proposals(self):
+        np.random.seed(5)
+        expected = [LaplacianPdf(5., h, 0., 1.)[0] for h in self.habits]
+        np.random.seed(5)
+        proposals = LaplacianPdf(5., self.habits, 0., 1.)[0]
+        np.testing.assert_almost_equal(proposals, expected)
+        assert ((proposals >= 0.) & (proposals <= 1.)).all()
+
+    def habit_sampler(self):
+        """ Return a NRLwithHabSampler holding the state used by its
+        habituation MH step (the whole model cannot be instanciated)
+        """
+        ny, nh, nbCond, nbTrials = 40, 5, 2, 7
+        X = np.zeros((nbCond, ny, nh), dtype=int)
+        for nc in xrange(nbCond):
+            for t in xrange(nbTrials):
+                for k in xrange(nh):
+                    X[nc, 5 * t + 2 * nc + k, k] = t + 1
+
+        s = NRLwithHabSampler.__new__(NRLwithHabSampler)
+        s.nbVox, s.nbConditions, s.ny, s.nh = self.nbVox, nbCond, ny, nh
+        s.varSingleCondXtrials = X
+        s.nbTrials = np.array([nbTrials] * nbCond)
+        s.deltaOns = dict((nc, np.random.rand(nbTrials - 1) * 3)
+                          for nc in xrange(nbCond))
+        s.trialBins = [(X[nc] * ny + np.arange(ny)[:, np.newaxis]).ravel()
+                       for nc in xrange(nbCond)]
+        s.Lexp = 5.
+        s.keepSamples = False
+        s.outputRatio = False
+        s.currentValue = np.random.randn(nbCond, self.nbVox) + 3.
+        s.labels = (np.random.rand(nbCond, self.nbVox) > .3).astype(int)
+        s.habits = np.random.rand(nbCond, self.nbVox)
+
+        class DataInput:
+            pass
+        s.dataInput = DataInput()
+        s.dataInput.delta = np.eye(ny) + .1 * np.eye(ny, k=1) + \
+            .1 * np.eye(ny, k=-1)
+        s.Gamma = [np.zeros((self.nbVox, nbTrials)) for nc in xrange(nbCond)]
+        s.timeNrls = [np.zeros((self.nbVox, nbTrials))
+                      for nc in xrange(nbCond)]
+        s.varXh = np.zeros((self.nbVox, ny, nbCond))
+        s.aXh = np.zeros((ny, self.nbVox, nbCond))
+        h = np.array([0., .5, 1., .5, 0.])
+        # data generated with other habituation speeds
+        habits = s.habits
+        s.habits = np.random.rand(nbCond, self.nbVox)
+        s.updateXh(h)
+        s.dataInput.varMBY = s.sumaXh + np.random.randn(ny, self.nbVox) * .5
+        s.habits = habits
+        s.updateXh(h)
+        s.updateYtilde()
+        return s, h
+
+    def test_batched_habit_sampling(self):
+        """ The vectorised MH step on habituation speeds must match a
+        voxel-wise computation fed with the same random draws
+        """
+        s, h = self.habit_sampler()
+        rb = np.random.rand(self.nbVox) * .5 + .1
+        j = 0
+        Q = s.dataInput.delta
+        active = np.where(s.labels[j] == 1)[0]
+        habits = s.habits[j].copy()
+        eji = s.varYtilde + s.aXh[:, :, j]
+
+        np.random.seed(7)
+        proposals = [LaplacianPdf(s.Lexp, habits[i], 0., 1.)[0]
+                     for i in active]
+        uniforms = [np.random.rand() for i in active]
+        expected = np.zeros(self.nbVox)
+        for i, c, u in zip(active, proposals, uniforms):
+            tn = subcptGamma(s.currentValue[j, i], c, s.nbTrials[j],
+                             s.deltaOns[j])[1]
+            Xtilde = s.spExtract(tn, s.varSingleCondXtrials[j], j)
+            dif1 = eji[:, i] - np.dot(Xtilde, h)
+            dif2 = eji[:, i] - s.aXh[:, i, j]
+            d = np.dot(np.dot(dif1, Q), dif1) - np.dot(np.dot(dif2, Q), dif2)
+            ratio1 = np.exp(-.5 * d / rb[i]) if d / rb[i] > -1400. else 1e6
+            ratio2 = (2. - np.exp(-s.Lexp * habits[i]) -
+                      np.exp(s.Lexp * (habits[i] - 1.))) / \
+                (2. - np.exp(-s.Lexp * c) - np.exp(s.Lexp * (c - 1.)))
+            expected[i] = c if u <= min(ratio1 * ratio2, 1) else habits[i]
+
+        np.random.seed(7)
+        s.habitCondSampler(j, rb, h)
+        np.testing.assert_almost_equal(s.habits[j], expected)
+
+        # the residuals seen by the next condition follow the new speeds
+        varYtilde = s.varYtilde.copy()
+        s.updateXh(h)
+        s.updateYtilde()
+        np.testing.assert_almost_equal(varYtilde, s.varYtilde)
+
+
 class ASLTest(unittest.TestCase):
 
     def setUp(self):
@@ -10,7 +10,9 @@ from pprint import pprint
 
 from pyhrf.stats import gm_cdf, cpt_ppm_a_mcmc, gm_mean, gm_var, \
     cpt_ppm_g_mcmc, cpt_ppm_g_apost, cpt_ppm_a_norm, cpt_ppm_g_norm
-from pyhrf.stats.random import rpnorm, gm_sample
+from pyhrf.stats.random import rpnorm, gm_sample, sample_diag_gaussian, \
+    sample_gaussian_precision, quadratic_forms, sample_noise_variances, \
+    sample_gaussian
 
 class RPNormTest(unittest.TestCase):
 
@@ -23,6 +25,83 @@ class RPNormTest(unittest.TestCase):
         #plt.hist(rnd)
         #plt.show()
 
+class BatchedSamplingTest(unittest.TestCase):
+    """ Batched voxel-wise samplers must give the same draws as the
+    equivalent loops over voxels
+    """
+
+    def setUp(self):
+        np.random.seed(2)
+        self.nbVox = 50
+        self.dim = 4
+
+    def test_diag_gaussian(self):
+        means = np.random.randn(2, self.dim, self.nbVox)
+        variances = np.random.rand(2, self.nbVox) + .1
+
+        np.random.seed(5)
+        expected = np.zeros_like(means)
+        for j in xrange(self.nbVox):
+            for s in xrange(2):
+                expected[s, :, j] = np.random.randn(self.dim) * \
+                    variances[s, j] ** .5 + means[s, :, j]
+
+        np.random.seed(5)
+        assert_almost_equal(sample_diag_gaussian(means, variances), expected)
+
+    def test_gaussian_precision(self):
+        a = np.random.randn(self.dim, self.dim, self.nbVox)
+        precisions = np.array([np.dot(a[:, :, j], a[:, :, j].T) + \
+                               np.eye(self.dim) for j in xrange(self.nbVox)])
+        precisions = np.rollaxis(precisions, 0, 3)
+        vectors = np.random.randn(self.dim, self.nbVox)
+
+        np.random.seed(5)
+        expected = np.array([sample_gaussian(precisions[:, :, j],
+                                             vectors[:, j])
+                             for j in xrange(self.nbVox)]).T
+        np.random.seed(5)
+        assert_almost_equal(sample_gaussian_precision(precisions, vectors),
+                            expected)
+
+    def test_quadratic_forms(self):
+        x = np.random.randn(self.dim, self.nbVox)
+        q = np.random.randn(self.dim, self.dim, self.nbVox)
+        expected = [np.dot(np.dot(x[:, j], q[:, :, j]), x[:, j])
+                    for j in xrange(self.nbVox)]
+        assert_almost_equal(quadratic_forms(x, q), expected)
+        assert_almost_equal(quadratic_forms(x, q[:, :, 0]),
+                            [np.dot(np.dot(x[:, j], q[:, :, 0]), x[:, j])
+                             for j in xrange(self.nbVox)])
+        assert_almost_equal(quadratic_forms(x), (x ** 2).sum(0))
+
+    def test_noise_variances(self):
+        betas = np.random.rand(3, self.nbVox)
+        np.random.seed(5)
+        expected = np.array([[b / np.random.gamma(10., 1) for b in bs]
+                             for bs in betas])
+        np.random.seed(5)
+        assert_almost_equal(sample_noise_variances(betas, 10.), expected)
+
+
+class GaussianSamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1)
+        self.dim = 4
+        a = np.random.randn(self.dim, self.dim)
+        self.a = np.dot(a, a.T) + np.eye(self.dim)
+        self.vector = np.random.randn(self.dim)
+
+    def test_sample_gaussian(self):
+        mean = np.linalg.solve(self.a, self.vector)
+        chol_up = np.linalg.cholesky(self.a).T
+        np.random.seed(5)
+        expected = mean + np.linalg.solve(chol_up, np.random.randn(self.dim))
+        np.random.seed(5)
+        assert_almost_equal(sample_gaussian(self.a, self.vector), expected)
+
+
 class PPMTest(unittest.TestCase):
     
     def setUp(self):
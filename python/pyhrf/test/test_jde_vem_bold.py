@@ -57,6 +57,20 @@ class VEMBOLDTest(unittest.TestCase):
                                  output_dir=None)
         tjde_vem.run()
 
+    def test_jdevemanalyser_numpy(self):
+        """ Test BOLD VEM analyser with the pure NumPy implementation
+        (fast=False) on a small simulation. Estimation accuracy is not tested.
+        """
+        pyhrf.logger.setLevel(logging.WARNING)
+        jde_vem_analyser = JDEVEMAnalyser(beta=.8, dt=.5, hrfDuration=25.,
+                                          nItMax=2, nItMin=2, fast=False,
+                                          computeContrast=False, PLOT=False,
+                                          constrained=False)
+        tjde_vem = FMRITreatment(fmri_data=self.data_simu,
+                                 analyser=jde_vem_analyser,
+                                 output_dir=None)
+        tjde_vem.run()
+
     @unittest.skipIf(not tools.is_importable('cvxpy'),
                      'joblib (optional dep) is N/A')
     def test_vem_bold_constrained(self):
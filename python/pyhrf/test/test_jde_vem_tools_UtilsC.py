@@ -16,6 +16,7 @@ from pyhrf.vbjde import UtilsC
 from pyhrf.ui.treatment import FMRITreatment
 from pyhrf.jde.models import simulate_bold
 from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.graph import graph_coloring
 try:
     from collections import OrderedDict
 except ImportError:
@@ -179,3 +180,145 @@ class VEMToolsTest(unittest.TestCase):
         UtilsC.expectation_A(q_Z, mu_M, sigma_M, PL, sigma_epsilone, Gamma,
                              Sigma_H, Y, y_tilde, m_A, m_H, Sigma_A,
                              XX.astype(np.int32), J, D, M, N, K)
+
+    def _vem_inputs(self):
+        np.random.seed(8652761)
+        data = self.data_simu
+        Y = data.bold
+        N, J = Y.shape
+        K = 2
+        D = 11
+        TR = 1.
+        dt = .5
+        Onsets = data.get_joined_onsets()
+        M = len(Onsets)
+        X = OrderedDict([])
+        for condition, Ons in Onsets.iteritems():
+            X[condition] = vt.compute_mat_X_2(N, TR, D, dt, Ons)
+        XX = np.array([X[c] for c in X]).astype(np.int32)
+        P = vt.PolyMat(N, 4, TR)
+        L = vt.polyFit(Y, TR, 4, P)
+        PL = np.dot(P, L)
+        TT, m_h = getCanoHRF(25., dt)
+        q_Z = np.random.rand(M, K, J)
+        q_Z /= q_Z.sum(1)[:, np.newaxis, :]
+        return dict(Y=Y, N=N, J=J, K=K, D=D, M=M, X=X, XX=XX, PL=PL,
+                    y_tilde=Y - PL, Gamma=np.identity(N), dt=dt,
+                    m_H=np.array(m_h[:D]).astype(np.float64),
+                    Sigma_H=0.01 * np.identity(D),
+                    sigma_epsilone=np.random.rand(J) + .5, q_Z=q_Z,
+                    mu_M=np.array([[0., 2.]] * M),
+                    sigma_M=np.array([[.5, .6]] * M),
+                    m_A=np.random.randn(J, M),
+                    Sigma_A=np.random.rand(M, M, J) * .01)
+
+    def test_expectA_numpy(self):
+        """ Check the NumPy E-A step against the C extension """
+        p = self._vem_inputs()
+        J, D, M, N, K = p['J'], p['D'], p['M'], p['N'], p['K']
+        m_A, Sigma_A = p['m_A'].copy(), p['Sigma_A'].copy()
+        UtilsC.expectation_A(p['q_Z'], p['mu_M'], p['sigma_M'], p['PL'],
+                             p['sigma_epsilone'].copy(), p['Gamma'],
+                             p['Sigma_H'], p['Y'], p['y_tilde'], m_A,
+                             p['m_H'], Sigma_A, p['XX'], J, D, M, N, K)
+        Sigma_A2, m_A2 = vt.expectation_A(p['Y'], p['Sigma_H'], p['m_H'],
+                                          p['m_A'].copy(), p['X'], p['Gamma'],
+                                          p['PL'], p['sigma_M'], p['q_Z'],
+                                          p['mu_M'], D, N, J, M, K,
+                                          p['y_tilde'], p['Sigma_A'].copy(),
+                                          p['sigma_epsilone'],
+                                          np.zeros((J, M, D)))
+        np.testing.assert_allclose(Sigma_A2, Sigma_A, rtol=1e-4)
+        np.testing.assert_allclose(m_A2, m_A, rtol=1e-4)
+
+    def test_expectH_numpy(self):
+        """ Check the NumPy E-H step against the C extension """
+        p = self._vem_inputs()
+        J, D, M, N = p['J'], p['D'], p['M'], p['N']
+        XX = p['XX']
+        D2 = vt.buildFiniteDiffMatrix(2, D)
+        R = np.dot(D2, D2) / pow(p['dt'], 4)
+        Q_barnCond = np.einsum('mnd,pne->mpde', XX, XX).astype(np.float64)
+        XGamma = XX.transpose(0, 2, 1).astype(np.float64)
+        m_H = np.zeros(D)
+        Sigma_H = np.zeros((D, D))
+        UtilsC.expectation_H(XGamma, Q_barnCond, p['sigma_epsilone'].copy(),
+                             p['Gamma'], R, Sigma_H, p['Y'], p['y_tilde'],
+                             p['m_A'], m_H, p['Sigma_A'], XX, J, D, M, N,
+                             1., .1)
+        m_H[0] = 0
+        m_H[-1] = 0
+        Sigma_H2, m_H2 = vt.expectation_H(p['Y'], p['Sigma_A'], p['m_A'],
+                                          p['X'], p['Gamma'], p['PL'], D, R,
+                                          .1, J, N, p['y_tilde'],
+                                          np.zeros((N, D)),
+                                          p['sigma_epsilone'], 1.,
+                                          np.zeros((D, D)), np.zeros(D))
+        np.testing.assert_allclose(Sigma_H2, Sigma_H, rtol=1e-4)
+        np.testing.assert_allclose(m_H2, m_H, rtol=1e-4)
+
+    def test_expectZ_numpy(self):
+        """ Check the NumPy E-Z step against the C extension, without
+        spatial interaction (the neighbour sweep order then does not matter)
+        """
+        p = self._vem_inputs()
+        J, M, K = p['J'], p['M'], p['K']
+        graph = self.data_simu.get_graph()
+        maxNeighbours = max([len(nl) for nl in graph])
+        neighboursIndexes = np.zeros((J, maxNeighbours), dtype=np.int32)
+        neighboursIndexes -= 1
+        for i in xrange(J):
+            neighboursIndexes[i, :len(graph[i])] = graph[i]
+        Beta = np.zeros(M)
+        q_Z = p['q_Z'].copy()
+        UtilsC.expectation_Z(p['Sigma_A'], p['m_A'], p['sigma_M'], Beta,
+                             p['q_Z'].copy(), p['mu_M'], q_Z,
+                             neighboursIndexes, M, J, K, maxNeighbours)
+        q_Z2, Z_tilde2 = vt.expectation_Z(p['Sigma_A'], p['m_A'],
+                                          p['sigma_M'], Beta,
+                                          p['q_Z'].copy(), p['mu_M'],
+                                          p['q_Z'].copy(), graph, M, J, K,
+                                          np.zeros(K))
+        np.testing.assert_allclose(q_Z2, q_Z, rtol=1e-3)
+        np.testing.assert_allclose(Z_tilde2.sum(1), 1., rtol=1e-4)
+
+    def _expectZ_spatial(self, color_blocks):
+        """ Run the C and NumPy E-Z steps with spatial interaction, sweeping
+        voxels along *color_blocks* (None: sequential sweep)
+        """
+        p = self._vem_inputs()
+        J, M, K = p['J'], p['M'], p['K']
+        graph = self.data_simu.get_graph()
+        maxNeighbours = max([len(nl) for nl in graph])
+        neighboursIndexes = np.zeros((J, maxNeighbours), dtype=np.int32)
+        neighboursIndexes -= 1
+        for i in xrange(J):
+            neighboursIndexes[i, :len(graph[i])] = graph[i]
+        Beta = .8 * np.ones(M)
+        q_Z = p['q_Z'].copy()
+        Z_tilde = p['q_Z'].copy()
+        args = (p['Sigma_A'], p['m_A'], p['sigma_M'], Beta, Z_tilde,
+                p['mu_M'], q_Z, neighboursIndexes, M, J, K, maxNeighbours)
+        if color_blocks is None:
+            UtilsC.expectation_Z(*args)
+        else:
+            sweep_order = np.concatenate(color_blocks).astype(np.int32)
+            UtilsC.expectation_Z(*(args + (sweep_order,)))
+        q_Z2, Z_tilde2 = vt.expectation_Z(p['Sigma_A'], p['m_A'],
+                                          p['sigma_M'], Beta,
+                                          p['q_Z'].copy(), p['mu_M'],
+                                          p['q_Z'].copy(), graph, M, J, K,
+                                          np.zeros(K), color_blocks)
+        np.testing.assert_allclose(Z_tilde2, Z_tilde, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(q_Z2, q_Z, rtol=1e-10, atol=1e-12)
+
+    def test_expectZ_numpy_spatial(self):
+        """ Check the NumPy E-Z step against the C extension with spatial
+        interaction, both sweeping voxels sequentially (default)
+        """
+        self._expectZ_spatial(None)
+
+    def test_expectZ_numpy_spatial_colors(self):
+        """ Same check with the colour block sweep, asked for on both sides
+        """
+        self._expectZ_spatial(graph_coloring(self.data_simu.get_graph()))
@@ -404,6 +404,14 @@ class xndarrayTest(unittest.TestCase):
         npt.assert_array_equal(new_data.data, data.data)
         npt.assert_array_equal(new_data.axes_names, data.axes_names)
 
+    def test_get_label_index(self):
+        labels = np.random.randint(0, 5, size=(4, 5, 6))
+        labels[labels == 3] = 4  # missing label
+        label_index = get_label_index(labels)
+        self.assertEqual(label_index.keys(), range(3) + [4])
+        for l, m in label_index.iteritems():
+            npt.assert_array_equal(m, np.where(labels == l))
+
     def test_set_orientation(self):
         c = xndarray(
             self.arr3d, self.arr3dNames, self.arr3dDom, self.arr3dLabel)
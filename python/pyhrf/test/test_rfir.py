@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import unittest
 import pyhrf
+import os
+import os.path as op
 import shutil
+import numpy as np
 
 import pyhrf.boldsynth.scenarios as simu
-from pyhrf.rfir import rfir
+from pyhrf.rfir import rfir, RFIREstim
+from pyhrf.tools import is_importable
 
 class RFIRTest(unittest.TestCase):
     """
@@ -29,3 +33,69 @@ class RFIRTest(unittest.TestCase):
             assert outputs.has_key(k)
 
         #TODO: test shape consistency
+
+    def test_voxel_blocks(self):
+        """ Check that the EM solver running on blocks of voxels gives the
+        same results as the voxel-wise one """
+        fdata = simu.create_small_bold_simulation()
+        for fixed_taum in [False, True]:
+            results = []
+            for block_size in [0, 3]:
+                estimator = RFIREstim(hrf_nb_coeffs=20, hrf_dt=1.2,
+                                      nb_its_max=20, nb_iterations=None,
+                                      stop_crit1=1e-3, stop_crit2=1e-2,
+                                      fixed_taum=fixed_taum,
+                                      voxel_block_size=block_size)
+                estimator.linkToData(fdata)
+                estimator.run()
+                results.append(estimator)
+            voxelwise, blocks = results
+            np.testing.assert_array_equal(voxelwise.stop_iterations,
+                                          blocks.stop_iterations)
+            for attr in ['ResponseFunctionsEvaluated', 'StdValEvaluated',
+                         'Pvalues', 'SignalEvaluated']:
+                np.testing.assert_allclose(getattr(blocks, attr),
+                                           getattr(voxelwise, attr),
+                                           rtol=1e-4, atol=1e-5)
+
+    def _estimate(self, fdata, **kwargs):
+        estimator = RFIREstim(hrf_nb_coeffs=20, hrf_dt=1.2, nb_iterations=5,
+                              **kwargs)
+        estimator.linkToData(fdata)
+        estimator.run()
+        return estimator
+
+    def _assert_same_results(self, estimator, ref):
+        for attr in RFIREstim.chunk_results:
+            np.testing.assert_allclose(getattr(estimator, attr),
+                                       getattr(ref, attr), rtol=1e-6)
+
+    def test_voxel_chunks_checkpoints(self):
+        """ Check that voxel chunks give the same results as the whole
+        estimation and that checkpointed chunks are not estimated again """
+        fdata = simu.create_small_bold_simulation()
+        ref = self._estimate(fdata)
+        chk_dir = op.join(self.tmp_dir, 'chunks')
+        estimator = self._estimate(fdata, voxel_chunk_size=3,
+                                   checkpoint_dir=chk_dir)
+        self._assert_same_results(estimator, ref)
+
+        chk_files = [op.join(chk_dir, f) for f in os.listdir(chk_dir)]
+        self.assertEqual(len(chk_files), 2)
+
+        # resume: one chunk was interrupted
+        os.remove(chk_files[0])
+        mtime = op.getmtime(chk_files[1])
+        estimator = self._estimate(fdata, voxel_chunk_size=3,
+                                   checkpoint_dir=chk_dir)
+        self._assert_same_results(estimator, ref)
+        self.assertEqual(op.getmtime(chk_files[1]), mtime)
+        self.assertTrue(op.exists(chk_files[0]))
+
+    @unittest.skipIf(not is_importable('joblib'),
+                     'joblib (optional dep) is N/A')
+    def test_voxel_chunks_parallel(self):
+        fdata = simu.create_small_bold_simulation()
+        ref = self._estimate(fdata)
+        estimator = self._estimate(fdata, voxel_chunk_size=1, nb_procs=2)
+        self._assert_same_results(estimator, ref)
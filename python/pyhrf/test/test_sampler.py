@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
+import os
 import unittest
+import tempfile
+import shutil
+import cPickle
 import numpy as np
 from numpy.testing import assert_array_equal, assert_almost_equal
 
-from pyhrf.jde.samplerbase import Trajectory
+import pyhrf
+from pyhrf.jde.samplerbase import Trajectory, HistoryBuffer, \
+    GibbsSamplerVariable, ConvergenceMonitor
 
 class TrajectoryTest(unittest.TestCase):
 
@@ -39,7 +45,114 @@ class TrajectoryTest(unittest.TestCase):
         assert_array_equal(t.get_last(), np.array([1, 2]) * 2**nb_its)
         self.assertEqual(t.saved_iterations, range(start,nb_its))
 
-        
+    def test_set_start(self):
+        """ The burn-in period ends earlier than planned """
+        v = np.array([1, 2])
+        nb_its = 10
+        t = Trajectory(v, ['time'], {'time':np.array([1,2])},
+                       1, 8, nb_its, first_saved_iteration=8)
+
+        for i in xrange(nb_its):
+            if i == 3:
+                t.set_start(3)
+            v *= 2
+            t.record(i)
+
+        assert_array_equal(t.get_last(), np.array([1, 2]) * 2**nb_its)
+        self.assertEqual(t.saved_iterations, range(3, nb_its))
+
+
+
+class DummyEngine:
+    nbIterations = 10
+    smplHistoryPace = 1
+    history_dir = None
+
+
+class HistoryBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='pyhrf_tests',
+                                        dir=pyhrf.cfg['global']['tmp_path'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append(self):
+        values = [np.array([i, 2 * i]) for i in xrange(5)]
+        for history_dir in [None, self.tmp_dir]:
+            # capacity is exceeded -> buffer is grown:
+            h = HistoryBuffer(values[0], 3, history_dir)
+            for v in values:
+                history = h.append(v)
+            assert_array_equal(history, np.array(values))
+            # memory-mapped files are not left on disk:
+            self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_upcast(self):
+        h = HistoryBuffer(np.array([1, 2]), 10)
+        h.append(np.array([1, 2]))
+        history = h.append(np.array([.5, 1.5]))
+        assert_array_equal(history, np.array([[1, 2], [.5, 1.5]]))
+
+    def test_variable_history(self):
+        v = GibbsSamplerVariable('dummy', np.array([0., 0.]))
+        v.setSamplerEngine(DummyEngine())
+        for it in xrange(4):
+            v.currentValue = np.array([it, -it], dtype=float)
+            v.saveCurrentValue(it)
+        v2 = cPickle.loads(cPickle.dumps(v))
+        for var in v, v2:
+            var.currentValue = np.array([4., -4.])
+            var.saveCurrentValue(4)
+            assert_array_equal(var.smplHistory,
+                               np.array([[i, -i] for i in xrange(5)]))
+
+
+class ConvergenceMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(67)
+
+    def test_iid(self):
+        monitor = ConvergenceMonitor(['x'], max_rhat=1.1, min_ess=300)
+        for i in xrange(1000):
+            monitor.record([np.random.randn(3), np.zeros(2)])
+        self.assertEqual(monitor.batch_size, 16)
+        self.assertEqual(monitor.nb_samples(), 992)
+        self.assertTrue(monitor.ess() > 500)
+        self.assertTrue(monitor.split_rhat() < 1.05)
+        self.assertTrue(monitor.converged())
+
+    def test_near_constant(self):
+        """ Round-off variances of constant components are ignored """
+        monitor = ConvergenceMonitor(['x'], max_rhat=1.1, min_ess=300)
+        for i in xrange(1000):
+            monitor.record([np.random.randn(3), np.zeros(2) + .1,
+                            np.zeros(1) + 1e6])
+        self.assertTrue(monitor.split_rhat() < 1.05)
+        self.assertTrue(monitor.ess() > 500)
+
+    def test_correlated(self):
+        monitor = ConvergenceMonitor(['x'], max_rhat=1.1, min_ess=300)
+        x = np.zeros(3)
+        for i in xrange(1000):
+            x = .99 * x + np.random.randn(3) * .1
+            monitor.record([x])
+        self.assertTrue(monitor.ess() < 100)
+        self.assertFalse(monitor.converged())
+
+    def test_burnin(self):
+        monitor = ConvergenceMonitor(['x'], max_rhat=1.1)
+        for i in xrange(1000):
+            monitor.record([np.array([i * .01 + np.random.randn()])])
+        self.assertTrue(monitor.split_rhat(last_half=True) > 1.1)
+        self.assertFalse(monitor.burnin_reached())
+        monitor.reset()
+        for i in xrange(1000):
+            monitor.record([np.random.randn(1)])
+        self.assertTrue(monitor.burnin_reached())
+
 
 class GibbsTest(unittest.TestCase):
 
@@ -215,3 +215,59 @@ class SimulationTest(unittest.TestCase):
             plt.plot(t, f)
             plt.title('inflow')
             plt.show()
+
+    def test_phy_integrate_voxels(self):
+        """ Integration of several neural efficacies at once should match
+        voxel-by-voxel integrations """
+        phy_params = phy.PHY_PARAMS_FRISTON00
+        tstep = .05
+        stim = np.array([1.] * 20 + [0.] * 380)
+        epsilon = np.array([.2, .5, .8])
+
+        signals = phy.phy_integrate(phy_params, tstep, stim, epsilon,
+                                    method='euler')
+        self.assertEqual(signals.shape, (4, stim.size, epsilon.size))
+        for i, eps in enumerate(epsilon):
+            npt.assert_array_equal(signals[:, :, i],
+                                   phy.phy_integrate(phy_params, tstep, stim,
+                                                     eps, method='euler')[:, :, 0])
+        npt.assert_array_equal(signals[:, :, 1],
+                               phy.phy_integrate_euler(phy_params, tstep, stim,
+                                                       .5))
+
+    def test_phy_integrate_rk4(self):
+        """ RK4 with a coarse time step should be closer to a fine
+        integration than Euler with the default time step """
+        phy_params = phy.PHY_PARAMS_FRISTON00
+        stim = np.array([1.] * 4 + [0.] * 76)  # time step: .25s
+        ref = phy.phy_integrate(phy_params, .005, np.repeat(stim, 50), .5,
+                                method='rk4')[:, 49::50]
+        rk4 = phy.phy_integrate(phy_params, .25, stim, .5, method='rk4')
+        euler = phy.phy_integrate(phy_params, .05, np.repeat(stim, 5), .5,
+                                  method='euler')[:, 4::5]
+        err_rk4 = np.abs(rk4 - ref).max()
+        self.assertLess(err_rk4, 1e-3)
+        self.assertLess(err_rk4, np.abs(euler - ref).max())
+
+    def test_create_evoked_physio_signal_efficacies(self):
+        """ By default, all voxels are driven by the efficacy of the model,
+        as with phy_integrate_euler. Per-voxel efficacies are optional """
+        import pyhrf.paradigm
+
+        phy_params = phy.PHY_PARAMS_FRISTON00
+        ne = np.array([[10., 5.]])
+        paradigm = pyhrf.paradigm.Paradigm({'c': [np.array([0.])]}, [20.],
+                                           {'c': [np.array([1.])]})
+        signals = phy.create_evoked_physio_signals(phy_params, paradigm, ne,
+                                                   .05)
+        stim = paradigm.get_rastered(.05)['c'][0]
+        expected = phy.phy_integrate_euler(phy_params, .05, stim, ne[0, 0])
+        for i in xrange(ne.shape[1]):
+            npt.assert_array_equal(signals[:, :, i], expected)
+
+        signals = phy.create_evoked_physio_signals(phy_params, paradigm, ne,
+                                                   .05, voxel_efficacies=True)
+        for i, eps in enumerate(ne[0]):
+            npt.assert_array_equal(signals[:, :, i],
+                                   phy.phy_integrate(phy_params, .05, stim,
+                                                     eps, method='euler')[:, :, 0])
@@ -6,6 +6,7 @@ import cPickle
 import os.path as op
 import shutil
 
+import numpy as np
 import numpy.testing as npt
 
 import pyhrf
@@ -96,6 +97,65 @@ class TreatmentTest(unittest.TestCase):
         t.enable_draft_testing()
         t.run(parallel='local', n_jobs=2)
 
+    @unittest.skipIf(not tools.is_importable('joblib'),
+                     'joblib (optional dep) is N/A')
+    def test_parallel_local_shared_rois(self):
+        from joblib import Parallel, delayed
+        t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
+        t.enable_draft_testing()
+        result = t.run_shared_rois(Parallel(n_jobs=2), delayed)
+        roi_datasets = t.data.roi_split()
+        self.assertEqual(len(result), len(roi_datasets))
+        for (roi_data, res, report), expected in zip(result, roi_datasets):
+            self.assertEqual(roi_data.get_roi_id(), expected.get_roi_id())
+            npt.assert_equal(roi_data.bold, expected.bold)
+
+    def test_parallel_threads(self):
+        t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
+        t.enable_draft_testing()
+        result = list(t.iter_threaded_rois(n_jobs=2))
+        roi_datasets = t.data.roi_split()
+        self.assertEqual(len(result), len(roi_datasets))
+        expected = dict((d.get_roi_id(), d) for d in roi_datasets)
+        for roi_data, res, report in result:
+            self.assertEqual(report, 'ok')
+            npt.assert_equal(roi_data.bold,
+                             expected[roi_data.get_roi_id()].bold)
+
+    def test_parallel_threads_seeded(self):
+        """ With a seeded sampler, threaded runs must be reproducible """
+        t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
+        t.enable_draft_testing()
+        t.analyser.sampler.randomSeed = 6
+        self.assertTrue(t.analyser.is_seeded())
+        nrls = []
+        for run in xrange(2):
+            nrls.append(dict((roi_data.get_roi_id(),
+                              res.get_variable('nrl').finalValue)
+                             for roi_data, res, report
+                             in t.iter_threaded_rois(n_jobs=2)))
+        self.assertEqual(sorted(nrls[0].keys()), sorted(nrls[1].keys()))
+        for roi_id, nrl in nrls[0].iteritems():
+            npt.assert_equal(nrl, nrls[1][roi_id])
+
+    def test_parallel_threads_vem(self):
+        """ VEM estimations of concurrent ROIs must match sequential ones """
+        from pyhrf.ui.vb_jde_analyser import JDEVEMAnalyser
+        analyser = JDEVEMAnalyser(nItMax=2, nItMin=2, fast=True,
+                                  computeContrast=False)
+        t = ptr.FMRITreatment(analyser=analyser, make_outputs=False,
+                              result_dump_file=None)
+        self.assertFalse(t.analyser.is_seeded())
+        nrls = []
+        for n_jobs in (1, 2):
+            nrls.append(dict((roi_data.get_roi_id(), res['nrls'].data)
+                             for roi_data, res, report
+                             in t.iter_threaded_rois(n_jobs=n_jobs)))
+        self.assertTrue(len(nrls[0]) > 1)
+        self.assertEqual(sorted(nrls[0].keys()), sorted(nrls[1].keys()))
+        for roi_id, nrl in nrls[0].iteritems():
+            npt.assert_equal(nrl, nrls[1][roi_id])
+
     def test_pickle_treatment(self):
         t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
         t.enable_draft_testing()
@@ -122,6 +182,19 @@ class TreatmentTest(unittest.TestCase):
         if os.system(cmd) != 0:
             raise Exception('"' + cmd + '" did not execute correctly')
 
+    def test_result_dump(self):
+        from pyhrf.tools._io import ResultArchive, load_results
+        t = ptr.FMRITreatment(make_outputs=False, output_dir=self.tmp_dir,
+                              result_dump_file='result.pck')
+        t.enable_draft_testing()
+        t.run()
+        results = load_results(t.result_dump_file)
+        roi_ids = [r[0].get_roi_id() for r in results]
+        self.assertEqual(sorted(roi_ids),
+                         sorted(d.get_roi_id() for d in t.data.roi_split()))
+        with ResultArchive(t.result_dump_file) as archive:
+            self.assertEqual(archive.load(roi_ids[0])[2], results[0][2])
+
     @unittest.skipIf(not tools.is_importable('joblib'),
                      'joblib (optional dep) is N/A')
     def test_default_treatment_parallel_local(self):
@@ -181,3 +254,48 @@ class TreatmentTest(unittest.TestCase):
         else:
             print 'Cluster testing is off '\
                 '([cluster-LAN][enable_unit_test] = 0 in config.cfg'
+
+
+class OutputSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = pyhrf.get_tmp_path()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_incremental_outputs(self):
+        from pyhrf.ndarray import xndarray
+        from pyhrf.ui.analyser_ui import FMRIAnalyser
+
+        fdata = pyhrf.FmriData.from_vol_ui()
+        results = []
+        for roi_data in fdata.roi_split():
+            nvox = roi_data.get_nb_vox_in_mask()
+            roi_id = roi_data.get_roi_id()
+            outputs = {'vox': xndarray(np.arange(nvox * 2.).reshape(2, nvox) +
+                                       roi_id, ['condition', 'voxel']),
+                       'roi': xndarray(np.array([roi_id, 1.]), ['stat'])}
+            results.append((roi_data, outputs, 'ok'))
+        results.append((roi_data, None, 'crashed'))
+
+        analyser = FMRIAnalyser()
+        out_dir = op.join(self.tmp_dir, 'incremental')
+        os.makedirs(out_dir)
+        sink = analyser.make_output_sink(out_dir)
+        for r in results:
+            sink.add(r)
+        outputs, output_fns = sink.close()
+
+        out_dir_mem = op.join(self.tmp_dir, 'in_memory')
+        os.makedirs(out_dir_mem)
+        expected, _ = analyser.outputResults_in_memory(list(results),
+                                                       out_dir_mem)
+        self.assertEqual(sorted(outputs.keys()), sorted(expected.keys()))
+        for name in expected:
+            npt.assert_array_equal(outputs[name].data, expected[name].data)
+            self.assertEqual(outputs[name].axes_names,
+                             expected[name].axes_names)
+        self.assertEqual(len(output_fns), 2)
+        for fn in output_fns:
+            self.assertTrue(op.exists(fn))
@@ -2,6 +2,7 @@
 
 import unittest
 import os
+import os.path as op
 import tempfile
 import shutil
 import time
@@ -16,7 +17,8 @@ import pyhrf.tools as mtools
 import pyhrf
 
 from pyhrf.tools import (diagBlock, get_2Dtable_string, do_if_nonexistent_file,
-                         peelVolume3D, cartesian, cached_eval, Pipeline,
+                         peelVolume3D, cartesian, cached_eval, ResultCache,
+                         Pipeline,
                          resampleToGrid, set_leaf, get_leaf, tree_rearrange)
 
 
@@ -394,6 +396,61 @@ class CachedEvalTest(unittest.TestCase):
                     path=self.cache_dir)
         delta = time.time() - t0
 
+    def test_large_arrays(self):
+        """ Arrays differing only in their middle (hidden by repr) must not
+        share a cache entry """
+        a = np.zeros(10000)
+        b = a.copy()
+        b[5000] = 1.
+        self.assertEqual(repr(a), repr(b))
+        self.assertEqual(cached_eval(np.sum, (a,), path=self.cache_dir), 0.)
+        self.assertEqual(cached_eval(np.sum, (b,), path=self.cache_dir), 1.)
+        self.assertEqual(cached_eval(np.sum, (a.astype(np.float32),),
+                                     path=self.cache_dir, return_file=True)
+                         .find('.gz'), -1)
+
+    def test_compressed(self):
+        fn = cached_eval(foo_func, (1, 2), path=self.cache_dir,
+                         gzip_mode='pygzip', return_file=True)
+        assert fn.endswith('.pck.gz')
+        self.assertEqual(cached_eval(foo_func, (1, 2), path=self.cache_dir,
+                                     gzip_mode='pygzip'), 3)
+
+    def test_eviction(self):
+        cache = ResultCache(self.cache_dir, max_size=.2)  # ~210 KB
+        fns = [cache.filename(np.ones, (10000 + i,)) for i in xrange(4)]
+        # accesses are ordered by file times: set them explicitly as file
+        # systems may have a coarse time resolution
+        t0 = time.time() - 100
+        for i in xrange(3):
+            cache.eval(np.ones, (10000 + i,))  # ~80 KB each
+            os.utime(fns[i], (t0 + i, t0 + i))
+        self.assertEqual([op.exists(fn) for fn in fns],
+                         [False, True, True, False])
+        index = cache.get_index()
+        self.assertEqual(sorted(index.keys()),
+                         sorted([op.basename(fn) for fn in fns[1:3]]))
+
+        # accessing a cached entry makes it the most recently used:
+        cache.eval(np.ones, (10001,))
+        cache.eval(np.ones, (10003,))
+        self.assertEqual([op.exists(fn) for fn in fns],
+                         [False, True, False, True])
+
+    def test_decorator(self):
+        calls = []
+
+        @ResultCache(self.cache_dir)
+        def sum_array(a, offset=0):
+            calls.append(1)
+            return a.sum() + offset
+
+        a = np.arange(5.)
+        self.assertEqual(sum_array(a, offset=1), 11.)
+        self.assertEqual(sum_array(a, offset=1), 11.)
+        self.assertEqual(sum_array(a), 10.)
+        self.assertEqual(len(calls), 2)
+
     def tearDown(self):
         shutil.rmtree(self.cache_dir)
 
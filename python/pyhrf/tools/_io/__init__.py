@@ -2,4 +2,5 @@
 
 import pyhrf.tools._io.spmio
 import pyhrf.tools._io._zip
+from pyhrf.tools._io._zip import ResultArchive, dump_results, load_results
 from pyhrf.tools._io._io import *
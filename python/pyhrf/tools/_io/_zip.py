@@ -2,9 +2,13 @@
 
 
 import os
+import re
 import gzip as _gzip
+import zipfile
+import cPickle
 
-__all__ = ['gunzip', 'gzip_file']
+__all__ = ['gunzip', 'gzip_file', 'ResultArchive', 'dump_results',
+           'load_results']
 
 
 def gunzip(gzFileName, outFileName=None):
@@ -29,3 +33,91 @@ def gzip_file(fileName, outFileName=None):
     fOut = _gzip.open(outFileName, 'w')
     fOut.writelines(content)
     fOut.close()
+
+
+class ResultArchive(object):
+    """
+    Zip archive of analysis results, each ROI result being stored as a
+    separate deflated member holding a binary pickle of the tuple
+    (roi data, roi result, report).
+
+    Results can be appended one at a time as soon as they are produced, and
+    loaded back either all together or by ROI id, without unpickling the
+    other ones.
+
+    Args:
+        - file_name (str): the archive file
+        - mode (str): 'r' to read, 'w' to create and 'a' to append
+    """
+
+    member_fmt = 'roi_%d.pck'
+    member_rx = re.compile(r'roi_(-?\d+)\.pck\Z')
+
+    def __init__(self, file_name, mode='r'):
+        self.file_name = file_name
+        self.zip_file = zipfile.ZipFile(file_name, mode, zipfile.ZIP_DEFLATED,
+                                        allowZip64=True)
+
+    def dump(self, roi_result):
+        """ Append *roi_result*, ie a tuple (roi data, result, report) """
+        roi_id = roi_result[0]
+        if hasattr(roi_id, 'get_roi_id'):
+            roi_id = roi_id.get_roi_id()
+        self.zip_file.writestr(self.member_fmt % roi_id,
+                               cPickle.dumps(roi_result,
+                                             cPickle.HIGHEST_PROTOCOL))
+
+    def roi_ids(self):
+        """ Return the ids of the ROIs stored in the archive """
+        ids = []
+        for member in self.zip_file.namelist():
+            m = self.member_rx.match(member)
+            if m is not None:
+                ids.append(int(m.group(1)))
+        return ids
+
+    def load(self, roi_id):
+        """ Return the tuple (roi data, result, report) of ROI *roi_id* """
+        return cPickle.loads(self.zip_file.read(self.member_fmt % roi_id))
+
+    def __iter__(self):
+        for roi_id in self.roi_ids():
+            yield self.load(roi_id)
+
+    def close(self):
+        self.zip_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def dump_results(results, file_name):
+    """
+    Store the list of ROI results *results* in the archive *file_name*
+    (see ResultArchive).
+    """
+    with ResultArchive(file_name, 'w') as archive:
+        for roi_result in results:
+            archive.dump(roi_result)
+
+
+def load_results(file_name):
+    """
+    Load the list of ROI results stored in *file_name*, either as a
+    ResultArchive or, for dumps made by older versions, as a single
+    (possibly gzipped) pickle of the whole list.
+    """
+    if zipfile.is_zipfile(file_name):
+        with ResultArchive(file_name) as archive:
+            return list(archive)
+    if os.path.splitext(file_name)[1] == '.gz':
+        f = _gzip.open(file_name, 'rb')
+    else:
+        f = open(file_name, 'rb')
+    try:
+        return cPickle.load(f)
+    finally:
+        f.close()
@@ -10,6 +10,7 @@ import gzip
 import datetime
 import inspect
 import re
+import tempfile
 import logging
 
 from itertools import izip
@@ -1300,24 +1301,52 @@ def get_cache_filename(args, path='./', prefix=None, gz=True):
         return fn
 
 
+def digest_data(digest, obj):
+    """
+    Update *digest* (a hashlib object) with the content of *obj*.
+    Arrays are digested from their dtype, shape and data buffer and
+    containers are traversed, so that, unlike repr, large arrays are never
+    truncated. Other objects are digested from their repr.
+    """
+    if isinstance(obj, np.ndarray):
+        digest.update('ndarray%s%s' % (obj.dtype.str, repr(obj.shape)))
+        if obj.dtype.hasobject:
+            for e in obj.flat:
+                digest_data(digest, e)
+        else:
+            digest.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, pyhrf.ndarray.xndarray):
+        digest.update('xndarray')
+        digest_data(digest, obj.data)
+        digest_data(digest, obj.axes_names)
+        digest_data(digest, obj.axes_domains)
+        digest_data(digest, obj.value_label)
+    elif isinstance(obj, (list, tuple)):
+        digest.update('%s%d' % (obj.__class__.__name__, len(obj)))
+        for e in obj:
+            digest_data(digest, e)
+    elif isinstance(obj, dict):
+        digest.update('dict%d' % len(obj))
+        for k in sorted(obj.keys()):
+            digest_data(digest, k)
+            digest_data(digest, obj[k])
+    else:
+        digest.update(repr(obj))
+
+
 def hash_func_input(func, args, digest_code):
 
-    if isinstance(args, dict):  # sort keys
-        to_digest = ''
-        for k in sorted(args.keys()):
-            v = args[k]
-            to_digest += repr(k) + repr(v)
-    else:
-        to_digest = repr(args)
+    digest = hashlib.sha512()
+    digest_data(digest, args)
 
     if digest_code:
-        to_digest += inspect.getsource(func)
+        digest.update(inspect.getsource(func))
 
-    return hashlib.sha512(to_digest).hexdigest()
+    return digest.hexdigest()
 
 
 def cache_filename(func, args=None, prefix=None, path='./',
-                   digest_code=False):
+                   digest_code=False, compress=False):
     if prefix is None:
         prefix = func.__name__
     else:
@@ -1325,53 +1354,203 @@ def cache_filename(func, args=None, prefix=None, path='./',
 
     hashArgs = hash_func_input(func, args, digest_code)
 
-    fn = os.path.join(path, prefix + '_' + hashArgs + '.pck.gz')
+    fn = os.path.join(path, prefix + '_' + hashArgs + '.pck')
+    if compress:
+        return fn + '.gz'
     return fn
 
 
 def cache_exists(func, args=None, prefix=None, path='./',
-                 digest_code=False):
+                 digest_code=False, compress=False):
 
     return op.exists(cache_filename(func, args=args, prefix=prefix,
-                                    path=path, digest_code=digest_code))
+                                    path=path, digest_code=digest_code,
+                                    compress=compress))
 
 
-def cached_eval(func, args=None, new=False, save=True, prefix=None,
-                path='./', return_file=False, digest_code=False,
-                gzip_mode='cmd'):
-
-    fn = cache_filename(func, args=args, prefix=prefix,
-                        path=path, digest_code=digest_code)
-
-    if not os.path.exists(fn) or new:
-        if args is None:
-            r = func()
-        elif isinstance(args, tuple) or isinstance(args, list):
-            r = func(*args)
-        elif isinstance(args, dict):
-            r = func(**args)
-        else:
-            raise Exception("type of arg (%s) is not valid. Should be tuple, "
-                            "list or dict" % str(args.__class__))
-        if save:
-            if gzip_mode == 'pygzip' and os.system('gzip -V') != 0:
-                f = gzip.open(fn, 'w')
-                cPickle.dump(r, f)
-                f.close()
-            else:
-                f = open(fn[:-3], 'w')
-                cPickle.dump(r, f)
+class ResultCache(object):
+    """
+    Content-addressed cache of function results, stored as binary pickles
+    (optionally compressed with a fast gzip level) in directory *path*.
+
+    An index file keeps the size of every entry. Accesses are recorded as
+    modification times of the entry files, so that reading an entry does not
+    rewrite the index. When *max_size* (in MB) is not None, least recently
+    used entries are removed once the total size of the cache exceeds it.
+
+    The index is only rewritten when an entry is stored. This update is not
+    locked: processes storing entries concurrently may drop each other's
+    index entries (which then escape eviction until the index is rebuilt).
+
+    A ResultCache instance can be used as a decorator:
+
+    >>> from pyhrf.tools import ResultCache
+    >>> cache = ResultCache(path=pyhrf.get_tmp_path())
+    >>> @cache
+    ... def foo(a, b=2):
+    ...     return a + b
+    >>> foo(1, b=3)
+    4
+    """
+
+    index_file = 'pyhrf_cache_index.pck'
+
+    def __init__(self, path='./', max_size=None, compress=False):
+        self.path = path
+        self.max_size = max_size
+        self.compress = compress
+
+    def filename(self, func, args=None, prefix=None, digest_code=False):
+        return cache_filename(func, args=args, prefix=prefix, path=self.path,
+                              digest_code=digest_code, compress=self.compress)
+
+    def get_index(self):
+        """
+        Return the cache index as a dict mapping file names to
+        [size, last access time]. The index is rebuilt from the content of
+        the cache directory if it is missing or corrupted.
+        """
+        index_file = op.join(self.path, self.index_file)
+        try:
+            f = open(index_file, 'rb')
+            try:
+                return cPickle.load(f)
+            finally:
                 f.close()
-                os.system("gzip -f %s" % fn[:-3])
-        if not return_file:
-            return r
-        else:
-            return fn
-    else:
-        if not return_file:
-            return cPickle.load(gzip.open(fn))
+        except Exception:
+            index = {}
+            if op.exists(self.path):
+                for fn in os.listdir(self.path):
+                    ffn = op.join(self.path, fn)
+                    if fn.endswith('.pck') or fn.endswith('.pck.gz'):
+                        if fn != self.index_file:
+                            index[fn] = [op.getsize(ffn), op.getmtime(ffn)]
+            return index
+
+    def set_index(self, index):
+        fd, tmp_file = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        f = os.fdopen(fd, 'wb')
+        cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp_file, op.join(self.path, self.index_file))
+
+    def load(self, fn):
+        """ Load the cached result in file *fn* and record this access """
+        f = (gzip.open if fn.endswith('.gz') else open)(fn, 'rb')
+        try:
+            result = cPickle.load(f)
+        finally:
+            f.close()
+        now = time()
+        try:
+            os.utime(fn, (now, now))
+        except OSError:
+            pass
+        return result
+
+    def save(self, fn, result):
+        """ Store *result* in file *fn* and apply the eviction policy """
+        if not op.exists(self.path):
+            os.makedirs(self.path)
+        # write to a temporary file first so that concurrent evaluations
+        # never read a partial entry:
+        fd, tmp_file = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        if fn.endswith('.gz'):
+            f = gzip.open(tmp_file, 'wb', compresslevel=1)
         else:
+            f = open(tmp_file, 'wb')
+        try:
+            cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_file, fn)
+
+        index = self.get_index()
+        index[op.basename(fn)] = [op.getsize(fn), time()]
+        self.evict(index, keep=op.basename(fn))
+        self.set_index(index)
+
+    def evict(self, index, keep=None):
+        """
+        Remove least recently used entries of *index* (and their files) until
+        the cache size is below max_size. Entry *keep* is never removed.
+        """
+        if self.max_size is None:
+            return
+        # last accesses are recorded on entry files (see load):
+        for fn in index.keys():
+            try:
+                index[fn][1] = op.getmtime(op.join(self.path, fn))
+            except OSError:
+                index.pop(fn)
+        total_size = sum(s for s, t in index.itervalues())
+        for fn in sorted(index, key=lambda fn: index[fn][1]):
+            if total_size <= self.max_size * 2 ** 20:
+                break
+            if fn == keep:
+                continue
+            total_size -= index.pop(fn)[0]
+            try:
+                os.remove(op.join(self.path, fn))
+            except OSError:
+                pass
+
+    def eval(self, func, args=None, new=False, save=True, prefix=None,
+             return_file=False, digest_code=False):
+        """ See function cached_eval """
+        fn = self.filename(func, args=args, prefix=prefix,
+                           digest_code=digest_code)
+
+        if not os.path.exists(fn) or new:
+            if args is None:
+                r = func()
+            elif isinstance(args, tuple) or isinstance(args, list):
+                r = func(*args)
+            elif isinstance(args, dict):
+                r = func(**args)
+            else:
+                raise Exception("type of arg (%s) is not valid. Should be "
+                                "tuple, list or dict" % str(args.__class__))
+            if save:
+                self.save(fn, r)
+        elif not return_file:
+            r = self.load(fn)
+
+        if return_file:
             return fn
+        return r
+
+    def __call__(self, func):
+        def cached_func(*args, **kwargs):
+            def call(args, kwargs):
+                return func(*args, **kwargs)
+            call.__name__ = func.__name__
+            return self.eval(call, (args, kwargs), prefix=func.__module__)
+        cached_func.__name__ = func.__name__
+        cached_func.__doc__ = func.__doc__
+        return cached_func
+
+
+def cached_eval(func, args=None, new=False, save=True, prefix=None,
+                path='./', return_file=False, digest_code=False,
+                gzip_mode=None, max_size=None):
+    """
+    Evaluate *func* with arguments *args* (tuple, list or dict) and store the
+    result in directory *path*, or load it from there if *func* has already
+    been evaluated with the same arguments.
+    Arrays in *args* are identified by their content (see digest_data).
+
+    Args:
+        - gzip_mode (None | str): if not None, results are compressed
+          (fast gzip level)
+        - max_size (None | float): maximum size of the cache in MB.
+          Least recently used results are removed beyond this size.
+    """
+    cache = ResultCache(path, max_size=max_size,
+                        compress=gzip_mode is not None)
+    return cache.eval(func, args, new=new, save=save, prefix=prefix,
+                      return_file=return_file, digest_code=digest_code)
 
 
 def montecarlo(datagen, festim, nbit=None):
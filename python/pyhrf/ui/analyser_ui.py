@@ -3,17 +3,19 @@
 import os.path as op
 import os
 import sys
+import shutil
 import traceback
 import StringIO
 import logging
 
 import numpy as np
 
+import pyhrf
 from pyhrf import xmlio, FmriData, FmriGroupData
 from pyhrf.ndarray import MRI3Daxes
 from pyhrf.tools import stack_trees, add_prefix
 from pyhrf.tools._io import read_volume, read_texture
-from pyhrf.ndarray import stack_cuboids
+from pyhrf.ndarray import xndarray, stack_cuboids
 
 
 logger = logging.getLogger(__name__)
@@ -22,7 +24,7 @@ logger = logging.getLogger(__name__)
 class FMRIAnalyser(xmlio.XmlInitable):
 
     P_OUTPUT_PREFIX = 'outputPrefix'
-    P_ROI_AVERAGE = 'averageRoiBold'
+    P_ROI_AVERAGE = 'roiAverage'
 
     parametersToShow = [P_ROI_AVERAGE, P_OUTPUT_PREFIX]
 
@@ -51,6 +53,16 @@ class FMRIAnalyser(xmlio.XmlInitable):
     def set_gzip_outputs(self, gzip_outputs):
         self.gzip_outputs = gzip_outputs
 
+    def set_checkpoint(self, checkpoint_dir, pace=None, resume=False):
+        raise NotImplementedError('%s does not support checkpoints'
+                                  % self.__class__.__name__)
+
+    def is_seeded(self):
+        """ Tell whether the analysis of a ROI seeds the process-wide random
+        generators, ie whether its results are meant to be reproducible.
+        """
+        return False
+
     def __call__(self, *args, **kargs):
         return self.analyse_roi_wrap(*args, **kargs)
 
@@ -135,10 +147,18 @@ class FMRIAnalyser(xmlio.XmlInitable):
                =   (list of tuple(parcel data, analysis results, analysis report))
             See method analyse_roi_wrap
         """
+        return list(self.analyse_iter(data, output_dir))
+
+    def analyse_iter(self, data, output_dir=None):
+        """
+        Same as method analyse but yield the result of each parcel as soon as
+        it is available.
+        """
         logger.info("Split data ...")
         explodedData = self.split_data(data, output_dir)
         logger.info("Data splitting returned %d rois", len(explodedData))
-        return [self.analyse_roi_wrap(d) for d in explodedData]
+        for d in explodedData:
+            yield self.analyse_roi_wrap(d)
 
     def filter_crashed_results(self, results):
         to_pop = []
@@ -166,9 +186,10 @@ class FMRIAnalyser(xmlio.XmlInitable):
         coutputs = {}
         output_fns = []
 
-        roi_masks = [(data_roi.roiMask != data_roi.backgroundLabel)
-                     for data_roi in data_rois]
-        np_roi_masks = [np.where(roi_mask) for roi_mask in roi_masks]
+        # ROI positions are taken from the sparse masks of the ROI data sets,
+        # the full-volume array is only used for its shape when expanding:
+        np_roi_masks = [data_roi.np_roi_mask for data_roi in data_rois]
+        target_mask = np.zeros(data_rois[0].spatial_shape, dtype=bool)
 
         for output_name, roi_outputs in all_outputs.iteritems():
             logger.info('Merge output %s ...', output_name)
@@ -177,7 +198,7 @@ class FMRIAnalyser(xmlio.XmlInitable):
                     logger.debug('Merge as expansion ...')
                     dest_c = None
                     for i_roi, c in enumerate(roi_outputs):
-                        dest_c = c.expand(roi_masks[i_roi],
+                        dest_c = c.expand(target_mask,
                                           'voxel', targetAxes,
                                           dest=dest_c, do_checks=False,
                                           m=np_roi_masks[i_roi])
@@ -277,8 +298,30 @@ class FMRIAnalyser(xmlio.XmlInitable):
 
         return coutputs, output_fns
 
+    def make_output_sink(self, output_dir):
+        """
+        Return an OutputSink merging ROI results into output files of
+        *output_dir* as they arrive.
+        """
+        return OutputSink(self, output_dir)
+
     def outputResults(self, results, output_dir, filter='.\A',):
         """
+        Return: a tuple (dictionary of outputs, output file names)
+        """
+        if output_dir is None:
+            return {}, []
+        sink = self.make_output_sink(output_dir)
+        for roi_result in results:
+            sink.add(roi_result)
+        return sink.close()
+
+    def outputResults_in_memory(self, results, output_dir, filter='.\A',):
+        """
+        Build outputs once all ROI results are gathered in *results*. Used
+        for group data and results in an outdated format, that OutputSink
+        can not merge incrementally.
+
         Return: a tuple (dictionary of outputs, output file names)
         """
         if output_dir is None:
@@ -475,3 +518,191 @@ class FMRIAnalyser(xmlio.XmlInitable):
                 for c in allOuts.itervalues():
                     c.cleanFiles()
                 os.remove(out_file)
+
+
+class OutputSink(object):
+    """
+    Merge ROI results into whole-brain outputs as soon as they are available,
+    so that only one ROI result is held in memory at a time.
+
+    Voxel-mapped outputs are written into destination arrays which are
+    preallocated in memory-mapped files at the first ROI providing them.
+    Other outputs are small per-ROI arrays, stacked along a 'ROI' axis on
+    closing. All outputs are saved in *output_dir* by method close.
+
+    Args:
+        - analyser (FMRIAnalyser): defines the output file names and format
+        - output_dir (str|None): where to save outputs. If None, results are
+          discarded.
+        - mmap_dir (str|None): where to store the memory-mapped destination
+          arrays. If None, a temporary directory is created and removed on
+          closing.
+    """
+
+    def __init__(self, analyser, output_dir, mmap_dir=None):
+        self.analyser = analyser
+        self.output_dir = output_dir
+        self.mmap_dir = mmap_dir
+        self.tmp_dir = None
+
+        self.expanded = {}  # output name -> destination xndarray
+        self.stacked = {}  # output name -> {roi id: xndarray}
+        # results that can not be merged incrementally:
+        self.pending = []
+
+        self.meta_data = None
+        self.target_mask = None
+        self.target_axes = None
+        self.nb_results = 0
+
+    def add(self, roi_result):
+        """
+        Merge *roi_result*, ie a tuple (roi data, result, report), into the
+        outputs.
+        """
+        if self.output_dir is None:
+            return
+
+        self.nb_results += 1
+        roi_data, result, report = roi_result
+        if not isinstance(roi_data, FmriData):
+            # group data or outdated result format
+            self.pending.append(roi_result)
+            return
+
+        if len(self.analyser.filter_crashed_results([roi_result])) == 0:
+            return
+
+        if self.target_mask is None:
+            target_shape = roi_data.spatial_shape
+            self.meta_data = roi_data.meta_obj
+            # only used for its shape when expanding:
+            self.target_mask = np.zeros(target_shape, dtype=bool)
+            if len(target_shape) == 3:  # Volumic data:
+                self.target_axes = MRI3Daxes
+            else:  # surfacic
+                self.target_axes = ['voxel']
+
+        roi_id = roi_data.get_roi_id()
+        if hasattr(result, 'getOutputs'):
+            outputs = result.getOutputs()
+        else:
+            outputs = result
+
+        for output_name, c in outputs.iteritems():
+            try:
+                if c.has_axis('voxel'):
+                    dest_c = self.get_destination(output_name, c)
+                    self.expanded[output_name] = \
+                        c.expand(self.target_mask, 'voxel', self.target_axes,
+                                 dest=dest_c, do_checks=False,
+                                 m=roi_data.np_roi_mask)
+                else:
+                    self.stacked.setdefault(output_name, {})[roi_id] = c
+            except Exception, e:
+                logger.error('Could not merge output %s of roi %d',
+                             output_name, roi_id)
+                logger.error('Exception was:')
+                logger.error(e)
+
+    def get_destination(self, output_name, c):
+        """
+        Return the destination array where voxel-mapped output *c* is
+        expanded, allocated in a memory-mapped file if it does not exist yet.
+        """
+        if output_name in self.expanded:
+            return self.expanded[output_name]
+
+        if self.tmp_dir is None:
+            if self.mmap_dir is None:
+                self.tmp_dir = pyhrf.get_tmp_path()
+            else:
+                self.tmp_dir = self.mmap_dir
+                if not op.exists(self.tmp_dir):
+                    os.makedirs(self.tmp_dir)
+
+        ivox = c.get_axis_id('voxel')
+        shape = (c.data.shape[:ivox] + self.target_mask.shape +
+                 c.data.shape[ivox + 1:])
+        fn = op.join(self.tmp_dir, 'output_%d.dat' % len(self.expanded))
+        logger.debug('Allocate output %s %s in %s', output_name, str(shape),
+                     fn)
+        return xndarray(np.memmap(fn, dtype=c.data.dtype, mode='w+',
+                                  shape=shape))
+
+    def save(self, output_name, c):
+        output_fn = op.join(self.output_dir, output_name + self.ext)
+        output_fn = add_prefix(output_fn, self.analyser.outPrefix)
+        logger.debug('Save output %s to %s', output_name, output_fn)
+        try:
+            c.save(output_fn, meta_data=self.meta_data,
+                   set_MRI_orientation=True)
+        except Exception:
+            print 'Could not save output "%s", error stack was:' \
+                % output_name
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      limit=4, file=sys.stdout)
+        return output_fn
+
+    @property
+    def ext(self):
+        if len(self.target_mask.shape) == 3:
+            ext = '.nii'
+        else:
+            ext = '.gii'
+        if self.analyser.gzip_outputs:
+            ext += '.gz'
+        return ext
+
+    def close(self):
+        """
+        Save all outputs. Files of memory-mapped destination arrays are
+        removed, the returned arrays remaining valid on POSIX systems.
+
+        Return: a tuple (dictionary of outputs, output file names)
+        """
+        if self.output_dir is None:
+            return {}, []
+
+        logger.info('Building outputs from %d results ...', self.nb_results)
+        if len(self.pending) > 0:
+            coutputs, output_fns = \
+                self.analyser.outputResults_in_memory(self.pending,
+                                                      self.output_dir)
+            self.pending = []
+        else:
+            coutputs, output_fns = {}, []
+
+        if self.target_mask is None:
+            if len(coutputs) == 0:
+                logger.info('No more result to treat. '
+                            'Did everything crash ?')
+            return coutputs, output_fns
+
+        for output_name, c in self.expanded.iteritems():
+            output_fns.append(self.save(output_name, c))
+            coutputs[output_name] = c
+
+        for output_name, roi_outputs in self.stacked.iteritems():
+            logger.debug('Merge as stack (%d elements)...',
+                         len(roi_outputs))
+            irois = sorted(roi_outputs.keys())
+            try:
+                c = stack_cuboids([roi_outputs[i] for i in irois],
+                                  domain=irois, axis='ROI')
+            except Exception, e:
+                print "Could not merge outputs for %s" % output_name
+                print "Exception was:"
+                print e
+                continue
+            output_fns.append(self.save(output_name, c))
+            coutputs[output_name] = c
+
+        if self.tmp_dir is not None and self.mmap_dir is None:
+            shutil.rmtree(self.tmp_dir)
+        self.tmp_dir = None
+        self.expanded = {}
+        self.stacked = {}
+
+        return coutputs, output_fns
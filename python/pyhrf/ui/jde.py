@@ -13,6 +13,7 @@ from pyhrf.ui.analyser_ui import FMRIAnalyser
 from pyhrf.jde.beta import BetaSampler
 from pyhrf.jde.nrl.bigaussian import NRLSampler  # , NRLSamplerWithRelVar
 from pyhrf.jde.models import BOLDGibbsSampler
+from pyhrf.jde.samplerbase import load_checkpoint
 from pyhrf.xmlio import XmlInitable
 from pyhrf.tools._io import read_volume
 
@@ -83,9 +84,34 @@ class JDEMCMCAnalyser(JDEAnalyser):
         self.driftLfdType = driftType
         self.copy_sampler = copy_sampler
 
+        cfg = pyhrf.cfg['treatment-default']
+        self.set_checkpoint(cfg['mcmc_checkpoint_path'],
+                            cfg['mcmc_checkpoint_pace'])
+
     def enable_draft_testing(self):
         self.sampler.set_nb_iterations(3)
 
+    def set_checkpoint(self, checkpoint_dir, pace=None, resume=False):
+        """
+        Periodically save the state of the sampling chain of each ROI in
+        *checkpoint_dir* (None: no checkpoint), every *pace* iterations.
+        If *resume* is True, the sampling of a ROI continues from its
+        checkpoint, if any, instead of restarting from the first iteration.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        if pace is not None:
+            self.checkpoint_pace = pace
+        self.resume = resume
+
+    def is_seeded(self):
+        return getattr(self.sampler, 'randomSeed', None) is not None
+
+    def get_checkpoint_file(self, roi_id):
+        checkpoint_dir = getattr(self, 'checkpoint_dir', None)
+        if checkpoint_dir is None:
+            return None
+        return op.join(checkpoint_dir, 'jde_checkpoint_roi%04d.pck' % roi_id)
+
     def analyse_roi(self, atomData):
         """
         Launch the JDE Gibbs Sampler on a parcel-specific data set *atomData*
@@ -95,15 +121,31 @@ class JDEMCMCAnalyser(JDEAnalyser):
             JDE sampler object
         """
 
-        if self.copy_sampler:
-            sampler = copyModule.deepcopy(self.sampler)
+        checkpoint_file = self.get_checkpoint_file(atomData.get_roi_id())
+        if checkpoint_file is not None and getattr(self, 'resume', False) \
+                and op.exists(checkpoint_file):
+            logger.info('Loading checkpoint %s ...', checkpoint_file)
+            sampler = load_checkpoint(checkpoint_file)
         else:
-            sampler = self.sampler
-        sInput = self.packSamplerInput(atomData)
-        sampler.linkToData(sInput)
+            if self.copy_sampler:
+                sampler = copyModule.deepcopy(self.sampler)
+            else:
+                sampler = self.sampler
+            sInput = self.packSamplerInput(atomData)
+            sampler.linkToData(sInput)
+
+        if checkpoint_file is not None:
+            if not op.exists(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+            sampler.set_checkpoint(checkpoint_file, self.checkpoint_pace)
 
         logger.info('Treating region %d', atomData.get_roi_id())
         sampler.runSampling(atomData)
+        if checkpoint_file is not None:
+            # the chain is complete, its result replaces the snapshot:
+            sampler.set_checkpoint(None, -1)
+            if op.exists(checkpoint_file):
+                os.remove(checkpoint_file)
         logger.info('Cleaning memory ...')
         sampler.dataInput.cleanMem()
         return sampler
@@ -11,7 +11,6 @@ import itertools
 import cProfile
 import logging
 
-from os.path import splitext
 from copy import deepcopy
 from optparse import OptionParser
 from pprint import pformat
@@ -21,11 +20,13 @@ import numpy as np
 import pyhrf
 
 from pyhrf.tools import format_duration
-from pyhrf.tools._io import remote_copy, load_paradigm_from_csv, remote_mkdir
+from pyhrf.tools._io import (remote_copy, load_paradigm_from_csv, remote_mkdir,
+                             ResultArchive, dump_results, load_results)
 from pyhrf.tools._io.spmio import load_paradigm_from_mat
 from pyhrf.configuration import cfg
 from pyhrf.core import (FmriData, FMRISessionVolumicData,
-                        FMRISessionSurfacicData, FMRISessionSimulationData)
+                        FMRISessionSurfacicData, FMRISessionSimulationData,
+                        FmriSharedData, get_roi_simulation)
 from pyhrf import (xmlio, DEFAULT_BOLD_VOL_FILE, DEFAULT_MASK_VOL_FILE,
                    DEFAULT_BOLD_SURF_FILE, DEFAULT_MESH_FILE,
                    DEFAULT_MASK_SURF_FILE, DEFAULT_OUT_MASK_VOL_FILE,
@@ -34,6 +35,7 @@ from pyhrf import (xmlio, DEFAULT_BOLD_VOL_FILE, DEFAULT_MASK_VOL_FILE,
                    REALISTIC_REAL_DATA_MASK_VOL_FILE, DEFAULT_PARADIGM_CSV)
 from pyhrf.tools import unstack_trees  # stack_trees
 from pyhrf.ui.jde import JDEMCMCAnalyser
+from pyhrf.jde.design import design_cache
 
 
 logger = logging.getLogger(__name__)
@@ -52,6 +54,27 @@ def exec_t(t):
     return t.execute()
 
 
+def exec_roi(analyser, shared_data, roi_id, graph, simulation,
+             design_dir=None):
+    """ Analyse one ROI of an FmriSharedData object. The ROI data set is
+    not sent back: it is rebuilt by the caller from its own shared data.
+    Design matrices of sampler inputs are shared through *design_dir*
+    (see pyhrf.jde.design.DesignCache).
+    """
+    if design_dir is not None:
+        design_cache.set_cache_dir(design_dir)
+    roi_data = shared_data.get_roi_data(roi_id, graph, simulation)
+    _, res, report = analyser.analyse_roi_wrap(roi_data)
+    return roi_id, res, report
+
+
+def exec_roi_data(task):
+    """ Analyse the ROI data set of *task*, a tuple (analyser, roi_data).
+    """
+    analyser, roi_data = task
+    return analyser.analyse_roi_wrap(roi_data)
+
+
 class FMRITreatment(xmlio.XmlInitable):
 
     parametersComments = {
@@ -60,7 +83,8 @@ class FMRITreatment(xmlio.XmlInitable):
         'analyser':
         'Define parameters of the analysis which will be applied to '
             ' the previously defined data',
-        'result_dump_file': 'File to save the analyser result (uses pickle).',
+        'result_dump_file': 'File to save the analyser result (zip archive '
+        'of pickled ROI results).',
         'make_outputs': 'Make outputs from analysis results',
     }
 
@@ -177,6 +201,13 @@ class FMRITreatment(xmlio.XmlInitable):
             op.exists(self.result_dump_file)
 
     def execute(self):
+        return list(self.execute_iter())
+
+    def execute_iter(self):
+        """
+        Run the analysis of all ROIs in the current process and yield each ROI
+        result as soon as it is produced.
+        """
         logger.info('Input data description:')
         logger.info(self.data.getSummary(long=True))
         logger.debug('Input data description:')
@@ -186,22 +217,25 @@ class FMRITreatment(xmlio.XmlInitable):
         # TODO : print summary of analyser setup.
         logger.info('Estimation start date is : %s', time.strftime('%c'))
         tIni = time.time()
-        result = self.analyser.analyse(self.data, self.output_dir)
+        for roi_result in self.analyser.analyse_iter(self.data,
+                                                     self.output_dir):
+            yield roi_result
         logger.info('Estimation done, total time : %s',
                     format_duration(time.time() - tIni))
         logger.info('End date is : %s', time.strftime('%c'))
-        return result
 
     def run(self, parallel=None, n_jobs=None):
         """
-        Run the analysis: load data, run estimation, output results
+        Run the analysis: load data, run estimation, output results.
+        ROI results are dumped and merged into the outputs as soon as they are
+        available.
         """
         if parallel is None:
-            result = self.execute()
+            result = self.execute_iter()
         elif parallel == 'local':
             cfg_parallel = pyhrf.cfg['parallel-local']
             try:
-                from joblib import Parallel, delayed
+                from joblib import Parallel, delayed, cpu_count
             except ImportError:
                 raise Exception('Can not import joblib. It is required to '
                                 'enable parallel processing on a local machine.')
@@ -214,9 +248,26 @@ class FMRITreatment(xmlio.XmlInitable):
                 n_jobs = cfg_parallel['nb_procs']
 
             p = Parallel(n_jobs=n_jobs, verbose=parallel_verb)
-            result = p(delayed(exec_t)(t) for t in self.split(output_dir=None))
-            # join list of lists:
-            result = list(itertools.chain.from_iterable(result))
+            if isinstance(self.data, FmriData) and \
+                    not self.analyser.roiAverage:
+                # number of workers, negative n_jobs as in joblib
+                # (-1: all CPUs):
+                if n_jobs < 0:
+                    n_workers = max(cpu_count() + 1 + n_jobs, 1)
+                else:
+                    n_workers = max(n_jobs, 1)
+                result = self.iter_shared_rois(p, delayed,
+                                               batch_size=4 * n_workers)
+            else:
+                result = p(delayed(exec_t)(t)
+                           for t in self.split(output_dir=None))
+                # join list of lists:
+                result = list(itertools.chain.from_iterable(result))
+
+        elif parallel == 'threads':
+            if n_jobs is None:
+                n_jobs = pyhrf.cfg['parallel-local']['nb_procs']
+            result = self.iter_threaded_rois(n_jobs)
 
         elif parallel == 'LAN':
 
@@ -305,38 +356,44 @@ class FMRITreatment(xmlio.XmlInitable):
             # TODO : test if everything went fine
 
             # 4. merge all results and create outputs
-            result = []
             # if op.exists(remoteDir): TODO :scp if remoteDir not readable
             nb_treatments = len(treatments_dump_files)
             remote_result_files = [op.join(remoteDir, 'result_%04d.pck' % i)
                                    for i in range(nb_treatments)]
             logger.info('remote_result_files: %s', str(remote_result_files))
             nres = len(filter(op.exists, remote_result_files))
-            if nres == nb_treatments:
-                logger.info('Grabbing results ...')
-                for fnresult in remote_result_files:
-                    fresult = open(fnresult)
-                    result.append(cPickle.load(fresult)[0])
-                    fresult.close()
-            else:
+            if nres != nb_treatments:
                 print 'Found only %d result files (expected %d)' \
                     % (nres, nb_treatments)
                 print 'Something went wrong, check the log files'
-            if not remote_writeable:
-                logger.info('Cleaning tmp dir (%s)...', tmpDir)
-                shutil.rmtree(tmpDir)
-                logger.info('Cleaning up remote dir (%s) through ssh ...',
-                            remoteDir)
-                cmd = 'ssh %s@%s rm -f "%s" "%s" ' \
-                    % (remoteUser, host, ' '.join(remote_result_files),
-                       ' '.join(remote_input_files))
-                logger.info(cmd)
-                os.system(cmd)
-            else:
-                if 0:
-                    logger.info('Cleaning up remote dir (%s)...', remoteDir)
-                    for f in os.listdir(remoteDir):
-                        os.remove(op.join(remoteDir, f))
+                remote_result_files = []
+
+            def grab_results():
+                # results are loaded one at a time, remote files are cleaned
+                # once all of them have been consumed
+                try:
+                    if len(remote_result_files) > 0:
+                        logger.info('Grabbing results ...')
+                    for fnresult in remote_result_files:
+                        yield load_results(fnresult)[0]
+                finally:
+                    if not remote_writeable:
+                        logger.info('Cleaning tmp dir (%s)...', tmpDir)
+                        shutil.rmtree(tmpDir)
+                        logger.info('Cleaning up remote dir (%s) through '
+                                    'ssh ...', remoteDir)
+                        cmd = 'ssh %s@%s rm -f "%s" "%s" ' \
+                            % (remoteUser, host, ' '.join(remote_result_files),
+                               ' '.join(remote_input_files))
+                        logger.info(cmd)
+                        os.system(cmd)
+                    else:
+                        if 0:
+                            logger.info('Cleaning up remote dir (%s)...',
+                                        remoteDir)
+                            for f in os.listdir(remoteDir):
+                                os.remove(op.join(remoteDir, f))
+            result = grab_results()
 
         elif parallel == 'cluster':
 
@@ -364,10 +421,91 @@ class FMRITreatment(xmlio.XmlInitable):
         else:
             raise Exception('Parallel mode "%s" not available' % parallel)
 
-        logger.info('Retrieved %d results', len(result))
         return self.output(result, (self.result_dump_file is not None),
                            self.make_outputs)
 
+    def run_shared_rois(self, parallel, delayed):
+        """
+        Analyse all ROIs with the given joblib *parallel* engine. The BOLD
+        matrix is stored once in a memory-mapped file and each job only
+        receives a ROI id, its graph and its simulation, instead of a
+        pickled sub-treatment.
+        """
+        return list(self.iter_shared_rois(parallel, delayed))
+
+    def iter_shared_rois(self, parallel, delayed, batch_size=None):
+        """
+        Same as method run_shared_rois but yield ROI results as they are
+        retrieved. ROIs are dispatched by batches of *batch_size* (all at once
+        if None) so that only one batch of results is held in memory.
+        """
+        data = self.data
+        data.build_graphs()
+        roi_index = data.get_roi_index()
+        roi_ids = roi_index.keys()
+        graphs = dict((i, None if data.graphs is None else data.graphs[i])
+                      for i in roi_ids)
+        simulations = dict((i, get_roi_simulation(data.simulation,
+                                                  data.roi_ids_in_mask, i,
+                                                  m=roi_index[i]))
+                           for i in roi_ids)
+        if batch_size is None:
+            batch_size = len(roi_ids)
+        shared_data = FmriSharedData(data)
+        tmp_dir = pyhrf.get_tmp_path()
+        design_dir = op.join(tmp_dir, 'shared_designs')
+        previous_design_dir = design_cache.cache_dir
+        try:
+            for b in xrange(0, len(roi_ids), batch_size):
+                batch = roi_ids[b:b + batch_size]
+                results = parallel(delayed(exec_roi)(deepcopy(self.analyser),
+                                                     shared_data, i, graphs[i],
+                                                     simulations[i],
+                                                     design_dir)
+                                   for i in batch)
+                for i, res, report in results:
+                    yield (shared_data.get_roi_data(i, graphs[i],
+                                                    simulations[i]),
+                           res, report)
+        finally:
+            shared_data.clean()
+            # workers running in this process may have switched the cache:
+            design_cache.set_cache_dir(previous_design_dir)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def iter_threaded_rois(self, n_jobs):
+        """
+        Analyse ROIs with a pool of *n_jobs* threads of the current process
+        and yield their results as they are retrieved.
+
+        Unlike the 'local' mode, data are neither dumped nor pickled: threads
+        work on the ROI data sets of self.data and share the design matrices
+        of the in-memory design cache. The C kernels of the samplers release
+        the GIL, so that ROIs are effectively processed concurrently.
+
+        Threads share the global numpy random state (and the rand() state of
+        the C kernels): draws of concurrent ROIs interleave depending on
+        thread scheduling. If the analyser is seeded, ROIs are then analysed
+        one at a time so that results are reproducible. VEM estimations draw
+        from a random state of their own and are not affected.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        if self.analyser.is_seeded() and n_jobs > 1:
+            logger.warning('Random generators are seeded: ROIs are analysed '
+                           'one at a time to keep results reproducible')
+            n_jobs = 1
+        roi_datasets = self.analyser.split_data(self.data)
+        pool = ThreadPool(max(n_jobs, 1))
+        try:
+            tasks = ((deepcopy(self.analyser), roi_data)
+                     for roi_data in roi_datasets)
+            for result in pool.imap_unordered(exec_roi_data, tasks):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
     def split(self, dump_sub_results=None, make_sub_outputs=None,
               output_dir=None, output_file_list=None):
 
@@ -404,37 +542,47 @@ class FMRITreatment(xmlio.XmlInitable):
         return sub_treatments
 
     def output(self, result, dump_result=True, outputs=True):
+        """
+        Dump and/or make outputs from *result*, an iterable of ROI results
+        which is consumed one ROI at a time: each ROI result is appended to
+        the result dump file and merged into the output files as soon as it
+        is available.
+        """
+        archive = None
         if dump_result and self.result_dump_file is not None:
-            self.pickle_result(result)
+            logger.info('Dumping results to %s ...', self.result_dump_file)
+            archive = ResultArchive(self.result_dump_file, 'w')
 
+        sink = None
         if outputs:
             logger.info('Output of results to %s ...', self.output_dir)
-            try:
-                tIni = time.time()
-                r = self.analyser.outputResults(result, self.output_dir)
-                logger.info('Creation of outputs took : %s',
-                            format_duration(time.time() - tIni))
-                return r
-            except NotImplementedError:
-                logger.error('No output function defined')
+            sink = self.analyser.make_output_sink(self.output_dir)
+
+        tIni = time.time()
+        nb_results = 0
+        try:
+            for roi_result in result:
+                if archive is not None:
+                    archive.dump(roi_result)
+                if sink is not None:
+                    sink.add(roi_result)
+                nb_results += 1
+        finally:
+            if archive is not None:
+                archive.close()
+        logger.info('Retrieved %d results', nb_results)
+
+        if sink is not None:
+            r = sink.close()
+            logger.info('Creation of outputs took : %s',
+                        format_duration(time.time() - tIni))
+            return r
 
     def pickle_result(self, result):
         if self.result_dump_file is not None:
             t0 = time.time()
-
-            if splitext(self.result_dump_file)[1] == '.gz':
-                res_file = splitext(self.result_dump_file)[0]
-            else:
-                res_file = self.result_dump_file
-
-            logger.info('Dumping results uncompressed...')
-            f = open(res_file, 'w')
-            cPickle.dump(result, f)
-            f.close()
-            if splitext(self.result_dump_file)[1] == '.gz':
-                logger.info('Gzip results ...')
-                os.system('gzip "%s"' % res_file)
-
+            logger.info('Dumping results to %s ...', self.result_dump_file)
+            dump_results(result, self.result_dump_file)
             logger.info(
                 'Dumping done ... time spent: %s s', str(time.time() - t0))
 
@@ -680,11 +828,30 @@ def run_pyhrf_cmd_treatment(cfg_cmd, exec_cmd, default_cfg_file,
                       '%s. NOTE: not avalaible in parallel mode.'
                       % default_profile_file)
 
-    parallel_choices = ['LAN', 'local', 'cluster']
+    parallel_choices = ['LAN', 'local', 'threads', 'cluster']
     parser.add_option('-x', '--parallel', choices=parallel_choices,
-                      help='Parallel processing. Choices are %s'
+                      help='Parallel processing. Choices are %s. In '
+                      '"threads" mode, ROIs share the random generators, so '
+                      'results depend on thread scheduling; analyses with a '
+                      'random seed (seeded sampler, VEM) then run ROIs one at '
+                      'a time.'
                       % string.join(parallel_choices, ', '))
 
+    parser.add_option('-k', '--checkpoint-dir', dest='checkpoint_dir',
+                      metavar='DIR', default=None,
+                      help='Periodically save the state of the sampling chain '
+                      'of each ROI in DIR (MCMC analyses only).')
+
+    parser.add_option('--checkpoint-pace', dest='checkpoint_pace',
+                      metavar='INTEGER', type='int', default=None,
+                      help='Number of iterations between two checkpoints.')
+
+    parser.add_option('--resume', dest='resume', action='store_true',
+                      default=False,
+                      help='Continue sampling chains from the checkpoints '
+                      'found in the checkpoint directory instead of '
+                      'restarting them.')
+
     (options, args) = parser.parse_args()
 
     # pyhrf.verbose.set_verbosity(options.verbose)
@@ -718,6 +885,22 @@ def run_pyhrf_cmd_treatment(cfg_cmd, exec_cmd, default_cfg_file,
 
     treatment.analyser.set_pass_errors(not options.stop_on_error)
 
+    if options.checkpoint_dir is not None or options.resume or \
+            options.checkpoint_pace is not None:
+        checkpoint_dir = options.checkpoint_dir
+        if checkpoint_dir is None:
+            checkpoint_dir = getattr(treatment.analyser, 'checkpoint_dir',
+                                     None)
+        if checkpoint_dir is None:
+            parser.error('No checkpoint directory: use option '
+                         '--checkpoint-dir')
+        try:
+            treatment.analyser.set_checkpoint(op.abspath(checkpoint_dir),
+                                              options.checkpoint_pace,
+                                              resume=options.resume)
+        except NotImplementedError, e:
+            parser.error(str(e))
+
     if options.parallel is not None:
 
         treatment.run(parallel=options.parallel)
@@ -742,9 +925,7 @@ def run_pyhrf_cmd_treatment(cfg_cmd, exec_cmd, default_cfg_file,
             outPath = op.dirname(op.abspath(options.roidata))
             fOut = op.join(outPath, "result_%04d.pck" % roidata.get_roi_id())
             logger.info('Dumping results to %s ...', fOut)
-            f = open(fOut, 'w')
-            cPickle.dump(result, f)
-            f.close()
+            dump_results([result], fOut)
         else:
             logger.info('ROI data is none')
             if options.profile:
@@ -46,7 +46,9 @@ class JDEVEMAnalyser(JDEAnalyser):
         'dt' : 'time resolution of the estimated HRF in seconds',
         'hrfDuration': 'duration of the HRF in seconds',
         'sigmaH': 'variance of the HRF',
-        'fast': 'running fast VEM with C extensions',
+        'fast': 'running fast VEM with C extensions. If False, the '\
+            'vectorised NumPy implementation is used, which does not '\
+            'require compiled extensions',
         'nbClasses': 'number of classes for the response levels',
         'PLOT': 'plotting flag for convergence curves',
         'nItMax': 'maximum iteration number',
@@ -207,19 +209,20 @@ class JDEVEMAnalyser(JDEAnalyser):
                                         self.MFapprox,self.InitVar,self.InitMean,
                                         self.MiniVemFlag,self.NbItMiniVem)
         else:
-            # if not self.fast
-            if self.estimateDrifts:
-                logger.info("not fast VEM")
-                logger.info("NOT WORKING")
-                nrls, estimated_hrf, \
-                labels, noiseVar, mu_k, \
-                sigma_k, Beta, L, \
-                PL = Main_vbjde_Python_constrained(graph,data,Onsets,
-                                       self.hrfDuration,self.nbClasses,
-                                       TR,beta,self.dt,scale,
-                                       self.estimateSigmaH,self.sigmaH,
-                                       self.nItMax,self.nItMin,
-                                       self.estimateBeta,self.PLOT)
+            # if not self.fast: pure NumPy E-steps, no C extension needed
+            if self.constrained:
+                logger.info("NumPy VEM with a constraint")
+                vem = Main_vbjde_Python_constrained
+            else:
+                logger.info("NumPy VEM with drift estimation")
+                vem = Main_vbjde_Python
+            nrls, estimated_hrf, \
+            labels, noiseVar, mu_k, \
+            sigma_k, Beta, L, \
+            PL = vem(graph, data, Onsets, self.hrfDuration, self.nbClasses,
+                     TR, beta, self.dt, scale, self.estimateSigmaH,
+                     self.sigmaH, self.nItMax, self.nItMin,
+                     self.estimateBeta, self.PLOT)
 
         # Plot analysis duration
         self.analysis_duration = time() - t_start
@@ -227,26 +230,26 @@ class JDEVEMAnalyser(JDEAnalyser):
                     format_duration(self.analysis_duration))
 
 
-        if self.fast:
-            ### OUTPUTS: Pack all outputs within a dict
-            outputs = {}
-            hrf_time = np.arange(len(estimated_hrf)) * self.dt
-
-            axes_names = ['iteration']
-            """axes_domains = {'iteration':np.arange(FreeEnergy.shape[0])}
-            outputs['FreeEnergy'] = xndarray(FreeEnergy,
-                                        axes_names=axes_names,
-                                        axes_domains=axes_domains)
-            """
-            outputs['hrf'] = xndarray(estimated_hrf, axes_names=['time'],
-                                axes_domains={'time':hrf_time},
-                                value_label="HRF")
+        ### OUTPUTS: Pack all outputs within a dict
+        outputs = {}
+        hrf_time = np.arange(len(estimated_hrf)) * self.dt
 
-            domCondition = {'condition':cNames}
-            outputs['nrls'] = xndarray(nrls.transpose(),value_label="NRLs",
-                                    axes_names=['condition','voxel'],
-                                    axes_domains=domCondition)
+        axes_names = ['iteration']
+        """axes_domains = {'iteration':np.arange(FreeEnergy.shape[0])}
+        outputs['FreeEnergy'] = xndarray(FreeEnergy,
+                                    axes_names=axes_names,
+                                    axes_domains=axes_domains)
+        """
+        outputs['hrf'] = xndarray(estimated_hrf, axes_names=['time'],
+                            axes_domains={'time':hrf_time},
+                            value_label="HRF")
+
+        domCondition = {'condition':cNames}
+        outputs['nrls'] = xndarray(nrls.transpose(),value_label="NRLs",
+                                axes_names=['condition','voxel'],
+                                axes_domains=domCondition)
 
+        if self.fast:
             ad = {'condition':cNames,'condition2':Onsets.keys()}
 
             outputs['Sigma_nrls'] = xndarray(Sigma_nrls,value_label="Sigma_NRLs",
@@ -255,69 +258,70 @@ class JDEVEMAnalyser(JDEAnalyser):
 
             outputs['NbIter'] = xndarray(np.array([NbIter]),value_label="NbIter")
 
-            outputs['beta'] = xndarray(Beta,value_label="beta",
-                                    axes_names=['condition'],
-                                    axes_domains=domCondition)
-
-            nbc, nbv = len(cNames), nrls.shape[0]
-            repeatedBeta = np.repeat(Beta, nbv).reshape(nbc, nbv)
-            outputs['beta_mapped'] = xndarray(repeatedBeta,value_label="beta",
-                                            axes_names=['condition','voxel'],
-                                            axes_domains=domCondition)
-
-            outputs['roi_mask'] = xndarray(np.zeros(nbv)+roiData.get_roi_id(),
-                                        value_label="ROI",
-                                        axes_names=['voxel'])
-
-            h = estimated_hrf
-            nrls = nrls.transpose()
-
-            nvox = nrls.shape[1]
-            nbconds = nrls.shape[0]
-            ah = np.zeros((h.shape[0], nvox, nbconds))
-
-            mixtp = np.zeros((roiData.nbConditions, self.nbClasses, 2))
-            mixtp[:, :, 0] = mu_k
-            mixtp[:, :, 1] = sigma_k**2
-
-            an = ['condition','Act_class','component']
-            ad = {'Act_class':['inactiv','activ'],
-                'condition': cNames,
-                'component':['mean','var']}
-            outputs['mixt_p'] = xndarray(mixtp, axes_names=an, axes_domains=ad)
-
-            ad = {'class' : ['inactiv','activ'],
-                'condition': cNames,
-                }
-            outputs['labels'] = xndarray(labels,value_label="Labels",
-                                    axes_names=['condition','class','voxel'],
-                                    axes_domains=ad)
-            outputs['noiseVar'] = xndarray(noiseVar,value_label="noiseVar",
-                                        axes_names=['voxel'])
-            if self.estimateDrifts:
-                outputs['drift_coeff'] = xndarray(L,value_label="Drift",
-                                axes_names=['coeff','voxel'])
-                outputs['drift'] = xndarray(PL,value_label="Delta BOLD",
-                            axes_names=['time','voxel'])
-            if (len(self.contrasts) >0) and self.computeContrast:
-                #keys = list((self.contrasts[nc]) for nc in self.contrasts)
-                domContrast = {'contrast':self.contrasts.keys()}
-                outputs['contrasts'] = xndarray(CONTRAST, value_label="Contrast",
-                                            axes_names=['voxel','contrast'],
-                                            axes_domains=domContrast)
-                #print 'contrast output:'
-                #print outputs['contrasts'].descrip()
-
-                c = xndarray(CONTRASTVAR, value_label="Contrasts_Variance",
-                        axes_names=['voxel','contrast'],
-                        axes_domains=domContrast)
-                outputs['contrasts_variance'] = c
-
-                outputs['ncontrasts'] = xndarray(CONTRAST/CONTRASTVAR**.5,
-                                            value_label="Normalized Contrast",
-                                            axes_names=['voxel','contrast'],
-                                            axes_domains=domContrast)
+        outputs['beta'] = xndarray(Beta,value_label="beta",
+                                axes_names=['condition'],
+                                axes_domains=domCondition)
+
+        nbc, nbv = len(cNames), nrls.shape[0]
+        repeatedBeta = np.repeat(Beta, nbv).reshape(nbc, nbv)
+        outputs['beta_mapped'] = xndarray(repeatedBeta,value_label="beta",
+                                        axes_names=['condition','voxel'],
+                                        axes_domains=domCondition)
+
+        outputs['roi_mask'] = xndarray(np.zeros(nbv)+roiData.get_roi_id(),
+                                    value_label="ROI",
+                                    axes_names=['voxel'])
+
+        h = estimated_hrf
+        nrls = nrls.transpose()
+
+        nvox = nrls.shape[1]
+        nbconds = nrls.shape[0]
+        ah = np.zeros((h.shape[0], nvox, nbconds))
+
+        mixtp = np.zeros((roiData.nbConditions, self.nbClasses, 2))
+        mixtp[:, :, 0] = mu_k
+        mixtp[:, :, 1] = sigma_k**2
+
+        an = ['condition','Act_class','component']
+        ad = {'Act_class':['inactiv','activ'],
+            'condition': cNames,
+            'component':['mean','var']}
+        outputs['mixt_p'] = xndarray(mixtp, axes_names=an, axes_domains=ad)
+
+        ad = {'class' : ['inactiv','activ'],
+            'condition': cNames,
+            }
+        outputs['labels'] = xndarray(labels,value_label="Labels",
+                                axes_names=['condition','class','voxel'],
+                                axes_domains=ad)
+        outputs['noiseVar'] = xndarray(noiseVar,value_label="noiseVar",
+                                    axes_names=['voxel'])
+        if self.estimateDrifts:
+            outputs['drift_coeff'] = xndarray(L,value_label="Drift",
+                            axes_names=['coeff','voxel'])
+            outputs['drift'] = xndarray(PL,value_label="Delta BOLD",
+                        axes_names=['time','voxel'])
+        if self.fast and (len(self.contrasts) >0) and self.computeContrast:
+            #keys = list((self.contrasts[nc]) for nc in self.contrasts)
+            domContrast = {'contrast':self.contrasts.keys()}
+            outputs['contrasts'] = xndarray(CONTRAST, value_label="Contrast",
+                                        axes_names=['voxel','contrast'],
+                                        axes_domains=domContrast)
+            #print 'contrast output:'
+            #print outputs['contrasts'].descrip()
+
+            c = xndarray(CONTRASTVAR, value_label="Contrasts_Variance",
+                    axes_names=['voxel','contrast'],
+                    axes_domains=domContrast)
+            outputs['contrasts_variance'] = c
+
+            outputs['ncontrasts'] = xndarray(CONTRAST/CONTRASTVAR**.5,
+                                        value_label="Normalized Contrast",
+                                        axes_names=['voxel','contrast'],
+                                        axes_domains=domContrast)
 
+        if self.fast:
             ################################################################################
             # CONVERGENCE
 
@@ -442,11 +446,10 @@ class JDEVEMAnalyser(JDEAnalyser):
 
         # END SIMULATION
         ##########################################################################
-        if self.fast:
-            d = {'parcel_size':np.array([nvox])}
-            outputs['analysis_duration'] = xndarray(np.array([self.analysis_duration]),
-                                                axes_names=['parcel_size'],
-                                                axes_domains=d)
+        d = {'parcel_size':np.array([nvox])}
+        outputs['analysis_duration'] = xndarray(np.array([self.analysis_duration]),
+                                            axes_names=['parcel_size'],
+                                            axes_domains=d)
 
         return #outputs
 
@@ -38,7 +38,7 @@ def Main_vbjde_c_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1,
     """ Version modified by Lofti from Christine's version """
     logger.info("Fast EM with C extension started ... "
                 "Here is the stable version !")
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
 
     #Initialize parameters
     #gamma_h = 7.5
@@ -125,7 +125,7 @@ def Main_vbjde_c_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1,
     for j in xrange(0, J):
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_Ma[m, k], \
+                m_A[j, m] += rng.normal(mu_Ma[m, k], \
                                 np.sqrt(sigma_Ma[m, k])) * q_Z[m, k, j]
     m_A1 = m_A
     Sigma_C = copy.deepcopy(Sigma_A)
@@ -407,7 +407,7 @@ def Main_vbjde_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1,
                            estimateMP=True, estimateLA=True):
     """ Version modified by Lofti from Christine's version """
     logger.info("EM for ASL!")
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
 
     # Initialization
     gamma_h = 1000000000  #7.5
@@ -487,7 +487,7 @@ def Main_vbjde_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1,
     for j in xrange(0, J):
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_Ma[m, k], \
+                m_A[j, m] += rng.normal(mu_Ma[m, k], \
                                 np.sqrt(sigma_Ma[m, k])) * q_Z[m, k, j]
     Sigma_C = copy.deepcopy(Sigma_A)
     m_C = copy.deepcopy(m_A)
@@ -16,11 +16,16 @@ import logging
 import numpy as np
 
 import pyhrf
-import pyhrf.vbjde.UtilsC as UtilsC
+try:
+    import pyhrf.vbjde.UtilsC as UtilsC
+except ImportError:
+    # only Main_vbjde_Python is available without the C extension
+    UtilsC = None
 import pyhrf.vbjde.vem_tools as vt
 
 from pyhrf.tools._io import read_volume
 from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.graph import graph_coloring
 from pyhrf.ndarray import xndarray
 try:
     from collections import OrderedDict
@@ -38,7 +43,7 @@ def Main_vbjde_Extension(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estim
     # VEM BOLD classic, using extension in C
 
     logger.info("Fast EM with C extension started ...")
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
 
     # TODO: Take out
     tau1 = 0.0
@@ -133,7 +138,7 @@ def Main_vbjde_Extension(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estim
     if MiniVEMFlag:
         logger.info("MiniVEM to choose the best initialisation...")
         InitVar, InitMean, gamma_h = vt.MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D, M, N, J, S, maxNeighbours,
-                                                        neighboursIndexes, XX, X, R, Det_invR, Gamma, Det_Gamma, p_Wtilde, scale, Q_barnCond, XGamma, tau1, tau2, NbItMiniVem, sigmaH, estimateHRF)
+                                                        neighboursIndexes, XX, X, R, Det_invR, Gamma, Det_Gamma, p_Wtilde, scale, Q_barnCond, XGamma, tau1, tau2, NbItMiniVem, sigmaH, estimateHRF, rng=rng)
 
     sigma_epsilone = np.ones(J)
 
@@ -176,7 +181,7 @@ def Main_vbjde_Extension(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estim
     for j in xrange(0, J):
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_M[m, k],
+                m_A[j, m] += rng.normal(mu_M[m, k],
                                               np.sqrt(sigma_M[m, k])) * q_Z[m, k, j]
     m_A1 = m_A
 
@@ -743,7 +748,7 @@ def Main_vbjde_Extension(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estim
     return ni, m_A, m_H, q_Z, sigma_epsilone, mu_M, sigma_M, Beta, L, PL, CONTRAST, CONTRASTVAR, cA[2:], cH[2:], cZ[2:], cAH[2:], cTime[2:], cTimeMean, Sigma_A, StimulusInducedSignal
 
 
-def Main_vbjde_Python(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimateSigmaH=True, sigmaH=0.1, NitMax=-1, NitMin=1, estimateBeta=False, PLOT=False):
+def Main_vbjde_Python(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimateSigmaH=True, sigmaH=0.1, NitMax=-1, NitMin=1, estimateBeta=False, PLOT=False, color_sweep=False):
     # VEM BOLD classic, using just python
 
     logger.info("EM started ...")
@@ -768,6 +773,9 @@ def Main_vbjde_Python(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimate
     neighboursIndexes -= 1
     for i in xrange(J):
         neighboursIndexes[i, :len(graph[i])] = graph[i]
+    # E-Z step: sequential voxel sweep as UtilsC, unless colour blocks are
+    # asked for (faster, different sweep order)
+    color_blocks = graph_coloring(neighboursIndexes) if color_sweep else None
     #-----------------------------------------------------------------------#
     sigma_epsilone = np.ones(J)
     X = OrderedDict([])
@@ -835,7 +843,8 @@ def Main_vbjde_Python(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimate
             Y, Sigma_A, m_A, X, Gamma, PL, D, R, sigmaH, J, N, y_tilde, zerosND, sigma_epsilone, scale, zerosDD, zerosD)
         logger.info("E Z step ...")
         q_Z, Z_tilde = vt.expectation_Z(
-            Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK)
+            Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK,
+            color_blocks)
 
         if estimateSigmaH:
             logger.info("M sigma_H step ...")
@@ -888,7 +897,8 @@ def Main_vbjde_Python(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimate
     cH += [Crit_H]
     m_H1[:] = m_H[:]
     q_Z, Z_tilde = vt.expectation_Z(
-        Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK)
+        Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK,
+        color_blocks)
     DIFF = abs(np.reshape(q_Z, (M * K * J)) - np.reshape(q_Z1, (M * K * J)))
     Crit_Z = sum(DIFF) / len(np.where(DIFF != 0))
     cZ += [Crit_Z]
@@ -931,7 +941,8 @@ def Main_vbjde_Python(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimate
             cH += [Crit_H]
             m_H1[:] = m_H[:]
             q_Z, Z_tilde = vt.expectation_Z(
-                Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK)
+                Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK,
+                color_blocks)
             DIFF = abs(
                 np.reshape(q_Z, (M * K * J)) - np.reshape(q_Z1, (M * K * J)))
             Crit_Z = sum(DIFF) / len(np.where(DIFF != 0))
@@ -1135,7 +1146,7 @@ def Main_vbjde_Extension_stable(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1
     logger.info(
         "Fast EM with C extension started ... Here is the stable version !")
 
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
     S = 100
     if NitMax < 0:
         NitMax = 100
@@ -1243,7 +1254,7 @@ def Main_vbjde_Extension_stable(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1
     for j in xrange(0, J):
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_M[m, k],
+                m_A[j, m] += rng.normal(mu_M[m, k],
                                               np.sqrt(sigma_M[m, k])) * q_Z[m, k, j]
     m_A1 = m_A
 
@@ -12,10 +12,14 @@ import logging
 
 import numpy as np
 
-import pyhrf.vbjde.UtilsC as UtilsC
+try:
+    import pyhrf.vbjde.UtilsC as UtilsC
+except ImportError:
+    UtilsC = None
 import pyhrf.vbjde.vem_tools as vt
 
 from pyhrf.tools._io import read_volume
+from pyhrf.graph import graph_coloring
 from pyhrf.boldsynth.hrf import getCanoHRF
 from pyhrf.ndarray import xndarray
 try:
@@ -44,7 +48,7 @@ def Main_vbjde_Extension_constrained(graph, Y, Onsets, Thrf, K, TR, beta,
     # VBJDE Function for BOLD with contraints
 
     logger.info("Fast EM with C extension started ...")
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
 
     ##########################################################################
     # INITIALIZATIONS
@@ -152,7 +156,7 @@ def Main_vbjde_Extension_constrained(graph, Y, Onsets, Thrf, K, TR, beta,
                                                      sigmaH,estimateHRF)"""
 
         InitVar, InitMean, gamma_h = vt.MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D, M, N, J, S, maxNeighbours,
-                                                        neighboursIndexes, XX, X, R, Det_invR, Gamma, Det_Gamma, p_Wtilde, scale, Q_barnCond, XGamma, tau1, tau2, NbItMiniVem, sigmaH, estimateHRF)
+                                                        neighboursIndexes, XX, X, R, Det_invR, Gamma, Det_Gamma, p_Wtilde, scale, Q_barnCond, XGamma, tau1, tau2, NbItMiniVem, sigmaH, estimateHRF, rng=rng)
 
     sigmaH = Init_sigmaH
     sigma_epsilone = np.ones(J)
@@ -195,7 +199,7 @@ def Main_vbjde_Extension_constrained(graph, Y, Onsets, Thrf, K, TR, beta,
     for j in xrange(0, J):
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_M[m, k],
+                m_A[j, m] += rng.normal(mu_M[m, k],
                                               np.sqrt(sigma_M[m, k])) * q_Z[m, k, j]
     m_A1 = m_A
 
@@ -493,9 +497,9 @@ def Main_vbjde_Extension_constrained(graph, Y, Onsets, Thrf, K, TR, beta,
     return ni, m_A, m_H, q_Z, sigma_epsilone, mu_M, sigma_M, Beta, L, PL, CONTRAST, CONTRASTVAR, cA[2:], cH[2:], cZ[2:], cAH[2:], cTime[2:], cTimeMean, Sigma_A, StimulusInducedSignal, FreeEnergyArray
 
 
-def Main_vbjde_Python_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimateSigmaH=True, sigmaH=0.1, NitMax=-1, NitMin=1, estimateBeta=False, PLOT=False):
+def Main_vbjde_Python_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale=1, estimateSigmaH=True, sigmaH=0.1, NitMax=-1, NitMin=1, estimateBeta=False, PLOT=False, color_sweep=False):
     logger.info("EM started ...")
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
 
     ##########################################################################
     # INITIALIZATIONS
@@ -522,6 +526,9 @@ def Main_vbjde_Python_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale
     neighboursIndexes -= 1
     for i in xrange(J):
         neighboursIndexes[i, :len(graph[i])] = graph[i]
+    # E-Z step: sequential voxel sweep as UtilsC, unless colour blocks are
+    # asked for (faster, different sweep order)
+    color_blocks = graph_coloring(neighboursIndexes) if color_sweep else None
     # Conditions
     X = OrderedDict([])
     for condition, Ons in Onsets.iteritems():
@@ -557,7 +564,7 @@ def Main_vbjde_Python_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale
         Sigma_A[:, :, j] = 0.01 * np.identity(M)
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_M[m, k],
+                m_A[j, m] += rng.normal(mu_M[m, k],
                                               np.sqrt(sigma_M[m, k])) * Z_tilde[m, k, j]
     m_H = np.array(m_h).astype(np.float64)
     m_H1 = np.array(m_h)
@@ -629,7 +636,8 @@ def Main_vbjde_Python_constrained(graph, Y, Onsets, Thrf, K, TR, beta, dt, scale
         # Z
         logger.info("E Z step ...")
         q_Z, Z_tilde = vt.expectation_Z(
-            Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK)
+            Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK,
+            color_blocks)
 
         # crit Z
         DIFF = np.abs(
@@ -795,7 +803,7 @@ def Main_vbjde_Extension_constrained_stable(graph, Y, Onsets, Thrf, K, TR, beta,
     logger.info(
         "Fast EM with C extension started ... Here is the stable version !")
 
-    np.random.seed(6537546)
+    rng = np.random.RandomState(6537546)
 
     # Initialize parameters
     S = 100
@@ -903,7 +911,7 @@ def Main_vbjde_Extension_constrained_stable(graph, Y, Onsets, Thrf, K, TR, beta,
     for j in xrange(0, J):
         for m in xrange(0, M):
             for k in xrange(0, K):
-                m_A[j, m] += np.random.normal(mu_M[m, k],
+                m_A[j, m] += rng.normal(mu_M[m, k],
                                               np.sqrt(sigma_M[m, k])) * q_Z[m, k, j]
     m_A1 = m_A
 
@@ -14,9 +14,14 @@ from numpy.matlib import *
 from scipy.linalg import toeplitz
 
 import pyhrf
-import pyhrf.vbjde.UtilsC as UtilsC
+try:
+    import pyhrf.vbjde.UtilsC as UtilsC
+except ImportError:
+    # pure NumPy functions of this module remain usable
+    UtilsC = None
 
 from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.graph import graph_coloring
 from pyhrf.ndarray import xndarray
 from pyhrf.paradigm import restarize_events
 from pyhrf.tools import format_duration
@@ -197,57 +202,78 @@ def roc_curve(dvals, labels, rocN=None, normalize=True):
 ##############################################################
 
 
+def _stack_conditions(X, N, D):
+    """ Stack the condition design matrices of the ordered dict *X* into a
+    (nb conditions, N, D) array, following the iteration order of *X*.
+    """
+    if len(X) == 0:
+        return np.zeros((0, N, D), dtype=np.float64)
+    return np.array([X[c] for c in X], dtype=np.float64)
+
+
+def _neighbours_array(graph, J):
+    """ Return neighbour indexes as a (J, maxNeighbours) array padded with J,
+    so that a zero column appended to voxel-wise arrays can be used to
+    discard padding when summing over neighbours.
+    """
+    graph = np.asarray(graph)
+    if graph.ndim == 2 and graph.dtype.kind == 'i':
+        neighbours = graph.copy()
+    else:
+        maxNeighbours = max([len(nl) for nl in graph] + [1])
+        neighbours = np.zeros((J, maxNeighbours), dtype=np.int32) - 1
+        for i in xrange(J):
+            neighbours[i, :len(graph[i])] = graph[i]
+    neighbours[neighbours < 0] = J
+    return neighbours
+
+
 def expectation_A(Y, Sigma_H, m_H, m_A, X, Gamma, PL, sigma_MK, q_Z, mu_MK, D, N, J, M, K, y_tilde, Sigma_A, sigma_epsilone, zerosJMD):
-    X_tilde = zerosJMD.copy()  # np.zeros((Y.shape[1],M,D),dtype=float)
+    """ Update the posterior covariances *Sigma_A* (M, M, J) and means *m_A*
+    (J, M) of the NRLs. All voxels are processed at once: the
+    voxel-independent matrices are computed once and the J systems are
+    inverted as a stack.
+    """
     J = Y.shape[1]
-    for i in xrange(0, J):
-        m = 0
-        for k1 in X:
-            m2 = 0
-            for k2 in X:
-                Sigma_A[m, m2, i] = np.dot(np.dot(np.dot(np.dot(m_H.transpose(), X[
-                                           k1].transpose()), Gamma / max(sigma_epsilone[i], eps)), X[k2]), m_H)
-                Sigma_A[m, m2, i] += (np.dot(np.dot(np.dot(
-                    Sigma_H, X[k1].transpose()), Gamma / max(sigma_epsilone[i], eps)), X[k2])).trace()
-                m2 += 1
-            X_tilde[i, m, :] = np.dot(
-                np.dot(Gamma / max(sigma_epsilone[i], eps), y_tilde[:, i]).transpose(), X[k1])
-            m += 1
-        tmp = np.dot(X_tilde[i, :, :], m_H)
-        for k in xrange(0, K):
-            Delta = np.diag(q_Z[:, k, i] / (sigma_MK[:, k] + eps))
-            tmp += np.dot(Delta, mu_MK[:, k])
-            Sigma_A[:, :, i] += Delta
-        # print Sigma_A[:,:,i]
-        tmp2 = np.linalg.inv(Sigma_A[:, :, i])
-        Sigma_A[:, :, i] = tmp2
-        m_A[i, :] = np.dot(Sigma_A[:, :, i], tmp)
+    XX = _stack_conditions(X, N, D)
+    nX = XX.shape[0]
+    s_eps = np.maximum(sigma_epsilone, eps)
+    GX = np.einsum('nk,mkd->mnd', Gamma, XX)
+    # XtGX[m, m2] = X_m^T Gamma X_m2
+    XtGX = np.einsum('mnd,pne->mpde', XX, GX)
+    Sigma_A0 = np.einsum('d,mpde,e->mp', m_H, XtGX, m_H) + \
+        np.einsum('ed,mpde->mp', Sigma_H, XtGX)
+    X_tilde = zerosJMD.copy()
+    X_tilde[:, :nX, :] = np.einsum('ni,mnd->imd', np.dot(Gamma, y_tilde), XX)
+    X_tilde /= s_eps[:, np.newaxis, np.newaxis]
+    tmp = np.dot(X_tilde, m_H)
+    Sigma_A[:nX, :nX, :] = Sigma_A0[:, :, np.newaxis] / s_eps
+    # Delta[m, i] = sum_k q_Z[m, k, i] / sigma_MK[m, k]
+    Delta = q_Z / (sigma_MK[:, :, np.newaxis] + eps)
+    tmp += np.einsum('mki,mk->im', Delta, mu_MK)
+    Sigma_A[range(M), range(M), :] += Delta.sum(1)
+    Sigma_A[:, :, :] = np.linalg.inv(Sigma_A.transpose(2, 0, 1))\
+                         .transpose(1, 2, 0)
+    m_A[:, :] = np.einsum('mpi,ip->im', Sigma_A, tmp)
     return Sigma_A, m_A
 
 
 def expectation_H(Y, Sigma_A, m_A, X, Gamma, PL, D, R, sigmaH, J, N, y_tilde, zerosND, sigma_epsilone, scale, zerosDD, zerosD):
-    Y_bar_tilde = zerosD.copy()  # np.zeros((D),dtype=float)
-    Q_bar = scale * R / sigmaH
-    Q_bar2 = scale * R / sigmaH
-    for i in xrange(0, J):
-        m = 0
-        tmp = zerosND.copy()  # np.zeros((N,D),dtype=float)
-        for k in X:  # Loop over the M conditions
-            tmp += m_A[i, m] * X[k]
-            m += 1
-        Y_bar_tilde += np.dot(np.dot(tmp.transpose(),
-                                     Gamma / max(sigma_epsilone[i], eps)), y_tilde[:, i])
-        Q_bar += np.dot(np.dot(tmp.transpose(), Gamma /
-                               max(sigma_epsilone[i], eps)), tmp)
-        Q_bar2[:, :] = Q_bar[:, :]
-        m1 = 0
-        for k1 in X:  # Loop over the M conditions
-            m2 = 0
-            for k2 in X:  # Loop over the M conditions
-                Q_bar += Sigma_A[m1, m2, i] * np.dot(
-                    np.dot(X[k1].transpose(), Gamma / max(sigma_epsilone[i], eps)), X[k2])
-                m2 += 1
-            m1 += 1
+    """ Update the posterior covariance *Sigma_H* (D, D) and mean *m_H* (D) of
+    the HRF, accumulating the contributions of all voxels with tensor
+    contractions over the voxel axis.
+    """
+    XX = _stack_conditions(X, N, D)
+    nX = XX.shape[0]
+    w = 1. / np.maximum(sigma_epsilone, eps)
+    m_Ax = m_A[:, :nX]
+    GX = np.einsum('nk,mkd->mnd', Gamma, XX)
+    XtGX = np.einsum('mnd,pne->mpde', XX, GX)
+    XtGy = np.einsum('mnd,ni->mdi', GX, y_tilde)
+    Y_bar_tilde = zerosD + np.einsum('i,im,mdi->d', w, m_Ax, XtGy)
+    coeffs = np.einsum('i,im,ip->mp', w, m_Ax, m_Ax) + \
+        np.einsum('i,mpi->mp', w, Sigma_A[:nX, :nX, :])
+    Q_bar = scale * R / sigmaH + np.einsum('mp,mpde->de', coeffs, XtGX)
     Sigma_H = np.linalg.inv(Q_bar)
     m_H = np.dot(Sigma_H, Y_bar_tilde)
     m_H[0] = 0
@@ -255,43 +281,51 @@ def expectation_H(Y, Sigma_A, m_A, X, Gamma, PL, D, R, sigmaH, J, N, y_tilde, ze
     return Sigma_H, m_H
 
 
-def expectation_Z(Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK):
-    energy = zerosK.copy()
-    Gauss = zerosK.copy()
-    for i in xrange(0, J):
-        for m in xrange(0, M):
-            alpha = -0.5 * Sigma_A[m, m, i] / (sigma_M[m, :] + eps)
-            alpha /= np.mean(alpha) + eps
-            tmp = sum(Z_tilde[m, :, graph[i]], 0)
-            for k in xrange(0, K):
-                extern_field = alpha[
-                    k] + max(np.log(normpdf(m_A[i, m], mu_M[m, k], np.sqrt(sigma_M[m, k])) + eps), -100)
-                local_energy = Beta[m] * tmp[k]
-                energy[k] = extern_field + local_energy
-            Emax = max(energy)
-            Probas = np.exp(energy - Emax)
-            Sum = sum(Probas)
-            Z_tilde[m, :, i] = Probas / (Sum + eps)
-    for i in xrange(0, J):
-        for m in xrange(0, M):
-            alpha = -0.5 * Sigma_A[m, m, i] / (sigma_M[m, :] + eps)
-            alpha /= np.mean(alpha) + eps
-            tmp = sum(Z_tilde[m, :, graph[i]], 0)
-            for k in xrange(0, K):
-                extern_field = alpha[k]
-                local_energy = Beta[m] * tmp[k]
-                energy[k] = extern_field + local_energy
-                Gauss[k] = normpdf(
-                    m_A[i, m], mu_M[m, k], np.sqrt(sigma_M[m, k]))
-            Emax = max(energy)
-            Probas = np.exp(energy - Emax)
-            Sum = sum(Probas)
-            q_Z[m, :, i] = Gauss * Probas / Sum
-            SZ = sum(q_Z[m, :, i])
-            q_Z[m, :, i] /= SZ
+def expectation_Z(Sigma_A, m_A, sigma_M, Beta, Z_tilde, mu_M, q_Z, graph, M, J, K, zerosK, color_blocks=None):
+    """ Mean-field update of the label posteriors *q_Z* (M, K, J) and of the
+    neighbourhood field *Z_tilde* (M, K, J), as UtilsC.expectation_Z.
+
+    Conditions and classes are processed at once. The first pass, which
+    refreshes *Z_tilde* from its neighbours, sweeps voxels one after the
+    other by default, giving the same results as UtilsC.expectation_Z.
+    If *color_blocks* is given (see :func:`pyhrf.graph.graph_coloring`),
+    the sweep goes block by block instead: voxels of the same colour do not
+    interact so each block is updated in a single step. This is the sweep
+    of UtilsC.expectation_Z with the concatenated blocks as *order*.
+    """
+    if color_blocks is None:
+        color_blocks = [[j] for j in xrange(J)]
+    neighbours = _neighbours_array(graph, J)
+    sigma_M = sigma_M[:, :, np.newaxis]
+    mu_M = mu_M[:, :, np.newaxis]
+    Beta = np.asarray(Beta, dtype=np.float64).reshape(M, 1, 1)
+    alpha = -0.5 * Sigma_A[range(M), range(M), :][:, np.newaxis, :] / \
+        (sigma_M + eps)
+    alpha /= alpha.mean(1)[:, np.newaxis, :]
+    Gauss = normpdf(m_A.T[:, np.newaxis, :], mu_M, np.sqrt(sigma_M))
+    extern_field = alpha + np.maximum(np.log(Gauss + eps), -100)
+
+    Z_pad = np.concatenate((Z_tilde, np.zeros((M, K, 1))), axis=2)
+    for block in color_blocks:
+        local_energy = Beta * Z_pad[:, :, neighbours[block]].sum(3)
+        Probas = _energy_probas(extern_field[:, :, block] + local_energy)
+        Z_pad[:, :, block] = Probas / (Probas.sum(1)[:, np.newaxis, :] + eps)
+    Z_tilde[:, :, :] = Z_pad[:, :, :J]
+
+    Probas = _energy_probas(alpha + Beta * Z_pad[:, :, neighbours].sum(3))
+    q_Z[:, :, :] = Gauss * Probas / (Probas.sum(1)[:, np.newaxis, :] + eps)
+    q_Z /= q_Z.sum(1)[:, np.newaxis, :]
     return q_Z, Z_tilde
 
 
+def _energy_probas(energy):
+    """ Return exp(energy - Emax) for energies of shape (M, K, nbVox), Emax
+    being the maximum over classes floored at 0 as in UtilsC.
+    """
+    Emax = np.maximum(energy.max(1), 0.)
+    return np.exp(energy - Emax[:, np.newaxis, :])
+
+
 # Maximization functions
 ##############################################################
 
@@ -515,7 +549,7 @@ def Compute_FreeEnergy2(y_tilde,m_A,Sigma_A,mu_M,sigma_M,m_H,Sigma_H,
 # MiniVEM
 #########################################################
 
-def MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D, M, N, J, S, maxNeighbours, neighboursIndexes, XX, X, R, Det_invR, Gamma, Det_Gamma, p_Wtilde, scale, Q_barnCond, XGamma, tau1, tau2, Nit, sigmaH, estimateHRF):
+def MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D, M, N, J, S, maxNeighbours, neighboursIndexes, XX, X, R, Det_invR, Gamma, Det_Gamma, p_Wtilde, scale, Q_barnCond, XGamma, tau1, tau2, Nit, sigmaH, estimateHRF, rng=np.random):
 
     # print 'InitVar =',InitVar,',    InitMean =',InitMean,',     gamma_h
     # =',gamma_h
@@ -556,7 +590,7 @@ def MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D,
                             l = [0]
                         for c in xrange(K):
                             l += [c] * nbVoxInClass
-                        q_Z[j, 0, :] = np.random.permutation(l)
+                        q_Z[j, 0, :] = rng.permutation(l)
                         q_Z[j, 1, :] = 1. - q_Z[j, 0, :]
                 if 1:
                     logger.info(
@@ -594,7 +628,7 @@ def MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D,
                 for j in xrange(0, J):
                     for m in xrange(0, M):
                         for k in xrange(0, K):
-                            m_A[j, m] += np.random.normal(
+                            m_A[j, m] += rng.normal(
                                 mu_M[m, k], np.sqrt(sigma_M[m, k])) * q_Z[m, k, j]
 
                 for ni in xrange(0, Nit + 1):
@@ -659,7 +693,7 @@ def MiniVEM_CompMod(Thrf, TR, dt, beta, Y, K, gamma, gradientStep, MaxItGrad, D,
 def MiniVEM_CompMod2(Thrf,TR,dt,beta,Y,K,gamma,gradientStep,MaxItGrad,
                     D,M,N,J,S,maxNeighbours,neighboursIndexes,XX,X,R,
                     Det_invR,Gamma,Det_Gamma,scale,Q_barnCond,XGamma,
-                    Nit,sigmaH,estimateHRF):
+                    Nit,sigmaH,estimateHRF,rng=np.random):
     # Mini VEM to have a goo initialization
 
     Init_sigmaH = sigmaH
@@ -694,7 +728,7 @@ def MiniVEM_CompMod2(Thrf,TR,dt,beta,Y,K,gamma,gradientStep,MaxItGrad,
                             l = [0]
                         for c in xrange(K) :
                             l += [c] * nbVoxInClass
-                        q_Z[j,0,:] = np.random.permutation(l)
+                        q_Z[j,0,:] = rng.permutation(l)
                         q_Z[j,1,:] = 1. - q_Z[j,0,:]
                 if 1:
                     logger.info("Labels are initialized by setting active probabilities to ones ...")
@@ -731,7 +765,7 @@ def MiniVEM_CompMod2(Thrf,TR,dt,beta,Y,K,gamma,gradientStep,MaxItGrad,
                 for j in xrange(0,J):
                     for m in xrange(0,M):
                         for k in xrange(0,K):
-                            m_A[j,m] += np.random.normal(mu_M[m,k], np.sqrt(sigma_M[m,k]))*q_Z[m,k,j]
+                            m_A[j,m] += rng.normal(mu_M[m,k], np.sqrt(sigma_M[m,k]))*q_Z[m,k,j]
 
                 for ni in xrange(0,Nit+1):
                     logger.info("------------------------------ Iteration n° " + str(ni+1) + " ------------------------------")
@@ -6,7 +6,7 @@ import sys
 from glob import glob
 from importlib import import_module
 
-install_requires = [("numpy", "1.6"),
+install_requires = [("numpy", "1.8"),
                     ("scipy", "0.9"),
                     ("nibabel", "1.1"),
                     ("sympy", "0.7"),
@@ -68,7 +68,7 @@ setup(
                       "sympy>=0.7"],
     include_package_data = True,
     scripts = glob('./bin/*'),
-    install_requires = ["numpy>=1.6",
+    install_requires = ["numpy>=1.8",
                         "scipy>=0.9",
                         "matplotlib>=1.1,<1.4",
                         "nibabel>=1.1",
@@ -100,6 +100,7 @@ static PyObject* quadFormNorm(PyObject *self, PyObject *arg)
                                                        2, 2);  
   res = (PyArrayObject*) PyArray_ContiguousFromObject(oRes, PyArray_FLOAT64,  
                                                       2, 2);  
+  Py_BEGIN_ALLOW_THREADS
   nlx = matX->dimensions[0]; 
   ncx = matX->dimensions[1]; 
 
@@ -115,6 +116,7 @@ static PyObject* quadFormNorm(PyObject *self, PyObject *arg)
 
   free(matXTQ);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(matQ);  
   Py_DECREF(matX);  
   Py_DECREF(res);  
@@ -147,6 +149,7 @@ static PyObject* computeStLambda(PyObject *self, PyObject *arg)
   varMBY = (PyArrayObject*) PyArray_ContiguousFromObject(oVarMBY, PyArray_FLOAT64, 2, 2);
   destStDS = (PyArrayObject*) PyArray_ContiguousFromObject(oDestStDS, PyArray_FLOAT64, 3, 3);
   destStDY = (PyArrayObject*) PyArray_ContiguousFromObject(oDestStDY, PyArray_FLOAT64, 2, 2);
+  Py_BEGIN_ALLOW_THREADS
   
   //  printf("wrapping ok\n");
   //  fflush(stdout);
@@ -219,6 +222,7 @@ static PyObject* computeStLambda(PyObject *self, PyObject *arg)
   
   free(stDelta);
   
+  Py_END_ALLOW_THREADS
   Py_DECREF(nrls);
   Py_DECREF(stackX);
   Py_DECREF(delta);
@@ -258,6 +262,7 @@ static PyObject* computeStLambdaARModel(PyObject *self, PyObject *arg)
   destStDS = (PyArrayObject*) PyArray_ContiguousFromObject(oDestStDS, PyArray_FLOAT64, 3, 3);
   destStDY = (PyArrayObject*) PyArray_ContiguousFromObject(oDestStDY, PyArray_FLOAT64, 2, 2);
   rb = (PyArrayObject*) PyArray_ContiguousFromObject(orb, PyArray_FLOAT64, 1, 1);
+  Py_BEGIN_ALLOW_THREADS
   
 //  printf("wrapping ok\n");
 //  fflush(stdout);
@@ -323,6 +328,7 @@ static PyObject* computeStLambdaARModel(PyObject *self, PyObject *arg)
     }
   free(stDelta);
   
+  Py_END_ALLOW_THREADS
   Py_DECREF(nrls);
   Py_DECREF(stackX);
   Py_DECREF(delta);
@@ -365,6 +371,7 @@ static PyObject* computePtLambdaARModel(PyObject *self, PyObject *arg)
   destPtDP = (PyArrayObject*) PyArray_ContiguousFromObject(oDestPtDP, PyArray_FLOAT64, 3, 3);
   destPtDY = (PyArrayObject*) PyArray_ContiguousFromObject(oDestPtDY, PyArray_FLOAT64, 2, 2);
   varReps = (PyArrayObject*) PyArray_ContiguousFromObject(oReps, PyArray_FLOAT64, 1, 1);
+  Py_BEGIN_ALLOW_THREADS
 
   ny = varMBY->dimensions[0];
   nbVox = varMBY->dimensions[1];
@@ -452,6 +459,7 @@ stop+=1;
     }
 
   free(ptDelta);  
+  Py_END_ALLOW_THREADS
   Py_DECREF(varNRLs);
   Py_DECREF(varXh);
   Py_DECREF(delta);
@@ -492,6 +500,7 @@ static PyObject* computeStLambdaSparse(PyObject *self, PyObject *arg)
   destStDY = (PyArrayObject*) PyArray_ContiguousFromObject(oDestStDY, PyArray_FLOAT64, 2, 2);
   rb = (PyArrayObject*) PyArray_ContiguousFromObject(orb, PyArray_FLOAT64, 1, 1);
   idxStackX = (PyArrayObject*) PyArray_ContiguousFromObject(oidxStackX, PyArray_INT, 1, 1);
+  Py_BEGIN_ALLOW_THREADS
 
   //printf("wrapping ok\n");
   //fflush(stdout);
@@ -616,6 +625,7 @@ static PyObject* computeStLambdaSparse(PyObject *self, PyObject *arg)
   free(sparseIdxSInCol);
 
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(nrls);
   Py_DECREF(stackX);
   Py_DECREF(delta); 
@@ -657,6 +667,7 @@ static PyObject* computeStLambdaARModelSparse(PyObject *self, PyObject *arg)
   destStDY = (PyArrayObject*) PyArray_ContiguousFromObject(oDestStDY, PyArray_FLOAT64, 2, 2);
   rb = (PyArrayObject*) PyArray_ContiguousFromObject(orb, PyArray_FLOAT64, 1, 1);
   idxStackX = (PyArrayObject*) PyArray_ContiguousFromObject(oidxStackX, PyArray_INT, 1, 1);
+  Py_BEGIN_ALLOW_THREADS
 
   //printf("wrapping ok\n");
   //fflush(stdout);
@@ -775,6 +786,7 @@ static PyObject* computeStLambdaARModelSparse(PyObject *self, PyObject *arg)
   free(sparseIdxSInCol);
 
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(nrls);
   Py_DECREF(stackX);
   Py_DECREF(delta); 
@@ -821,6 +833,7 @@ static PyObject* calcCorrEnergies(PyObject *self, PyObject *arg)
                                                              PyArray_INT,  
                                                              1, 1);
   */
+  Py_BEGIN_ALLOW_THREADS
   //printf("done !\n"); 
   //fflush(stdout); 
 
@@ -859,6 +872,7 @@ static PyObject* calcCorrEnergies(PyObject *self, PyObject *arg)
     }
   //printf("Test\n");
   free(nCount);
+  Py_END_ALLOW_THREADS
   Py_DECREF(curLabels);
   Py_DECREF(energies);
   Py_DECREF(neighbours);
@@ -1370,6 +1384,7 @@ static PyObject* sampleSmmNrl(PyObject *self, PyObject *arg)
 
   varXhtQ = (PyArrayObject*) PyArray_ContiguousFromObject(oVarXhtQ, 
                                                           PyArray_FLOAT64, 2, 2);
+  Py_BEGIN_ALLOW_THREADS
   if (1 && debug){
     printf("Wrapping done\n "); 
     fflush(stdout); 
@@ -1625,6 +1640,7 @@ static PyObject* sampleSmmNrl(PyObject *self, PyObject *arg)
   free(vApost);
   free(lApost2);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(voxOrder);
   Py_DECREF(yTilde);
   Py_DECREF(labels);
@@ -1724,6 +1740,7 @@ static PyObject* sampleSmmNrlWithRelVar(PyObject *self, PyObject *arg)
 
   varXhtQ = (PyArrayObject*) PyArray_ContiguousFromObject(oVarXhtQ, 
                                                           PyArray_FLOAT64, 2, 2);
+  Py_BEGIN_ALLOW_THREADS
   if (1 && debug){
     printf("Wrapping done\n "); 
     fflush(stdout); 
@@ -2070,6 +2087,7 @@ static PyObject* sampleSmmNrlWithRelVar(PyObject *self, PyObject *arg)
   free(lApost2_RelCond);
   free(lApost2_IRRelCond);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(voxOrder);
   Py_DECREF(yTilde);
   Py_DECREF(labels);
@@ -2179,6 +2197,7 @@ static PyObject* sampleSmmNrl2(PyObject *self, PyObject *arg)
   current_mean_apost = (PyArrayObject*) PyArray_ContiguousFromObject(o_current_mean_apost, PyArray_FLOAT64, 3, 3);
 
   current_var_apost = (PyArrayObject*) PyArray_ContiguousFromObject(o_current_var_apost, PyArray_FLOAT64, 3, 3);
+  Py_BEGIN_ALLOW_THREADS
 
   if (debug){
     printf("Wrapping done\n "); 
@@ -2530,6 +2549,7 @@ static PyObject* sampleSmmNrl2(PyObject *self, PyObject *arg)
   free(vApost);
   free(lApost2);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(voxOrder);
   Py_DECREF(yTilde);
   Py_DECREF(labels);
@@ -2642,6 +2662,7 @@ static PyObject* sampleSmmNrlBar(PyObject *self, PyObject *arg)
   current_mean_apost = (PyArrayObject*) PyArray_ContiguousFromObject(o_current_mean_apost, PyArray_FLOAT64, 3, 3);
 
   current_var_apost = (PyArrayObject*) PyArray_ContiguousFromObject(o_current_var_apost, PyArray_FLOAT64, 3, 3);
+  Py_BEGIN_ALLOW_THREADS
   
   if (debug){
     printf("Wrapping done\n "); 
@@ -2864,6 +2885,7 @@ static PyObject* sampleSmmNrlBar(PyObject *self, PyObject *arg)
   free(vApost);
   free(lApost2);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(voxOrder);
   Py_DECREF(labels);
   Py_DECREF(nrls);
@@ -2991,6 +3013,7 @@ static PyObject* sampleSmmNrl2WithRelVar(PyObject *self, PyObject *arg)
   
   NbVoxAct = (PyArrayObject*) PyArray_ContiguousFromObject(oNbVoxAct, PyArray_INT32, 
                                                        1, 1);
+  Py_BEGIN_ALLOW_THREADS
   
   if (debug){
     printf("Wrapping done\n "); 
@@ -3306,6 +3329,7 @@ static PyObject* sampleSmmNrl2WithRelVar(PyObject *self, PyObject *arg)
   free(lApost2_RelCond);
   free(lApost2_IRRelCond);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(voxOrder);
   Py_DECREF(yTilde);
   Py_DECREF(labels);
@@ -3438,6 +3462,7 @@ static PyObject* sampleSmmNrl2WithRelVar_NEW(PyObject *self, PyObject *arg)
     
     NbVoxAct = (PyArrayObject*) PyArray_ContiguousFromObject(oNbVoxAct, PyArray_INT32, 
                                                              1, 1);
+  Py_BEGIN_ALLOW_THREADS
     
     vApost = malloc(sizeof(npy_float64)*nbClasses);
     sApost = malloc(sizeof(npy_float64)*nbClasses);
@@ -3564,6 +3589,7 @@ static PyObject* sampleSmmNrl2WithRelVar_NEW(PyObject *self, PyObject *arg)
     free(mApost);
     free(vApost);
     
+  Py_END_ALLOW_THREADS
     Py_DECREF(voxOrder);
     Py_DECREF(y);
     Py_DECREF(labels);
@@ -3648,6 +3674,7 @@ static PyObject* computeYtilde(PyObject *self, PyObject *arg) {
   sumaXh = (PyArrayObject*) PyArray_ContiguousFromObject(oSumaXh, 
                                                          PyArray_FLOAT64,  
                                                          2, 2);
+  Py_BEGIN_ALLOW_THREADS
 
   nbVox = nrls->dimensions[1];
   nbCond = nrls->dimensions[0];
@@ -3670,6 +3697,7 @@ static PyObject* computeYtilde(PyObject *self, PyObject *arg) {
       PYA_MVAL(yTilde,n,i,0) = PYA_MVAL(mby,n,i,0) - PYA_MVAL(sumaXh,n,i,0);
     }
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(varXh);
   Py_DECREF(nrls);
   Py_DECREF(mby);
@@ -3732,6 +3760,7 @@ static PyObject* sample_potts(PyObject *self, PyObject *arg) {
   ext_field = (PyArrayObject*) PyArray_ContiguousFromObject(oExtField, 
                                                             PyArray_FLOAT64, 
                                                             3, 3);
+  Py_BEGIN_ALLOW_THREADS
 
   if (debug){
     printf("Wrapping done\n "); 
@@ -3808,6 +3837,7 @@ static PyObject* sample_potts(PyObject *self, PyObject *arg) {
   free(proba);
   free(sp_corr);
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(voxOrder);
   Py_DECREF(labels);
   Py_DECREF(neighbours);
@@ -3878,6 +3908,7 @@ static PyObject* asl_compute_y_tilde(PyObject *self, PyObject *arg) {
   sumcXg = (PyArrayObject*) PyArray_ContiguousFromObject(oSumcXg,
                                                          PyArray_FLOAT64,
                                                          2, 2);
+  Py_BEGIN_ALLOW_THREADS
 
 
   nbVox = brls->dimensions[1];
@@ -3916,6 +3947,7 @@ static PyObject* asl_compute_y_tilde(PyObject *self, PyObject *arg) {
         PYA_MVAL(sumcXg,n,i,0);
     }
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(varXh);
   Py_DECREF(varXg);
   Py_DECREF(prls);
@@ -3972,6 +4004,7 @@ static PyObject* computeYtildeWithRelVar(PyObject *self, PyObject *arg) {
   Wa = (PyArrayObject*) PyArray_ContiguousFromObject(oWa, 
                                                      PyArray_FLOAT64,  
                                                          2, 2);
+  Py_BEGIN_ALLOW_THREADS
  
 /*  printf("Array wrap OK\n");  
   fflush(stdout);*/  
@@ -3991,6 +4024,7 @@ static PyObject* computeYtildeWithRelVar(PyObject *self, PyObject *arg) {
       PYA_MVAL(yTilde,n,i,0) = PYA_MVAL(mby,n,i,0) - PYA_MVAL(sumWaXh,n,i,0);
     }   
 
+  Py_END_ALLOW_THREADS
   Py_DECREF(varXh);
   Py_DECREF(nrls);
   Py_DECREF(mby);
@@ -236,6 +236,7 @@ static PyObject *UtilsC_maximization_sigma_noise(PyObject *self, PyObject *args)
     Sigma_Harray   = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_H,PyArray_FLOAT64,2,2);
     Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
     Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
+    Py_BEGIN_ALLOW_THREADS
     npy_float64 *S,*H,*Htilde,*Yj,*PLj,*Sigma_A0,*m_Aj,*tmpnCondnCond,*tmpnCond,*tmpD,*tmp,*tmpDD,*SSigma_H,*GGamma;
     int *XX,*XXT;
 
@@ -348,6 +349,7 @@ static PyObject *UtilsC_maximization_sigma_noise(PyObject *self, PyObject *args)
     free(SQ);
     free(YGamma);
 
+    Py_END_ALLOW_THREADS
     Py_DECREF(Yarray);
     Py_DECREF(m_Aarray);
     Py_DECREF(m_Harray);
@@ -382,6 +384,7 @@ static PyObject *UtilsC_expectation_A(PyObject *self, PyObject *args){
     Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
     Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
+    Py_BEGIN_ALLOW_THREADS
     npy_float64 *H,*tmp,*tmpT,*GGamma,*tmp2,*X_tilde,*Sigma_Aj,*Delta,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*tmpnCond,*tmpnCond2;
     npy_float64 *yy_tilde,*SSigma_H,*Sigma_A0;
     int *XX,*XXT;
@@ -496,6 +499,7 @@ static PyObject *UtilsC_expectation_A(PyObject *self, PyObject *args){
     free(XX);
     free(XXT);
 
+    Py_END_ALLOW_THREADS
     Py_DECREF(q_Zarray);
     Py_DECREF(Sigma_Harray);
     Py_DECREF(Sigma_Aarray);
@@ -533,6 +537,7 @@ static PyObject *UtilsC_expectation_H(PyObject *self, PyObject *args){
     Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
     QQ_barnCondarray = (PyArrayObject *) PyArray_ContiguousFromObject(QQ_barnCond,PyArray_FLOAT64,4,4);
     XGammaarray = (PyArrayObject *) PyArray_ContiguousFromObject(XGamma,PyArray_FLOAT64,3,3);
+    Py_BEGIN_ALLOW_THREADS
     npy_float64 *S,*H,*tmp,*tmpT,*GGamma,*tmp2;
     npy_float64 *yy_tilde,*Y_bar_tilde,*Q_bar,*Q_barnCond;
     struct timeval tstart, tend;
@@ -622,6 +627,7 @@ static PyObject *UtilsC_expectation_H(PyObject *self, PyObject *args){
     free(Y_bar_tilde);
     free(Q_bar);
     free(Q_barnCond);
+    Py_END_ALLOW_THREADS
     Py_DECREF(QQ_barnCondarray);
     Py_DECREF(XGammaarray);
     Py_DECREF(Sigma_Harray);
@@ -650,6 +656,7 @@ static PyObject *UtilsC_maximization_L(PyObject *self, PyObject *args){
     Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2); 
     Larray   = (PyArrayObject *) PyArray_ContiguousFromObject(L,PyArray_FLOAT64,2,2); 
     Parray   = (PyArrayObject *) PyArray_ContiguousFromObject(P,PyArray_FLOAT64,2,2); 
+    Py_BEGIN_ALLOW_THREADS
     npy_float64 *PP,*S,*H,*Yj,*Lj,*tmp,*XH;
     int *XX;
     PP = malloc(sizeof(npy_float64)*Nrep*Ndrift);
@@ -704,6 +711,7 @@ static PyObject *UtilsC_maximization_L(PyObject *self, PyObject *args){
     free(XX);
     free(tmp);
     free(XH);
+    Py_END_ALLOW_THREADS
     Py_DECREF(m_Aarray);
     Py_DECREF(m_Harray);
     Py_DECREF(Xarray);
@@ -726,6 +734,7 @@ static PyObject *UtilsC_maximization_beta(PyObject *self, PyObject *args){
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,2,2); 
     Z_tildearray = (PyArrayObject *) PyArray_ContiguousFromObject(Z_tilde,PyArray_FLOAT64,2,2); 
     grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2); 
+    Py_BEGIN_ALLOW_THREADS
     npy_float64 tmp2[K],Emax,Sum,tmp,Pzmi;
     
     Gr = gamma; 
@@ -762,6 +771,7 @@ static PyObject *UtilsC_maximization_beta(PyObject *self, PyObject *args){
         ni++;
     }
     if (eps > beta) beta = 0.01;
+    Py_END_ALLOW_THREADS
     Py_DECREF(grapharray);
     Py_DECREF(q_Zarray);
     Py_DECREF(Z_tildearray);
@@ -784,6 +794,7 @@ static PyObject *UtilsC_expectation_Z(PyObject *self, PyObject *args){
     m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
+    Py_BEGIN_ALLOW_THREADS
 
     npy_float64 tmp[K],Emax,Sum,alpha[K],Malpha,extern_field,Gauss[K],local_energy,energy[K],Probas[K];
 
@@ -866,6 +877,7 @@ static PyObject *UtilsC_expectation_Z(PyObject *self, PyObject *args){
             }
         } 
     }
+    Py_END_ALLOW_THREADS
     Py_DECREF(grapharray);
     Py_DECREF(q_Zarray);
     Py_DECREF(Z_tildearray);
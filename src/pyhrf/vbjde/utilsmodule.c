@@ -10,6 +10,7 @@
 #define GetValueInt(array,x,y) ( *(int*)(array->data + array->strides[0]*x + array->strides[1]*y) )
 #define GetValue(array,x,y) ( *(npy_float64*)(array->data + array->strides[0]*x + array->strides[1]*y) )
 #define GetValue1D(array,x) ( *(npy_float64*)(array->data + array->strides[0]*x) )
+#define GetValue1DInt(array,x) ( *(int*)(array->data + array->strides[0]*x) )
 #define GetValue3D(array,x,y,z) ( *(npy_float64*)(array->data + array->strides[0]*x + array->strides[1]*y + array->strides[2]*z) )
 #define GetValue3DInt(array,x,y,z) ( *(int*)(array->data + array->strides[0]*x + array->strides[1]*y + array->strides[2]*z) )
 #define GetValue4D(array,x,y,z,t) ( *(npy_float64*)(array->data + array->strides[0]*x + array->strides[1]*y + array->strides[2]*z + array->strides[3]*t) )
@@ -394,6 +395,7 @@ sigma_epsilonearray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_epsil
 Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2);
 Sigma_Harray   = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_H,PyArray_FLOAT64,3,3);
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
+Py_BEGIN_ALLOW_THREADS
 npy_float64 *S,*H,*Htilde,*Yj,*PLj,*Sigma_A0,*m_Aj,*tmpnCondnCond,*tmpnCond,*tmpD,*tmp,*tmpDD,*SSigma_H;
 int *XX,*XXT;
 
@@ -485,6 +487,7 @@ free(XXT);
 free(SSigma_H);
 // free(SQ);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(Yarray);
 Py_DECREF(m_Aarray);
 Py_DECREF(m_Harray);
@@ -512,6 +515,7 @@ Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2)
 Sigma_Harray   = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_H,PyArray_FLOAT64,2,2);
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
 Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *S,*H,*Htilde,*Yj,*PLj,*Sigma_A0,*m_Aj,*tmpnCondnCond,*tmpnCond,*tmpD,*tmp,*tmpDD,*SSigma_H,*GGamma;
 int *XX,*XXT;
@@ -625,6 +629,7 @@ free(GGamma);
 free(SQ);
 free(YGamma);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(Yarray);
 Py_DECREF(m_Aarray);
 Py_DECREF(m_Harray);
@@ -653,6 +658,7 @@ Sigma_Harray   = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_H,PyArray_
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
 Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
 p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*Htilde,*Sigma_A0;
 npy_float64 *yy_tilde,*SSigma_H,*m_Aj,*S,*tmpnCondnCond,*tmpnCond;
@@ -772,6 +778,7 @@ free(GGamma);
 free(SQ);
 free(yGamma);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(y_tildearray);
 Py_DECREF(m_Aarray);
 Py_DECREF(m_Harray);
@@ -801,6 +808,7 @@ Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FL
 Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
 m_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(m_W,PyArray_FLOAT64,1,1);
 v_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(v_W,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*Htilde,*Sigma_A0;
 npy_float64 *yy_tilde,*SSigma_H,*m_Aj,*S,*tmpnCondnCond,*tmpnCond;
@@ -919,6 +927,7 @@ free(GGamma);
 free(SQ);
 free(yGamma);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(m_Warray);
 Py_DECREF(v_Warray);
 Py_DECREF(y_tildearray);
@@ -952,6 +961,7 @@ Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2)
 Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
+Py_BEGIN_ALLOW_THREADS
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmp2,*X_tilde,*Sigma_Aj,*Delta,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*tmpnCond,*tmpnCond2;
 npy_float64 *yy_tilde,*SSigma_H,*Sigma_A0;
 int *XX,*XXT;
@@ -1069,6 +1079,7 @@ free(yy_tilde);
 free(XX);
 free(XXT);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(q_Zarray);
 Py_DECREF(Sigma_Harray);
 Py_DECREF(Sigma_Aarray);
@@ -1106,6 +1117,7 @@ Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2)
 Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
+Py_BEGIN_ALLOW_THREADS
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmp2,*X_tilde,*Sigma_Aj,*Delta,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*tmpnCond,*tmpnCond2;
 npy_float64 *yy_tilde,*SSigma_H,*Sigma_A0;
 int *XX,*XXT;
@@ -1220,6 +1232,7 @@ free(yy_tilde);
 free(XX);
 free(XXT);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(q_Zarray);
 Py_DECREF(Sigma_Harray);
 Py_DECREF(Sigma_Aarray);
@@ -1255,6 +1268,7 @@ Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOA
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
 p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmp2,*X_tilde,*Sigma_Aj,*Delta0,*Delta1,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*tmpnCond,*tmpnCond2,*tmpnCond3;
 npy_float64 *yy_tilde,*SSigma_H,*Sigma_A0;
@@ -1383,6 +1397,7 @@ free(yy_tilde);
 free(XX);
 free(XXT);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(p_Warray);
 Py_DECREF(q_Zarray);
 Py_DECREF(Sigma_Harray);
@@ -1418,6 +1433,7 @@ Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FL
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
 m_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(m_W,PyArray_FLOAT64,1,1);
 v_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(v_W,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *H,*tmp,*tmpT,*GGamma,*X_tilde,*Sigma_Aj,*Delta,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*tmpnCond,*tmpnCond2;
 npy_float64 *yy_tilde,*SSigma_H,*Sigma_A0;
@@ -1535,6 +1551,7 @@ free(yy_tilde);
 free(XX);
 free(XXT);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(m_Warray);
 Py_DECREF(v_Warray);
 Py_DECREF(q_Zarray);
@@ -1571,6 +1588,7 @@ Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOA
 Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FLOAT64,3,3);
 QQ_barnCondarray = (PyArrayObject *) PyArray_ContiguousFromObject(QQ_barnCond,PyArray_FLOAT64,4,4);
 XGammaarray = (PyArrayObject *) PyArray_ContiguousFromObject(XGamma,PyArray_FLOAT64,3,3);
+Py_BEGIN_ALLOW_THREADS
 npy_float64 *S,*H,*tmp,*tmpT,*GGamma,*tmp2;
 npy_float64 *yy_tilde,*Y_bar_tilde,*Q_bar,*Q_barnCond;
 struct timeval tstart, tend;
@@ -1658,6 +1676,7 @@ free(yy_tilde);
 free(Y_bar_tilde);
 free(Q_bar);
 free(Q_barnCond);
+Py_END_ALLOW_THREADS
 Py_DECREF(QQ_barnCondarray);
 Py_DECREF(XGammaarray);
 Py_DECREF(Sigma_Harray);
@@ -1692,6 +1711,7 @@ Sigma_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_A,PyArray_FL
 QQ_barnCondarray = (PyArrayObject *) PyArray_ContiguousFromObject(QQ_barnCond,PyArray_FLOAT64,4,4);
 XGammaarray = (PyArrayObject *) PyArray_ContiguousFromObject(XGamma,PyArray_FLOAT64,3,3);
 p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *S,*H,*tmp,*tmpT,*GGamma,*tmp2;
 npy_float64 *yy_tilde,*Y_bar_tilde,*Q_bar,*Q_barnCond;
@@ -1780,6 +1800,7 @@ free(yy_tilde);
 free(Y_bar_tilde);
 free(Q_bar);
 free(Q_barnCond);
+Py_END_ALLOW_THREADS
 Py_DECREF(p_Warray);
 Py_DECREF(QQ_barnCondarray);
 Py_DECREF(XGammaarray);
@@ -1815,6 +1836,7 @@ QQ_barnCondarray = (PyArrayObject *) PyArray_ContiguousFromObject(QQ_barnCond,Py
 XGammaarray = (PyArrayObject *) PyArray_ContiguousFromObject(XGamma,PyArray_FLOAT64,3,3);
 m_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(m_W,PyArray_FLOAT64,1,1);
 v_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(v_W,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *S,*H,*tmp,*tmpT,*GGamma,*tmp2;
 npy_float64 *yy_tilde,*Y_bar_tilde,*Q_bar,*Q_barnCond;
@@ -1903,6 +1925,7 @@ free(yy_tilde);
 free(Y_bar_tilde);
 free(Q_bar);
 free(Q_barnCond);
+Py_END_ALLOW_THREADS
 Py_DECREF(m_Warray);
 Py_DECREF(v_Warray);
 Py_DECREF(QQ_barnCondarray);
@@ -1971,6 +1994,7 @@ m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,
 mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
 Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
 MC_meanarray = (PyArrayObject *) PyArray_ContiguousFromObject(MC_mean,PyArray_FLOAT64,4,4); 
+Py_BEGIN_ALLOW_THREADS
 // printf("tau1 =%f\n",tau1);
 // printf("tau2 =%f\n",tau2);
 
@@ -2075,6 +2099,7 @@ free(tmp);
 free(proba);
 free(E_log_term);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(grapharray);
 Py_DECREF(q_Zarray);
 Py_DECREF(p_Warray);
@@ -2104,6 +2129,7 @@ m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,
 mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
 Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
 MC_meanarray = (PyArrayObject *) PyArray_ContiguousFromObject(MC_mean,PyArray_FLOAT64,4,4); 
+Py_BEGIN_ALLOW_THREADS
 // printf("tau1 =%f\n",tau1);
 // printf("tau2 =%f\n",tau2);
 
@@ -2208,6 +2234,7 @@ free(tmp);
 free(proba);
 free(E_log_term);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(grapharray);
 Py_DECREF(q_Zarray);
 Py_DECREF(p_Warray);
@@ -2236,6 +2263,7 @@ static PyObject *UtilsC_expectation_Z_ParsiMod_2(PyObject *self, PyObject *args)
     m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1);
+    Py_BEGIN_ALLOW_THREADS
     
 //     printf("alpha_0 =%f\n",alpha_0);
     
@@ -2291,6 +2319,7 @@ static PyObject *UtilsC_expectation_Z_ParsiMod_2(PyObject *self, PyObject *args)
     free(tmp);
     free(Qm);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(grapharray);
     Py_DECREF(q_Zarray);
     Py_DECREF(p_Warray);
@@ -2320,6 +2349,7 @@ static PyObject *UtilsC_expectation_Z_ParsiMod_3(PyObject *self, PyObject *args)
     m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 part_5, part_6, part_7;
     npy_float64 *part_4, *tmp,*proba;
@@ -2373,6 +2403,7 @@ static PyObject *UtilsC_expectation_Z_ParsiMod_3(PyObject *self, PyObject *args)
     free(tmp);
     free(proba);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(grapharray);
     Py_DECREF(q_Zarray);
     Py_DECREF(p_Warray);
@@ -2399,6 +2430,7 @@ static PyObject *UtilsC_expectation_Z_ParsiMod_RVM_and_CompMod(PyObject *self, P
     m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 part_5, part_6, part_7;
     npy_float64 *part_4, *tmp,*proba;
@@ -2452,6 +2484,7 @@ static PyObject *UtilsC_expectation_Z_ParsiMod_RVM_and_CompMod(PyObject *self, P
     free(tmp);
     free(proba);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(grapharray);
     Py_DECREF(q_Zarray);
     Py_DECREF(m_Aarray);
@@ -2485,6 +2518,7 @@ p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
 sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FLOAT64,2,2); 
 mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1,*proba;
 npy_float64 *yy_tilde,*SSigma_H;
@@ -2664,6 +2698,7 @@ free(part_4);
 free(part_6);
 free(proba);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(p_Warray);
 Py_DECREF(q_Zarray);
 Py_DECREF(HXGammaArray);
@@ -2702,6 +2737,7 @@ p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
 sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FLOAT64,2,2); 
 mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1,*proba;
 npy_float64 *yy_tilde,*SSigma_H;
@@ -2880,6 +2916,7 @@ free(part_4);
 free(part_6);
 free(proba);
 
+Py_END_ALLOW_THREADS
 Py_DECREF(p_Warray);
 Py_DECREF(q_Zarray);
 Py_DECREF(HXGammaArray);
@@ -2920,6 +2957,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_2(PyObject *self, PyObject *args)
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1);
     grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2);
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1;
     npy_float64 *yy_tilde,*SSigma_H;
@@ -3155,6 +3193,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_2(PyObject *self, PyObject *args)
     free(Pmfj1);
     free(Pmfj2);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(p_Warray);
     Py_DECREF(q_Zarray);
     Py_DECREF(HXGammaArray);
@@ -3193,6 +3232,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_3(PyObject *self, PyObject *args)
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
     sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1,*proba;
     npy_float64 *yy_tilde,*SSigma_H;
@@ -3388,6 +3428,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_3(PyObject *self, PyObject *args)
     free(part_6);
     free(proba);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(p_Warray);
     Py_DECREF(q_Zarray);
     Py_DECREF(HXGammaArray);
@@ -3427,6 +3468,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_RVM(PyObject *self, PyObject *arg
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
     sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1,*part_3,*part_5;
     npy_float64 *yy_tilde,*SSigma_H;
@@ -3561,6 +3603,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_RVM(PyObject *self, PyObject *arg
     free(part_4);
     free(part_6);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(m_Warray);
     Py_DECREF(v_Warray);
     Py_DECREF(alpha_RVMarray);
@@ -3602,6 +3645,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_3_Cond(PyObject *self, PyObject *
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
     tau1_array = (PyArrayObject *) PyArray_ContiguousFromObject(tau1,PyArray_FLOAT64,1,1);
     tau2_array = (PyArrayObject *) PyArray_ContiguousFromObject(tau2,PyArray_FLOAT64,1,1);
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1,*proba;
     npy_float64 *yy_tilde,*SSigma_H;
@@ -3806,6 +3850,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_3_Cond(PyObject *self, PyObject *
     free(part_6);
     free(proba);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(p_Warray);
     Py_DECREF(q_Zarray);
     Py_DECREF(HXGammaArray);
@@ -3844,6 +3889,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_4(PyObject *self, PyObject *args)
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
     sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FLOAT64,2,2); 
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *H,*tmp,*tmpT,*GGamma,*tmpDD,*tmpD,*tmpNrep,*tmpNrep2,*part_6,*part_4,*part_1,*proba;
     npy_float64 *yy_tilde,*SSigma_H;
@@ -4045,6 +4091,7 @@ static PyObject *UtilsC_expectation_W_ParsiMod_4(PyObject *self, PyObject *args)
     free(part_6);
     free(proba);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(p_Warray);
     Py_DECREF(q_Zarray);
     Py_DECREF(HXGammaArray);
@@ -4073,6 +4120,7 @@ m_Harray = (PyArrayObject *) PyArray_ContiguousFromObject(m_H,PyArray_FLOAT64,2,
 Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2); 
 Larray   = (PyArrayObject *) PyArray_ContiguousFromObject(L,PyArray_FLOAT64,2,2); 
 Parray   = (PyArrayObject *) PyArray_ContiguousFromObject(P,PyArray_FLOAT64,2,2); 
+Py_BEGIN_ALLOW_THREADS
 npy_float64 *PP,*S,*H,*Yj,*Lj,*tmp,*XH;
 int *XX;
 PP = malloc(sizeof(npy_float64)*Nrep*Ndrift);
@@ -4129,6 +4177,7 @@ free(Lj);
 free(XX);
 free(tmp);
 free(XH);
+Py_END_ALLOW_THREADS
 Py_DECREF(m_Aarray);
 Py_DECREF(m_Harray);
 Py_DECREF(Xarray);
@@ -4151,6 +4200,7 @@ m_Harray = (PyArrayObject *) PyArray_ContiguousFromObject(m_H,PyArray_FLOAT64,1,
 Yarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Y,PyArray_FLOAT64,2,2); 
 Larray   = (PyArrayObject *) PyArray_ContiguousFromObject(L,PyArray_FLOAT64,2,2); 
 Parray   = (PyArrayObject *) PyArray_ContiguousFromObject(P,PyArray_FLOAT64,2,2); 
+Py_BEGIN_ALLOW_THREADS
 npy_float64 *PP,*S,*H,*Yj,*Lj,*tmp,*XH;
 int *XX;
 PP = malloc(sizeof(npy_float64)*Nrep*Ndrift);
@@ -4204,6 +4254,7 @@ free(Lj);
 free(XX);
 free(tmp);
 free(XH);
+Py_END_ALLOW_THREADS
 Py_DECREF(m_Aarray);
 Py_DECREF(m_Harray);
 Py_DECREF(Xarray);
@@ -4226,6 +4277,7 @@ static PyObject *UtilsC_maximization_L_ParsiMod(PyObject *self, PyObject *args){
     Larray   = (PyArrayObject *) PyArray_ContiguousFromObject(L,PyArray_FLOAT64,2,2); 
     Parray   = (PyArrayObject *) PyArray_ContiguousFromObject(P,PyArray_FLOAT64,2,2); 
     p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
+    Py_BEGIN_ALLOW_THREADS
     npy_float64 *PP,*S,*H,*Yj,*Lj,*tmp,*XH;
     int *XX;
     PP = malloc(sizeof(npy_float64)*Nrep*Ndrift);
@@ -4279,6 +4331,7 @@ static PyObject *UtilsC_maximization_L_ParsiMod(PyObject *self, PyObject *args){
     free(XX);
     free(tmp);
     free(XH);
+    Py_END_ALLOW_THREADS
     Py_DECREF(m_Aarray);
     Py_DECREF(m_Harray);
     Py_DECREF(Xarray);
@@ -4302,6 +4355,7 @@ static PyObject *UtilsC_maximization_L_ParsiMod_RVM(PyObject *self, PyObject *ar
     Larray   = (PyArrayObject *) PyArray_ContiguousFromObject(L,PyArray_FLOAT64,2,2); 
     Parray   = (PyArrayObject *) PyArray_ContiguousFromObject(P,PyArray_FLOAT64,2,2); 
     m_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(m_W,PyArray_FLOAT64,1,1);
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *PP,*S,*H,*Yj,*Lj,*tmp,*XH;
     int *XX;
@@ -4356,6 +4410,7 @@ static PyObject *UtilsC_maximization_L_ParsiMod_RVM(PyObject *self, PyObject *ar
     free(XX);
     free(tmp);
     free(XH);
+    Py_END_ALLOW_THREADS
     Py_DECREF(m_Aarray);
     Py_DECREF(m_Harray);
     Py_DECREF(Xarray);
@@ -4377,6 +4432,7 @@ PyArg_ParseTuple(args, "dOOiiOdiid", &beta,&q_Z,&Z_tilde,&J,&K,&graph,&gamma,&ma
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,2,2); 
 Z_tildearray = (PyArrayObject *) PyArray_ContiguousFromObject(Z_tilde,PyArray_FLOAT64,2,2); 
 grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2); 
+Py_BEGIN_ALLOW_THREADS
 npy_float64 tmp2[K],Emax,Sum,tmp,Pzmi;
 Gr = gamma; 
 ni = 0;
@@ -4412,6 +4468,7 @@ while( (ni<MaxItGrad) && (fabs(Gr) > eps) ){
   ni++;
 }
 if (eps > beta) beta = 0.01;
+Py_END_ALLOW_THREADS
 Py_DECREF(grapharray);
 Py_DECREF(q_Zarray);
 Py_DECREF(Z_tildearray);
@@ -4428,6 +4485,7 @@ int j,J,K,k,ni,maxNeighbours,nn,MaxItGrad;
 PyArg_ParseTuple(args, "dOiiOdiid", &beta,&q_Z,&J,&K,&graph,&gamma,&maxNeighbours,&MaxItGrad,&gradientStep);
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,2,2); 
 grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2); 
+Py_BEGIN_ALLOW_THREADS
 npy_float64 tmp;
 Gr = gamma; 
 ni = 0;
@@ -4451,6 +4509,7 @@ while( (ni<MaxItGrad) && (fabs(Gr) > eps) ){
   ni++;
 }
 if (eps > beta) beta = 0.01; // Pourquoi pas beta = eps ?
+Py_END_ALLOW_THREADS
 Py_DECREF(grapharray);
 Py_DECREF(q_Zarray);
 Py_INCREF(Py_None);
@@ -4458,10 +4517,13 @@ return Py_BuildValue("d", beta);
 }
 
 static PyObject *UtilsC_expectation_Z(PyObject *self, PyObject *args){
-PyObject *q_Z,*Z_tilde,*graph,*Sigma_A,*m_A,*sigma_M,*Beta,*mu_M;
-PyArrayObject *q_Zarray,*Z_tildearray,*grapharray,*Sigma_Aarray,*m_Aarray,*sigma_Marray,*Betaarray,*mu_Marray;
-int j,J,K,k,m,maxNeighbours,nn,M;
-PyArg_ParseTuple(args, "OOOOOOOOiiii",&Sigma_A,&m_A,&sigma_M, &Beta,&Z_tilde,&mu_M,&q_Z,&graph,&M,&J,&K,&maxNeighbours);
+PyObject *q_Z,*Z_tilde,*graph,*Sigma_A,*m_A,*sigma_M,*Beta,*mu_M,*order=NULL;
+PyArrayObject *q_Zarray,*Z_tildearray,*grapharray,*Sigma_Aarray,*m_Aarray,*sigma_Marray,*Betaarray,*mu_Marray,*orderarray=NULL;
+int j,jj,J,K,k,m,maxNeighbours,nn,M;
+/* optional 'order': sweep order of voxels for the update of Z_tilde
+   (default: 0 to J-1). Passing the concatenated colour blocks of the graph
+   gives the sweep of vem_tools.expectation_Z with color_blocks. */
+PyArg_ParseTuple(args, "OOOOOOOOiiii|O",&Sigma_A,&m_A,&sigma_M, &Beta,&Z_tilde,&mu_M,&q_Z,&graph,&M,&J,&K,&maxNeighbours,&order);
 q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
 Z_tildearray = (PyArrayObject *) PyArray_ContiguousFromObject(Z_tilde,PyArray_FLOAT64,3,3); 
 grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2); 
@@ -4470,9 +4532,13 @@ sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FL
 m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,2); 
 mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
 Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
+if (order != NULL && order != Py_None)
+  orderarray = (PyArrayObject *) PyArray_ContiguousFromObject(order,PyArray_INT,1,1); 
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 tmp[K],Emax,Sum,alpha[K],Malpha,extern_field,Gauss[K],local_energy,energy[K],Probas[K];
-for (j=0;j<J;j++){
+for (jj=0;jj<J;jj++){
+  j = (orderarray == NULL) ? jj : GetValue1DInt(orderarray,jj);
   for (m=0;m<M;m++){
     Malpha = 0;
     for (k=0;k<K;k++){
@@ -4552,6 +4618,7 @@ for (j=0;j<J;j++){
     }
   } 
 }
+Py_END_ALLOW_THREADS
 Py_DECREF(grapharray);
 Py_DECREF(q_Zarray);
 Py_DECREF(Z_tildearray);
@@ -4560,6 +4627,7 @@ Py_DECREF(mu_Marray);
 Py_DECREF(Sigma_Aarray);
 Py_DECREF(Betaarray);
 Py_DECREF(sigma_Marray);
+Py_XDECREF(orderarray);
 Py_INCREF(Py_None);
   return Py_None;
 }
@@ -4578,6 +4646,7 @@ sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FL
 m_Aarray = (PyArrayObject *) PyArray_ContiguousFromObject(m_A,PyArray_FLOAT64,2,2); 
 mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2); 
 Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1); 
+Py_BEGIN_ALLOW_THREADS
 
 npy_float64 tmp[K],Emax,Sum,alpha[K],Malpha,extern_field,Gauss[K],local_energy,energy[K],Probas[K],C;
 for (j=0;j<J;j++){
@@ -4664,6 +4733,7 @@ for (j=0;j<J;j++){
     }
   } 
 }
+Py_END_ALLOW_THREADS
 Py_DECREF(grapharray);
 Py_DECREF(q_Zarray);
 Py_DECREF(Z_tildearray);
@@ -4693,6 +4763,8 @@ static PyObject *UtilsC_expectation_Ptilde_Likelihood(PyObject *self, PyObject *
     Gammaarray   = (PyArrayObject *) PyArray_ContiguousFromObject(Gamma,PyArray_FLOAT64,2,2);
     p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
     XGammaarray = (PyArrayObject *) PyArray_ContiguousFromObject(XGamma,PyArray_FLOAT64,3,3);
+    npy_float64 EPtilde1;
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 Const;
     Const = - (0.5*Nrep*J*log(2*pi)) + 0.5*J*log(Det_Gamma + eps_FreeEnergy);
@@ -4803,7 +4875,6 @@ static PyObject *UtilsC_expectation_Ptilde_Likelihood(PyObject *self, PyObject *
         part_4 += 0.5*log(GetValue1D(sigma_epsilonearray,j));
     } 
 
-    npy_float64 EPtilde1;
     EPtilde1 = Const - Nrep*part_4 - 0.5*part_1 + part_2 - 0.5*part_3;
 //     printf("Const = %f, part_1 = %f,    part_2 = %f,    part_3 = %f, part_4 =%f\n",Const,part_1,part_2,part_3,part_4);
     
@@ -4824,6 +4895,7 @@ static PyObject *UtilsC_expectation_Ptilde_Likelihood(PyObject *self, PyObject *
     free(Y_bar_tilde);
     free(yGamma);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(y_tildearray);
     Py_DECREF(m_Aarray);
     Py_DECREF(m_Harray);
@@ -4858,6 +4930,8 @@ static PyObject *UtilsC_expectation_Ptilde_Likelihood_RVM(PyObject *self, PyObje
     m_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(m_W,PyArray_FLOAT64,1,1);
     v_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(v_W,PyArray_FLOAT64,2,2);
     XGammaarray = (PyArrayObject *) PyArray_ContiguousFromObject(XGamma,PyArray_FLOAT64,3,3);
+    npy_float64 EPtilde1;
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 Const;
     Const = - (0.5*Nrep*J*log(2*pi)) + 0.5*J*log(Det_Gamma + eps_FreeEnergy);
@@ -4968,7 +5042,6 @@ static PyObject *UtilsC_expectation_Ptilde_Likelihood_RVM(PyObject *self, PyObje
         part_4 += 0.5*log(GetValue1D(sigma_epsilonearray,j));
     } 
     
-    npy_float64 EPtilde1;
     EPtilde1 = Const - Nrep*part_4 - 0.5*part_1 + part_2 - 0.5*part_3;
     //     printf("Const = %f, part_1 = %f,    part_2 = %f,    part_3 = %f, part_4 =%f\n",Const,part_1,part_2,part_3,part_4);
     
@@ -4989,6 +5062,7 @@ static PyObject *UtilsC_expectation_Ptilde_Likelihood_RVM(PyObject *self, PyObje
     free(Y_bar_tilde);
     free(yGamma);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(y_tildearray);
     Py_DECREF(m_Aarray);
     Py_DECREF(m_Harray);
@@ -5018,9 +5092,10 @@ static PyObject *UtilsC_expectation_Ptilde_A(PyObject *self, PyObject *args)
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
     mu_MKarray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_MK,PyArray_FLOAT64,2,2);
     sigma_MKarray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_MK,PyArray_FLOAT64,2,2);
+    npy_float64 EPtilde2 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
 
     npy_float64 *val1,*val2,*part;
-    npy_float64 EPtilde2 = 0.0;
     val1 = malloc(sizeof(npy_float64)*K);
     val2 = malloc(sizeof(npy_float64)*K);
     part = malloc(sizeof(npy_float64)*K);
@@ -5041,6 +5116,7 @@ static PyObject *UtilsC_expectation_Ptilde_A(PyObject *self, PyObject *args)
     free(val2);
     free(part);
 
+    Py_END_ALLOW_THREADS
     Py_DECREF(m_Aarray);
     Py_DECREF(Sigma_Aarray);
     Py_DECREF(p_Warray);
@@ -5064,6 +5140,8 @@ static PyObject *UtilsC_expectation_Ptilde_H(PyObject *self, PyObject *args)
     Rarray = (PyArrayObject *) PyArray_ContiguousFromObject(R,PyArray_FLOAT64,2,2);
     m_Harray = (PyArrayObject *) PyArray_ContiguousFromObject(m_H,PyArray_FLOAT64,1,1);
     Sigma_Harray   = (PyArrayObject *) PyArray_ContiguousFromObject(Sigma_H,PyArray_FLOAT64,2,2);
+    npy_float64 EPtilde3;
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *Rarray2,*RH,*VhR,*H,*SSigma_H;
     Rarray2 = malloc(sizeof(npy_float64)*D*D);
@@ -5095,7 +5173,6 @@ static PyObject *UtilsC_expectation_Ptilde_H(PyObject *self, PyObject *args)
     Const = -0.5*D*log(2*pi*v_h) - 0.5*log(Det_invR);
 //     printf("log(Det_inv)R = %f\n",log(Det_invR));
     
-    npy_float64 EPtilde3;
     
     EPtilde3 = Const - 0.5*v_h*HRH;
 
@@ -5105,6 +5182,7 @@ static PyObject *UtilsC_expectation_Ptilde_H(PyObject *self, PyObject *args)
     free(H);
     free(SSigma_H);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(Rarray);
     Py_DECREF(m_Harray);
     Py_DECREF(Sigma_Harray);
@@ -5123,11 +5201,12 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod1(PyObject *self, PyObject
     PyArg_ParseTuple(args, "OOiiiidd", &q_Z, &p_W, &nCond, &S, &J, &K, &tau1, &tau2);
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3);
     p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
+    npy_float64 EPtilde4 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 sum_log_term, alea, log_term, E_log_term,SUM_Q_Z_1;
     int SUM, lab;
     
-    npy_float64 EPtilde4 = 0.0;
     
     // MC Step of S Iterations
     for(m=0;m<nCond;m++){
@@ -5164,6 +5243,7 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod1(PyObject *self, PyObject
         EPtilde4 += E_log_term - ( tau1 * (1 - GetValue(p_Warray,m,1)) * (SUM_Q_Z_1 - tau2) );  
     }
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(q_Zarray);
     Py_DECREF(p_Warray);
     
@@ -5183,8 +5263,9 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod3(PyObject *self, PyObject
 
     p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
-    
     npy_float64 EPtilde4 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
+    
     npy_float64 part_1 = 0.0, part_2;
     
     for(m=0;m<nCond;m++)
@@ -5198,6 +5279,7 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod3(PyObject *self, PyObject
         EPtilde4 += (part_1 - part_2);
     }
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(mu_Marray);
     Py_DECREF(p_Warray);
     
@@ -5219,8 +5301,9 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod3_Cond(PyObject *self, PyOb
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
     tau1_array = (PyArrayObject *) PyArray_ContiguousFromObject(tau1,PyArray_FLOAT64,1,1);
     tau2_array = (PyArrayObject *) PyArray_ContiguousFromObject(tau2,PyArray_FLOAT64,1,1);
-    
     npy_float64 EPtilde4 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
+    
     npy_float64 part_1 = 0.0, part_2;
     
     for(m=0;m<nCond;m++)
@@ -5234,6 +5317,7 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod3_Cond(PyObject *self, PyOb
         EPtilde4 += (part_1 - part_2);
     }
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(mu_Marray);
     Py_DECREF(p_Warray);
     
@@ -5254,8 +5338,9 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod4(PyObject *self, PyObject
     p_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(p_W,PyArray_FLOAT64,2,2);
     mu_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(mu_M,PyArray_FLOAT64,2,2);
     sigma_Marray = (PyArrayObject *) PyArray_ContiguousFromObject(sigma_M,PyArray_FLOAT64,2,2);
-    
     npy_float64 EPtilde4 = 0.0, dKL, m1, v1, v0;
+    Py_BEGIN_ALLOW_THREADS
+    
     npy_float64 part_1 = 0.0, part_2;
     
     for(m=0;m<nCond;m++)
@@ -5276,6 +5361,7 @@ static PyObject *UtilsC_expectation_Ptilde_W_ParsiMod4(PyObject *self, PyObject
         EPtilde4 += (part_1 - part_2); 
     }
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(mu_Marray);
     Py_DECREF(p_Warray);
     
@@ -5294,13 +5380,15 @@ static PyObject *UtilsC_expectation_Ptilde_W_RVM(PyObject *self, PyObject *args)
     m_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(m_W,PyArray_FLOAT64,1,1);
     v_Warray = (PyArrayObject *) PyArray_ContiguousFromObject(v_W,PyArray_FLOAT64,2,2);
     alpha_RVMarray = (PyArrayObject *) PyArray_ContiguousFromObject(alpha_RVM,PyArray_FLOAT64,1,1);
-    
     npy_float64 EPtilde4 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
+    
     
     for(m=0;m<nCond;m++){
         EPtilde4 += 0.5*log(GetValue1D(alpha_RVMarray,m)+eps_FreeEnergy) - 0.5*log(2.*pi) - 0.5*GetValue1D(alpha_RVMarray,m)*( pow(GetValue1D(m_Warray,m),2) + GetValue(v_Warray,m,m) );
     }
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(q_Zarray);
     Py_DECREF(m_Warray);
     Py_DECREF(v_Warray);
@@ -5323,13 +5411,14 @@ static PyObject *UtilsC_expectation_Ptilde_Z_MF_Begin(PyObject *self, PyObject *
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
     grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2); 
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1);
+    npy_float64 EPtilde5 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 *tmp;
     tmp = malloc(sizeof(npy_float64)*K);
     
     npy_float64 Beta_m;
     
-    npy_float64 EPtilde5 = 0.0;
     npy_float64 tmp2, part_1, part_2;
     
     for(m=0;m<nCond;m++){
@@ -5354,6 +5443,7 @@ static PyObject *UtilsC_expectation_Ptilde_Z_MF_Begin(PyObject *self, PyObject *
     
     free(tmp);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(q_Zarray);
     Py_DECREF(grapharray);
     Py_DECREF(Betaarray);
@@ -5374,10 +5464,11 @@ static PyObject *UtilsC_expectation_Ptilde_Z(PyObject *self, PyObject *args)
     q_Zarray = (PyArrayObject *) PyArray_ContiguousFromObject(q_Z,PyArray_FLOAT64,3,3); 
     grapharray = (PyArrayObject *) PyArray_ContiguousFromObject(graph,PyArray_INT,2,2); 
     Betaarray = (PyArrayObject *) PyArray_ContiguousFromObject(Beta,PyArray_FLOAT64,1,1);
+    npy_float64 EPtilde5 = 0.0;
+    Py_BEGIN_ALLOW_THREADS
     
     npy_float64 Beta_m, part_1, part_2, part_3, part_4;
     
-    npy_float64 EPtilde5 = 0.0;
     
     npy_float64 *Pmf, *SUM_Q_Z_neighbours, *tmp, *tmp2;
     Pmf = malloc(sizeof(npy_float64)*K*J);
@@ -5437,6 +5528,7 @@ static PyObject *UtilsC_expectation_Ptilde_Z(PyObject *self, PyObject *args)
     free(Pmf);
     free(SUM_Q_Z_neighbours);
     
+    Py_END_ALLOW_THREADS
     Py_DECREF(q_Zarray);
     Py_DECREF(grapharray);
     Py_DECREF(Betaarray);